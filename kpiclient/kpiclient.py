@@ -30,27 +30,101 @@ Register a new username with KPI
 Usage: ```kpicmd.py useradd [username]```  
 Example: ```kpicmd.py useradd samnsparky```
 
+Import many users (administrators only)
+---------------------------------------
+Usage: ```kpicmd.py userimport [path to users csv or json]```  
+Example: ```kpicmd.py userimport ./lab_users.csv```
+
 Update user password for KPI  
 ----------------------------
 Usage: ```kpicmd.py passwd [username]```  
 Example: ```kpicmd.py passwd samnsparky```
 
+Download a package
+------------------
+Usage: ```kpicmd.py download [name of module] [path to save zip] [path to previous zip (optional)]```  
+Example: ```kpicmd.py download simple_ain ./simple_ain_002.zip ./simple_ain_001.zip```
+
+Add ```--proxy``` to download through the package index when the uploads
+bucket can't be reached directly. Interrupted downloads are resumed when the
+command is run again.
+
+Look up packages in the catalog
+-------------------------------
+Usage: ```kpicmd.py catalog [name or start of name of module]```  
+Example: ```kpicmd.py catalog simple_```
+
+The whole index is downloaded once as a single compressed file and kept in
+~/.kpi. It is downloaded again only when the index changes.
+
+Run commands through a background daemon
+----------------------------------------
+Usage: ```kpicmd.py daemon [stop (optional)]```  
+Example: ```kpicmd.py daemon &```
+
+While the daemon is running, create, read, update, delete, userimport,
+download, and catalog are sent to it over a Unix socket and run with its
+warm interpreter, connection pool, and metadata cache. Credentials entered
+when the daemon starts are used instead of prompting for each command.
+
 
 @author: Sam Pottinger (samnsparky)
 @license: GNU GPL v3
 """
 
 import getpass
+import hashlib
+import importlib
 import json
+import mmap
+import os
+import posixpath
+import struct
 import sys
-
-import requests
+import tempfile
+import zipfile
+import zlib
 
 BASE_URL = 'https://kiplingwebservices.herokuapp.com/kpi/'
 USERS_URL = BASE_URL + 'users.json'
+USERS_IMPORT_URL = BASE_URL + 'users/import.json'
 USER_URL = BASE_URL + 'user/%s.json'
 PACKAGES_URL = BASE_URL + 'packages.json'
 PACKAGE_URL = BASE_URL + 'package/%s.json'
+PACKAGE_UPLOADED_URL = BASE_URL + 'package/%s/uploaded.json'
+PACKAGE_DELTAS_URL = BASE_URL + 'package/%s/deltas.json'
+PACKAGE_ARCHIVE_URL = BASE_URL + 'package/%s/archive.zip'
+INDEX_URL = BASE_URL + 'index.json'
+INDEX_FILE_URL = BASE_URL + 'index/%s'
+
+INDEX_MAGIC = 'KPIX'
+INDEX_FORMAT_VERSION = 1
+INDEX_HEADER_FORMAT = '<4sHHIIII'
+INDEX_ENTRY_FORMAT = '<IIIH'
+INDEX_EXTRA_FIELDS = ['humanName', 'description', 'homepage', 'repository']
+DEFAULT_INDEX_PATH = os.path.join(os.path.expanduser('~'), '.kpi', 'index')
+MANIFEST_SUFFIX = '.json'
+
+MODULE_JSON_NAME = 'module.json'
+CHUNK_SIZE = 64 * 1024
+PARTIAL_SUFFIX = '.part'
+MAX_DOWNLOAD_ATTEMPTS = 5
+PROXY_FLAG = '--proxy'
+
+DEFAULT_DAEMON_SOCKET_PATH = os.path.join(
+    os.path.expanduser('~'),
+    '.kpi',
+    'daemon.sock'
+)
+DAEMON_SOCKET_PATH = os.environ.get(
+    'KPI_DAEMON_SOCKET',
+    DEFAULT_DAEMON_SOCKET_PATH
+)
+CREDENTIAL_COMMANDS = ['create', 'update', 'delete', 'userimport']
+FORWARDED_COMMANDS = CREDENTIAL_COMMANDS + ['read', 'download', 'catalog']
+
+SESSION = None
+DAEMON_USER_INFO = None
 
 COMMAND_NOT_RECOGNIZED_ERR = '[Error] Command not recognized.'
 PASSWORD_MISMATCH_ERR = 'New password and confirm password don\'t match.'
@@ -62,6 +136,12 @@ HUMAN_NAME_FIELD_MISSING_ERR = 'humanName field is required but missing in '\
 VERSION_FIELD_MISSING_ERR = 'version field is required but missing in '\
                                'module.json'
 MODULE_JSON_MISSING_ERR = 'Could not load module.json.'
+DOWNLOAD_FAILED_ERR = 'Could not download %s.'
+HASH_MISMATCH_ERR = 'Hash of %s does not match the package index.'
+DELTA_FILE_MISSING_ERR = '%s is in neither the previous archive nor the delta.'
+INDEX_FORMAT_ERR = '%s is not a supported package index.'
+NOT_IN_CATALOG_ERR = 'No packages in the catalog start with %s.'
+INVALID_RESPONSE_ERR = 'The package index sent a response that is not JSON.'
 DEFAULT_LICENSE = 'GNU GPL v3'
 parsed_response = 'Zip file not found or invalid.'
 
@@ -75,7 +155,12 @@ HELP_TEXT = {
               '[path to zip archive]',
     'delete': 'USAGE: kpicmd.py delete [name of module]',
     'useradd': 'kpicmd.py useradd [username]',
-    'passwd': 'kpicmd.py passwd [username]'
+    'userimport': 'USAGE: kpicmd.py userimport [path to users csv or json]',
+    'passwd': 'kpicmd.py passwd [username]',
+    'download': 'USAGE: kpicmd.py download [name of module] [path to save zip] '\
+                '[path to previous zip (optional)] [--proxy (optional)]',
+    'catalog': 'USAGE: kpicmd.py catalog [name or start of name of module]',
+    'daemon': 'USAGE: kpicmd.py daemon [stop (optional)]'
 }
 
 REQUIRED_PARAMS = {
@@ -84,10 +169,131 @@ REQUIRED_PARAMS = {
     'update': 3,
     'delete': 1,
     'useradd': 1,
-    'passwd': 1
+    'userimport': 1,
+    'passwd': 1,
+    'download': 2,
+    'catalog': 1,
+    'daemon': 0
 }
 
 
+def send_daemon_request(request, socket_path=None):
+    """Send a request to the kpicmd.py daemon if one is running.
+
+    @param request: The JSON serializable request.
+    @type request: dict
+    @keyword socket_path: The path of the daemon's Unix socket. Defaults to
+        DAEMON_SOCKET_PATH.
+    @type socket_path: str
+    @return: The daemon's response or None if no daemon is listening.
+    @rtype: dict
+    """
+    socket_path = socket_path or DAEMON_SOCKET_PATH
+    if not os.path.exists(socket_path):
+        return None
+
+    import socket
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+        connection.sendall(json.dumps(request) + '\n')
+        response = connection.makefile('rb').readline()
+    except socket.error:
+        return None
+    finally:
+        connection.close()
+
+    if not response:
+        return None
+    return json.loads(response)
+
+
+def forward_command(argv, socket_path=None):
+    """Run a command in the kpicmd.py daemon if one is running and can.
+
+    @param argv: The command line arguments including the script name.
+    @type argv: list of str
+    @keyword socket_path: The path of the daemon's Unix socket. Defaults to
+        DAEMON_SOCKET_PATH.
+    @type socket_path: str
+    @return: The result of the command or None if it must be run locally.
+    @rtype: dict
+    """
+    response = send_daemon_request(
+        {'argv': argv, 'cwd': os.getcwd()},
+        socket_path
+    )
+    if not response or not response['forwarded']:
+        return None
+    sys.stdout.write(response['output'])
+    return response['result']
+
+
+class CommandRegistry:
+    """Commands understood by the tool, each loaded only when it is run.
+
+    Handlers are registered by name so that listing or checking commands does
+    not load a handler or the modules it depends on.
+    """
+
+    def __init__(self):
+        """Create a new registry without any commands."""
+        self.handler_paths = {}
+
+    def register(self, name, handler_path):
+        """Add a command to the registry.
+
+        @param name: The name of the command as typed after kpicmd.py.
+        @type name: str
+        @param handler_path: The name of the handler function in this module
+            or module:function for a handler in another module. The handler
+            takes no arguments.
+        @type handler_path: str
+        """
+        self.handler_paths[name] = handler_path
+
+    def __contains__(self, name):
+        return name in self.handler_paths
+
+    def get_names(self):
+        """Get the names of all registered commands.
+
+        @return: The command names in sorted order.
+        @rtype: list of str
+        """
+        return sorted(self.handler_paths.keys())
+
+    def load(self, name):
+        """Load the handler for a command, importing its module if needed.
+
+        @param name: The name of the command.
+        @type name: str
+        @return: The command's handler function.
+        @rtype: function
+        """
+        handler_path = self.handler_paths[name]
+        if ':' in handler_path:
+            module_name, function_name = handler_path.split(':', 1)
+            module = importlib.import_module(module_name)
+        else:
+            module = sys.modules[__name__]
+            function_name = handler_path
+        return getattr(module, function_name)
+
+
+COMMANDS = CommandRegistry()
+COMMANDS.register('create', 'main_create')
+COMMANDS.register('read', 'main_read')
+COMMANDS.register('update', 'main_update')
+COMMANDS.register('delete', 'main_delete')
+COMMANDS.register('useradd', 'main_useradd')
+COMMANDS.register('userimport', 'main_userimport')
+COMMANDS.register('passwd', 'main_passwd')
+COMMANDS.register('download', 'main_download')
+COMMANDS.register('catalog', 'main_catalog')
+COMMANDS.register('daemon', 'kpidaemon:main_daemon')
+
+
 class FakeResponse:
     """Wrapper that pretends to the be a response from requests HTTP lib.
 
@@ -127,6 +333,21 @@ class UserInfo:
         self.password = password
 
 
+def prompt_user_info():
+    """Get the username and password of the user running a command.
+
+    @return: The credentials held by the kpicmd.py daemon when running inside
+        it and otherwise credentials typed at the terminal.
+    @rtype: UserInfo
+    """
+    if DAEMON_USER_INFO:
+        return DAEMON_USER_INFO
+
+    username = raw_input('Username: ')
+    password = getpass.getpass()
+    return UserInfo(username, password)
+
+
 def generate_error(error):
     """Generate a fake response from the server reporting an error.
 
@@ -170,7 +391,26 @@ def upload_zip_file(local_path, remote_url, upload_spec):
     @rtype: requests.models.Response
     """
     files = {'file': open(local_path, 'rb')}
-    return requests.post(remote_url, files=files, data=upload_spec)
+    return get_http().post(remote_url, files=files, data=upload_spec)
+
+
+def notify_upload_complete(user_info, package_name):
+    """Tell the package index that a package's zip archive finished uploading.
+
+    The server validates the archive and extracts its metadata in the
+    background.
+
+    @param user_info: Authentication information about the user who uploaded
+        the archive.
+    @type user_info: UserInfo
+    @param package_name: The name of the package whose archive was uploaded.
+    @type package_name: str
+    @return: The response from the package index.
+    @rtype: requests.models.Response
+    """
+    payload = {}
+    add_user_info(user_info, payload)
+    return get_http().post(PACKAGE_UPLOADED_URL % package_name, data=payload)
 
 
 def add_user_info(user_info, info_dict):
@@ -185,6 +425,19 @@ def add_user_info(user_info, info_dict):
     info_dict['password'] = user_info.password
 
 
+def get_http():
+    """Get the object to make HTTP requests with.
+
+    @return: The pooled session of the kpicmd.py daemon when running inside
+        it and otherwise the requests module.
+    @rtype: requests.Session
+    """
+    if SESSION:
+        return SESSION
+    import requests
+    return requests
+
+
 def parse_response(response):
     """Parse the JSON payload from a requests.models.Response.
 
@@ -194,12 +447,32 @@ def parse_response(response):
     return response.json()
 
 
+def get_result(result):
+    """Get the JSON values of what a command's handler returned.
+
+    Handlers return a response from the package index, a FakeResponse, a
+    dictionary, or a false value after printing help.
+
+    @param result: The value returned by the handler.
+    @return: Dictionary with success and message fields or the false value.
+    @rtype: dict
+    """
+    if not hasattr(result, 'json'):
+        return result
+    try:
+        return result.json()
+    except ValueError:
+        return generate_error(INVALID_RESPONSE_ERR).json()
+
+
 def internal_print_table(values):
     """Print a pretty display with information about a package in the index.
 
     @param values: The information about the package.
     @type values: dict
     """
+    import prettytable
+
     description = values['description']
     print description
     print ''
@@ -260,9 +533,12 @@ def deploy(user_info, package_name, module_json_path, zip_path, new_entry):
     add_user_info(user_info, json_info)
 
     if new_entry:
-        response = requests.post(PACKAGES_URL, data=json_info)
+        response = get_http().post(PACKAGES_URL, data=json_info)
     else:
-        response = requests.put(PACKAGE_URL % json_info['name'], data=json_info)
+        response = get_http().put(
+            PACKAGE_URL % json_info['name'],
+            data=json_info
+        )
 
     parsed_response = parse_response(response)
     if not parsed_response['success']:
@@ -274,6 +550,7 @@ def deploy(user_info, package_name, module_json_path, zip_path, new_entry):
     if not zip_file_response:
         return generate_error(ZIP_FILE_NOT_FOUND)
 
+    notify_upload_complete(user_info, json_info['name'])
     return response
 
 
@@ -302,14 +579,14 @@ def read(package_name):
     @return: The response from HTTP request to the package index.
     @rtype: requests.models.Response
     """
-    response = requests.get(PACKAGE_URL % package_name)
+    response = get_http().get(PACKAGE_URL % package_name)
     parsed_response = parse_response(response)
 
     if not parsed_response['success']:
         return parsed_response
 
     internal_print_table(parsed_response['record'])
-    return parse_response
+    return parsed_response
 
 
 def update(user_info, package_name, module_json_path, zip_path):
@@ -340,7 +617,7 @@ def delete(user_info, package_name):
     """
     payload = {'name': package_name}
     add_user_info(user_info, payload)
-    return requests.delete(PACKAGE_URL % package_name, data=payload)
+    return get_http().delete(PACKAGE_URL % package_name, data=payload)
 
 
 def useradd(username, email):
@@ -352,7 +629,30 @@ def useradd(username, email):
     @rtype: requests.models.Response
     """
     payload = {'username': username, 'email': email}
-    return requests.post(USERS_URL, data=payload)
+    return get_http().post(USERS_URL, data=payload)
+
+
+def userimport(user_info, users_path):
+    """Create many users at once. The user must be an index administrator.
+
+    @param user_info: Authentication information about the administrator who
+        is making this request.
+    @type user_info: UserInfo
+    @param users_path: Path to a CSV file with a username and email on each row
+        or a JSON file with a list of objects with username and email fields.
+    @type users_path: str
+    @return: Response from the server for the original HTTP request.
+    @rtype: requests.models.Response
+    """
+    if users_path.lower().endswith('.json'):
+        users_format = 'json'
+    else:
+        users_format = 'csv'
+
+    with open(users_path) as f:
+        payload = {'format': users_format, 'users': f.read()}
+    add_user_info(user_info, payload)
+    return get_http().post(USERS_IMPORT_URL, data=payload)
 
 
 def passwd(username, old_password, new_password, confirm_password):
@@ -381,7 +681,614 @@ def passwd(username, old_password, new_password, confirm_password):
         'old_password': old_password,
         'new_password': new_password
     }
-    return requests.post(USER_URL % username, data=payload)
+    return get_http().post(USER_URL % username, data=payload)
+
+
+def hash_file(path):
+    """Calculate the SHA-256 digest of a file without loading it into memory.
+
+    @param path: The path of the file to hash.
+    @type path: str
+    @return: The hex SHA-256 digest of the file.
+    @rtype: str
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        chunk = f.read(CHUNK_SIZE)
+        while chunk:
+            digest.update(chunk)
+            chunk = f.read(CHUNK_SIZE)
+    return digest.hexdigest()
+
+
+def continue_download(url, partial_path, etag=None):
+    """Download the rest of a file, appending to what was already received.
+
+    @param url: The URL to download from.
+    @type url: str
+    @param partial_path: The local path holding the bytes received so far.
+    @type partial_path: str
+    @keyword etag: The entity tag of the file being downloaded. If provided,
+        the server sends the whole file again if it has changed since the
+        partial download started. Defaults to None.
+    @type etag: str
+    @raise IOError: Raised if the server refused the download.
+    @raise requests.exceptions.RequestException: Raised if the connection
+        failed or was interrupted.
+    """
+    offset = 0
+    if os.path.exists(partial_path):
+        offset = os.path.getsize(partial_path)
+
+    headers = {}
+    if offset:
+        headers['Range'] = 'bytes=%d-' % offset
+        if etag:
+            headers['If-Range'] = '"%s"' % etag
+
+    response = get_http().get(url, headers=headers, stream=True)
+    if response.status_code == 416 and offset:
+        # Already have everything; the hash check decides if it is usable.
+        return
+    if response.status_code == 206 and offset:
+        mode = 'ab'
+    elif response.status_code == 200:
+        mode = 'wb'
+    else:
+        raise IOError(DOWNLOAD_FAILED_ERR % url)
+
+    with open(partial_path, mode) as f:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            f.write(chunk)
+
+
+def download_file(url, path, expected_sha256, etag=None):
+    """Download a file, verifying its contents against a known hash.
+
+    Bytes are received into path.part. If the connection drops the download
+    is continued from where it stopped with a Range request, including across
+    runs of the command line tool. A resumed download whose contents do not
+    match is discarded and downloaded again from the start.
+
+    @param url: The URL to download from.
+    @type url: str
+    @param path: The local path to save the file to.
+    @type path: str
+    @param expected_sha256: The hex SHA-256 digest the file must have.
+    @type expected_sha256: str
+    @keyword etag: The entity tag the server uses for the file or None if not
+        known. Defaults to None.
+    @type etag: str
+    @raise IOError: Raised if the file could not be downloaded.
+    @raise ValueError: Raised if the downloaded file has a different hash.
+    """
+    import requests
+
+    partial_path = path + PARTIAL_SUFFIX
+    resumed = os.path.exists(partial_path)
+
+    for attempt in range(MAX_DOWNLOAD_ATTEMPTS):
+        try:
+            continue_download(url, partial_path, etag)
+            break
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout):
+            if attempt == MAX_DOWNLOAD_ATTEMPTS - 1:
+                raise IOError(DOWNLOAD_FAILED_ERR % url)
+
+    if hash_file(partial_path) != expected_sha256:
+        os.remove(partial_path)
+        if resumed:
+            return download_file(url, path, expected_sha256, etag)
+        raise ValueError(HASH_MISMATCH_ERR % url)
+
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(partial_path, path)
+
+
+def get_archive_version(zip_path):
+    """Read the version of a package from the module.json in its archive.
+
+    @param zip_path: Path to the package's zip archive.
+    @type zip_path: str
+    @return: The version of the package or None if the archive or its
+        module.json could not be read.
+    @rtype: str
+    """
+    try:
+        zip_file = zipfile.ZipFile(zip_path)
+    except (IOError, zipfile.BadZipfile):
+        return None
+
+    try:
+        names = [
+            name for name in zip_file.namelist()
+            if posixpath.basename(name) == MODULE_JSON_NAME and
+                name.count('/') <= 1
+        ]
+        if not names:
+            return None
+        name = min(names, key=lambda name: name.count('/'))
+        return json.loads(zip_file.read(name)).get('version', None)
+    except (ValueError, AttributeError):
+        return None
+    finally:
+        zip_file.close()
+
+
+def apply_delta(base_path, delta_path, manifest, output_path):
+    """Build a package archive from a previous version and a delta.
+
+    Files in the delta replace those in the previous archive and files not in
+    the new manifest are dropped. Every file is checked against the manifest.
+
+    @param base_path: Path to the archive of the previous version.
+    @type base_path: str
+    @param delta_path: Path to the delta archive.
+    @type delta_path: str
+    @param manifest: The files of the new version each with path and sha256.
+    @type manifest: list of dict
+    @param output_path: Path to write the new version's archive to.
+    @type output_path: str
+    @raise ValueError: Raised if a file is missing or has the wrong hash.
+    """
+    base_zip = zipfile.ZipFile(base_path)
+    delta_zip = zipfile.ZipFile(delta_path)
+    delta_names = set(delta_zip.namelist())
+    base_names = set(base_zip.namelist())
+    output_zip = zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED)
+
+    try:
+        for entry in manifest:
+            path = entry['path']
+            if path in delta_names:
+                contents = delta_zip.read(path)
+            elif path in base_names:
+                contents = base_zip.read(path)
+            else:
+                raise ValueError(DELTA_FILE_MISSING_ERR % path)
+
+            if hashlib.sha256(contents).hexdigest() != entry['sha256']:
+                raise ValueError(HASH_MISMATCH_ERR % path)
+            output_zip.writestr(path, contents)
+    finally:
+        output_zip.close()
+        delta_zip.close()
+        base_zip.close()
+
+
+def choose_delta(downloads, base_version):
+    """Choose the delta to download instead of the full archive if any.
+
+    @param downloads: The downloads listed by the package index.
+    @type downloads: dict
+    @param base_version: The version of the package already downloaded or None
+        if no previous version is available.
+    @type base_version: str
+    @return: The delta from base_version if one exists and is smaller than the
+        full archive or None otherwise.
+    @rtype: dict
+    """
+    if not base_version:
+        return None
+
+    for delta in downloads['deltas']:
+        is_smaller = delta['size'] < downloads['archive']['size']
+        if delta['from_version'] == base_version and is_smaller:
+            return delta
+    return None
+
+
+def update_from_delta(delta, manifest, base_path, output_path):
+    """Try to build the new version of a package from a delta.
+
+    @param delta: The delta to download.
+    @type delta: dict
+    @param manifest: The files of the new version each with path and sha256.
+    @type manifest: list of dict
+    @param base_path: Path to the archive of the previous version.
+    @type base_path: str
+    @param output_path: Path to write the new version's archive to.
+    @type output_path: str
+    @return: True if the new version was built and False otherwise.
+    @rtype: bool
+    """
+    delta_handle, delta_path = tempfile.mkstemp(suffix='.zip')
+    os.close(delta_handle)
+    try:
+        download_file(delta['url'], delta_path, delta['sha256'])
+        apply_delta(base_path, delta_path, manifest, output_path)
+        return True
+    except (IOError, ValueError, zipfile.BadZipfile):
+        return False
+    finally:
+        os.remove(delta_path)
+
+
+def download(package_name, output_path, base_path=None, proxy=False):
+    """Download the current version of a package.
+
+    If the archive of a previous version is provided and the package index has
+    a smaller delta from that version, only the changed files are downloaded.
+    Falls back to the full archive if the delta is larger or fails to apply.
+
+    @param package_name: The name of the package to download.
+    @type package_name: str
+    @param output_path: Path to save the package's zip archive to.
+    @type output_path: str
+    @keyword base_path: Path to the archive of a previously downloaded version
+        or None if not available. Defaults to None.
+    @type base_path: str
+    @keyword proxy: Flag indicating if the full archive should be downloaded
+        through the package index instead of directly from the uploads bucket.
+        Deltas are only available directly so are not used. Defaults to False.
+    @type proxy: bool
+    @return: Dictionary describing the result of the download.
+    @rtype: dict
+    """
+    response = get_http().get(PACKAGE_DELTAS_URL % package_name)
+    downloads = parse_response(response)
+    if not downloads['success']:
+        return downloads
+
+    base_version = get_archive_version(base_path) if base_path else None
+    delta = None if proxy else choose_delta(downloads, base_version)
+    if delta:
+        updated = update_from_delta(
+            delta,
+            downloads['manifest'],
+            base_path,
+            output_path
+        )
+        if updated:
+            return {
+                'success': True,
+                'message': 'Updated %s to %s with a %d byte delta.' % (
+                    package_name,
+                    downloads['version'],
+                    delta['size']
+                )
+            }
+
+    archive = downloads['archive']
+    try:
+        if proxy:
+            download_file(
+                PACKAGE_ARCHIVE_URL % package_name,
+                output_path,
+                archive['sha256'],
+                etag=archive['sha256']
+            )
+        else:
+            download_file(archive['url'], output_path, archive['sha256'])
+    except (IOError, ValueError), e:
+        return generate_error(str(e)).json()
+
+    return {
+        'success': True,
+        'message': 'Downloaded %s %s (%d bytes).' % (
+            package_name,
+            downloads['version'],
+            archive['size']
+        )
+    }
+
+
+class PackageIndex:
+    """Read only view of a downloaded snapshot of the whole package index.
+
+    The index file is memory mapped and packages are found by binary search
+    over its sorted name table so that lookups only decode the entries they
+    visit.
+    """
+
+    def __init__(self, path):
+        """Open a downloaded index.
+
+        @param path: The path of the uncompressed index file.
+        @type path: str
+        @raise ValueError: Raised if the file is not a supported index.
+        """
+        self.index_file = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(
+                self.index_file.fileno(),
+                0,
+                access=mmap.ACCESS_READ
+            )
+            header = struct.unpack_from(INDEX_HEADER_FORMAT, self.data)
+        except (ValueError, struct.error, mmap.error):
+            self.index_file.close()
+            raise ValueError(INDEX_FORMAT_ERR % path)
+
+        magic, format_version, flags, self.num_packages, self.num_strings, \
+            self.string_table_offset, self.name_table_offset = header
+        if magic != INDEX_MAGIC or format_version != INDEX_FORMAT_VERSION:
+            self.close()
+            raise ValueError(INDEX_FORMAT_ERR % path)
+
+    def close(self):
+        """Unmap and close the index file."""
+        self.data.close()
+        self.index_file.close()
+
+    def __len__(self):
+        return self.num_packages
+
+    def get_string(self, string_id):
+        """Read a version, license, or author from the string table.
+
+        @param string_id: The index of the string in the table.
+        @type string_id: int
+        @return: The string.
+        @rtype: unicode
+        """
+        start, end = struct.unpack_from(
+            '<II',
+            self.data,
+            self.string_table_offset + 4 * string_id
+        )
+        return self.data[start:end].decode('utf-8')
+
+    def get_entry_offset(self, position):
+        """Get where the entry of a package is in the index.
+
+        @param position: The position of the package in name order.
+        @type position: int
+        @return: The offset of the package's entry.
+        @rtype: int
+        """
+        return struct.unpack_from(
+            '<I',
+            self.data,
+            self.name_table_offset + 4 * position
+        )[0]
+
+    def get_name(self, position):
+        """Get the UTF-8 encoded name of a package.
+
+        @param position: The position of the package in name order.
+        @type position: int
+        @return: The package name.
+        @rtype: str
+        """
+        offset = self.get_entry_offset(position)
+        length = struct.unpack_from('<H', self.data, offset)[0]
+        return self.data[offset + 2:offset + 2 + length]
+
+    def find_position(self, name):
+        """Find the first package whose name is not less than a name.
+
+        @param name: The name to search for.
+        @type name: basestring
+        @return: The position of the package in name order. Equal to the
+            number of packages if every name is less.
+        @rtype: int
+        """
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        low = 0
+        high = self.num_packages
+        while low < high:
+            middle = (low + high) / 2
+            if self.get_name(middle) < name:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def get_package_at(self, position):
+        """Decode the entry of a package.
+
+        @param position: The position of the package in name order.
+        @type position: int
+        @return: The package's record.
+        @rtype: dict
+        """
+        offset = self.get_entry_offset(position)
+        name_length = struct.unpack_from('<H', self.data, offset)[0]
+        offset += 2
+        name = self.data[offset:offset + name_length].decode('utf-8')
+        offset += name_length
+
+        version, license, revision, num_authors = struct.unpack_from(
+            INDEX_ENTRY_FORMAT,
+            self.data,
+            offset
+        )
+        offset += struct.calcsize(INDEX_ENTRY_FORMAT)
+        authors = struct.unpack_from('<%dI' % num_authors, self.data, offset)
+        offset += 4 * num_authors
+        extra_length = struct.unpack_from('<I', self.data, offset)[0]
+        offset += 4
+
+        record = dict((field, '') for field in INDEX_EXTRA_FIELDS)
+        record.update(json.loads(self.data[offset:offset + extra_length]))
+        record.update({
+            'name': name,
+            'version': self.get_string(version),
+            'license': self.get_string(license),
+            'revision': revision,
+            'authors': [self.get_string(author) for author in authors]
+        })
+        return record
+
+    def get_package(self, name):
+        """Look up a package by name.
+
+        @param name: The name of the package.
+        @type name: basestring
+        @return: The package's record or None if it is not in the index.
+        @rtype: dict
+        """
+        position = self.find_position(name)
+        if position == self.num_packages:
+            return None
+        encoded_name = name.encode('utf-8') if isinstance(name, unicode) \
+            else name
+        if self.get_name(position) != encoded_name:
+            return None
+        return self.get_package_at(position)
+
+    def get_names(self, prefix=''):
+        """Get the names of the packages starting with a prefix.
+
+        @keyword prefix: The start of the names to list. Defaults to all
+            packages.
+        @type prefix: basestring
+        @return: The matching names in sorted order.
+        @rtype: list of unicode
+        """
+        if isinstance(prefix, unicode):
+            prefix = prefix.encode('utf-8')
+        names = []
+        position = self.find_position(prefix)
+        while position < self.num_packages:
+            name = self.get_name(position)
+            if not name.startswith(prefix):
+                break
+            names.append(name.decode('utf-8'))
+            position += 1
+        return names
+
+
+def read_index_manifest(index_path):
+    """Read the manifest of the index previously downloaded to a path.
+
+    @param index_path: The path of the downloaded index.
+    @type index_path: str
+    @return: The manifest or None if no index has been downloaded.
+    @rtype: dict
+    """
+    if not os.path.exists(index_path):
+        return None
+    try:
+        with open(index_path + MANIFEST_SUFFIX) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def decompress_file(source_path, output_path):
+    """Decompress a gzip file, replacing the output once it is complete.
+
+    @param source_path: The path of the gzip file.
+    @type source_path: str
+    @param output_path: The path to write the decompressed contents to.
+    @type output_path: str
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    partial_path = output_path + PARTIAL_SUFFIX
+    with open(source_path, 'rb') as source:
+        with open(partial_path, 'wb') as output:
+            chunk = source.read(CHUNK_SIZE)
+            while chunk:
+                output.write(decompressor.decompress(chunk))
+                chunk = source.read(CHUNK_SIZE)
+            output.write(decompressor.flush())
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    os.rename(partial_path, output_path)
+
+
+def update_index(index_path=DEFAULT_INDEX_PATH):
+    """Download the package index snapshot if it changed since last time.
+
+    @keyword index_path: Where to keep the uncompressed index. Its manifest is
+        kept next to it. Defaults to DEFAULT_INDEX_PATH.
+    @type index_path: str
+    @return: Dictionary describing the result of the update.
+    @rtype: dict
+    """
+    response = get_http().get(INDEX_URL)
+    manifest = parse_response(response)
+    if not manifest['success']:
+        return manifest
+
+    previous = read_index_manifest(index_path)
+    if previous and previous['version'] == manifest['version']:
+        return {
+            'success': True,
+            'message': 'Catalog is up to date (%d packages).' % (
+                manifest['packages']
+            )
+        }
+
+    index_dir = os.path.dirname(os.path.abspath(index_path))
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+
+    compressed_path = index_path + '.gz'
+    try:
+        download_file(
+            INDEX_FILE_URL % manifest['file'],
+            compressed_path,
+            manifest['sha256'],
+            etag=manifest['sha256']
+        )
+        decompress_file(compressed_path, index_path)
+    except (IOError, ValueError, zlib.error), e:
+        return generate_error(str(e)).json()
+    finally:
+        if os.path.exists(compressed_path):
+            os.remove(compressed_path)
+
+    with open(index_path + MANIFEST_SUFFIX, 'w') as f:
+        json.dump(manifest, f)
+
+    return {
+        'success': True,
+        'message': 'Downloaded catalog of %d packages (%d bytes).' % (
+            manifest['packages'],
+            manifest['size']
+        )
+    }
+
+
+def catalog(query, index_path=DEFAULT_INDEX_PATH):
+    """Look up packages in a local copy of the whole package index.
+
+    Refreshes the local copy first if the index has changed. Prints the
+    package if one is named exactly by the query and otherwise lists the
+    packages whose names start with the query.
+
+    @param query: The name or start of the name of the package.
+    @type query: str
+    @keyword index_path: Where the local copy of the index is kept. Defaults
+        to DEFAULT_INDEX_PATH.
+    @type index_path: str
+    @return: Dictionary describing the result of the lookup.
+    @rtype: dict
+    """
+    result = update_index(index_path)
+    if not result['success'] and not os.path.exists(index_path):
+        return result
+
+    try:
+        index = PackageIndex(index_path)
+    except (IOError, ValueError), e:
+        return generate_error(str(e)).json()
+
+    try:
+        package = index.get_package(query)
+        if package:
+            internal_print_table(package)
+            return {
+                'success': True,
+                'message': '%s %s' % (package['name'], package['version'])
+            }
+
+        names = index.get_names(query)
+    finally:
+        index.close()
+
+    if not names:
+        return generate_error(NOT_IN_CATALOG_ERR % query).json()
+    for name in names:
+        print name
+    return {'success': True, 'message': '%d packages found.' % len(names)}
 
 
 def get_params(num_params):
@@ -416,10 +1323,7 @@ def main_create():
     path_to_module = params[1]
     path_to_zip = params[2]
 
-    username = raw_input('Username: ')
-    password = getpass.getpass()
-
-    user_info = UserInfo(username, password)
+    user_info = prompt_user_info()
     return create(user_info, module_name, path_to_module, path_to_zip)
 
 
@@ -453,10 +1357,7 @@ def main_update():
     path_to_module = params[1]
     path_to_zip = params[2]
 
-    username = raw_input('Username: ')
-    password = getpass.getpass()
-
-    user_info = UserInfo(username, password)
+    user_info = prompt_user_info()
     return update(user_info, module_name, path_to_module, path_to_zip)
 
 
@@ -472,10 +1373,7 @@ def main_delete():
         return False
 
     module_name = params[0]
-    username = raw_input('Username: ')
-    password = getpass.getpass()
-
-    user_info = UserInfo(username, password)
+    user_info = prompt_user_info()
     return delete(user_info, module_name)
 
 
@@ -500,6 +1398,22 @@ def main_useradd():
     return useradd(username, email_address)
 
 
+def main_userimport():
+    """Main program driver for importing many users into the UAC service.
+
+    @return: Response from the server for the original HTTP request.
+    @rtype: requests.models.Response
+    """
+    params = get_params(REQUIRED_PARAMS['userimport'])
+    if not params:
+        print HELP_TEXT['userimport']
+        return False
+
+    users_path = params[0]
+    user_info = prompt_user_info()
+    return userimport(user_info, users_path)
+
+
 def main_passwd():
     """Main program driver for updating a user's password.
 
@@ -522,10 +1436,48 @@ def main_passwd():
     return passwd(username, current_password, new_password, confirm_new)
 
 
+def main_download():
+    """Main program driver for downloading a package.
+
+    @return: Information about the result of the download.
+    @rtype: dict
+    """
+    params = get_params(REQUIRED_PARAMS['download'])
+    if not params or len(params) < REQUIRED_PARAMS['download']:
+        print HELP_TEXT['download']
+        return False
+
+    proxy = PROXY_FLAG in params
+    params = [param for param in params if param != PROXY_FLAG]
+    if len(params) < REQUIRED_PARAMS['download']:
+        print HELP_TEXT['download']
+        return False
+
+    module_name = params[0]
+    output_path = params[1]
+    base_path = params[2] if len(params) > 2 else None
+    return download(module_name, output_path, base_path, proxy)
+
+
+def main_catalog():
+    """Main program driver for looking up packages in the local catalog.
+
+    @return: Dictionary describing the result of the lookup.
+    @rtype: dict
+    """
+    params = get_params(REQUIRED_PARAMS['catalog'])
+    if not params:
+        print HELP_TEXT['catalog']
+        return False
+
+    return catalog(params[0])
+
+
 def main():
     """Top level main program driver."""
     if len(sys.argv) < 2:
         print ROOT_HELP_TEXT
+        print 'Commands: ' + ', '.join(COMMANDS.get_names())
         return
 
     command = sys.argv[1]
@@ -533,23 +1485,20 @@ def main():
         print COMMAND_NOT_RECOGNIZED_ERR
         return
 
-    result = COMMANDS[command]()
-    if not result['success']:
+    result = None
+    if command in FORWARDED_COMMANDS or command == 'daemon':
+        result = forward_command(sys.argv)
+    if result is None:
+        result = get_result(COMMANDS.load(command)())
+
+    if not result:
+        return
+    elif not result['success']:
         print '[Error] ' + result['message']
         return
     else:
         print '[Success] ' + result['message']
 
 
-COMMANDS = {
-    'create': main_create,
-    'read': main_read,
-    'update': main_update,
-    'delete': main_delete,
-    'useradd': main_useradd,
-    'passwd': main_passwd
-}
-
-
 if __name__ == '__main__':
     main()
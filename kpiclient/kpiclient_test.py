@@ -4,13 +4,148 @@
 @license: GNU GPL v3
 """
 
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+import zipfile
 
 import mox
 import requests
 
 import kpiclient
 
+OLD_FILES = {
+    'simple_ain/module.json': json.dumps({'version': '1.0.0'}),
+    'simple_ain/main.js': 'unchanged',
+    'simple_ain/removed.js': 'removed'
+}
+NEW_FILES = {
+    'simple_ain/module.json': json.dumps({'version': '1.0.1'}),
+    'simple_ain/main.js': 'unchanged',
+    'simple_ain/added.js': 'added'
+}
+DELTA_FILES = {
+    'simple_ain/module.json': NEW_FILES['simple_ain/module.json'],
+    'simple_ain/added.js': NEW_FILES['simple_ain/added.js']
+}
+
+
+def write_archive(path, files):
+    zip_file = zipfile.ZipFile(path, 'w')
+    for name, contents in sorted(files.items()):
+        zip_file.writestr(name, contents)
+    zip_file.close()
+
+
+def create_manifest(files):
+    return [
+        {'path': name, 'sha256': hashlib.sha256(contents).hexdigest()}
+        for name, contents in sorted(files.items())
+    ]
+
+
+CLIENT_DIR = os.path.dirname(os.path.abspath(__file__))
+STARTUP_ROUNDS = 3
+
+
+def time_startup(args):
+    """Get the median time to run a new interpreter with some arguments."""
+    timings = []
+    for i in range(STARTUP_ROUNDS):
+        start = time.time()
+        output = subprocess.check_output(
+            [sys.executable] + args,
+            cwd=CLIENT_DIR
+        )
+        timings.append(time.time() - start)
+    return sorted(timings)[STARTUP_ROUNDS / 2], output
+
+
+INDEX_PACKAGES = [
+    ('simple_ain', '1.0.0', 'MIT', ['sam', 'rory']),
+    ('simple_aout', '1.2.0', 'MIT', ['sam']),
+    ('timer', '0.1.0', 'GNU GPL v3', ['rory'])
+]
+
+
+def build_index(packages):
+    """Write the server's binary index format for a few packages."""
+    strings = []
+
+    def add_string(value):
+        if not value in strings:
+            strings.append(value)
+        return strings.index(value)
+
+    entries = []
+    for name, version, license, authors in packages:
+        author_ids = [add_string(author) for author in authors]
+        extra = json.dumps({'description': name + ' description'})
+        entries.append(''.join([
+            struct.pack('<H', len(name)),
+            name,
+            struct.pack(
+                '<IIIH',
+                add_string(version),
+                add_string(license),
+                1,
+                len(author_ids)
+            ),
+            struct.pack('<%dI' % len(author_ids), *author_ids),
+            struct.pack('<I', len(extra)),
+            extra
+        ]))
+
+    string_table_offset = struct.calcsize(kpiclient.INDEX_HEADER_FORMAT)
+    offsets = [string_table_offset + 4 * (len(strings) + 1)]
+    for value in strings:
+        offsets.append(offsets[-1] + len(value))
+    string_table = struct.pack('<%dI' % len(offsets), *offsets) + \
+        ''.join(strings)
+
+    name_table_offset = string_table_offset + len(string_table)
+    entry_offsets = []
+    entry_offset = name_table_offset + 4 * len(entries)
+    for entry in entries:
+        entry_offsets.append(entry_offset)
+        entry_offset += len(entry)
+
+    header = struct.pack(
+        kpiclient.INDEX_HEADER_FORMAT,
+        'KPIX',
+        1,
+        0,
+        len(entries),
+        len(strings),
+        string_table_offset,
+        name_table_offset
+    )
+    name_table = struct.pack('<%dI' % len(entries), *entry_offsets)
+    return header + string_table + name_table + ''.join(entries)
+
+
+class FakeStreamResponse:
+    """Stand-in for a streamed requests response that may be interrupted."""
+
+    def __init__(self, status_code, chunks, interrupted=False):
+        self.status_code = status_code
+        self.chunks = chunks
+        self.interrupted = interrupted
+
+    def iter_content(self, chunk_size):
+        for chunk in self.chunks:
+            yield chunk
+        if self.interrupted:
+            raise requests.exceptions.ConnectionError('Connection reset.')
+
 
 class KPIClientTests(mox.MoxTestBase):
 
@@ -54,6 +189,7 @@ class KPIClientTests(mox.MoxTestBase):
         self.mox.StubOutWithMock(requests, 'post')
         self.mox.StubOutWithMock(requests, 'put')
         self.mox.StubOutWithMock(kpiclient, 'upload_zip_file')
+        self.mox.StubOutWithMock(kpiclient, 'notify_upload_complete')
 
         kpiclient.get_module_json('module_path').AndReturn(test_json_info)
         requests.post(
@@ -73,6 +209,7 @@ class KPIClientTests(mox.MoxTestBase):
             'remote_url',
             upload_spec
         ).AndReturn(kpiclient.FakeResponse(second_response))
+        kpiclient.notify_upload_complete(user_info, 'analog_inputs')
 
         self.mox.ReplayAll()
 
@@ -98,6 +235,7 @@ class KPIClientTests(mox.MoxTestBase):
         self.mox.StubOutWithMock(requests, 'post')
         self.mox.StubOutWithMock(requests, 'put')
         self.mox.StubOutWithMock(kpiclient, 'upload_zip_file')
+        self.mox.StubOutWithMock(kpiclient, 'notify_upload_complete')
 
         kpiclient.get_module_json('module_path').AndReturn(test_json_info)
 
@@ -133,6 +271,7 @@ class KPIClientTests(mox.MoxTestBase):
         self.mox.StubOutWithMock(requests, 'post')
         self.mox.StubOutWithMock(requests, 'put')
         self.mox.StubOutWithMock(kpiclient, 'upload_zip_file')
+        self.mox.StubOutWithMock(kpiclient, 'notify_upload_complete')
 
         kpiclient.get_module_json('module_path').AndReturn(test_json_info)
         requests.post(
@@ -152,6 +291,7 @@ class KPIClientTests(mox.MoxTestBase):
             'remote_url',
             upload_spec
         ).AndReturn(kpiclient.FakeResponse(second_response))
+        kpiclient.notify_upload_complete(user_info, 'analog_inputs')
 
         self.mox.ReplayAll()
 
@@ -185,6 +325,7 @@ class KPIClientTests(mox.MoxTestBase):
         self.mox.StubOutWithMock(requests, 'post')
         self.mox.StubOutWithMock(requests, 'put')
         self.mox.StubOutWithMock(kpiclient, 'upload_zip_file')
+        self.mox.StubOutWithMock(kpiclient, 'notify_upload_complete')
 
         kpiclient.get_module_json('module_path').AndReturn(test_json_info)
         requests.put(
@@ -204,6 +345,7 @@ class KPIClientTests(mox.MoxTestBase):
             'remote_url',
             upload_spec
         ).AndReturn(kpiclient.FakeResponse(second_response))
+        kpiclient.notify_upload_complete(user_info, 'analog_inputs')
 
         self.mox.ReplayAll()
 
@@ -215,6 +357,18 @@ class KPIClientTests(mox.MoxTestBase):
         )
         self.assertEqual(response.json(), first_response)
 
+    def test_notify_upload_complete(self):
+        user_info = kpiclient.UserInfo('user', 'pass')
+        self.mox.StubOutWithMock(requests, 'post')
+        requests.post(
+            kpiclient.PACKAGE_UPLOADED_URL % 'analog_inputs',
+            data={'username': 'user', 'password': 'pass'}
+        ).AndReturn(kpiclient.FakeResponse({'success': True}))
+        self.mox.ReplayAll()
+
+        response = kpiclient.notify_upload_complete(user_info, 'analog_inputs')
+        self.assertTrue(response.json()['success'])
+
     def test_read(self):
         package_name = 'test_module'
         test_response = kpiclient.FakeResponse({
@@ -231,7 +385,23 @@ class KPIClientTests(mox.MoxTestBase):
         kpiclient.internal_print_table('record')
         self.mox.ReplayAll()
 
-        kpiclient.read(package_name)
+        self.assertEqual(
+            kpiclient.read(package_name),
+            {'success': True, 'record': 'record'}
+        )
+
+    def test_get_result(self):
+        invalid = requests.models.Response()
+        invalid._content = 'not json'
+        values = {'success': True, 'message': 'done'}
+
+        self.assertEqual(
+            kpiclient.get_result(kpiclient.FakeResponse(values)),
+            values
+        )
+        self.assertEqual(kpiclient.get_result(values), values)
+        self.assertEqual(kpiclient.get_result(False), False)
+        self.assertFalse(kpiclient.get_result(invalid)['success'])
 
     def test_delete(self):
         package_name = 'test_module'
@@ -260,6 +430,29 @@ class KPIClientTests(mox.MoxTestBase):
 
         kpiclient.useradd('testuser', 'test@example.com')
 
+    def test_userimport(self):
+        directory = tempfile.mkdtemp()
+        users_path = os.path.join(directory, 'users.json')
+        with open(users_path, 'w') as f:
+            f.write('[]')
+
+        self.mox.StubOutWithMock(requests, 'post')
+        requests.post(kpiclient.USERS_IMPORT_URL, data={
+            'format': 'json',
+            'users': '[]',
+            'username': 'admin',
+            'password': 'password'
+        })
+        self.mox.ReplayAll()
+
+        try:
+            kpiclient.userimport(
+                kpiclient.UserInfo('admin', 'password'),
+                users_path
+            )
+        finally:
+            shutil.rmtree(directory)
+
     def test_passwd(self):
         self.mox.StubOutWithMock(requests, 'post')
         requests.post(kpiclient.USER_URL % 'testuser', data={
@@ -279,5 +472,410 @@ class KPIClientTests(mox.MoxTestBase):
         self.assertFalse(result['success'])
 
 
+
+class KPIClientDownloadTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.base_path = os.path.join(self.directory, 'old.zip')
+        self.delta_path = os.path.join(self.directory, 'delta.zip')
+        self.output_path = os.path.join(self.directory, 'new.zip')
+        write_archive(self.base_path, OLD_FILES)
+        write_archive(self.delta_path, DELTA_FILES)
+        self.downloads = {
+            'success': True,
+            'version': '1.0.1',
+            'archive': {'url': 'archive_url', 'size': 1000, 'sha256': 'full'},
+            'manifest': create_manifest(NEW_FILES),
+            'deltas': [{
+                'from_version': '1.0.0',
+                'url': 'delta_url',
+                'size': 100,
+                'sha256': 'delta'
+            }]
+        }
+
+    def tearDown(self):
+        mox.MoxTestBase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def copy_delta(self, url, path, expected_sha256):
+        shutil.copy(self.delta_path, path)
+
+    def test_get_archive_version(self):
+        self.assertEqual(
+            kpiclient.get_archive_version(self.base_path),
+            '1.0.0'
+        )
+        self.assertEqual(
+            kpiclient.get_archive_version(os.path.join(self.directory, 'x')),
+            None
+        )
+
+    def test_apply_delta(self):
+        kpiclient.apply_delta(
+            self.base_path,
+            self.delta_path,
+            self.downloads['manifest'],
+            self.output_path
+        )
+
+        output_zip = zipfile.ZipFile(self.output_path)
+        self.assertEqual(sorted(output_zip.namelist()), sorted(NEW_FILES))
+        for name, contents in NEW_FILES.items():
+            self.assertEqual(output_zip.read(name), contents)
+        output_zip.close()
+
+    def test_apply_delta_hash_mismatch(self):
+        manifest = self.downloads['manifest']
+        manifest[0]['sha256'] = 'bad'
+        self.assertRaises(
+            ValueError,
+            kpiclient.apply_delta,
+            self.base_path,
+            self.delta_path,
+            manifest,
+            self.output_path
+        )
+
+    def test_choose_delta(self):
+        self.assertEqual(
+            kpiclient.choose_delta(self.downloads, '1.0.0'),
+            self.downloads['deltas'][0]
+        )
+        self.assertEqual(kpiclient.choose_delta(self.downloads, '0.9.0'), None)
+        self.assertEqual(kpiclient.choose_delta(self.downloads, None), None)
+
+        self.downloads['deltas'][0]['size'] = 1000
+        self.assertEqual(kpiclient.choose_delta(self.downloads, '1.0.0'), None)
+
+    def test_download_with_delta(self):
+        self.mox.StubOutWithMock(requests, 'get')
+        self.mox.StubOutWithMock(kpiclient, 'download_file')
+        requests.get(kpiclient.PACKAGE_DELTAS_URL % 'simple_ain').AndReturn(
+            kpiclient.FakeResponse(self.downloads)
+        )
+        kpiclient.download_file(
+            'delta_url',
+            mox.IsA(str),
+            'delta'
+        ).WithSideEffects(self.copy_delta)
+        self.mox.ReplayAll()
+
+        result = kpiclient.download(
+            'simple_ain',
+            self.output_path,
+            self.base_path
+        )
+
+        self.assertTrue(result['success'])
+        self.assertTrue('delta' in result['message'])
+        self.assertEqual(
+            kpiclient.get_archive_version(self.output_path),
+            '1.0.1'
+        )
+
+    def test_download_delta_fails_falls_back(self):
+        self.mox.StubOutWithMock(requests, 'get')
+        self.mox.StubOutWithMock(kpiclient, 'download_file')
+        requests.get(kpiclient.PACKAGE_DELTAS_URL % 'simple_ain').AndReturn(
+            kpiclient.FakeResponse(self.downloads)
+        )
+        kpiclient.download_file(
+            'delta_url',
+            mox.IsA(str),
+            'delta'
+        ).AndRaise(ValueError('bad hash'))
+        kpiclient.download_file('archive_url', self.output_path, 'full')
+        self.mox.ReplayAll()
+
+        result = kpiclient.download(
+            'simple_ain',
+            self.output_path,
+            self.base_path
+        )
+
+        self.assertTrue(result['success'])
+        self.assertTrue('1000 bytes' in result['message'])
+
+    def test_download_full_hash_mismatch(self):
+        self.mox.StubOutWithMock(requests, 'get')
+        self.mox.StubOutWithMock(kpiclient, 'download_file')
+        requests.get(kpiclient.PACKAGE_DELTAS_URL % 'simple_ain').AndReturn(
+            kpiclient.FakeResponse(self.downloads)
+        )
+        kpiclient.download_file(
+            'archive_url',
+            self.output_path,
+            'full'
+        ).AndRaise(ValueError('bad hash'))
+        self.mox.ReplayAll()
+
+        result = kpiclient.download('simple_ain', self.output_path)
+
+        self.assertFalse(result['success'])
+
+
+class KPIClientResumeTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'package.zip')
+        self.partial_path = self.path + kpiclient.PARTIAL_SUFFIX
+        self.sha256 = hashlib.sha256('abcdef').hexdigest()
+        self.mox.StubOutWithMock(requests, 'get')
+
+    def tearDown(self):
+        mox.MoxTestBase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def read_output(self):
+        self.assertFalse(os.path.exists(self.partial_path))
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_download_file_resumes_after_interruption(self):
+        requests.get('url', headers={}, stream=True).AndReturn(
+            FakeStreamResponse(200, ['abc'], interrupted=True)
+        )
+        requests.get('url', headers={
+            'Range': 'bytes=3-',
+            'If-Range': '"tag"'
+        }, stream=True).AndReturn(FakeStreamResponse(206, ['def']))
+        self.mox.ReplayAll()
+
+        kpiclient.download_file('url', self.path, self.sha256, etag='tag')
+
+        self.assertEqual(self.read_output(), 'abcdef')
+
+    def test_download_file_resume_changed(self):
+        with open(self.partial_path, 'wb') as f:
+            f.write('old')
+        requests.get('url', headers={
+            'Range': 'bytes=3-',
+            'If-Range': '"tag"'
+        }, stream=True).AndReturn(FakeStreamResponse(200, ['abc', 'def']))
+        self.mox.ReplayAll()
+
+        kpiclient.download_file('url', self.path, self.sha256, etag='tag')
+
+        self.assertEqual(self.read_output(), 'abcdef')
+
+    def test_download_file_stale_partial_restarts(self):
+        with open(self.partial_path, 'wb') as f:
+            f.write('xyz')
+        requests.get(
+            'url',
+            headers={'Range': 'bytes=3-'},
+            stream=True
+        ).AndReturn(FakeStreamResponse(206, ['def']))
+        requests.get('url', headers={}, stream=True).AndReturn(
+            FakeStreamResponse(200, ['abcdef'])
+        )
+        self.mox.ReplayAll()
+
+        kpiclient.download_file('url', self.path, self.sha256)
+
+        self.assertEqual(self.read_output(), 'abcdef')
+
+    def test_download_file_gives_up(self):
+        for attempt in range(kpiclient.MAX_DOWNLOAD_ATTEMPTS):
+            requests.get(
+                'url',
+                headers=mox.IsA(dict),
+                stream=True
+            ).AndRaise(requests.exceptions.ConnectionError())
+        self.mox.ReplayAll()
+
+        self.assertRaises(
+            IOError,
+            kpiclient.download_file,
+            'url',
+            self.path,
+            self.sha256
+        )
+
+    def test_download_proxy(self):
+        downloads = {
+            'success': True,
+            'version': '1.0.1',
+            'archive': {'url': 'archive_url', 'size': 6, 'sha256': 'full'},
+            'manifest': [],
+            'deltas': []
+        }
+        self.mox.StubOutWithMock(kpiclient, 'download_file')
+        requests.get(kpiclient.PACKAGE_DELTAS_URL % 'simple_ain').AndReturn(
+            kpiclient.FakeResponse(downloads)
+        )
+        kpiclient.download_file(
+            kpiclient.PACKAGE_ARCHIVE_URL % 'simple_ain',
+            self.path,
+            'full',
+            etag='full'
+        )
+        self.mox.ReplayAll()
+
+        result = kpiclient.download('simple_ain', self.path, proxy=True)
+
+        self.assertTrue(result['success'])
+
+
+class KPIClientCatalogTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.directory, 'cache', 'index')
+        self.contents = build_index(INDEX_PACKAGES)
+        self.manifest = {
+            'success': True,
+            'message': '',
+            'version': 'abc',
+            'file': 'index-abc.kpix.gz',
+            'packages': len(INDEX_PACKAGES),
+            'size': 10,
+            'sha256': 'def'
+        }
+
+    def tearDown(self):
+        mox.MoxTestBase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def write_index(self):
+        os.makedirs(os.path.dirname(self.index_path))
+        with open(self.index_path, 'wb') as f:
+            f.write(self.contents)
+
+    def write_compressed(self, url, path, sha256, etag=None):
+        compressed = gzip.GzipFile(path, 'wb')
+        compressed.write(self.contents)
+        compressed.close()
+
+    def test_package_index_lookup(self):
+        self.write_index()
+        index = kpiclient.PackageIndex(self.index_path)
+        try:
+            self.assertEqual(len(index), 3)
+            package = index.get_package('simple_aout')
+            self.assertEqual(package['version'], '1.2.0')
+            self.assertEqual(package['license'], 'MIT')
+            self.assertEqual(package['authors'], ['sam'])
+            self.assertEqual(package['description'], 'simple_aout description')
+            self.assertEqual(package['homepage'], '')
+            self.assertEqual(
+                index.get_package(u'timer')['authors'],
+                ['rory']
+            )
+
+            for name in ['a', 'simple', 'simple_b', 'zzz']:
+                self.assertEqual(index.get_package(name), None)
+
+            self.assertEqual(
+                index.get_names('simple_'),
+                ['simple_ain', 'simple_aout']
+            )
+            self.assertEqual(len(index.get_names()), 3)
+            self.assertEqual(index.get_names('zzz'), [])
+        finally:
+            index.close()
+
+    def test_package_index_invalid(self):
+        self.contents = 'not an index' * 4
+        self.write_index()
+        self.assertRaises(
+            ValueError,
+            kpiclient.PackageIndex,
+            self.index_path
+        )
+
+    def test_update_index(self):
+        self.mox.StubOutWithMock(requests, 'get')
+        self.mox.StubOutWithMock(kpiclient, 'download_file')
+        requests.get(kpiclient.INDEX_URL).AndReturn(
+            kpiclient.FakeResponse(self.manifest)
+        )
+        kpiclient.download_file(
+            kpiclient.INDEX_FILE_URL % 'index-abc.kpix.gz',
+            self.index_path + '.gz',
+            'def',
+            etag='def'
+        ).WithSideEffects(self.write_compressed)
+        requests.get(kpiclient.INDEX_URL).AndReturn(
+            kpiclient.FakeResponse(self.manifest)
+        )
+        self.mox.ReplayAll()
+
+        result = kpiclient.update_index(self.index_path)
+        self.assertTrue(result['success'])
+        with open(self.index_path, 'rb') as f:
+            self.assertEqual(f.read(), self.contents)
+        self.assertFalse(os.path.exists(self.index_path + '.gz'))
+        self.assertEqual(
+            kpiclient.read_index_manifest(self.index_path)['version'],
+            'abc'
+        )
+
+        result = kpiclient.update_index(self.index_path)
+        self.assertTrue('up to date' in result['message'])
+
+    def test_catalog(self):
+        self.write_index()
+        self.mox.StubOutWithMock(kpiclient, 'update_index')
+        self.mox.StubOutWithMock(kpiclient, 'internal_print_table')
+        kpiclient.update_index(self.index_path).AndReturn(
+            {'success': False, 'message': 'offline'}
+        )
+        kpiclient.internal_print_table(mox.IgnoreArg())
+        kpiclient.update_index(self.index_path).AndReturn(
+            {'success': True, 'message': ''}
+        )
+        kpiclient.update_index(self.index_path).AndReturn(
+            {'success': True, 'message': ''}
+        )
+        self.mox.ReplayAll()
+
+        result = kpiclient.catalog('timer', self.index_path)
+        self.assertEqual(result['message'], 'timer 0.1.0')
+
+        result = kpiclient.catalog('simple', self.index_path)
+        self.assertEqual(result['message'], '2 packages found.')
+
+        result = kpiclient.catalog('missing', self.index_path)
+        self.assertFalse(result['success'])
+
+
+
+class KPIClientStartupTests(unittest.TestCase):
+
+    def test_registry_loads_handlers(self):
+        registry = kpiclient.CommandRegistry()
+        registry.register('read', 'main_read')
+        registry.register('dumps', 'json:dumps')
+
+        self.assertTrue('read' in registry)
+        self.assertFalse('missing' in registry)
+        self.assertEqual(registry.get_names(), ['dumps', 'read'])
+        self.assertEqual(registry.load('read'), kpiclient.main_read)
+        self.assertEqual(registry.load('dumps'), json.dumps)
+
+        for name in kpiclient.COMMANDS.get_names():
+            self.assertTrue(callable(kpiclient.COMMANDS.load(name)))
+
+    def test_startup_skips_heavy_imports(self):
+        startup_time, output = time_startup([
+            '-c',
+            'import sys, kpiclient; sys.argv = ["kpicmd.py"]; '
+            'kpiclient.main(); '
+            'print "requests" in sys.modules, "prettytable" in sys.modules'
+        ])
+        self.assertTrue(output.endswith('False False\n'))
+
+        import_time, output = time_startup(['-c', 'import requests'])
+        self.assertTrue(startup_time < import_time)
+
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,257 @@
+"""Long running agent that runs kpicmd.py commands for scripts.
+
+Scripts that run kpicmd.py many times pay for interpreter startup, new
+connections to the package index, and typing credentials on every command.
+The daemon started with ```kpicmd.py daemon``` listens on a Unix socket and
+runs forwarded commands itself with a pooled HTTP session, a short lived
+cache of package metadata, and the credentials entered when it started.
+kpicmd.py forwards commands to it whenever it is running.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import collections
+import getpass
+import json
+import os
+import SocketServer
+import StringIO
+import sys
+import threading
+import time
+
+import requests
+
+import kpiclient
+
+METADATA_CACHE_TTL = 30
+MAX_CACHED_RESPONSES = 256
+
+ALREADY_RUNNING_ERR = 'A daemon is already running.'
+NOT_RUNNING_ERR = 'No daemon is running.'
+UNSENDABLE_RESULT_ERR = 'The command ran but its result could not be sent: %s'
+
+
+class CachingSession(requests.Session):
+    """Session that briefly caches package metadata responses.
+
+    Plain GET requests with a successful response are reused for
+    METADATA_CACHE_TTL seconds. Streamed downloads and requests with headers
+    are never cached and any other method clears the cache so that a command
+    reads its own writes. Expired responses are dropped as the cache is used
+    and the oldest responses are dropped once it is full.
+    """
+
+    def __init__(self, ttl=METADATA_CACHE_TTL, timer=time.time,
+            max_entries=MAX_CACHED_RESPONSES):
+        """Create a new session with an empty cache.
+
+        @keyword ttl: The number of seconds responses are reused for.
+            Defaults to METADATA_CACHE_TTL.
+        @type ttl: float
+        @keyword timer: Function returning the current time in seconds.
+            Defaults to time.time.
+        @type timer: function
+        @keyword max_entries: The maximum number of responses to keep.
+            Defaults to MAX_CACHED_RESPONSES.
+        @type max_entries: int
+        """
+        requests.Session.__init__(self)
+        self.ttl = ttl
+        self.timer = timer
+        self.max_entries = max_entries
+        self.cache = collections.OrderedDict()
+
+    def drop_expired(self, now):
+        """Remove cached responses that may no longer be reused.
+
+        Entries are kept in the order they were cached and share one ttl so
+        the expired entries are always the oldest.
+
+        @param now: The current time in seconds.
+        @type now: float
+        """
+        while self.cache:
+            key, (expires, response) = next(self.cache.iteritems())
+            if expires > now:
+                return
+            del self.cache[key]
+
+    def request(self, method, url, **kwargs):
+        if method.upper() != 'GET':
+            self.cache.clear()
+            return requests.Session.request(self, method, url, **kwargs)
+        if kwargs.get('stream', False) or kwargs.get('headers', None):
+            return requests.Session.request(self, method, url, **kwargs)
+
+        key = (url, json.dumps(kwargs.get('params', None), sort_keys=True))
+        now = self.timer()
+        self.drop_expired(now)
+        cached = self.cache.get(key, None)
+        if cached:
+            return cached[1]
+
+        response = requests.Session.request(self, method, url, **kwargs)
+        if response.status_code == 200:
+            while len(self.cache) >= self.max_entries:
+                self.cache.popitem(last=False)
+            self.cache[key] = (now + self.ttl, response)
+        return response
+
+
+class DaemonRequestHandler(SocketServer.StreamRequestHandler):
+    """Handler for a single forwarded command."""
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        response = self.server.run_request(json.loads(line))
+        try:
+            encoded = json.dumps(response)
+        except (TypeError, ValueError), e:
+            # The command already ran so report the error rather than letting
+            # the forwarding process run it again.
+            encoded = json.dumps({
+                'forwarded': True,
+                'output': response['output'],
+                'result': kpiclient.generate_error(
+                    UNSENDABLE_RESULT_ERR % e
+                ).json()
+            })
+        self.wfile.write(encoded + '\n')
+
+
+class DaemonServer(SocketServer.UnixStreamServer):
+    """Server running forwarded commands one at a time.
+
+    Commands run one at a time because each changes the working directory,
+    arguments, and standard output of the process while it runs.
+    """
+
+    def __init__(self, socket_path):
+        """Create a new server listening on a Unix socket.
+
+        @param socket_path: The path to listen on. Only the current user may
+            connect.
+        @type socket_path: str
+        """
+        SocketServer.UnixStreamServer.__init__(
+            self,
+            socket_path,
+            DaemonRequestHandler
+        )
+        os.chmod(socket_path, 0600)
+        self.socket_path = socket_path
+
+    def stop(self):
+        """Stop serving once the current request is answered."""
+        thread = threading.Thread(target=self.shutdown)
+        thread.daemon = True
+        thread.start()
+
+    def run_request(self, request):
+        """Run a forwarded command and capture what it prints.
+
+        @param request: The command line arguments (argv) and working
+            directory (cwd) of the forwarding kpicmd.py.
+        @type request: dict
+        @return: Whether the command was run (forwarded) and, if so, its
+            output and result.
+        @rtype: dict
+        """
+        argv = request['argv']
+        command = argv[1] if len(argv) > 1 else None
+        if command == 'daemon':
+            if argv[2:] == ['stop']:
+                self.stop()
+                result = {'success': True, 'message': 'Daemon stopped.'}
+            else:
+                result = kpiclient.generate_error(ALREADY_RUNNING_ERR).json()
+            return {'forwarded': True, 'output': '', 'result': result}
+
+        if not command in kpiclient.FORWARDED_COMMANDS:
+            return {'forwarded': False}
+        if command in kpiclient.CREDENTIAL_COMMANDS and \
+            not kpiclient.DAEMON_USER_INFO:
+            return {'forwarded': False}
+
+        prior_argv = sys.argv
+        prior_stdout = sys.stdout
+        prior_cwd = os.getcwd()
+        output = StringIO.StringIO()
+        try:
+            sys.argv = argv
+            sys.stdout = output
+            os.chdir(request['cwd'])
+            result = kpiclient.get_result(kpiclient.COMMANDS.load(command)())
+        except Exception, e:
+            result = kpiclient.generate_error(str(e)).json()
+        finally:
+            sys.argv = prior_argv
+            sys.stdout = prior_stdout
+            os.chdir(prior_cwd)
+
+        return {
+            'forwarded': True,
+            'output': output.getvalue(),
+            'result': result
+        }
+
+
+def start_daemon(socket_path, user_info=None):
+    """Prepare the client to run commands in this process and start serving.
+
+    @param socket_path: The path to listen on.
+    @type socket_path: str
+    @keyword user_info: The credentials to run commands with or None to let
+        commands that need credentials run in the forwarding process.
+        Defaults to None.
+    @type user_info: kpiclient.UserInfo
+    @return: The server, ready for serve_forever.
+    @rtype: DaemonServer
+    """
+    socket_dir = os.path.dirname(os.path.abspath(socket_path))
+    if not os.path.isdir(socket_dir):
+        os.makedirs(socket_dir, 0700)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    kpiclient.SESSION = CachingSession()
+    kpiclient.DAEMON_USER_INFO = user_info
+    return DaemonServer(socket_path)
+
+
+def main_daemon():
+    """Main program driver for running or stopping the daemon.
+
+    @return: Dictionary describing the result.
+    @rtype: dict
+    """
+    params = sys.argv[2:]
+    if params == ['stop']:
+        return kpiclient.generate_error(NOT_RUNNING_ERR).json()
+    elif params:
+        print kpiclient.HELP_TEXT['daemon']
+        return False
+
+    print 'Enter credentials to use for all commands or leave blank to be'
+    print 'prompted by each command.'
+    username = raw_input('Username: ')
+    user_info = None
+    if username:
+        user_info = kpiclient.UserInfo(username, getpass.getpass())
+
+    server = start_daemon(kpiclient.DAEMON_SOCKET_PATH, user_info)
+    print 'Listening on %s' % kpiclient.DAEMON_SOCKET_PATH
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(server.socket_path):
+            os.remove(server.socket_path)
+    return {'success': True, 'message': 'Daemon stopped.'}
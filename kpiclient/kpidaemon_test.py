@@ -0,0 +1,227 @@
+"""Automated tests for the kpicmd.py daemon.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mox
+import requests
+
+import kpiclient
+import kpidaemon
+
+
+class FakeTimer:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeResponse:
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def create_response(values):
+    """Create a response from the package index with a JSON body.
+
+    @param values: The JSON values of the body.
+    @type values: dict
+    @return: The response.
+    @rtype: requests.models.Response
+    """
+    response = requests.models.Response()
+    response.status_code = 200
+    response.headers['Content-Type'] = 'application/json'
+    response._content = json.dumps(values)
+    return response
+
+
+class CachingSessionTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.timer = FakeTimer()
+        self.session = kpidaemon.CachingSession(10, self.timer)
+        self.mox.StubOutWithMock(requests.Session, 'request')
+
+    def test_caches_metadata(self):
+        first = FakeResponse(200)
+        second = FakeResponse(200)
+        requests.Session.request(self.session, 'GET', 'url').AndReturn(first)
+        requests.Session.request(self.session, 'GET', 'url').AndReturn(second)
+        self.mox.ReplayAll()
+
+        self.assertEqual(self.session.request('GET', 'url'), first)
+        self.timer.now = 5
+        self.assertEqual(self.session.request('GET', 'url'), first)
+        self.timer.now = 11
+        self.assertEqual(self.session.request('GET', 'url'), second)
+
+    def test_evicts_entries(self):
+        for url in ['first', 'second', 'third']:
+            requests.Session.request(
+                self.session,
+                'GET',
+                url
+            ).AndReturn(FakeResponse(200))
+        self.mox.ReplayAll()
+
+        self.session.max_entries = 2
+        self.session.request('GET', 'first')
+        self.timer.now = 5
+        self.session.request('GET', 'second')
+        self.session.request('GET', 'third')
+        self.assertEqual(
+            [key[0] for key in self.session.cache.keys()],
+            ['second', 'third']
+        )
+
+        self.session.drop_expired(16)
+        self.assertEqual(self.session.cache, {})
+
+    def test_skips_downloads_and_errors(self):
+        requests.Session.request(
+            self.session,
+            'GET',
+            'url',
+            stream=True
+        ).MultipleTimes().AndReturn(FakeResponse(200))
+        requests.Session.request(
+            self.session,
+            'GET',
+            'missing'
+        ).MultipleTimes().AndReturn(FakeResponse(404))
+        self.mox.ReplayAll()
+
+        self.session.request('GET', 'url', stream=True)
+        self.session.request('GET', 'missing')
+        self.assertEqual(self.session.cache, {})
+
+    def test_writes_clear_cache(self):
+        requests.Session.request(
+            self.session,
+            'GET',
+            'url'
+        ).MultipleTimes().AndReturn(FakeResponse(200))
+        requests.Session.request(
+            self.session,
+            'POST',
+            'url',
+            data={}
+        ).AndReturn(FakeResponse(200))
+        self.mox.ReplayAll()
+
+        self.session.request('GET', 'url')
+        self.session.request('POST', 'url', data={})
+        self.assertEqual(self.session.cache, {})
+
+
+class DaemonTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, 'kpi', 'daemon.sock')
+        self.server = None
+        self.thread = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.shutdown()
+            self.thread.join()
+            self.server.server_close()
+        kpiclient.SESSION = None
+        kpiclient.DAEMON_USER_INFO = None
+        shutil.rmtree(self.directory)
+        mox.MoxTestBase.tearDown(self)
+
+    def start(self, user_info=None):
+        self.server = kpidaemon.start_daemon(self.socket_path, user_info)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def forward(self, *args):
+        return kpiclient.forward_command(
+            ['kpicmd.py'] + list(args),
+            self.socket_path
+        )
+
+    def test_not_running(self):
+        self.assertEqual(self.forward('read', 'simple_ain'), None)
+
+    def test_forwards_commands(self):
+        self.mox.StubOutWithMock(kpiclient, 'read')
+        kpiclient.read('simple_ain').AndReturn(
+            create_response({'success': True, 'message': 'read'})
+        )
+        self.mox.StubOutWithMock(kpiclient, 'delete')
+        kpiclient.delete(mox.IgnoreArg(), 'simple_ain').AndReturn(
+            kpiclient.FakeResponse({'success': True, 'message': 'deleted'})
+        )
+        self.mox.ReplayAll()
+
+        self.start(kpiclient.UserInfo('user', 'pass'))
+        self.assertTrue(isinstance(
+            kpiclient.SESSION,
+            kpidaemon.CachingSession
+        ))
+        self.assertEqual(
+            os.stat(self.socket_path).st_mode & 0777,
+            0600
+        )
+
+        self.assertEqual(self.forward('read', 'simple_ain')['message'], 'read')
+        self.assertEqual(
+            self.forward('delete', 'simple_ain')['message'],
+            'deleted'
+        )
+        self.assertEqual(self.forward('passwd', 'user'), None)
+        self.assertFalse(self.forward('daemon')['success'])
+
+    def test_credentials_required(self):
+        self.start()
+        self.assertEqual(self.forward('delete', 'simple_ain'), None)
+
+    def test_errors_reported(self):
+        self.mox.StubOutWithMock(kpiclient, 'read')
+        kpiclient.read('simple_ain').AndRaise(IOError('offline'))
+        self.mox.ReplayAll()
+
+        self.start()
+        result = self.forward('read', 'simple_ain')
+        self.assertFalse(result['success'])
+        self.assertEqual(result['message'], 'offline')
+
+    def test_unsendable_result(self):
+        self.mox.StubOutWithMock(kpiclient, 'read')
+        kpiclient.read('simple_ain').AndReturn(
+            {'success': True, 'message': object()}
+        )
+        self.mox.ReplayAll()
+
+        self.start()
+        result = self.forward('read', 'simple_ain')
+        self.assertFalse(result['success'])
+
+    def test_stop(self):
+        self.start()
+        self.assertTrue(self.forward('daemon', 'stop')['success'])
+        self.thread.join()
+        self.server.server_close()
+        self.server = None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,705 @@
+"""Validation and metadata extraction for uploaded package archives.
+
+After a client finishes uploading a package's zip archive, the archive is
+streamed from the uploads bucket (or a local directory standing in for it) to a
+temporary file, checked, and summarized. The resulting module.json and a
+manifest of files with sizes and hashes are saved on the package record. This
+work happens on a pool of background workers so that publishing a package does
+not wait on it.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import hashlib
+import json
+import os
+import posixpath
+import Queue
+import shutil
+import tempfile
+import threading
+import zipfile
+import zlib
+
+import cache_service
+import db_service
+import delta_service
+import file_store_service
+
+MODULE_JSON_NAME = 'module.json'
+
+STATUS_VALID = 'valid'
+STATUS_INVALID = 'invalid'
+
+CHUNK_SIZE = 64 * 1024
+MAX_MODULE_JSON_SIZE = 1024 * 1024
+
+DEFAULT_MAX_UNCOMPRESSED_SIZE = 200 * 1024 * 1024
+DEFAULT_MAX_FILES = 5000
+DEFAULT_NUM_WORKERS = 2
+DEFAULT_S3_TIMEOUT = 30
+
+MEMBER_ERRORS = (
+    zipfile.BadZipfile,
+    zipfile.LargeZipFile,
+    zlib.error,
+    RuntimeError,
+    NotImplementedError
+)
+
+worker_pool_lock = threading.Lock()
+
+
+def get_s3_timeout(application):
+    """Get the number of seconds to wait on S3 before giving up.
+
+    Applies to connecting and to each read so that a stalled connection does
+    not hold a worker indefinitely.
+
+    @param application: The application whose S3_TIMEOUT configuration value
+        sets the timeout.
+    @type application: flask.Flask
+    @return: The timeout in seconds.
+    @rtype: float
+    """
+    return application.config.get('S3_TIMEOUT', DEFAULT_S3_TIMEOUT)
+
+
+class ArchiveStoreAdapter:
+    """Interface for a service holding uploaded package archives."""
+
+    def open_archive(self, object_name, start=0, end=None):
+        """Open a stream over the contents of an uploaded archive.
+
+        @param object_name: The name of the archive in the store.
+        @type object_name: str
+        @keyword start: The offset in bytes of the first byte to read.
+            Defaults to 0.
+        @type start: int
+        @keyword end: The offset in bytes after the last byte to read or None
+            to read to the end of the archive. Defaults to None.
+        @type end: int
+        @return: File-like object supporting read(size) and close() positioned
+            at start. Callers should stop reading at end.
+        @rtype: file
+        @raise IOError: Raised if the archive could not be opened.
+        """
+        raise NotImplementedError()
+
+    def save_archive(self, object_name, archive_file):
+        """Save an archive into the store where clients may download it.
+
+        @param object_name: The name of the archive in the store.
+        @type object_name: str
+        @param archive_file: File positioned at the start of the archive.
+        @type archive_file: file
+        @raise IOError: Raised if the archive could not be saved.
+        """
+        raise NotImplementedError()
+
+
+class S3ArchiveStoreAdapter(ArchiveStoreAdapter):
+    """Implementation of the ArchiveStoreAdapter for the S3 uploads bucket."""
+
+    def __init__(self, application):
+        """Create a new adapter around the uploads bucket.
+
+        @param application: The application with the S3 configuration values.
+        @type application: flask.Flask
+        """
+        self.application = application
+
+    def open_archive(self, object_name, start=0, end=None):
+        import requests
+
+        url = file_store_service.create_signed_url(
+            self.application,
+            'GET',
+            object_name,
+            file_store_service.get_download_expiration(self.application)
+        )
+
+        headers = {}
+        expected_status = 200
+        if start or end is not None:
+            headers['Range'] = 'bytes=%d-%s' % (
+                start,
+                '' if end is None else end - 1
+            )
+            expected_status = 206
+
+        response = requests.get(
+            url,
+            headers=headers,
+            stream=True,
+            timeout=get_s3_timeout(self.application)
+        )
+        if response.status_code != expected_status:
+            response.close()
+            raise IOError('Archive not found: %s' % object_name)
+        return response.raw
+
+    def save_archive(self, object_name, archive_file):
+        import requests
+
+        url = file_store_service.create_signed_url(
+            self.application,
+            'PUT',
+            object_name,
+            file_store_service.get_upload_expiration(self.application),
+            mime_type=file_store_service.ZIP_MIME_TYPE,
+            amz_headers=file_store_service.PUBLIC_READ_HEADERS
+        )
+        response = requests.put(
+            url,
+            data=archive_file,
+            headers={
+                'Content-Type': file_store_service.ZIP_MIME_TYPE,
+                'x-amz-acl': 'public-read'
+            },
+            timeout=get_s3_timeout(self.application)
+        )
+        if response.status_code != 200:
+            raise IOError('Could not save archive: %s' % object_name)
+
+
+class LocalArchiveStoreAdapter(ArchiveStoreAdapter):
+    """Implementation of the ArchiveStoreAdapter for a local directory."""
+
+    def __init__(self, directory):
+        """Create a new adapter around a directory of archives.
+
+        @param directory: The directory standing in for the uploads bucket.
+        @type directory: str
+        """
+        self.directory = directory
+
+    def open_archive(self, object_name, start=0, end=None):
+        archive_file = open(os.path.join(self.directory, object_name), 'rb')
+        archive_file.seek(start)
+        return archive_file
+
+    def save_archive(self, object_name, archive_file):
+        path = os.path.join(self.directory, object_name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(archive_file, f, CHUNK_SIZE)
+
+
+def get_client(application):
+    """Get the archive store specified by configuration.
+
+    Uses the ARCHIVE_STORE_BACKEND configuration value which may be 's3'
+    (default) or 'local' (using ARCHIVE_STORE_LOCAL_DIR).
+
+    @param application: The application with the archive store configuration.
+    @type application: flask.Flask
+    @return: Implementor of ArchiveStoreAdapter
+    @rtype: ArchiveStoreAdapter
+    """
+    backend = application.config.get('ARCHIVE_STORE_BACKEND', 's3')
+
+    if backend == 'local':
+        return LocalArchiveStoreAdapter(
+            application.config['ARCHIVE_STORE_LOCAL_DIR']
+        )
+    else:
+        return S3ArchiveStoreAdapter(application)
+
+
+def open_archive_range(application, package_name, sha256, start, end):
+    """Open a stream over part of a package's validated archive.
+
+    Reads through the local archive cache if ARCHIVE_CACHE_DIR is configured,
+    fetching the whole archive from the store on a miss, or directly from the
+    store otherwise.
+
+    @param application: The application with the archive store configuration.
+    @type application: flask.Flask
+    @param package_name: The name of the package whose archive should be read.
+    @type package_name: str
+    @param sha256: The hex SHA-256 digest of the validated archive.
+    @type sha256: str
+    @param start: The offset in bytes of the first byte to read.
+    @type start: int
+    @param end: The offset in bytes after the last byte to read.
+    @type end: int
+    @return: File-like object positioned at start.
+    @rtype: file
+    @raise IOError: Raised if the archive could not be opened.
+    """
+    client = get_client(application)
+    object_name = file_store_service.get_archive_name(package_name)
+    cache = file_store_service.get_archive_cache(application)
+    if not cache:
+        return client.open_archive(object_name, start=start, end=end)
+
+    def fill(target):
+        stream = client.open_archive(object_name)
+        try:
+            shutil.copyfileobj(stream, target, CHUNK_SIZE)
+        finally:
+            stream.close()
+
+    try:
+        cached = cache.open(sha256, fill)
+    except ValueError:
+        raise IOError('Archive changed since validation: %s' % object_name)
+    cached.seek(start)
+    return cached
+
+
+def stream_archive(stream, length):
+    """Read part of an archive stream in fixed size chunks.
+
+    @param stream: The stream over the archive contents positioned at the
+        first byte to read.
+    @type stream: file
+    @param length: The number of bytes to read.
+    @type length: int
+    @return: Generator yielding chunks of at most CHUNK_SIZE bytes. The stream
+        is closed once exhausted.
+    @rtype: generator
+    """
+    try:
+        remaining = length
+        while remaining > 0:
+            chunk = stream.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        stream.close()
+
+
+def spool_archive(stream, max_size):
+    """Copy an archive stream to a temporary file in fixed size chunks.
+
+    zipfile needs to seek to the central directory at the end of an archive so
+    the stream is spooled to disk rather than held in memory.
+
+    @param stream: The stream over the archive contents.
+    @type stream: file
+    @param max_size: The maximum number of bytes allowed in the archive.
+    @type max_size: int
+    @return: Tuple of (temporary file positioned at its start, size in bytes,
+        hex SHA-256 digest of the archive).
+    @rtype: tuple
+    @raise ValueError: Raised if the archive is larger than max_size.
+    """
+    spooled = tempfile.TemporaryFile()
+    digest = hashlib.sha256()
+    size = 0
+
+    try:
+        chunk = stream.read(CHUNK_SIZE)
+        while chunk:
+            size += len(chunk)
+            if size > max_size:
+                raise ValueError('Archive is larger than %d bytes.' % max_size)
+            digest.update(chunk)
+            spooled.write(chunk)
+            chunk = stream.read(CHUNK_SIZE)
+    except:
+        spooled.close()
+        raise
+
+    spooled.seek(0)
+    return (spooled, size, digest.hexdigest())
+
+
+def check_member_name(name):
+    """Ensure the path of a file in an archive stays within the archive.
+
+    @param name: The path of the file within the archive.
+    @type name: str
+    @raise ValueError: Raised if the path is absolute or escapes the archive.
+    """
+    normalized = posixpath.normpath(name.replace('\\', '/'))
+    is_absolute = normalized.startswith('/') or ':' in normalized
+    if is_absolute or normalized == '..' or normalized.startswith('../'):
+        raise ValueError('Archive contains an unsafe path: %s' % name)
+
+
+def hash_member(zip_file, info):
+    """Hash a file within an archive without reading it into memory at once.
+
+    Reading the whole member also verifies its CRC.
+
+    @param zip_file: The open archive.
+    @type zip_file: zipfile.ZipFile
+    @param info: The entry for the file to hash.
+    @type info: zipfile.ZipInfo
+    @return: Hex SHA-256 digest of the file's uncompressed contents.
+    @rtype: str
+    """
+    digest = hashlib.sha256()
+    member = zip_file.open(info)
+    try:
+        chunk = member.read(CHUNK_SIZE)
+        while chunk:
+            digest.update(chunk)
+            chunk = member.read(CHUNK_SIZE)
+    finally:
+        member.close()
+    return digest.hexdigest()
+
+
+def find_module_json(names):
+    """Find the module.json describing an archive.
+
+    module.json may be at the root of the archive or within a single top level
+    directory. The shallowest match is used.
+
+    @param names: The paths of the files in the archive.
+    @type names: list of str
+    @return: The path of module.json within the archive.
+    @rtype: str
+    @raise ValueError: Raised if the archive does not contain module.json.
+    """
+    candidates = [
+        name for name in names
+        if posixpath.basename(name) == MODULE_JSON_NAME and name.count('/') <= 1
+    ]
+    if not candidates:
+        raise ValueError('Archive does not contain %s.' % MODULE_JSON_NAME)
+    return min(candidates, key=lambda name: name.count('/'))
+
+
+def read_module_json(zip_file, name):
+    """Read and parse module.json from an archive.
+
+    @param zip_file: The open archive.
+    @type zip_file: zipfile.ZipFile
+    @param name: The path of module.json within the archive.
+    @type name: str
+    @return: The parsed module.json contents.
+    @rtype: dict
+    @raise ValueError: Raised if module.json is too large or not a JSON object.
+    """
+    if zip_file.getinfo(name).file_size > MAX_MODULE_JSON_SIZE:
+        raise ValueError('%s is too large.' % MODULE_JSON_NAME)
+
+    member = zip_file.open(name)
+    try:
+        module_info = json.loads(member.read())
+    finally:
+        member.close()
+
+    if not isinstance(module_info, dict):
+        raise ValueError('%s must contain a JSON object.' % MODULE_JSON_NAME)
+    return module_info
+
+
+def inspect_archive(archive_file, max_files, max_uncompressed_size):
+    """Validate an archive and build a manifest of the files within it.
+
+    @param archive_file: Seekable file with the archive contents.
+    @type archive_file: file
+    @param max_files: The maximum number of files allowed in the archive.
+    @type max_files: int
+    @param max_uncompressed_size: The maximum total size in bytes of the
+        archive's files once uncompressed.
+    @type max_uncompressed_size: int
+    @return: Tuple of (module.json contents, manifest of files). Each manifest
+        entry has the file's path, uncompressed size, and hex SHA-256 digest.
+    @rtype: tuple
+    @raise ValueError: Raised if the archive is invalid.
+    """
+    try:
+        zip_file = zipfile.ZipFile(archive_file)
+    except (zipfile.BadZipfile, zipfile.LargeZipFile):
+        raise ValueError('Upload is not a valid zip archive.')
+
+    try:
+        infos = [info for info in zip_file.infolist()
+            if not info.filename.endswith('/')]
+
+        if len(infos) > max_files:
+            raise ValueError('Archive has more than %d files.' % max_files)
+
+        total_size = sum(info.file_size for info in infos)
+        if total_size > max_uncompressed_size:
+            raise ValueError(
+                'Archive is larger than %d bytes uncompressed.' %
+                max_uncompressed_size
+            )
+
+        for info in infos:
+            check_member_name(info.filename)
+
+        names = [info.filename for info in infos]
+        module_json_name = find_module_json(names)
+
+        # Members can be corrupt, encrypted, or use a compression method
+        # zipfile does not support, each of which raises its own error.
+        try:
+            module_info = read_module_json(zip_file, module_json_name)
+            manifest = [{
+                'path': info.filename,
+                'size': info.file_size,
+                'sha256': hash_member(zip_file, info)
+            } for info in infos]
+        except MEMBER_ERRORS:
+            raise ValueError('Archive contains a corrupt file.')
+    finally:
+        zip_file.close()
+
+    return (module_info, manifest)
+
+
+def is_current_archive(package, archive):
+    """Check if a validated archive is for the current version of a package.
+
+    Updating a package to a new version keeps the previous version's archive
+    on the record until the new archive is validated so that a delta can be
+    built from it.
+
+    @param package: The package record.
+    @type package: dict
+    @param archive: The validated archive information saved on the package.
+    @type archive: dict
+    @return: True if the archive's module.json has the package's version.
+    @rtype: bool
+    """
+    return archive['module'].get('version', None) == package['version']
+
+
+def check_module_info(module_info, package):
+    """Ensure module.json in an archive agrees with the package record.
+
+    @param module_info: The contents of module.json from the archive.
+    @type module_info: dict
+    @param package: The package record the archive was uploaded for.
+    @type package: dict
+    @raise ValueError: Raised if the name or version do not match.
+    """
+    for field in ['name', 'version']:
+        if module_info.get(field, None) != package[field]:
+            raise ValueError(
+                '%s %s does not match the package %s.' %
+                (MODULE_JSON_NAME, field, field)
+            )
+
+
+def save_deltas(application, client, package, archive_file, manifest):
+    """Create and save the delta from the previous version of a package.
+
+    A delta that cannot be created or saved is skipped as clients fall back to
+    the full archive.
+
+    @param application: The application with the archive configuration.
+    @type application: flask.Flask
+    @param client: The store to save the delta archive into.
+    @type client: ArchiveStoreAdapter
+    @param package: The package record at the time the upload completed. Its
+        archive field describes the previous version's archive.
+    @type package: dict
+    @param archive_file: Seekable file with the new archive's contents.
+    @type archive_file: file
+    @param manifest: The manifest of the new archive.
+    @type manifest: list of dict
+    @return: Information about the saved deltas.
+    @rtype: list of dict
+    """
+    previous = package.get(db_service.ARCHIVE_FIELD, None)
+    if not previous or previous.get('status', None) != STATUS_VALID:
+        return []
+
+    try:
+        delta = delta_service.create_delta(
+            previous,
+            package['name'],
+            package['version'],
+            archive_file,
+            manifest
+        )
+        if not delta:
+            return []
+
+        delta_file, delta_info = delta
+        try:
+            client.save_archive(delta_info['object'], delta_file)
+        finally:
+            delta_file.close()
+    except (IOError,) + MEMBER_ERRORS, e:
+        application.logger.warning(
+            'Skipped delta for %s: %s' % (package['name'], e)
+        )
+        return []
+
+    return [delta_info]
+
+
+def process_archive(application, db_adapter, package):
+    """Validate an uploaded archive and save what was found on its package.
+
+    @param application: The application with the archive configuration.
+    @type application: flask.Flask
+    @param db_adapter: Wrapper around the application database.
+    @type db_adapter: db_service.DBAdapter
+    @param package: The package record at the time the upload completed.
+    @type package: dict
+    @return: The archive information saved on the package.
+    @rtype: dict
+    """
+    config = application.config
+    client = get_client(application)
+    object_name = file_store_service.get_archive_name(package['name'])
+    archive_info = {}
+
+    try:
+        stream = client.open_archive(object_name)
+        try:
+            spooled, size, sha256 = spool_archive(
+                stream,
+                file_store_service.get_max_upload_size(application)
+            )
+        finally:
+            stream.close()
+
+        archive_info['size'] = size
+        archive_info['sha256'] = sha256
+
+        try:
+            module_info, manifest = inspect_archive(
+                spooled,
+                config.get('ARCHIVE_MAX_FILES', DEFAULT_MAX_FILES),
+                config.get(
+                    'ARCHIVE_MAX_UNCOMPRESSED_SIZE',
+                    DEFAULT_MAX_UNCOMPRESSED_SIZE
+                )
+            )
+            check_module_info(module_info, package)
+            deltas = save_deltas(
+                application,
+                client,
+                package,
+                spooled,
+                manifest
+            )
+        finally:
+            spooled.close()
+
+        archive_info['status'] = STATUS_VALID
+        archive_info['module'] = module_info
+        archive_info['manifest'] = manifest
+        archive_info['deltas'] = deltas
+    except (IOError, ValueError), e:
+        archive_info['status'] = STATUS_INVALID
+        archive_info['error'] = str(e)
+
+    saved = db_adapter.set_package_archive(
+        package['name'],
+        package['version'],
+        archive_info
+    )
+    if saved:
+        cache_service.purge_package(application, package['name'])
+    return archive_info
+
+
+class ArchiveWorkerPool:
+    """Pool of background threads processing uploaded archives."""
+
+    def __init__(self, application, num_workers):
+        """Create and start a new pool of workers.
+
+        @param application: The application with the archive configuration.
+        @type application: flask.Flask
+        @param num_workers: The number of worker threads to start.
+        @type num_workers: int
+        """
+        self.application = application
+        self.jobs = Queue.Queue()
+        self.workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(target=self.run_worker)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, db_adapter, package):
+        """Queue an uploaded archive for processing.
+
+        @param db_adapter: Wrapper around the application database.
+        @type db_adapter: db_service.DBAdapter
+        @param package: The package record at the time the upload completed.
+        @type package: dict
+        """
+        self.jobs.put((db_adapter, package))
+
+    def join(self):
+        """Wait until every queued archive has been processed."""
+        self.jobs.join()
+
+    def shutdown(self):
+        """Stop the workers after they finish the archives already queued."""
+        for worker in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def run_worker(self):
+        """Process queued archives until the pool is shut down."""
+        while True:
+            job = self.jobs.get()
+            if job == None:
+                self.jobs.task_done()
+                return
+
+            db_adapter, package = job
+            try:
+                process_archive(self.application, db_adapter, package)
+            except Exception:
+                self.application.logger.exception(
+                    'Failed to process archive for %s.' % package['name']
+                )
+            finally:
+                self.jobs.task_done()
+
+
+def get_worker_pool(application):
+    """Get the archive worker pool for an application, creating it if needed.
+
+    @param application: The application with the archive configuration.
+    @type application: flask.Flask
+    @return: The pool shared across requests.
+    @rtype: ArchiveWorkerPool
+    """
+    pool = application.extensions.get('kpi_archive_workers', None)
+    if pool:
+        return pool
+
+    with worker_pool_lock:
+        pool = application.extensions.get('kpi_archive_workers', None)
+        if not pool:
+            pool = ArchiveWorkerPool(
+                application,
+                application.config.get('ARCHIVE_WORKERS', DEFAULT_NUM_WORKERS)
+            )
+            application.extensions['kpi_archive_workers'] = pool
+    return pool
+
+
+def enqueue_archive(application, db_adapter, package):
+    """Process an uploaded archive in the background.
+
+    Processes the archive immediately in the calling thread if the
+    ARCHIVE_WORKERS configuration value is 0.
+
+    @param application: The application with the archive configuration.
+    @type application: flask.Flask
+    @param db_adapter: Wrapper around the application database.
+    @type db_adapter: db_service.DBAdapter
+    @param package: The package record at the time the upload completed.
+    @type package: dict
+    """
+    if application.config.get('ARCHIVE_WORKERS', DEFAULT_NUM_WORKERS) == 0:
+        process_archive(application, db_adapter, package)
+    else:
+        get_worker_pool(application).submit(db_adapter, package)
@@ -0,0 +1,430 @@
+"""Tests for validation and metadata extraction of uploaded package archives.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+import zipfile
+
+import flask
+import mox
+import requests
+
+import archive_service
+import cache_service
+import db_service
+import file_store_service
+
+TEST_PACKAGE = {
+    'name': 'simple_ain',
+    'version': '1.2.3',
+    'authors': ['user']
+}
+TEST_MODULE_INFO = {'name': 'simple_ain', 'version': '1.2.3'}
+TEST_SOURCE = 'console.log("simple_ain");'
+
+
+def create_archive(files):
+    """Create the contents of a zip archive.
+
+    @param files: Dictionary mapping path within the archive to contents.
+    @type files: dict
+    @return: The archive contents.
+    @rtype: str
+    """
+    archive = StringIO.StringIO()
+    zip_file = zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED)
+    for name, contents in sorted(files.items()):
+        zip_file.writestr(name, contents)
+    zip_file.close()
+    return archive.getvalue()
+
+
+def corrupt_member(contents, name):
+    """Overwrite the compressed data of a file within a zip archive.
+
+    @param contents: The archive contents.
+    @type contents: str
+    @param name: The path of the file to corrupt.
+    @type name: str
+    @return: The archive contents with the file's deflate stream replaced by
+        an invalid block.
+    @rtype: str
+    """
+    zip_file = zipfile.ZipFile(StringIO.StringIO(contents))
+    info = zip_file.getinfo(name)
+    zip_file.close()
+    start = info.header_offset + 30 + len(info.filename) + len(info.extra)
+    end = start + info.compress_size
+    return contents[:start] + '\xff' * (end - start) + contents[end:]
+
+
+class ArchiveServiceTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.app = flask.Flask(__name__)
+        self.app.config['ARCHIVE_STORE_BACKEND'] = 'local'
+        self.app.config['ARCHIVE_STORE_LOCAL_DIR'] = self.directory
+        self.app.config['ARCHIVE_WORKERS'] = 0
+        self.db_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        self.mox.StubOutWithMock(cache_service, 'purge_package')
+
+    def tearDown(self):
+        mox.MoxTestBase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def write_archive(self, contents):
+        path = os.path.join(self.directory, 'simple_ain.zip')
+        with open(path, 'wb') as f:
+            f.write(contents)
+
+    def test_s3_open_archive_timeout(self):
+        self.app.config['S3_TIMEOUT'] = 5
+        self.mox.StubOutWithMock(file_store_service, 'create_signed_url')
+        self.mox.StubOutWithMock(requests, 'get')
+        file_store_service.create_signed_url(
+            self.app,
+            'GET',
+            'simple_ain.zip',
+            mox.IgnoreArg()
+        ).AndReturn('http://bucket/simple_ain.zip')
+        requests.get(
+            'http://bucket/simple_ain.zip',
+            headers={},
+            stream=True,
+            timeout=5
+        ).AndRaise(requests.exceptions.Timeout())
+        self.mox.ReplayAll()
+
+        store = archive_service.S3ArchiveStoreAdapter(self.app)
+        self.assertRaises(IOError, store.open_archive, 'simple_ain.zip')
+
+    def test_spool_archive(self):
+        contents = 'a' * (archive_service.CHUNK_SIZE * 2 + 5)
+        spooled, size, sha256 = archive_service.spool_archive(
+            StringIO.StringIO(contents),
+            len(contents)
+        )
+        self.assertEqual(spooled.read(), contents)
+        self.assertEqual(size, len(contents))
+        self.assertEqual(sha256, hashlib.sha256(contents).hexdigest())
+        spooled.close()
+
+    def test_stream_archive(self):
+        contents = 'a' * (archive_service.CHUNK_SIZE + 5)
+        stream = StringIO.StringIO(contents)
+        chunks = list(archive_service.stream_archive(stream, len(contents) - 1))
+        self.assertEqual([len(chunk) for chunk in chunks], [
+            archive_service.CHUNK_SIZE,
+            4
+        ])
+        self.assertTrue(stream.closed)
+
+    def test_local_open_archive_offset(self):
+        self.write_archive('0123456789')
+        client = archive_service.get_client(self.app)
+        stream = client.open_archive('simple_ain.zip', start=4, end=6)
+        self.assertEqual(stream.read(2), '45')
+        stream.close()
+
+    def test_open_archive_range_cached(self):
+        self.write_archive('0123456789')
+        self.app.config['ARCHIVE_CACHE_DIR'] = os.path.join(
+            self.directory,
+            'cache'
+        )
+        sha256 = hashlib.sha256('0123456789').hexdigest()
+
+        for i in range(2):
+            stream = archive_service.open_archive_range(
+                self.app,
+                'simple_ain',
+                sha256,
+                4,
+                6
+            )
+            self.assertEqual(stream.read(2), '45')
+            stream.close()
+
+        stats = self.app.extensions['kpi_archive_cache'].get_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_open_archive_range_changed(self):
+        self.write_archive('0123456789')
+        self.app.config['ARCHIVE_CACHE_DIR'] = os.path.join(
+            self.directory,
+            'cache'
+        )
+        self.assertRaises(
+            IOError,
+            archive_service.open_archive_range,
+            self.app,
+            'simple_ain',
+            hashlib.sha256('other').hexdigest(),
+            0,
+            10
+        )
+
+    def test_spool_archive_too_large(self):
+        self.assertRaises(
+            ValueError,
+            archive_service.spool_archive,
+            StringIO.StringIO('a' * 10),
+            9
+        )
+
+    def test_check_member_name(self):
+        archive_service.check_member_name('simple_ain/lib/main.js')
+        for name in ['/etc/passwd', '../escape.js', 'a/../../b', 'C:\\x.js']:
+            self.assertRaises(
+                ValueError,
+                archive_service.check_member_name,
+                name
+            )
+
+    def test_find_module_json(self):
+        self.assertEqual(
+            archive_service.find_module_json([
+                'simple_ain/lib/module.json',
+                'simple_ain/module.json'
+            ]),
+            'simple_ain/module.json'
+        )
+        self.assertRaises(
+            ValueError,
+            archive_service.find_module_json,
+            ['a/b/module.json']
+        )
+
+    def test_inspect_archive(self):
+        contents = create_archive({
+            'module.json': json.dumps(TEST_MODULE_INFO),
+            'main.js': TEST_SOURCE
+        })
+        module_info, manifest = archive_service.inspect_archive(
+            StringIO.StringIO(contents),
+            10,
+            1000
+        )
+        self.assertEqual(module_info, TEST_MODULE_INFO)
+        self.assertEqual(manifest[0], {
+            'path': 'main.js',
+            'size': len(TEST_SOURCE),
+            'sha256': hashlib.sha256(TEST_SOURCE).hexdigest()
+        })
+        self.assertEqual(manifest[1]['path'], 'module.json')
+
+    def test_inspect_archive_limits(self):
+        contents = create_archive({
+            'module.json': json.dumps(TEST_MODULE_INFO),
+            'main.js': TEST_SOURCE
+        })
+        self.assertRaises(
+            ValueError,
+            archive_service.inspect_archive,
+            StringIO.StringIO(contents),
+            1,
+            1000
+        )
+        self.assertRaises(
+            ValueError,
+            archive_service.inspect_archive,
+            StringIO.StringIO(contents),
+            10,
+            10
+        )
+
+    def test_inspect_archive_not_zip(self):
+        self.assertRaises(
+            ValueError,
+            archive_service.inspect_archive,
+            StringIO.StringIO('not a zip'),
+            10,
+            1000
+        )
+
+    def test_inspect_archive_corrupt_member(self):
+        contents = create_archive({
+            'module.json': json.dumps(TEST_MODULE_INFO),
+            'main.js': TEST_SOURCE
+        })
+        for name in ['module.json', 'main.js']:
+            self.assertRaises(
+                ValueError,
+                archive_service.inspect_archive,
+                StringIO.StringIO(corrupt_member(contents, name)),
+                10,
+                1000
+            )
+
+    def test_is_current_archive(self):
+        archive = {'status': 'valid', 'module': TEST_MODULE_INFO}
+        self.assertTrue(
+            archive_service.is_current_archive(TEST_PACKAGE, archive)
+        )
+        self.assertFalse(archive_service.is_current_archive(
+            dict(TEST_PACKAGE, version='1.3.0'),
+            archive
+        ))
+
+    def test_check_module_info_mismatch(self):
+        module_info = dict(TEST_MODULE_INFO, version='1.2.4')
+        self.assertRaises(
+            ValueError,
+            archive_service.check_module_info,
+            module_info,
+            TEST_PACKAGE
+        )
+
+    def test_process_archive_valid(self):
+        contents = create_archive({
+            'simple_ain/module.json': json.dumps(TEST_MODULE_INFO),
+            'simple_ain/main.js': TEST_SOURCE
+        })
+        self.write_archive(contents)
+
+        self.db_adapter.set_package_archive(
+            'simple_ain',
+            '1.2.3',
+            mox.IsA(dict)
+        ).AndReturn(True)
+        cache_service.purge_package(self.app, 'simple_ain')
+        self.mox.ReplayAll()
+
+        archive_info = archive_service.process_archive(
+            self.app,
+            self.db_adapter,
+            TEST_PACKAGE
+        )
+
+        self.assertEqual(archive_info['status'], archive_service.STATUS_VALID)
+        self.assertEqual(archive_info['size'], len(contents))
+        self.assertEqual(archive_info['module'], TEST_MODULE_INFO)
+        self.assertEqual(len(archive_info['manifest']), 2)
+        self.assertEqual(archive_info['deltas'], [])
+
+    def test_process_archive_saves_delta(self):
+        old_contents = create_archive({
+            'module.json': json.dumps(dict(TEST_MODULE_INFO, version='1.2.2')),
+            'main.js': TEST_SOURCE
+        })
+        old_manifest = archive_service.inspect_archive(
+            StringIO.StringIO(old_contents),
+            10,
+            1000
+        )[1]
+        package = dict(TEST_PACKAGE, archive={
+            'status': archive_service.STATUS_VALID,
+            'module': {'version': '1.2.2'},
+            'manifest': old_manifest
+        })
+        self.write_archive(create_archive({
+            'module.json': json.dumps(TEST_MODULE_INFO),
+            'main.js': TEST_SOURCE
+        }))
+
+        self.db_adapter.set_package_archive(
+            'simple_ain',
+            '1.2.3',
+            mox.IsA(dict)
+        ).AndReturn(True)
+        cache_service.purge_package(self.app, 'simple_ain')
+        self.mox.ReplayAll()
+
+        archive_info = archive_service.process_archive(
+            self.app,
+            self.db_adapter,
+            package
+        )
+
+        delta_info = archive_info['deltas'][0]
+        self.assertEqual(delta_info['from_version'], '1.2.2')
+        self.assertEqual(delta_info['files'], 1)
+        delta_path = os.path.join(self.directory, delta_info['object'])
+        delta_zip = zipfile.ZipFile(delta_path)
+        self.assertEqual(delta_zip.namelist(), ['module.json'])
+        delta_zip.close()
+
+    def test_process_archive_invalid(self):
+        self.write_archive(create_archive({'main.js': TEST_SOURCE}))
+
+        self.db_adapter.set_package_archive(
+            'simple_ain',
+            '1.2.3',
+            mox.Func(lambda info: info['status'] == 'invalid')
+        ).AndReturn(True)
+        cache_service.purge_package(self.app, 'simple_ain')
+        self.mox.ReplayAll()
+
+        archive_service.enqueue_archive(self.app, self.db_adapter, TEST_PACKAGE)
+
+    def test_process_archive_corrupt_member(self):
+        self.write_archive(corrupt_member(
+            create_archive({
+                'module.json': json.dumps(TEST_MODULE_INFO),
+                'main.js': TEST_SOURCE
+            }),
+            'module.json'
+        ))
+
+        self.db_adapter.set_package_archive(
+            'simple_ain',
+            '1.2.3',
+            mox.Func(lambda info: info['status'] == 'invalid')
+        ).AndReturn(True)
+        cache_service.purge_package(self.app, 'simple_ain')
+        self.mox.ReplayAll()
+
+        archive_info = archive_service.process_archive(
+            self.app,
+            self.db_adapter,
+            TEST_PACKAGE
+        )
+        self.assertEqual(
+            archive_info['error'],
+            'Archive contains a corrupt file.'
+        )
+
+    def test_process_archive_missing(self):
+        self.db_adapter.set_package_archive(
+            'simple_ain',
+            '1.2.3',
+            mox.Func(lambda info: info['status'] == 'invalid')
+        ).AndReturn(False)
+        self.mox.ReplayAll()
+
+        archive_service.enqueue_archive(self.app, self.db_adapter, TEST_PACKAGE)
+
+    def test_worker_pool(self):
+        self.write_archive(create_archive({
+            'module.json': json.dumps(TEST_MODULE_INFO)
+        }))
+        self.app.config['ARCHIVE_WORKERS'] = 1
+
+        self.db_adapter.set_package_archive(
+            'simple_ain',
+            '1.2.3',
+            mox.IsA(dict)
+        ).AndReturn(True)
+        cache_service.purge_package(self.app, 'simple_ain')
+        self.mox.ReplayAll()
+
+        archive_service.enqueue_archive(self.app, self.db_adapter, TEST_PACKAGE)
+        pool = archive_service.get_worker_pool(self.app)
+        pool.join()
+        self.assertTrue(pool is archive_service.get_worker_pool(self.app))
+        pool.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
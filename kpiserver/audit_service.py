@@ -0,0 +1,239 @@
+"""Structured audit log of changes to users and packages in the index.
+
+Each audit event is written as a single JSON document per line. Writing to a
+file on the request path would make every write to the index wait on disk so
+requests only hand events to a bounded in-memory queue. A background thread
+drains the queue into a size-rotated log file. If the writer falls behind far
+enough to fill the queue, events are dropped and counted rather than blocking
+requests.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import Queue
+import threading
+
+import flask
+
+AUDIT_LOGGER_NAME = 'kpiserver.audit'
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5
+DEFAULT_QUEUE_SIZE = 10000
+
+# Upper bound on the time log_event may add to a request as a fraction of the
+# time taken to write the event synchronously to a file. Checked against the
+# fastest rounds of the audit_log_event microbenchmark by the tests. A ratio
+# keeps the check stable on slower machines.
+MAX_EVENT_OVERHEAD_RATIO = 1.0
+
+USER_CREATE_EVENT = 'user_create'
+USER_IMPORT_EVENT = 'user_import'
+USER_UPDATE_EVENT = 'user_update'
+PASSWORD_RESET_EVENT = 'password_reset'
+PACKAGE_CREATE_EVENT = 'package_create'
+PACKAGE_UPDATE_EVENT = 'package_update'
+PACKAGE_DELETE_EVENT = 'package_delete'
+AUTH_FAILURE_EVENT = 'auth_failure'
+
+audit_logger = logging.getLogger(AUDIT_LOGGER_NAME)
+audit_logger.addHandler(logging.NullHandler())
+audit_logger.propagate = False
+
+
+class JSONLinesFormatter(logging.Formatter):
+    """Formats audit events as a single line JSON document."""
+
+    def format(self, record):
+        """Serialize an audit event along with the time it was logged.
+
+        @param record: The record whose msg is the audit event dictionary.
+        @type record: logging.LogRecord
+        @return: The JSON document without a trailing newline.
+        @rtype: str
+        """
+        event = dict(record.msg)
+        event['time'] = datetime.datetime.utcfromtimestamp(
+            record.created
+        ).isoformat() + 'Z'
+        return json.dumps(event, sort_keys=True)
+
+
+class QueueHandler(logging.Handler):
+    """Log handler that passes records to a queue without blocking.
+
+    Python 2 does not include logging.handlers.QueueHandler.
+    """
+
+    def __init__(self, queue):
+        """Create a new handler.
+
+        @param queue: The bounded queue to put records on.
+        @type queue: Queue.Queue
+        """
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        """Put a record on the queue or drop it if the queue is full.
+
+        @param record: The record to pass to the writer.
+        @type record: logging.LogRecord
+        """
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+
+class AuditLog:
+    """Queue of audit events and the thread writing them to a log file."""
+
+    def __init__(self, target_handler, queue_size):
+        """Create a new audit log. Call start to begin writing events.
+
+        @param target_handler: The handler that writes formatted events.
+        @type target_handler: logging.Handler
+        @param queue_size: The number of events that may be waiting to be
+            written before new events are dropped.
+        @type queue_size: int
+        """
+        self.target_handler = target_handler
+        self.queue = Queue.Queue(queue_size)
+        self.handler = QueueHandler(self.queue)
+        self.writer = None
+
+    def start(self):
+        """Start writing queued events in the background.
+
+        Events still queued when the interpreter exits are written first.
+        """
+        if not self.writer:
+            self.writer = threading.Thread(target=self.run_writer)
+            self.writer.daemon = True
+            self.writer.start()
+            atexit.register(self.shutdown)
+
+    def get_dropped(self):
+        """Get the number of events dropped because the queue was full.
+
+        @return: The number of dropped events.
+        @rtype: int
+        """
+        return self.handler.dropped
+
+    def shutdown(self):
+        """Write any queued events and stop the writer thread."""
+        if self.writer:
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+            self.target_handler.close()
+
+    def run_writer(self):
+        """Write queued events until given None."""
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            self.target_handler.handle(record)
+
+
+def create_audit_log(path, max_bytes, backup_count, queue_size):
+    """Create an audit log writing JSON lines to a size-rotated file.
+
+    @param path: The path of the log file.
+    @type path: str
+    @param max_bytes: The size of the log file at which it is rotated.
+    @type max_bytes: int
+    @param backup_count: The number of rotated log files to keep.
+    @type backup_count: int
+    @param queue_size: The number of events that may be waiting to be written.
+    @type queue_size: int
+    @return: The audit log. Not yet started.
+    @rtype: AuditLog
+    """
+    target_handler = logging.handlers.RotatingFileHandler(
+        path,
+        maxBytes=max_bytes,
+        backupCount=backup_count
+    )
+    target_handler.setFormatter(JSONLinesFormatter())
+    return AuditLog(target_handler, queue_size)
+
+
+def configure(application):
+    """Start the audit log for an application if one is configured.
+
+    Uses the AUDIT_LOG_PATH, AUDIT_LOG_MAX_BYTES, AUDIT_LOG_BACKUP_COUNT, and
+    AUDIT_LOG_QUEUE_SIZE configuration values. Audit logging is disabled if
+    AUDIT_LOG_PATH is not set.
+
+    @param application: The application with the audit log configuration.
+    @type application: flask.Flask
+    @return: The started audit log or None if disabled.
+    @rtype: AuditLog
+    """
+    audit_log = application.extensions.get('kpi_audit_log', None)
+    if audit_log:
+        return audit_log
+
+    config = application.config
+    path = config.get('AUDIT_LOG_PATH', None)
+    if not path:
+        return None
+
+    audit_log = create_audit_log(
+        path,
+        config.get('AUDIT_LOG_MAX_BYTES', DEFAULT_MAX_BYTES),
+        config.get('AUDIT_LOG_BACKUP_COUNT', DEFAULT_BACKUP_COUNT),
+        config.get('AUDIT_LOG_QUEUE_SIZE', DEFAULT_QUEUE_SIZE)
+    )
+    audit_log.start()
+    audit_logger.addHandler(audit_log.handler)
+    audit_logger.setLevel(logging.INFO)
+    application.extensions['kpi_audit_log'] = audit_log
+    return audit_log
+
+
+def create_event(event, fields):
+    """Create an audit event document.
+
+    Adds the remote address, method, and path of the current request if
+    called while handling a request.
+
+    @param event: The name of the event like PACKAGE_CREATE_EVENT.
+    @type event: str
+    @param fields: Additional information to record like username.
+    @type fields: dict
+    @return: The event document to log.
+    @rtype: dict
+    """
+    entry = {'event': event}
+    if flask.has_request_context():
+        entry['remote_addr'] = flask.request.remote_addr
+        entry['method'] = flask.request.method
+        entry['path'] = flask.request.path
+    entry.update(fields)
+    return entry
+
+
+def log_event(event, **fields):
+    """Log an audit event if audit logging is enabled.
+
+    Never include passwords in fields.
+
+    @param event: The name of the event like PACKAGE_CREATE_EVENT.
+    @type event: str
+    @param fields: Additional information to record like username.
+    @type fields: dict
+    """
+    if audit_logger.isEnabledFor(logging.INFO):
+        audit_logger.info(create_event(event, fields))
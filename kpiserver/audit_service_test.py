@@ -0,0 +1,88 @@
+"""Tests for the structured audit log.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import json
+import logging
+import os
+import Queue
+import shutil
+import tempfile
+import unittest
+
+import flask
+
+import audit_service
+
+
+def read_events(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+class AuditServiceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'audit.log')
+        self.app = flask.Flask(__name__)
+        self.app.config['AUDIT_LOG_PATH'] = self.path
+
+    def tearDown(self):
+        audit_log = self.app.extensions.pop('kpi_audit_log', None)
+        if audit_log:
+            audit_service.audit_logger.removeHandler(audit_log.handler)
+            audit_service.audit_logger.setLevel(logging.NOTSET)
+            audit_log.shutdown()
+        shutil.rmtree(self.directory)
+
+    def test_log_event_disabled(self):
+        audit_service.log_event(audit_service.USER_CREATE_EVENT, username='a')
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_log_event(self):
+        audit_log = audit_service.configure(self.app)
+        self.assertTrue(audit_log is audit_service.configure(self.app))
+
+        with self.app.test_request_context('/kpi/users.json', method='POST'):
+            audit_service.log_event(
+                audit_service.USER_CREATE_EVENT,
+                username='a',
+                success=True
+            )
+        audit_service.log_event(audit_service.AUTH_FAILURE_EVENT, username='b')
+        audit_log.shutdown()
+
+        events = read_events(self.path)
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[0]['event'], 'user_create')
+        self.assertEqual(events[0]['username'], 'a')
+        self.assertEqual(events[0]['method'], 'POST')
+        self.assertEqual(events[0]['path'], '/kpi/users.json')
+        self.assertTrue(events[0]['time'].endswith('Z'))
+        self.assertFalse('path' in events[1])
+
+    def test_rotation(self):
+        audit_log = audit_service.create_audit_log(self.path, 200, 2, 100)
+        audit_log.start()
+        for i in range(20):
+            record = logging.makeLogRecord({'msg': {'event': 'e', 'i': i}})
+            audit_log.handler.handle(record)
+        audit_log.shutdown()
+
+        self.assertTrue(os.path.exists(self.path + '.1'))
+        self.assertTrue(os.path.exists(self.path + '.2'))
+        self.assertFalse(os.path.exists(self.path + '.3'))
+        self.assertEqual(read_events(self.path)[-1]['i'], 19)
+
+    def test_queue_full_drops(self):
+        handler = audit_service.QueueHandler(Queue.Queue(1))
+        for i in range(3):
+            handler.handle(logging.makeLogRecord({'msg': {'event': 'e'}}))
+        self.assertEqual(handler.dropped, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
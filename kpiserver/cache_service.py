@@ -0,0 +1,280 @@
+"""HTTP caching policies and cache purging for the Kipling Package Index.
+
+Lets a CDN or reverse-proxy cache sit in front of the package index. Routes
+declare a named cache policy that becomes Cache-Control headers, cacheable
+responses are tagged with surrogate keys, and writes to a package purge that
+package's surrogate key through a pluggable purge service.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import functools
+import httplib
+import urllib2
+
+import flask
+
+SURROGATE_KEY_HEADER = 'Surrogate-Key'
+PACKAGE_SURROGATE_KEY = 'package/%s'
+DEFAULT_PURGE_TIMEOUT = 5
+
+DEFAULT_CACHE_POLICIES = {
+    'package_read': {
+        'public': True,
+        'max_age': 60,
+        'stale_while_revalidate': 300
+    },
+    'stats_read': {
+        'public': True,
+        'max_age': 300
+    },
+    'index_manifest': {
+        'public': True,
+        'max_age': 60
+    },
+    'index_file': {
+        'public': True,
+        'max_age': 31536000
+    },
+    'no_store': {
+        'no_store': True
+    }
+}
+
+
+class PurgeServiceAdapter:
+    """Interface for a service that purges content from an HTTP cache."""
+
+    def purge(self, surrogate_keys):
+        """Purge all cached responses tagged with any of the given keys.
+
+        @param surrogate_keys: The surrogate keys whose responses should be
+            removed from the cache.
+        @type surrogate_keys: list of str
+        """
+        raise NotImplementedError()
+
+
+class NullPurgeServiceAdapter(PurgeServiceAdapter):
+    """Implementation of the PurgeServiceAdapter for when there is no cache."""
+
+    def purge(self, surrogate_keys):
+        pass
+
+
+class FakePurgeServiceAdapter(PurgeServiceAdapter):
+    """Local implementation of the PurgeServiceAdapter that records purges."""
+
+    def __init__(self):
+        """Create a new adapter with no recorded purges."""
+        self.purged_keys = []
+
+    def purge(self, surrogate_keys):
+        self.purged_keys.extend(surrogate_keys)
+
+
+class HTTPPurgeServiceAdapter(PurgeServiceAdapter):
+    """Implementation of the PurgeServiceAdapter for CDN purge APIs.
+
+    Issues a POST per surrogate key to a URL template, like Fastly's
+    https://api.fastly.com/service/[service id]/purge/%s endpoint.
+    """
+
+    def __init__(self, url_template, token_header=None, token=None,
+            timeout=DEFAULT_PURGE_TIMEOUT):
+        """Create a new adapter around a CDN purge API.
+
+        @param url_template: URL to POST to with %s in place of the surrogate
+            key to purge.
+        @type url_template: str
+        @keyword token_header: The name of the header to send an API token in.
+            Defaults to None (no token sent).
+        @type token_header: str
+        @keyword token: The API token to authenticate with. Defaults to None.
+        @type token: str
+        @keyword timeout: The number of seconds to wait for the purge API.
+            Defaults to DEFAULT_PURGE_TIMEOUT.
+        @type timeout: float
+        """
+        self.url_template = url_template
+        self.token_header = token_header
+        self.token = token
+        self.timeout = timeout
+
+    def purge(self, surrogate_keys):
+        for key in surrogate_keys:
+            request = urllib2.Request(self.url_template % key, data='')
+            if self.token_header:
+                request.add_header(self.token_header, self.token)
+            urllib2.urlopen(request, timeout=self.timeout).close()
+
+
+def get_client(application):
+    """Get the purge client for the service specified by configuration.
+
+    Uses the CACHE_PURGE_BACKEND configuration value which may be 'none'
+    (default), 'fake', or 'http'. The fake client is shared across calls for an
+    application so that its recorded purges may be inspected.
+
+    @param application: The application that has the configuration values
+        necessary for interacting with the purge service.
+    @type application: flask.Flask
+    @return: Implementor of PurgeServiceAdapter
+    @rtype: PurgeServiceAdapter
+    """
+    backend = application.config.get('CACHE_PURGE_BACKEND', 'none')
+
+    if backend == 'http':
+        return HTTPPurgeServiceAdapter(
+            application.config['CACHE_PURGE_URL'],
+            application.config.get('CACHE_PURGE_TOKEN_HEADER', None),
+            application.config.get('CACHE_PURGE_TOKEN', None),
+            application.config.get(
+                'CACHE_PURGE_TIMEOUT',
+                DEFAULT_PURGE_TIMEOUT
+            )
+        )
+    elif backend == 'fake':
+        return application.extensions.setdefault(
+            'kpi_fake_purge_client',
+            FakePurgeServiceAdapter()
+        )
+    else:
+        return NullPurgeServiceAdapter()
+
+
+def get_package_surrogate_key(package_name):
+    """Get the surrogate key that tags cached responses about a package.
+
+    @param package_name: The name of the package.
+    @type package_name: str
+    @return: The surrogate key for the package.
+    @rtype: str
+    """
+    return PACKAGE_SURROGATE_KEY % package_name
+
+
+def get_package_surrogate_keys(package_name):
+    """Get the surrogate keys for a route responding with a package.
+
+    @param package_name: The name of the package as read from the url.
+    @type package_name: str
+    @return: The surrogate keys for the route's response.
+    @rtype: list of str
+    """
+    return [get_package_surrogate_key(package_name)]
+
+
+def purge_package(application, package_name):
+    """Purge cached responses about a package after it changed.
+
+    Purges happen after the change is saved so a purge service that is down
+    or slow is logged instead of failing the request. Cached responses then
+    expire on their own according to their cache policy.
+
+    @param application: The application that has the configuration values
+        necessary for interacting with the purge service.
+    @type application: flask.Flask
+    @param package_name: The name of the package that changed.
+    @type package_name: str
+    """
+    client = get_client(application)
+    try:
+        client.purge([get_package_surrogate_key(package_name)])
+    except (IOError, httplib.HTTPException), e:
+        application.logger.warning(
+            'Could not purge cached responses for %s: %s',
+            package_name,
+            e
+        )
+
+
+def get_policy(application, policy_name):
+    """Get the settings for a named cache policy.
+
+    Policies in the CACHE_POLICIES configuration value take precedence over
+    those in DEFAULT_CACHE_POLICIES.
+
+    @param application: The application with the cache configuration.
+    @type application: flask.Flask
+    @param policy_name: The name of the policy to look up.
+    @type policy_name: str
+    @return: The policy settings.
+    @rtype: dict
+    """
+    configured = application.config.get('CACHE_POLICIES', {})
+    if policy_name in configured:
+        return configured[policy_name]
+    return DEFAULT_CACHE_POLICIES[policy_name]
+
+
+def apply_cache_policy(response, policy, surrogate_keys=None):
+    """Set the caching headers on a response according to a policy.
+
+    @param response: The response to modify.
+    @type response: flask.Response
+    @param policy: The policy settings as returned by get_policy.
+    @type policy: dict
+    @keyword surrogate_keys: Keys to tag a cacheable response with. Defaults to
+        None (no keys).
+    @type surrogate_keys: list of str
+    """
+    cache_control = response.cache_control
+
+    if policy.get('no_store', False):
+        cache_control.no_store = True
+        return
+
+    if policy.get('public', False):
+        cache_control.public = True
+    if 'max_age' in policy:
+        cache_control.max_age = policy['max_age']
+    if 'stale_while_revalidate' in policy:
+        cache_control['stale-while-revalidate'] = str(
+            policy['stale_while_revalidate']
+        )
+
+    if surrogate_keys:
+        response.headers[SURROGATE_KEY_HEADER] = ' '.join(surrogate_keys)
+
+
+def cache_policy(policy_name, surrogate_keys=None):
+    """Decorator applying a named cache policy to the responses of a route.
+
+    Responses of routes using a cacheable policy also get an ETag so that
+    caches can revalidate them with conditional requests.
+
+    @param policy_name: The name of the policy to apply.
+    @type policy_name: str
+    @keyword surrogate_keys: Function that, given the keyword arguments of the
+        route, returns the surrogate keys for its responses. Defaults to None.
+    @type surrogate_keys: function
+    @return: Decorator for a route function.
+    @rtype: function
+    """
+    def decorator(route):
+
+        @functools.wraps(route)
+        def decorated_route(*args, **kwargs):
+            response = flask.make_response(route(*args, **kwargs))
+            policy = get_policy(flask.current_app, policy_name)
+
+            keys = None
+            if surrogate_keys:
+                keys = surrogate_keys(**kwargs)
+            apply_cache_policy(response, policy, keys)
+
+            if not policy.get('no_store', False):
+                accept_ranges = response.headers.get('Accept-Ranges', None)
+                response.add_etag()
+                response.make_conditional(
+                    flask.request,
+                    accept_ranges=accept_ranges == 'bytes'
+                )
+
+            return response
+
+        return decorated_route
+
+    return decorator
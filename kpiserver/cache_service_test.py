@@ -0,0 +1,120 @@
+"""Tests for HTTP caching policies and cache purging.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import unittest
+import urllib2
+
+import flask
+import mox
+
+import cache_service
+
+
+class CacheServiceTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.app = flask.Flask(__name__)
+
+    def test_get_client_default(self):
+        client = cache_service.get_client(self.app)
+        self.assertTrue(isinstance(
+            client,
+            cache_service.NullPurgeServiceAdapter
+        ))
+
+    def test_get_client_fake_shared(self):
+        self.app.config['CACHE_PURGE_BACKEND'] = 'fake'
+        client = cache_service.get_client(self.app)
+        self.assertTrue(isinstance(
+            client,
+            cache_service.FakePurgeServiceAdapter
+        ))
+        self.assertTrue(client is cache_service.get_client(self.app))
+
+    def test_purge_package(self):
+        self.app.config['CACHE_PURGE_BACKEND'] = 'fake'
+        cache_service.purge_package(self.app, 'simple_ain')
+        client = cache_service.get_client(self.app)
+        self.assertEqual(client.purged_keys, ['package/simple_ain'])
+
+    def test_http_purge(self):
+        self.mox.StubOutWithMock(urllib2, 'urlopen')
+        test_response = self.mox.CreateMockAnything()
+        urllib2.urlopen(mox.Func(
+            lambda request: request.get_full_url() == 'http://cdn/purge/a' and
+                request.get_header('Fastly-key') == 'token'
+        ), timeout=cache_service.DEFAULT_PURGE_TIMEOUT).AndReturn(test_response)
+        test_response.close()
+        self.mox.ReplayAll()
+
+        client = cache_service.HTTPPurgeServiceAdapter(
+            'http://cdn/purge/%s',
+            'Fastly-Key',
+            'token'
+        )
+        client.purge(['a'])
+
+    def test_purge_package_unavailable(self):
+        self.app.config['CACHE_PURGE_BACKEND'] = 'http'
+        self.app.config['CACHE_PURGE_URL'] = 'http://cdn/purge/%s'
+        self.app.config['CACHE_PURGE_TIMEOUT'] = 2
+        self.mox.StubOutWithMock(urllib2, 'urlopen')
+        urllib2.urlopen(mox.IgnoreArg(), timeout=2).AndRaise(
+            urllib2.URLError('timed out')
+        )
+        self.mox.ReplayAll()
+
+        cache_service.purge_package(self.app, 'simple_ain')
+
+    def test_get_policy_configured(self):
+        self.app.config['CACHE_POLICIES'] = {'package_read': {'max_age': 5}}
+        policy = cache_service.get_policy(self.app, 'package_read')
+        self.assertEqual(policy, {'max_age': 5})
+        policy = cache_service.get_policy(self.app, 'no_store')
+        self.assertEqual(policy, {'no_store': True})
+
+    def test_cache_policy_no_store(self):
+
+        @cache_service.cache_policy('no_store')
+        def route():
+            return 'body'
+
+        with self.app.test_request_context():
+            response = route()
+
+        self.assertTrue(response.cache_control.no_store)
+        self.assertEqual(response.cache_control.max_age, None)
+        self.assertFalse('ETag' in response.headers)
+
+    def test_cache_policy_cacheable(self):
+
+        @cache_service.cache_policy(
+            'package_read',
+            surrogate_keys=cache_service.get_package_surrogate_keys
+        )
+        def route(package_name):
+            return 'body'
+
+        with self.app.test_request_context():
+            response = route(package_name='simple_ain')
+
+        self.assertTrue(response.cache_control.public)
+        self.assertEqual(response.cache_control.max_age, 60)
+        self.assertEqual(
+            response.headers['Surrogate-Key'],
+            'package/simple_ain'
+        )
+        etag = response.headers['ETag']
+
+        with self.app.test_request_context(headers={'If-None-Match': etag}):
+            response = route(package_name='simple_ain')
+
+        self.assertEqual(response.status_code, 304)
+
+
+if __name__ == '__main__':
+    unittest.main()
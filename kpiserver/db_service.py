@@ -1,16 +1,65 @@
 """Interface to the package index's datastore.
 
+Package reads can be served by replica set secondaries while writes always go
+to the primary. Secondaries may lag behind the primary so reads of a package
+go to the primary for a short window after this process writes to it, letting
+a client read its own writes. Recent writes are only tracked within a process
+so a client whose requests are balanced across several server processes may
+still read a stale package from a secondary. pymongo 2.x cannot bound how
+far secondaries lag, so with it a client may also read a stale package after
+the window ends. Every package query includes the package name so that
+queries can be routed to a single shard when the collections are sharded on
+name.
+
+Every release of a package is also kept as its own document in the package
+versions collection so that version ranges can resolve to older releases than
+the current one.
+
+Usage after upgrading (for example before starting the new server):
+```python db_service.py backfill_versions``` adds parsed version fields to
+packages written before they were stored and records the current release of
+packages written before releases were kept.
+
 @author: Sam Pottinger
 @license: GNU GPL v3
 """
 
+import argparse
 import json
+import os
+import sys
+import threading
+import time
 
 import pymongo
+from pymongo import errors
+from pymongo import read_preferences
+
+import versions
 
 DATABASE_NAME = 'kpiserver'
 PACKAGES_COLLECTION_NAME = 'packages'
 USERS_COLLECTION_NAME = 'users'
+STATS_COLLECTION_NAME = 'package_stats'
+VERSIONS_COLLECTION_NAME = 'package_versions'
+
+READ_PREFERENCES = {
+    'primary': read_preferences.Primary,
+    'primaryPreferred': read_preferences.PrimaryPreferred,
+    'secondary': read_preferences.Secondary,
+    'secondaryPreferred': read_preferences.SecondaryPreferred,
+    'nearest': read_preferences.Nearest
+}
+DEFAULT_BACKEND = 'mongo'
+READ_ONLY_BACKENDS = ['memory']
+DEFAULT_READ_PREFERENCE = 'primary'
+DEFAULT_MAX_STALENESS = 90
+MAX_RECENT_WRITES = 1000
+
+REVISION_FIELD = 'revision'
+ARCHIVE_FIELD = 'archive'
+AUTHORED_FIELD = 'authored'
+ARCHIVE_UPDATES_FIELD = 'archive_updates'
 
 MINIMUM_REQUIRED_USER_FIELDS = ['username', 'password_hash', 'email']
 MINIMUM_REQUIRED_PACKAGE_FIELDS = [
@@ -32,24 +81,95 @@ ALLOWED_PACKAGE_FIELDS = [
 ]
 
 
+class PartialWriteError(Exception):
+    """Raised when only some writes of a bulk operation were applied."""
+
+    def __init__(self, message, failed_keys):
+        """Create a new error.
+
+        @param message: Description of the failure.
+        @type message: str
+        @param failed_keys: The keys of the writes that were not applied.
+        @type failed_keys: list
+        """
+        Exception.__init__(self, message)
+        self.failed_keys = failed_keys
+
+
+class ReadOnlyError(Exception):
+    """Raised when writing to a backend that only serves reads."""
+
+
 class DBAdapter:
     """Dependency inversion adapter to make db access suck less."""
 
-    def __init__(self, client):
+    def __init__(self, client, read_preference=None,
+            read_your_writes_window=DEFAULT_MAX_STALENESS):
         """Create a new database adapater around the database engine.
 
         @param client: The native database wrapper to adapt.
         @type client: flask.ext.pymongo.PyMongo
+        @keyword read_preference: Where package reads should be served from or
+            None to read from the primary. Defaults to None.
+        @type read_preference: pymongo.read_preferences.ServerMode
+        @keyword read_your_writes_window: The number of seconds after writing
+            to a package that reads of it go to the primary. Defaults to
+            DEFAULT_MAX_STALENESS.
+        @type read_your_writes_window: float
         """
         self.client = client
+        self.read_preference = read_preference
+        self.read_your_writes_window = read_your_writes_window
+        self.recent_writes = {}
+        self.recent_writes_lock = threading.Lock()
 
     def initialize_indicies(self):
-        """Initialize indicies to improve access speeds for the database."""
+        """Initialize indicies to improve access speeds for the database.
+
+        Called once when the server starts. The unique indicies on package
+        names, users, and hourly stats are what make package and user inserts
+        and stats upserts atomic so they must exist before the server handles
+        requests.
+        """
         package_collection = self.get_package_collection()
-        package_collection.ensure_index([('name', pymongo.ASCENDING)])
+        try:
+            package_collection.ensure_index(
+                [('name', pymongo.ASCENDING)],
+                unique=True
+            )
+        except errors.OperationFailure:
+            # Databases created before package names were unique have a
+            # non-unique index on name that must be replaced.
+            package_collection.drop_index([('name', pymongo.ASCENDING)])
+            package_collection.ensure_index(
+                [('name', pymongo.ASCENDING)],
+                unique=True
+            )
+        versions_collection = self.get_versions_collection()
+        versions_collection.ensure_index(
+            [('name', pymongo.ASCENDING), ('version', pymongo.ASCENDING)],
+            unique=True
+        )
+        versions_collection.ensure_index([
+            ('name', pymongo.ASCENDING),
+            (versions.VERSION_KEY_FIELD, pymongo.DESCENDING)
+        ])
 
         users_collection = self.get_users_collection()
-        users_collection.ensure_index([('username', pymongo.ASCENDING)])
+        users_collection.ensure_index(
+            [('username', pymongo.ASCENDING)],
+            unique=True
+        )
+        users_collection.ensure_index(
+            [('email', pymongo.ASCENDING)],
+            unique=True
+        )
+
+        stats_collection = self.get_stats_collection()
+        stats_collection.ensure_index(
+            [('name', pymongo.ASCENDING), ('hour', pymongo.ASCENDING)],
+            unique=True
+        )
 
     def get_database(self):
         """Get the database for the application.
@@ -68,6 +188,109 @@ class DBAdapter:
         """
         return self.get_database()[PACKAGES_COLLECTION_NAME]
 
+    def get_package_read_collection(self, package_name):
+        """Get the package collection to read a package from.
+
+        Uses the adapter's read preference unless the package was written by
+        this adapter within the read your writes window. Writes made by other
+        server processes are not seen.
+
+        @param package_name: The name of the package to be read.
+        @type package_name: str
+        @return: The mongodb database collection used to store package
+            information with the read preference to use.
+        @rtype: pymongo.collection
+        """
+        return self.with_read_preference(
+            self.get_package_collection(),
+            package_name
+        )
+
+    def get_versions_collection(self):
+        """Get the database collection for the releases of each package.
+
+        @return: The mongodb database collection with one document per
+            released version of each package.
+        @rtype: pymongo.collection
+        """
+        return self.get_database()[VERSIONS_COLLECTION_NAME]
+
+    def with_read_preference(self, collection, package_name):
+        """Apply the adapter's read preference to reads about a package.
+
+        Uses the adapter's read preference unless the package was written by
+        this adapter within the read your writes window.
+
+        @param collection: The collection to read from.
+        @type collection: pymongo.collection
+        @param package_name: The name of the package to be read.
+        @type package_name: str
+        @return: The collection with the read preference to use.
+        @rtype: pymongo.collection
+        """
+        if not self.read_preference or self.was_recently_written(package_name):
+            return collection
+        return collection.with_options(read_preference=self.read_preference)
+
+    def save_version(self, record):
+        """Keep a copy of a package record as the release of its version.
+
+        Replaces any earlier copy of the same version so that the release
+        reflects the latest metadata written for it.
+
+        @param record: The package record as written.
+        @type record: dict
+        """
+        release = dict(
+            (field, value) for field, value in record.items()
+            if field != '_id'
+        )
+        collection = self.get_versions_collection()
+        collection.replace_one(
+            {'name': release['name'], 'version': release['version']},
+            release,
+            upsert=True
+        )
+
+    def record_write(self, package_name, now=None):
+        """Send reads of a package to the primary for a while after a write.
+
+        @param package_name: The name of the package written.
+        @type package_name: str
+        @keyword now: The time of the write. Defaults to None (time.time()).
+        @type now: float
+        """
+        if not self.read_preference:
+            return
+        if now is None:
+            now = time.time()
+
+        with self.recent_writes_lock:
+            if len(self.recent_writes) >= MAX_RECENT_WRITES:
+                self.recent_writes = dict(
+                    (name, expires)
+                    for name, expires in self.recent_writes.items()
+                    if expires > now
+                )
+            expires = now + self.read_your_writes_window
+            self.recent_writes[package_name] = expires
+
+    def was_recently_written(self, package_name, now=None):
+        """Determine if a package is within the read your writes window.
+
+        @param package_name: The name of the package to check.
+        @type package_name: str
+        @keyword now: The current time. Defaults to None (time.time()).
+        @type now: float
+        @return: True if reads of the package should go to the primary.
+        @rtype: bool
+        """
+        if now is None:
+            now = time.time()
+        with self.recent_writes_lock:
+            expires = self.recent_writes.get(package_name, None)
+        return expires != None and expires > now
+
     def get_users_collection(self):
         """Get the database collection for user information.
 
@@ -76,6 +299,15 @@ class DBAdapter:
         """
         return self.get_database()[USERS_COLLECTION_NAME]
 
+    def get_stats_collection(self):
+        """Get the database collection for hourly package statistics.
+
+        @return: The mongodb database collection used to store per-package
+            per-hour event counters.
+        @rtype: pymongo.collection
+        """
+        return self.get_database()[STATS_COLLECTION_NAME]
+
     def ensure_fields(self, record, fields):
         """Ensure a record has a series of fields.
 
@@ -90,6 +322,33 @@ class DBAdapter:
             if not field in record:
                 raise ValueError('%s must be in this record.' % field)
 
+    def create_package_update(self, package_info, strict=True):
+        """Create the update document for writing package information.
+
+        Stores the version's parsed numeric components and sortable key
+        alongside the version string and increments the package's revision.
+
+        @param package_info: Dictionary with package information. Will check
+            that MINIMUM_REQUIRED_PACKAGE_FIELDS are present.
+        @type package_info: dict
+        @keyword strict: If True, the version must be major.minor.patch.
+            Otherwise versions in older formats are accepted as described in
+            versions.get_version_fields. Defaults to True.
+        @type strict: bool
+        @return: MongoDB update document.
+        @rtype: dict
+        @raise ValueError: Raised if a required field is missing or strict and
+            the version is not major.minor.patch.
+        """
+        self.ensure_fields(package_info, MINIMUM_REQUIRED_PACKAGE_FIELDS)
+        fields = dict(package_info)
+        fields.update(versions.get_version_fields(
+            package_info['version'],
+            strict
+        ))
+        fields[ARCHIVE_UPDATES_FIELD] = 0
+        return {'$set': fields, '$inc': {REVISION_FIELD: 1}}
+
     def get_package(self, package_name):
         """Get information about a specific package.
 
@@ -100,7 +359,7 @@ class DBAdapter:
             package information.
         @rtype: dict
         """
-        collection = self.get_package_collection()
+        collection = self.get_package_read_collection(package_name)
         return collection.find_one({'name': package_name})
 
     def put_package(self, package_info):
@@ -109,16 +368,301 @@ class DBAdapter:
         Adds a new record of a package in the index if a prior one does not
         exist. Otherwise, updates the prior entry. Fields not specified in the
         provided package_info but already present in the prior entry will
-        remain untouched.
+        remain untouched. Increments the package's revision.
 
         @param package_info: Dictionary with package information. Will check
             that MINIMUM_REQUIRED_PACKAGE_FIELDS are present.
         @type package_info: dict
+        @raise ValueError: Raised if a required field is missing or the version
+            is not major.minor.patch.
         """
-        self.ensure(package_info, MINIMUM_REQUIRED_PACKAGE_FIELDS)
+        update = self.create_package_update(package_info)
         name = package_info['name']
         collection = self.get_package_collection()
-        collection.update({'name':name}, {'$set': package_info}, upsert=True)
+        record = collection.find_one_and_update(
+            {'name': name},
+            update,
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        self.record_write(name)
+        self.save_version(record)
+
+    def insert_package(self, package_info):
+        """Add a new package if no package by the same name exists.
+
+        Relies on the unique index on name created by initialize_indicies so
+        that checking for a prior package and adding the new package happen
+        in a single atomic operation.
+
+        @param package_info: Dictionary with package information. Will check
+            that MINIMUM_REQUIRED_PACKAGE_FIELDS are present.
+        @type package_info: dict
+        @return: True if the package was added and False if a package with the
+            same name already exists.
+        @rtype: bool
+        @raise ValueError: Raised if a required field is missing or the version
+            is not major.minor.patch.
+        """
+        record = self.create_package_update(package_info)['$set']
+        record[REVISION_FIELD] = 1
+        collection = self.get_package_collection()
+        try:
+            collection.insert_one(record)
+        except errors.DuplicateKeyError:
+            return False
+        self.record_write(package_info['name'])
+        self.save_version(record)
+        return True
+
+    def get_latest_package_in_range(self, package_name, lower_key, upper_key):
+        """Get the newest release of a package within a version range.
+
+        Runs as a single query on the name and version key index of the
+        package versions collection so that older releases than the current
+        one can be found.
+
+        @param package_name: The name of the package to look up.
+        @type package_name: str
+        @param lower_key: The inclusive lower bound on the version key.
+        @type lower_key: int
+        @param upper_key: The exclusive upper bound on the version key or None
+            if the range has no upper bound.
+        @type upper_key: int
+        @return: The package record as of the release with the highest
+            version in the range or None if no release is in the range.
+        @rtype: dict
+        """
+        key_range = {'$gte': lower_key}
+        if upper_key != None:
+            key_range['$lt'] = upper_key
+
+        collection = self.with_read_preference(
+            self.get_versions_collection(),
+            package_name
+        )
+        return collection.find_one(
+            {'name': package_name, versions.VERSION_KEY_FIELD: key_range},
+            sort=[(versions.VERSION_KEY_FIELD, pymongo.DESCENDING)]
+        )
+
+    def is_package_author(self, package_name, username):
+        """Determine if a user is listed as an author of a package.
+
+        Checks authorship within the query itself and only returns the
+        document id so that the full package record is not transferred.
+
+        @param package_name: The name of the package to check.
+        @type package_name: str
+        @param username: The name of the user to check.
+        @type username: str
+        @return: True if the package exists and lists the user as an author
+            and False otherwise.
+        @rtype: bool
+        """
+        collection = self.get_package_collection()
+        author_filter = {'name': package_name, 'authors': username}
+        return collection.find_one(author_filter, {'_id': True}) != None
+
+    def get_user_as_author(self, username, package_name):
+        """Get a user and whether they are an author of a package in one query.
+
+        The authorship check runs as a lookup into the package collection
+        within the user query so that checking a password and authorship
+        takes a single round trip. Requires MongoDB 3.6 or later.
+
+        @param username: The name of the user to look up.
+        @type username: str
+        @param package_name: The name of the package to check.
+        @type package_name: str
+        @return: Tuple of the user's record (None if the user does not exist)
+            and True if the package exists and lists the user as an author.
+        @rtype: tuple
+        """
+        collection = self.get_users_collection()
+        results = list(collection.aggregate([
+            {'$match': {'username': username}},
+            {'$limit': 1},
+            {'$lookup': {
+                'from': PACKAGES_COLLECTION_NAME,
+                'pipeline': [
+                    {'$match': {'name': package_name, 'authors': username}},
+                    {'$project': {'_id': True}}
+                ],
+                'as': AUTHORED_FIELD
+            }}
+        ], cursor={}))
+        if not results:
+            return (None, False)
+        user_record = results[0]
+        return (user_record, len(user_record.pop(AUTHORED_FIELD)) > 0)
+
+    def update_package_as_author(self, package_name, username, package_info,
+            expected_revision=None):
+        """Update information about a package only if a user is an author.
+
+        The author check and, if given, the expected revision are part of the
+        update filter so that checking permissions, checking for concurrent
+        modification, and writing all happen in one atomic operation. Fields
+        not specified in the provided package_info but already present in the
+        prior entry will remain untouched. A name in package_info is ignored
+        so that a package cannot be renamed onto another. Versions in older
+        formats are only accepted if the package's current version is also in
+        an older format so that packages published before versions were
+        validated can still be updated. Increments the package's revision.
+
+        @param package_name: The name of the package to update.
+        @type package_name: str
+        @param username: The name of the user who must be listed as an author
+            of the package prior to the update.
+        @type username: str
+        @param package_info: Dictionary with package information. Will check
+            that MINIMUM_REQUIRED_PACKAGE_FIELDS are present.
+        @type package_info: dict
+        @keyword expected_revision: The revision the package must be at prior
+            to the update or None if any revision is acceptable. Revisions
+            that differ only by archive results saved since are also accepted
+            (see is_expected_revision). Records written before revisions were
+            tracked are at revision 0. Defaults to None.
+        @type expected_revision: int
+        @return: The package's new revision or None if the package does not
+            exist, does not list the user as an author, was not at the
+            expected revision, or has a major.minor.patch version while
+            package_info has a version in an older format.
+        @rtype: int
+        @raise ValueError: Raised if a required field is missing.
+        """
+        update = self.create_package_update(package_info, False)
+        update['$set']['name'] = package_name
+
+        update_filter = {'name': package_name, 'authors': username}
+        if expected_revision != None:
+            update_filter.update(
+                create_expected_revision_filter(expected_revision)
+            )
+        if not versions.is_valid_version(package_info['version']):
+            update_filter['version'] = {'$not': versions.VERSION_PATTERN}
+
+        collection = self.get_package_collection()
+        result = collection.find_one_and_update(
+            update_filter,
+            update,
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        if not result:
+            return None
+        self.record_write(package_name)
+        self.save_version(result)
+        return result[REVISION_FIELD]
+
+    def set_package_archive(self, package_name, version, archive_info):
+        """Save the results of processing a package's uploaded archive.
+
+        Only saves if the package is still at the version the archive was
+        uploaded for so that slow processing of an old upload cannot overwrite
+        the results for a newer one. Increments the package's revision so that
+        caches and mirrors see the change and counts the increment in
+        ARCHIVE_UPDATES_FIELD so that authors updating from the prior revision
+        do not conflict with it.
+
+        @param package_name: The name of the package the archive is for.
+        @type package_name: str
+        @param version: The version of the package the archive was uploaded
+            for.
+        @type version: str
+        @param archive_info: Validation results and metadata extracted from the
+            archive.
+        @type archive_info: dict
+        @return: True if the results were saved and False if the package no
+            longer exists or is at a different version.
+        @rtype: bool
+        """
+        update = {
+            '$set': {ARCHIVE_FIELD: archive_info},
+            '$inc': {REVISION_FIELD: 1, ARCHIVE_UPDATES_FIELD: 1}
+        }
+        version_filter = {'name': package_name, 'version': version}
+        collection = self.get_package_collection()
+        result = collection.update_one(version_filter, update)
+        self.record_write(package_name)
+        if not result.matched_count:
+            return False
+
+        self.get_versions_collection().update_one(
+            version_filter,
+            {'$set': {ARCHIVE_FIELD: archive_info}}
+        )
+        return True
+
+    def backfill_version_fields(self):
+        """Add derived version fields to packages written before they existed.
+
+        Versions are parsed as by versions.get_version_fields without strict
+        validation. Revisions are unchanged since the packages themselves are
+        unchanged.
+
+        @return: The number of packages updated.
+        @rtype: int
+        """
+        collection = self.get_package_collection()
+        missing = collection.find(
+            {versions.VERSION_KEY_FIELD: {'$exists': False}},
+            {'version': True}
+        )
+
+        updated = 0
+        for record in missing:
+            version = record.get('version', None)
+            fields = versions.get_version_fields(version or '', False)
+            result = collection.update_one(
+                {'_id': record['_id'], 'version': version},
+                {'$set': fields}
+            )
+            updated += result.matched_count
+        return updated
+
+    def backfill_package_versions(self):
+        """Keep the current release of packages written before releases were.
+
+        Releases already kept are left unchanged.
+
+        @return: The number of releases added.
+        @rtype: int
+        """
+        versions_collection = self.get_versions_collection()
+        added = 0
+        for record in self.get_package_collection().find({}, {'_id': False}):
+            result = versions_collection.update_one(
+                {'name': record['name'], 'version': record['version']},
+                {'$setOnInsert': record},
+                upsert=True
+            )
+            if result.upserted_id != None:
+                added += 1
+        return added
+
+    def delete_package_as_author(self, package_name, username):
+        """Delete a package only if a user is listed as an author.
+
+        @param package_name: The name of the package to delete.
+        @type package_name: str
+        @param username: The name of the user who must be listed as an author
+            of the package.
+        @type username: str
+        @return: True if the package was deleted and False if the package does
+            not exist or does not list the user as an author.
+        @rtype: bool
+        """
+        collection = self.get_package_collection()
+        result = collection.delete_one(
+            {'name': package_name, 'authors': username}
+        )
+        self.record_write(package_name)
+        if result.deleted_count != 1:
+            return False
+
+        self.get_versions_collection().delete_many({'name': package_name})
+        return True
 
     def delete_package(self, package_name):
         """Delete a package already in the index if it is in the index.
@@ -131,6 +675,20 @@ class DBAdapter:
         """
         collection = self.get_package_collection()
         collection.remove({'name': package_name})
+        self.get_versions_collection().delete_many({'name': package_name})
+        self.record_write(package_name)
+
+    def get_packages(self):
+        """Get information about every package in the index.
+
+        Reads from the primary so that exports of the whole index include
+        every write.
+
+        @return: The record of each package without database ids.
+        @rtype: iterable of dict
+        """
+        collection = self.get_package_collection()
+        return collection.find({}, {'_id': False})
 
     def get_user(self, username):
         """Get information about a specific user.
@@ -174,11 +732,352 @@ class DBAdapter:
             MINIMUM_REQUIRED_USER_FIELDS are present in this record.
         @type user_info: dict
         """
-        self.ensure(user_info, MINIMUM_REQUIRED_USER_FIELDS)
+        self.ensure_fields(user_info, MINIMUM_REQUIRED_USER_FIELDS)
         username = user_info['username']
-        collection = self.get_user_collection()
+        collection = self.get_users_collection()
         collection.update(
             {'username':username},
             {'$set': user_info},
             upsert=True
         )
+
+    def insert_user(self, user_info):
+        """Add a new user if no user by the same username or email exists.
+
+        Relies on the unique indicies created by initialize_indicies so that
+        checking for a prior user and adding the new user happen in a single
+        atomic operation.
+
+        @param user_info: Record of the user to add. This will check that
+            MINIMUM_REQUIRED_USER_FIELDS are present in this record.
+        @type user_info: dict
+        @return: True if the user was added and False if a user with the same
+            username or email address already exists.
+        @rtype: bool
+        """
+        self.ensure_fields(user_info, MINIMUM_REQUIRED_USER_FIELDS)
+        collection = self.get_users_collection()
+        try:
+            collection.insert_one(user_info)
+        except errors.DuplicateKeyError:
+            return False
+        return True
+
+    def find_existing_users(self, usernames, emails):
+        """Find users that have any of the given usernames or email addresses.
+
+        Checks all of the usernames and email addresses in a single query.
+
+        @param usernames: The usernames to look for.
+        @type usernames: list of str
+        @param emails: The email addresses to look for.
+        @type emails: list of str
+        @return: The username and email of each matching user.
+        @rtype: list of dict
+        """
+        collection = self.get_users_collection()
+        return list(collection.find(
+            {'$or': [
+                {'username': {'$in': usernames}},
+                {'email': {'$in': emails}}
+            ]},
+            {'_id': False, 'username': True, 'email': True}
+        ))
+
+    def insert_users(self, users_info):
+        """Add many new users in a single bulk write.
+
+        Users whose username or email address is already taken are skipped
+        without stopping the other inserts.
+
+        @param users_info: Records of the users to add. This will check that
+            MINIMUM_REQUIRED_USER_FIELDS are present in each record.
+        @type users_info: list of dict
+        @return: The usernames of the users that were added.
+        @rtype: list of str
+        """
+        for user_info in users_info:
+            self.ensure_fields(user_info, MINIMUM_REQUIRED_USER_FIELDS)
+        if not users_info:
+            return []
+
+        collection = self.get_users_collection()
+        try:
+            collection.insert_many(users_info, ordered=False)
+        except errors.BulkWriteError, e:
+            failed = set(error['index'] for error in e.details['writeErrors'])
+        else:
+            failed = set()
+
+        return [
+            user_info['username']
+            for index, user_info in enumerate(users_info)
+            if not index in failed
+        ]
+
+    def update_user(self, username, user_info):
+        """Update fields of an existing user and get the updated record.
+
+        Fields not specified in user_info but already present in the prior
+        record will remain untouched. Does nothing if the user does not exist.
+
+        @param username: The name of the user to update.
+        @type username: str
+        @param user_info: The fields to set on the user's record.
+        @type user_info: dict
+        @return: Record of the user after the update or None if no matching
+            user found.
+        @rtype: dict
+        """
+        collection = self.get_users_collection()
+        return collection.find_one_and_update(
+            {'username': username},
+            {'$set': user_info},
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+
+    def add_package_stats(self, counts):
+        """Add to the hourly event counters of many packages at once.
+
+        Sends every counter in a single unordered bulk write, creating
+        counters that do not exist yet.
+
+        @param counts: Dictionary mapping (package name, start of hour in
+            seconds since epoch) to a dictionary of event name to the number of
+            events to add.
+        @type counts: dict
+        @raise PartialWriteError: Raised with the keys of the counters that
+            were not written if only some were.
+        """
+        if not counts:
+            return
+
+        keys = sorted(counts.keys())
+        requests = [
+            pymongo.UpdateOne(
+                {'name': package_name, 'hour': hour},
+                {'$inc': counts[(package_name, hour)]},
+                upsert=True
+            )
+            for package_name, hour in keys
+        ]
+        collection = self.get_stats_collection()
+        try:
+            collection.bulk_write(requests, ordered=False)
+        except errors.BulkWriteError, e:
+            write_errors = e.details.get('writeErrors', [])
+            raise PartialWriteError(
+                'Failed to write %d counters.' % len(write_errors),
+                [keys[write_error['index']] for write_error in write_errors]
+            )
+
+    def get_package_stats(self, package_name, since_hour):
+        """Get the hourly event counters for a package.
+
+        @param package_name: The name of the package to get counters for.
+        @type package_name: str
+        @param since_hour: The start of the earliest hour to include in
+            seconds since epoch.
+        @type since_hour: int
+        @return: Counters in order of hour each with hour and a count for each
+            event recorded that hour.
+        @rtype: list of dict
+        """
+        collection = self.get_stats_collection()
+        if self.read_preference:
+            collection = collection.with_options(
+                read_preference=self.read_preference
+            )
+        return list(collection.find(
+            {'name': package_name, 'hour': {'$gte': since_hour}},
+            {'_id': False, 'name': False},
+            sort=[('hour', pymongo.ASCENDING)]
+        ))
+
+
+def is_expected_revision(record, expected_revision):
+    """Determine if a package is still at the revision a client expects.
+
+    Saving archive results also increments a package's revision. Revisions
+    from the last metadata write up to the current revision differ only by
+    archive results, so any of them is accepted.
+
+    @param record: The current package record.
+    @type record: dict
+    @param expected_revision: The revision the client expects or None if any
+        revision is acceptable.
+    @type expected_revision: int
+    @return: True if the package's metadata is unchanged since the expected
+        revision.
+    @rtype: bool
+    """
+    if expected_revision == None:
+        return True
+    revision = record.get(REVISION_FIELD, None) or 0
+    archive_updates = record.get(ARCHIVE_UPDATES_FIELD, None) or 0
+    return revision - archive_updates <= expected_revision <= revision
+
+
+def create_expected_revision_filter(expected_revision):
+    """Create the MongoDB query equivalent of is_expected_revision.
+
+    @param expected_revision: The revision the client expects.
+    @type expected_revision: int
+    @return: Query fields to add to a package filter.
+    @rtype: dict
+    """
+    revision = {'$ifNull': ['$' + REVISION_FIELD, 0]}
+    archive_updates = {'$ifNull': ['$' + ARCHIVE_UPDATES_FIELD, 0]}
+    metadata_revision = {'$subtract': [revision, archive_updates]}
+    return {'$expr': {'$and': [
+        {'$lte': [metadata_revision, expected_revision]},
+        {'$gte': [revision, expected_revision]}
+    ]}}
+
+
+def create_read_preference(application, mode, max_staleness):
+    """Create a read preference that bounds how stale secondary reads may be.
+
+    Versions of pymongo before 3.4, including every pymongo 2.x release, have
+    no max_staleness option. With those versions the staleness bound is
+    ignored: the mode is used without a bound and a warning is logged as
+    secondaries may then lag by more than the read your writes window.
+
+    @param application: The application whose logger reports an unbounded
+        read preference.
+    @type application: flask.Flask
+    @param mode: The name of the read preference like secondaryPreferred.
+    @type mode: str
+    @param max_staleness: The maximum number of seconds a secondary may lag
+        the primary and still serve reads.
+    @type max_staleness: float
+    @return: The read preference or None if reads should go to the primary.
+    @rtype: pymongo.read_preferences.ServerMode
+    @raise ValueError: Raised if the mode is not recognized.
+    """
+    if not mode in READ_PREFERENCES:
+        raise ValueError('Unknown read preference %s.' % mode)
+    if mode == 'primary':
+        return None
+
+    try:
+        return READ_PREFERENCES[mode](max_staleness=max_staleness)
+    except TypeError:
+        application.logger.warning(
+            'pymongo %s cannot bound staleness so %s reads may lag by more '
+            'than %s seconds.',
+            pymongo.version,
+            mode,
+            max_staleness
+        )
+        return READ_PREFERENCES[mode]()
+
+
+def is_read_only(application):
+    """Determine if an application's configured backend rejects writes.
+
+    @param application: The application with the database configuration.
+    @type application: flask.Flask
+    @return: True if the DB_BACKEND configuration value is a backend like
+        memory that only serves reads.
+    @rtype: bool
+    """
+    backend = application.config.get('DB_BACKEND', DEFAULT_BACKEND)
+    return backend in READ_ONLY_BACKENDS
+
+
+def create_adapter(application, client=None):
+    """Create a database adapter for an application's configured backend.
+
+    Uses the DB_BACKEND configuration value (mongo, sqlite, or memory). The
+    mongo backend uses the DB_READ_PREFERENCE and DB_MAX_STALENESS
+    configuration values, the sqlite backend uses SQLITE_DB_PATH and
+    SQLITE_POOL_SIZE, and the read only memory backend for mirrors uses
+    MEMORY_SNAPSHOT_PATH, MEMORY_JOURNAL_PATH, and MEMORY_REFRESH_INTERVAL.
+
+    @param application: The application with the database configuration.
+    @type application: flask.Flask
+    @keyword client: The native database wrapper to adapt. Only used by the
+        mongo backend. Defaults to None.
+    @type client: flask.ext.pymongo.PyMongo
+    @return: The new adapter.
+    @rtype: DBAdapter
+    @raise ValueError: Raised if the backend is not recognized.
+    """
+    config = application.config
+    backend = config.get('DB_BACKEND', DEFAULT_BACKEND)
+    if backend == 'sqlite':
+        import sqlite_db_service
+        return sqlite_db_service.SQLiteDBAdapter(
+            config.get('SQLITE_DB_PATH', sqlite_db_service.DEFAULT_DB_PATH),
+            config.get('SQLITE_POOL_SIZE', sqlite_db_service.DEFAULT_POOL_SIZE)
+        )
+    elif backend == 'memory':
+        import memory_db_service
+        return memory_db_service.MemoryDBAdapter(
+            config.get(
+                'MEMORY_SNAPSHOT_PATH',
+                memory_db_service.DEFAULT_SNAPSHOT_PATH
+            ),
+            config.get('MEMORY_JOURNAL_PATH', None),
+            config.get(
+                'MEMORY_REFRESH_INTERVAL',
+                memory_db_service.DEFAULT_REFRESH_INTERVAL
+            )
+        )
+    elif backend != 'mongo':
+        raise ValueError('Unknown database backend %s.' % backend)
+
+    max_staleness = config.get('DB_MAX_STALENESS', DEFAULT_MAX_STALENESS)
+    read_preference = create_read_preference(
+        application,
+        config.get('DB_READ_PREFERENCE', DEFAULT_READ_PREFERENCE),
+        max_staleness
+    )
+    return DBAdapter(client, read_preference, max_staleness)
+
+
+def create_command_adapter(application):
+    """Create the database adapter for a command run outside of the server.
+
+    Must be called and used within the application's context.
+
+    @param application: The application with the database configuration.
+    @type application: flask.Flask
+    @return: The new adapter.
+    @rtype: DBAdapter
+    """
+    if application.config.get('DB_BACKEND', DEFAULT_BACKEND) == 'mongo':
+        from flask.ext.pymongo import PyMongo
+        client = PyMongo(application)
+    else:
+        client = None
+    return create_adapter(application, client)
+
+
+def main():
+    """Run database maintenance from the command line.
+
+    @return: Exit status.
+    @rtype: int
+    """
+    parser = argparse.ArgumentParser(description='Maintain the database.')
+    parser.add_argument('command', choices=['backfill_versions'])
+    parser.add_argument('--config', default='kpiserver.cfg')
+    args = parser.parse_args()
+
+    import flask
+
+    app = flask.Flask(__name__)
+    app.config.from_pyfile(os.path.abspath(args.config))
+    with app.app_context():
+        db_adapter = create_command_adapter(app)
+        count = db_adapter.backfill_version_fields()
+        releases = db_adapter.backfill_package_versions()
+    print 'Added version fields to %d packages.' % count
+    print 'Added %d releases.' % releases
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1168 @@
+"""Tests for the interface to the package index's datastore.
+
+Each expected call on a mock collection is a round trip to the database so
+these tests also verify how many round trips each operation takes.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import copy
+import os
+import time
+import unittest
+
+import flask
+import mox
+import pymongo
+from pymongo import collection
+from pymongo import errors
+from pymongo import read_preferences
+
+import db_service
+import versions
+
+TEST_USERNAME = 'username'
+TEST_EMAIL = 'test@example.com'
+TEST_USER = {
+    'username': TEST_USERNAME,
+    'email': TEST_EMAIL,
+    'password_hash': 'hash'
+}
+TEST_PACKAGE_NAME = 'package'
+TEST_PACKAGE = {
+    'authors': [TEST_USERNAME],
+    'license': 'MIT',
+    'name': TEST_PACKAGE_NAME,
+    'humanName': 'Package',
+    'version': '1.2.3'
+}
+TEST_AUTHOR_FILTER = {'name': TEST_PACKAGE_NAME, 'authors': TEST_USERNAME}
+TEST_PACKAGE_FIELDS = dict(TEST_PACKAGE)
+TEST_PACKAGE_FIELDS['version_parts'] = [1, 2, 3]
+TEST_PACKAGE_FIELDS['version_key'] = versions.create_version_key([1, 2, 3])
+TEST_PACKAGE_FIELDS['archive_updates'] = 0
+TEST_PACKAGE_UPDATE = {'$set': TEST_PACKAGE_FIELDS, '$inc': {'revision': 1}}
+
+
+class FakeWriteResult:
+    """Stand-in for the result of a pymongo write operation."""
+
+    def __init__(self, matched_count=0, deleted_count=0, upserted_id=None):
+        self.matched_count = matched_count
+        self.deleted_count = deleted_count
+        self.upserted_id = upserted_id
+
+
+MONGO_TEST_URI = os.environ.get('KPI_MONGO_TEST_URI', None)
+
+
+def create_contract_package(version, authors=None):
+    return dict(TEST_PACKAGE, version=version, authors=authors or ['author'])
+
+
+def create_legacy_record(version):
+    record = create_contract_package(version)
+    record.update(versions.get_version_fields(version, False))
+    record['archive_updates'] = 0
+    record['revision'] = 1
+    return record
+
+
+def create_contract_user(username, email=None):
+    return {
+        'username': username,
+        'email': email or username + '@example.com',
+        'password_hash': 'hash'
+    }
+
+
+class DBAdapterContract:
+    """Behavior every DBAdapter implementation must share.
+
+    Mix into a unittest.TestCase that implements create_adapter and
+    put_legacy_record, which writes a record as it was stored before versions
+    were validated.
+    """
+
+    def setUp(self):
+        self.adapter = self.create_adapter()
+
+    def test_contract_packages(self):
+        self.adapter.put_package(create_contract_package('1.0.0'))
+        self.adapter.put_package(create_contract_package('1.0.1'))
+
+        package = self.adapter.get_package(TEST_PACKAGE_NAME)
+        self.assertEqual(package['version'], '1.0.1')
+        self.assertEqual(package['revision'], 2)
+        self.assertEqual(self.adapter.get_package('missing'), None)
+
+        self.assertEqual(
+            self.adapter.get_latest_package_in_range(
+                TEST_PACKAGE_NAME,
+                *versions.parse_range('^1.0')
+            )['version'],
+            '1.0.1'
+        )
+        self.assertEqual(
+            self.adapter.get_latest_package_in_range(
+                TEST_PACKAGE_NAME,
+                *versions.parse_range('>=1.0.2')
+            ),
+            None
+        )
+
+        self.adapter.delete_package(TEST_PACKAGE_NAME)
+        self.assertEqual(self.adapter.get_package(TEST_PACKAGE_NAME), None)
+
+    def test_contract_insert_package(self):
+        self.assertTrue(self.adapter.insert_package(
+            create_contract_package('1.0.0')
+        ))
+        self.assertFalse(self.adapter.insert_package(
+            create_contract_package('2.0.0', ['other'])
+        ))
+
+        package = self.adapter.get_package(TEST_PACKAGE_NAME)
+        self.assertEqual(package['version'], '1.0.0')
+        self.assertEqual(package['authors'], ['author'])
+        self.assertEqual(package['revision'], 1)
+        self.assertTrue(self.adapter.is_package_author(
+            TEST_PACKAGE_NAME,
+            'author'
+        ))
+
+    def test_contract_as_author(self):
+        self.adapter.put_package(create_contract_package('1.0.0'))
+        new_info = create_contract_package('1.0.1', ['author', 'other'])
+
+        self.assertTrue(self.adapter.is_package_author(
+            TEST_PACKAGE_NAME,
+            'author'
+        ))
+        self.assertFalse(self.adapter.is_package_author(
+            TEST_PACKAGE_NAME,
+            'other'
+        ))
+        self.assertEqual(
+            self.adapter.update_package_as_author(
+                TEST_PACKAGE_NAME,
+                'other',
+                new_info
+            ),
+            None
+        )
+        self.assertEqual(
+            self.adapter.update_package_as_author(
+                TEST_PACKAGE_NAME,
+                'author',
+                new_info,
+                1
+            ),
+            2
+        )
+        self.assertTrue(self.adapter.is_package_author(
+            TEST_PACKAGE_NAME,
+            'other'
+        ))
+        self.assertEqual(
+            self.adapter.update_package_as_author(
+                TEST_PACKAGE_NAME,
+                'author',
+                new_info,
+                1
+            ),
+            None
+        )
+
+        self.assertFalse(self.adapter.delete_package_as_author(
+            TEST_PACKAGE_NAME,
+            'missing'
+        ))
+        self.assertTrue(self.adapter.delete_package_as_author(
+            TEST_PACKAGE_NAME,
+            'other'
+        ))
+        self.assertEqual(self.adapter.get_package(TEST_PACKAGE_NAME), None)
+
+    def test_contract_update_keeps_name(self):
+        self.adapter.put_package(create_contract_package('1.0.0'))
+        other_package = dict(
+            create_contract_package('2.0.0', ['other']),
+            name='other_package'
+        )
+        self.adapter.put_package(other_package)
+
+        renamed = dict(
+            create_contract_package('1.0.1'),
+            name='other_package'
+        )
+        self.assertEqual(
+            self.adapter.update_package_as_author(
+                TEST_PACKAGE_NAME,
+                'author',
+                renamed
+            ),
+            2
+        )
+
+        package = self.adapter.get_package(TEST_PACKAGE_NAME)
+        self.assertEqual(package['name'], TEST_PACKAGE_NAME)
+        self.assertEqual(package['version'], '1.0.1')
+        package = self.adapter.get_package('other_package')
+        self.assertEqual(package['version'], '2.0.0')
+        self.assertEqual(package['authors'], ['other'])
+
+    def test_contract_update_legacy_version(self):
+        self.adapter.put_package(create_contract_package('1.0.0'))
+
+        self.assertEqual(
+            self.adapter.update_package_as_author(
+                TEST_PACKAGE_NAME,
+                'author',
+                create_contract_package('1.2-beta')
+            ),
+            None
+        )
+        self.assertEqual(
+            self.adapter.get_package(TEST_PACKAGE_NAME)['version'],
+            '1.0.0'
+        )
+
+    def test_contract_update_legacy_package(self):
+        self.put_legacy_record(create_legacy_record('1.1'))
+
+        self.assertEqual(
+            self.adapter.update_package_as_author(
+                TEST_PACKAGE_NAME,
+                'author',
+                create_contract_package('1.2-beta')
+            ),
+            2
+        )
+        self.assertEqual(
+            self.adapter.get_latest_package_in_range(
+                TEST_PACKAGE_NAME,
+                *versions.parse_range('^1.2')
+            )['version'],
+            '1.2-beta'
+        )
+
+        self.adapter.update_package_as_author(
+            TEST_PACKAGE_NAME,
+            'author',
+            create_contract_package('latest')
+        )
+        self.assertEqual(
+            self.adapter.get_package(TEST_PACKAGE_NAME)['version'],
+            'latest'
+        )
+        self.assertEqual(
+            self.adapter.get_latest_package_in_range(
+                TEST_PACKAGE_NAME,
+                *versions.parse_range('*')
+            )['version'],
+            '1.2-beta'
+        )
+
+    def test_contract_resolve_older_release(self):
+        self.adapter.put_package(create_contract_package('1.2.0'))
+        self.adapter.put_package(create_contract_package('1.3.0'))
+        self.assertEqual(
+            self.adapter.update_package_as_author(
+                TEST_PACKAGE_NAME,
+                'author',
+                create_contract_package('2.0.0')
+            ),
+            3
+        )
+
+        self.assertEqual(
+            self.adapter.get_latest_package_in_range(
+                TEST_PACKAGE_NAME,
+                *versions.parse_range('^1.2')
+            )['version'],
+            '1.3.0'
+        )
+        self.assertEqual(
+            self.adapter.get_latest_package_in_range(
+                TEST_PACKAGE_NAME,
+                *versions.parse_range('~1.2.0')
+            )['version'],
+            '1.2.0'
+        )
+        self.assertEqual(
+            self.adapter.get_latest_package_in_range(
+                TEST_PACKAGE_NAME,
+                *versions.parse_range('*')
+            )['version'],
+            '2.0.0'
+        )
+
+        self.assertTrue(self.adapter.delete_package_as_author(
+            TEST_PACKAGE_NAME,
+            'author'
+        ))
+        self.assertEqual(
+            self.adapter.get_latest_package_in_range(
+                TEST_PACKAGE_NAME,
+                *versions.parse_range('*')
+            ),
+            None
+        )
+
+    def test_contract_archive_does_not_conflict(self):
+        self.adapter.put_package(create_contract_package('1.0.0'))
+        self.adapter.set_package_archive(
+            TEST_PACKAGE_NAME,
+            '1.0.0',
+            {'status': 'valid'}
+        )
+
+        self.assertEqual(
+            self.adapter.update_package_as_author(
+                TEST_PACKAGE_NAME,
+                'author',
+                create_contract_package('1.0.1'),
+                1
+            ),
+            3
+        )
+        self.assertEqual(
+            self.adapter.update_package_as_author(
+                TEST_PACKAGE_NAME,
+                'author',
+                create_contract_package('1.0.2'),
+                2
+            ),
+            None
+        )
+
+    def test_contract_get_user_as_author(self):
+        self.adapter.insert_user(create_contract_user('author'))
+        self.adapter.insert_user(create_contract_user('other'))
+        self.adapter.put_package(create_contract_package('1.0.0'))
+
+        user, is_author = self.adapter.get_user_as_author(
+            'author',
+            TEST_PACKAGE_NAME
+        )
+        self.assertEqual(user['email'], 'author@example.com')
+        self.assertTrue(is_author)
+        user, is_author = self.adapter.get_user_as_author(
+            'other',
+            TEST_PACKAGE_NAME
+        )
+        self.assertEqual(user['username'], 'other')
+        self.assertFalse(is_author)
+        self.assertEqual(
+            self.adapter.get_user_as_author('author', 'missing')[1],
+            False
+        )
+        self.assertEqual(
+            self.adapter.get_user_as_author('missing', TEST_PACKAGE_NAME),
+            (None, False)
+        )
+
+    def test_contract_get_packages(self):
+        self.assertEqual(list(self.adapter.get_packages()), [])
+        self.adapter.put_package(create_contract_package('1.0.0'))
+        self.adapter.put_package(dict(
+            create_contract_package('2.0.0'),
+            name='other'
+        ))
+
+        packages = sorted(
+            self.adapter.get_packages(),
+            key=lambda package: package['name']
+        )
+        self.assertEqual(
+            [(package['name'], package['version']) for package in packages],
+            [('other', '2.0.0'), (TEST_PACKAGE_NAME, '1.0.0')]
+        )
+
+    def test_contract_set_package_archive(self):
+        self.adapter.put_package(create_contract_package('1.0.0'))
+
+        self.assertFalse(self.adapter.set_package_archive(
+            TEST_PACKAGE_NAME,
+            '0.9.0',
+            {'status': 'valid'}
+        ))
+        self.assertTrue(self.adapter.set_package_archive(
+            TEST_PACKAGE_NAME,
+            '1.0.0',
+            {'status': 'valid'}
+        ))
+
+        package = self.adapter.get_package(TEST_PACKAGE_NAME)
+        self.assertEqual(package['archive'], {'status': 'valid'})
+        self.assertEqual(package['revision'], 2)
+
+    def test_contract_users(self):
+        self.assertTrue(self.adapter.insert_user(create_contract_user('a')))
+        self.assertFalse(self.adapter.insert_user(create_contract_user('a')))
+        self.assertFalse(self.adapter.insert_user(
+            create_contract_user('b', 'a@example.com')
+        ))
+
+        self.assertEqual(
+            self.adapter.get_user_by_email('a@example.com')['username'],
+            'a'
+        )
+        updated = self.adapter.update_user('a', {'password_hash': 'new'})
+        self.assertEqual(updated['password_hash'], 'new')
+        self.assertEqual(updated['email'], 'a@example.com')
+        self.assertEqual(self.adapter.update_user('missing', {}), None)
+
+        self.adapter.put_user(create_contract_user('c'))
+        self.assertEqual(self.adapter.get_user('c')['email'], 'c@example.com')
+        self.assertEqual(self.adapter.get_user('missing'), None)
+
+    def test_contract_bulk_users(self):
+        self.adapter.insert_user(create_contract_user('a'))
+
+        existing = self.adapter.find_existing_users(
+            ['b', 'c'],
+            ['a@example.com']
+        )
+        self.assertEqual(
+            [user['username'] for user in existing],
+            ['a']
+        )
+
+        inserted = self.adapter.insert_users([
+            create_contract_user('a'),
+            create_contract_user('b'),
+            create_contract_user('c')
+        ])
+        self.assertEqual(inserted, ['b', 'c'])
+        self.assertEqual(self.adapter.get_user('c')['username'], 'c')
+
+    def test_contract_stats(self):
+        self.adapter.add_package_stats({
+            (TEST_PACKAGE_NAME, 3600): {'reads': 1},
+            (TEST_PACKAGE_NAME, 7200): {'reads': 2, 'downloads': 1},
+            ('other', 7200): {'reads': 5}
+        })
+        self.adapter.add_package_stats({
+            (TEST_PACKAGE_NAME, 7200): {'reads': 1}
+        })
+
+        self.assertEqual(
+            self.adapter.get_package_stats(TEST_PACKAGE_NAME, 0),
+            [
+                {'hour': 3600, 'reads': 1},
+                {'hour': 7200, 'reads': 3, 'downloads': 1}
+            ]
+        )
+        self.assertEqual(
+            len(self.adapter.get_package_stats(TEST_PACKAGE_NAME, 7200)),
+            1
+        )
+
+
+class MongoClientWrapper:
+    """Stand-in for flask.ext.pymongo.PyMongo around a database."""
+
+    def __init__(self, database):
+        self.db = database
+
+
+@unittest.skipUnless(MONGO_TEST_URI, 'KPI_MONGO_TEST_URI is not set.')
+class MongoDBAdapterContractTests(DBAdapterContract, unittest.TestCase):
+
+    def create_adapter(self):
+        self.native_client = pymongo.MongoClient(MONGO_TEST_URI)
+        adapter = db_service.DBAdapter(
+            MongoClientWrapper(self.native_client.get_default_database())
+        )
+        self.drop_collections(adapter)
+        adapter.initialize_indicies()
+        return adapter
+
+    def put_legacy_record(self, record):
+        self.adapter.get_package_collection().insert_one(dict(record))
+        self.adapter.save_version(record)
+
+    def drop_collections(self, adapter):
+        adapter.get_package_collection().drop()
+        adapter.get_versions_collection().drop()
+        adapter.get_users_collection().drop()
+        adapter.get_stats_collection().drop()
+
+    def tearDown(self):
+        self.drop_collections(self.adapter)
+        self.native_client.close()
+
+
+class LocalReplicaSetCollection:
+    """Stand-in for a package collection on a replica set.
+
+    Writes go to the primary and only reach the secondary when replicate is
+    called. Reads use the secondary if a secondary read preference is set.
+    """
+
+    def __init__(self, primary=None, secondary=None, read_preference=None):
+        self.primary = primary if primary != None else {}
+        self.secondary = secondary if secondary != None else {}
+        self.read_preference = read_preference
+
+    def replicate(self):
+        self.secondary.clear()
+        self.secondary.update(copy.deepcopy(self.primary))
+
+    def with_options(self, read_preference=None):
+        return LocalReplicaSetCollection(
+            self.primary,
+            self.secondary,
+            read_preference
+        )
+
+    def find_one(self, query, *args, **kwargs):
+        use_secondary = self.read_preference is not None and \
+            self.read_preference.name != 'Primary'
+        records = self.secondary if use_secondary else self.primary
+        record = records.get(query['name'], None)
+        return copy.deepcopy(record)
+
+    def find_one_and_update(self, query, update, upsert=False,
+            return_document=None):
+        record = self.primary.setdefault(query['name'], {})
+        record.update(update['$set'])
+        for field, amount in update['$inc'].items():
+            record[field] = record.get(field, 0) + amount
+        return copy.deepcopy(record)
+
+    def replace_one(self, query, replacement, upsert=False):
+        self.primary[query['name']] = copy.deepcopy(replacement)
+
+
+class ReplicaRoutingTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.collection = LocalReplicaSetCollection()
+        self.adapter = db_service.DBAdapter(
+            None,
+            read_preferences.SecondaryPreferred(),
+            10
+        )
+        self.versions_collection = LocalReplicaSetCollection()
+        self.mox.StubOutWithMock(self.adapter, 'get_package_collection')
+        self.stubs.Set(
+            self.adapter,
+            'get_versions_collection',
+            lambda: self.versions_collection
+        )
+        self.adapter.get_package_collection().MultipleTimes().AndReturn(
+            self.collection
+        )
+        self.mox.ReplayAll()
+
+    def test_reads_from_secondary(self):
+        self.collection.primary[TEST_PACKAGE_NAME] = {'version': '1.0.0'}
+        self.assertEqual(self.adapter.get_package(TEST_PACKAGE_NAME), None)
+
+        self.collection.replicate()
+        self.assertEqual(
+            self.adapter.get_package(TEST_PACKAGE_NAME)['version'],
+            '1.0.0'
+        )
+
+    def test_read_your_writes(self):
+        self.adapter.put_package(TEST_PACKAGE)
+        self.assertEqual(
+            self.adapter.get_package(TEST_PACKAGE_NAME)['version'],
+            TEST_PACKAGE['version']
+        )
+        self.assertTrue(self.adapter.was_recently_written(TEST_PACKAGE_NAME))
+        self.assertFalse(self.adapter.was_recently_written(
+            TEST_PACKAGE_NAME,
+            time.time() + 11
+        ))
+
+    def test_read_your_writes_expires(self):
+        self.adapter.record_write(TEST_PACKAGE_NAME, time.time() - 11)
+        self.collection.primary[TEST_PACKAGE_NAME] = {'version': '1.0.0'}
+        self.assertEqual(self.adapter.get_package(TEST_PACKAGE_NAME), None)
+
+
+class DBServiceTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.adapter = db_service.DBAdapter(None)
+        self.users_collection = self.mox.CreateMock(collection.Collection)
+        self.packages_collection = self.mox.CreateMock(collection.Collection)
+        self.mox.StubOutWithMock(self.adapter, 'get_users_collection')
+        self.mox.StubOutWithMock(self.adapter, 'get_package_collection')
+        self.stats_collection = self.mox.CreateMock(collection.Collection)
+        self.mox.StubOutWithMock(self.adapter, 'get_stats_collection')
+        self.versions_collection = self.mox.CreateMock(collection.Collection)
+        self.mox.StubOutWithMock(self.adapter, 'get_versions_collection')
+
+    def expect_save_version(self, record):
+        release = dict(record)
+        release.pop('_id', None)
+        self.adapter.get_versions_collection().AndReturn(
+            self.versions_collection
+        )
+        self.versions_collection.replace_one(
+            {'name': release['name'], 'version': release['version']},
+            release,
+            upsert=True
+        )
+
+    def test_get_packages(self):
+        self.adapter.get_package_collection().AndReturn(
+            self.packages_collection
+        )
+        self.packages_collection.find({}, {'_id': False}).AndReturn(
+            [TEST_PACKAGE]
+        )
+        self.mox.ReplayAll()
+
+        self.assertEqual(self.adapter.get_packages(), [TEST_PACKAGE])
+
+    def test_initialize_indicies_unique_users(self):
+        self.adapter.get_package_collection().AndReturn(
+            self.packages_collection
+        )
+        self.packages_collection.ensure_index(
+            [('name', pymongo.ASCENDING)],
+            unique=True
+        )
+        self.adapter.get_versions_collection().AndReturn(
+            self.versions_collection
+        )
+        self.versions_collection.ensure_index(
+            [('name', pymongo.ASCENDING), ('version', pymongo.ASCENDING)],
+            unique=True
+        )
+        self.versions_collection.ensure_index([
+            ('name', pymongo.ASCENDING),
+            ('version_key', pymongo.DESCENDING)
+        ])
+        self.adapter.get_users_collection().AndReturn(self.users_collection)
+        self.users_collection.ensure_index(
+            [('username', pymongo.ASCENDING)],
+            unique=True
+        )
+        self.users_collection.ensure_index(
+            [('email', pymongo.ASCENDING)],
+            unique=True
+        )
+        self.adapter.get_stats_collection().AndReturn(self.stats_collection)
+        self.stats_collection.ensure_index(
+            [('name', pymongo.ASCENDING), ('hour', pymongo.ASCENDING)],
+            unique=True
+        )
+        self.mox.ReplayAll()
+
+        self.adapter.initialize_indicies()
+
+    def test_is_expected_revision(self):
+        record = {'revision': 5, 'archive_updates': 2}
+        self.assertTrue(db_service.is_expected_revision(record, None))
+        self.assertTrue(db_service.is_expected_revision(record, 3))
+        self.assertTrue(db_service.is_expected_revision(record, 5))
+        self.assertFalse(db_service.is_expected_revision(record, 2))
+        self.assertFalse(db_service.is_expected_revision(record, 6))
+        self.assertTrue(db_service.is_expected_revision({}, 0))
+        self.assertFalse(db_service.is_expected_revision({}, 1))
+
+    def test_create_read_preference(self):
+        app = flask.Flask(__name__)
+        self.assertEqual(
+            db_service.create_read_preference(app, 'primary', 90),
+            None
+        )
+        self.assertRaises(
+            ValueError,
+            db_service.create_read_preference,
+            app,
+            'unknown',
+            90
+        )
+
+        read_preference = db_service.create_read_preference(
+            app,
+            'secondaryPreferred',
+            90
+        )
+        self.assertEqual(
+            read_preference.mode,
+            read_preferences.SecondaryPreferred().mode
+        )
+
+    def test_insert_user(self):
+        self.adapter.get_users_collection().AndReturn(self.users_collection)
+        self.users_collection.insert_one(TEST_USER)
+        self.mox.ReplayAll()
+
+        self.assertTrue(self.adapter.insert_user(TEST_USER))
+
+    def test_insert_user_duplicate(self):
+        self.adapter.get_users_collection().AndReturn(self.users_collection)
+        self.users_collection.insert_one(TEST_USER).AndRaise(
+            errors.DuplicateKeyError('duplicate')
+        )
+        self.mox.ReplayAll()
+
+        self.assertFalse(self.adapter.insert_user(TEST_USER))
+
+    def test_insert_package(self):
+        record = dict(TEST_PACKAGE_FIELDS, revision=1)
+        self.adapter.get_package_collection().AndReturn(
+            self.packages_collection
+        )
+        self.packages_collection.insert_one(record)
+        self.expect_save_version(record)
+        self.mox.ReplayAll()
+
+        self.assertTrue(self.adapter.insert_package(TEST_PACKAGE))
+
+    def test_insert_package_duplicate(self):
+        self.adapter.get_package_collection().AndReturn(
+            self.packages_collection
+        )
+        self.packages_collection.insert_one(mox.IsA(dict)).AndRaise(
+            errors.DuplicateKeyError('duplicate')
+        )
+        self.mox.ReplayAll()
+
+        self.assertFalse(self.adapter.insert_package(TEST_PACKAGE))
+
+    def test_insert_user_missing_fields(self):
+        self.mox.ReplayAll()
+
+        self.assertRaises(
+            ValueError,
+            self.adapter.insert_user,
+            {'username': TEST_USERNAME}
+        )
+
+    def test_find_existing_users(self):
+        self.adapter.get_users_collection().AndReturn(self.users_collection)
+        self.users_collection.find(
+            {'$or': [
+                {'username': {'$in': [TEST_USERNAME]}},
+                {'email': {'$in': ['a@b.com']}}
+            ]},
+            {'_id': False, 'username': True, 'email': True}
+        ).AndReturn(iter([{'username': TEST_USERNAME, 'email': 'c@d.com'}]))
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            self.adapter.find_existing_users([TEST_USERNAME], ['a@b.com']),
+            [{'username': TEST_USERNAME, 'email': 'c@d.com'}]
+        )
+
+    def test_insert_users_partial(self):
+        other_user = dict(TEST_USER, username='other', email='other@b.com')
+        self.adapter.get_users_collection().AndReturn(self.users_collection)
+        self.users_collection.insert_many(
+            [TEST_USER, other_user],
+            ordered=False
+        ).AndRaise(errors.BulkWriteError({
+            'writeErrors': [{'index': 0, 'code': 11000}]
+        }))
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            self.adapter.insert_users([TEST_USER, other_user]),
+            ['other']
+        )
+
+    def test_update_user(self):
+        self.adapter.get_users_collection().AndReturn(self.users_collection)
+        self.users_collection.find_one_and_update(
+            {'username': TEST_USERNAME},
+            {'$set': {'password_hash': 'new hash'}},
+            return_document=pymongo.ReturnDocument.AFTER
+        ).AndReturn(TEST_USER)
+        self.mox.ReplayAll()
+
+        result = self.adapter.update_user(
+            TEST_USERNAME,
+            {'password_hash': 'new hash'}
+        )
+        self.assertEqual(result, TEST_USER)
+
+    def test_is_package_author(self):
+        self.adapter.get_package_collection().AndReturn(
+            self.packages_collection
+        )
+        self.packages_collection.find_one(
+            TEST_AUTHOR_FILTER,
+            {'_id': True}
+        ).AndReturn({'_id': 1})
+        self.mox.ReplayAll()
+
+        self.assertTrue(
+            self.adapter.is_package_author(TEST_PACKAGE_NAME, TEST_USERNAME)
+        )
+
+    def test_is_package_author_not_author(self):
+        self.adapter.get_package_collection().AndReturn(
+            self.packages_collection
+        )
+        self.packages_collection.find_one(
+            TEST_AUTHOR_FILTER,
+            {'_id': True}
+        ).AndReturn(None)
+        self.mox.ReplayAll()
+
+        self.assertFalse(
+            self.adapter.is_package_author(TEST_PACKAGE_NAME, TEST_USERNAME)
+        )
+
+    def expect_update_package_as_author(self, update_filter, result,
+            update=TEST_PACKAGE_UPDATE):
+        self.adapter.get_package_collection().AndReturn(
+            self.packages_collection
+        )
+        self.packages_collection.find_one_and_update(
+            update_filter,
+            update,
+            return_document=pymongo.ReturnDocument.AFTER
+        ).AndReturn(result)
+        if result:
+            self.expect_save_version(result)
+
+    def test_update_package_as_author(self):
+        self.expect_update_package_as_author(
+            TEST_AUTHOR_FILTER,
+            dict(TEST_PACKAGE_FIELDS, _id=1, revision=4)
+        )
+        self.mox.ReplayAll()
+
+        self.assertEqual(self.adapter.update_package_as_author(
+            TEST_PACKAGE_NAME,
+            TEST_USERNAME,
+            TEST_PACKAGE
+        ), 4)
+
+    def test_update_package_as_author_not_author(self):
+        self.expect_update_package_as_author(TEST_AUTHOR_FILTER, None)
+        self.mox.ReplayAll()
+
+        self.assertEqual(self.adapter.update_package_as_author(
+            TEST_PACKAGE_NAME,
+            TEST_USERNAME,
+            TEST_PACKAGE
+        ), None)
+
+    def test_update_package_as_author_keeps_name(self):
+        self.expect_update_package_as_author(
+            TEST_AUTHOR_FILTER,
+            dict(TEST_PACKAGE_FIELDS, _id=1, revision=4)
+        )
+        self.mox.ReplayAll()
+
+        self.assertEqual(self.adapter.update_package_as_author(
+            TEST_PACKAGE_NAME,
+            TEST_USERNAME,
+            dict(TEST_PACKAGE, name='other')
+        ), 4)
+
+    def expect_get_user_as_author(self, results):
+        self.adapter.get_users_collection().AndReturn(self.users_collection)
+        self.users_collection.aggregate(
+            mox.Func(lambda pipeline: pipeline[0] == {
+                '$match': {'username': TEST_USERNAME}
+            } and pipeline[2]['$lookup']['pipeline'][0] == {
+                '$match': TEST_AUTHOR_FILTER
+            }),
+            cursor={}
+        ).AndReturn(iter(results))
+
+    def test_get_user_as_author(self):
+        self.expect_get_user_as_author([
+            dict(TEST_USER, authored=[{'_id': 1}])
+        ])
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            self.adapter.get_user_as_author(TEST_USERNAME, TEST_PACKAGE_NAME),
+            (TEST_USER, True)
+        )
+
+    def test_get_user_as_author_not_author(self):
+        self.expect_get_user_as_author([dict(TEST_USER, authored=[])])
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            self.adapter.get_user_as_author(TEST_USERNAME, TEST_PACKAGE_NAME),
+            (TEST_USER, False)
+        )
+
+    def test_get_user_as_author_no_user(self):
+        self.expect_get_user_as_author([])
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            self.adapter.get_user_as_author(TEST_USERNAME, TEST_PACKAGE_NAME),
+            (None, False)
+        )
+
+    def test_update_package_as_author_expected_revision(self):
+        update_filter = dict(TEST_AUTHOR_FILTER)
+        update_filter.update(db_service.create_expected_revision_filter(3))
+        self.expect_update_package_as_author(update_filter, None)
+        self.mox.ReplayAll()
+
+        self.assertEqual(self.adapter.update_package_as_author(
+            TEST_PACKAGE_NAME,
+            TEST_USERNAME,
+            TEST_PACKAGE,
+            3
+        ), None)
+
+    def test_update_package_as_author_unrevisioned(self):
+        update_filter = dict(TEST_AUTHOR_FILTER)
+        update_filter.update(db_service.create_expected_revision_filter(0))
+        self.expect_update_package_as_author(
+            update_filter,
+            dict(TEST_PACKAGE_FIELDS, _id=1, revision=1)
+        )
+        self.mox.ReplayAll()
+
+        self.assertEqual(self.adapter.update_package_as_author(
+            TEST_PACKAGE_NAME,
+            TEST_USERNAME,
+            TEST_PACKAGE,
+            0
+        ), 1)
+
+    def test_put_package_increments_revision(self):
+        record = dict(TEST_PACKAGE_FIELDS, _id=1, revision=2)
+        self.adapter.get_package_collection().AndReturn(
+            self.packages_collection
+        )
+        self.packages_collection.find_one_and_update(
+            {'name': TEST_PACKAGE_NAME},
+            TEST_PACKAGE_UPDATE,
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER
+        ).AndReturn(record)
+        self.expect_save_version(record)
+        self.mox.ReplayAll()
+
+        self.adapter.put_package(TEST_PACKAGE)
+
+    def test_put_package_invalid_version(self):
+        package = dict(TEST_PACKAGE, version='1.2')
+        self.mox.ReplayAll()
+
+        self.assertRaises(ValueError, self.adapter.put_package, package)
+
+    def test_update_package_as_author_legacy_version(self):
+        update = copy.deepcopy(TEST_PACKAGE_UPDATE)
+        update['$set'].update({
+            'version': '1.2',
+            'version_parts': [1, 2, 0],
+            'version_key': versions.create_version_key([1, 2, 0])
+        })
+        update_filter = dict(
+            TEST_AUTHOR_FILTER,
+            version={'$not': versions.VERSION_PATTERN}
+        )
+        self.expect_update_package_as_author(
+            update_filter,
+            dict(update['$set'], _id=1, revision=2),
+            update
+        )
+        self.mox.ReplayAll()
+
+        self.assertEqual(self.adapter.update_package_as_author(
+            TEST_PACKAGE_NAME,
+            TEST_USERNAME,
+            dict(TEST_PACKAGE, version='1.2')
+        ), 2)
+
+    def test_backfill_version_fields(self):
+        self.adapter.get_package_collection().AndReturn(
+            self.packages_collection
+        )
+        self.packages_collection.find(
+            {'version_key': {'$exists': False}},
+            {'version': True}
+        ).AndReturn([
+            {'_id': 1, 'version': '1.2.3'},
+            {'_id': 2, 'version': 'latest'}
+        ])
+        self.packages_collection.update_one(
+            {'_id': 1, 'version': '1.2.3'},
+            {'$set': {
+                'version_parts': [1, 2, 3],
+                'version_key': versions.create_version_key([1, 2, 3])
+            }}
+        ).AndReturn(FakeWriteResult(matched_count=1))
+        self.packages_collection.update_one(
+            {'_id': 2, 'version': 'latest'},
+            {'$set': {'version_parts': None, 'version_key': None}}
+        ).AndReturn(FakeWriteResult(matched_count=1))
+        self.mox.ReplayAll()
+
+        self.assertEqual(self.adapter.backfill_version_fields(), 2)
+
+    def test_backfill_package_versions(self):
+        records = [
+            {'name': 'kept', 'version': '1.0.0'},
+            {'name': 'added', 'version': '2.0.0'}
+        ]
+        self.adapter.get_versions_collection().AndReturn(
+            self.versions_collection
+        )
+        self.adapter.get_package_collection().AndReturn(
+            self.packages_collection
+        )
+        self.packages_collection.find({}, {'_id': False}).AndReturn(records)
+        self.versions_collection.update_one(
+            {'name': 'kept', 'version': '1.0.0'},
+            {'$setOnInsert': records[0]},
+            upsert=True
+        ).AndReturn(FakeWriteResult(matched_count=1))
+        self.versions_collection.update_one(
+            {'name': 'added', 'version': '2.0.0'},
+            {'$setOnInsert': records[1]},
+            upsert=True
+        ).AndReturn(FakeWriteResult(upserted_id=3))
+        self.mox.ReplayAll()
+
+        self.assertEqual(self.adapter.backfill_package_versions(), 1)
+
+    def test_get_latest_package_in_range(self):
+        self.adapter.get_versions_collection().AndReturn(
+            self.versions_collection
+        )
+        self.versions_collection.find_one(
+            {'name': TEST_PACKAGE_NAME, 'version_key': {'$gte': 1, '$lt': 2}},
+            sort=[('version_key', pymongo.DESCENDING)]
+        ).AndReturn(TEST_PACKAGE)
+        self.mox.ReplayAll()
+
+        result = self.adapter.get_latest_package_in_range(
+            TEST_PACKAGE_NAME,
+            1,
+            2
+        )
+        self.assertEqual(result, TEST_PACKAGE)
+
+    def test_get_latest_package_in_range_unbounded(self):
+        self.adapter.get_versions_collection().AndReturn(
+            self.versions_collection
+        )
+        self.versions_collection.find_one(
+            {'name': TEST_PACKAGE_NAME, 'version_key': {'$gte': 0}},
+            sort=[('version_key', pymongo.DESCENDING)]
+        ).AndReturn(None)
+        self.mox.ReplayAll()
+
+        result = self.adapter.get_latest_package_in_range(
+            TEST_PACKAGE_NAME,
+            0,
+            None
+        )
+        self.assertEqual(result, None)
+
+    def test_set_package_archive(self):
+        archive_info = {'status': 'valid'}
+        self.adapter.get_package_collection().AndReturn(
+            self.packages_collection
+        )
+        self.packages_collection.update_one(
+            {'name': TEST_PACKAGE_NAME, 'version': '1.2.3'},
+            {
+                '$set': {'archive': archive_info},
+                '$inc': {'revision': 1, 'archive_updates': 1}
+            }
+        ).AndReturn(FakeWriteResult(matched_count=0))
+        self.mox.ReplayAll()
+
+        self.assertFalse(self.adapter.set_package_archive(
+            TEST_PACKAGE_NAME,
+            '1.2.3',
+            archive_info
+        ))
+
+    def test_delete_package_as_author(self):
+        self.adapter.get_package_collection().AndReturn(
+            self.packages_collection
+        )
+        self.packages_collection.delete_one(TEST_AUTHOR_FILTER).AndReturn(
+            FakeWriteResult(deleted_count=1)
+        )
+        self.adapter.get_versions_collection().AndReturn(
+            self.versions_collection
+        )
+        self.versions_collection.delete_many({'name': TEST_PACKAGE_NAME})
+        self.mox.ReplayAll()
+
+        self.assertTrue(self.adapter.delete_package_as_author(
+            TEST_PACKAGE_NAME,
+            TEST_USERNAME
+        ))
+
+    def test_add_package_stats(self):
+        def check_requests(requests):
+            filters = sorted(request._filter['hour'] for request in requests)
+            return filters == [0, 3600] and all(
+                request._upsert and '$inc' in request._doc
+                for request in requests
+            )
+
+        self.adapter.get_stats_collection().AndReturn(self.stats_collection)
+        self.stats_collection.bulk_write(
+            mox.Func(check_requests),
+            ordered=False
+        )
+        self.mox.ReplayAll()
+
+        self.adapter.add_package_stats({
+            (TEST_PACKAGE_NAME, 0): {'reads': 2},
+            (TEST_PACKAGE_NAME, 3600): {'reads': 1, 'downloads': 1}
+        })
+
+    def test_add_package_stats_partial(self):
+        self.adapter.get_stats_collection().AndReturn(self.stats_collection)
+        self.stats_collection.bulk_write(
+            mox.IgnoreArg(),
+            ordered=False
+        ).AndRaise(errors.BulkWriteError({
+            'writeErrors': [{'index': 1, 'code': 11000}]
+        }))
+        self.mox.ReplayAll()
+
+        try:
+            self.adapter.add_package_stats({
+                (TEST_PACKAGE_NAME, 0): {'reads': 2},
+                (TEST_PACKAGE_NAME, 3600): {'reads': 1}
+            })
+            self.fail('Expected PartialWriteError.')
+        except db_service.PartialWriteError, e:
+            self.assertEqual(e.failed_keys, [(TEST_PACKAGE_NAME, 3600)])
+
+    def test_add_package_stats_empty(self):
+        self.mox.ReplayAll()
+        self.adapter.add_package_stats({})
+
+    def test_get_package_stats(self):
+        self.adapter.get_stats_collection().AndReturn(self.stats_collection)
+        self.stats_collection.find(
+            {'name': TEST_PACKAGE_NAME, 'hour': {'$gte': 3600}},
+            {'_id': False, 'name': False},
+            sort=[('hour', pymongo.ASCENDING)]
+        ).AndReturn(iter([{'hour': 3600, 'reads': 1}]))
+        self.mox.ReplayAll()
+
+        self.assertEqual(
+            self.adapter.get_package_stats(TEST_PACKAGE_NAME, 3600),
+            [{'hour': 3600, 'reads': 1}]
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
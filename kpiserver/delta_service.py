@@ -0,0 +1,136 @@
+"""Per-file delta archives between consecutive package versions.
+
+When a new version's archive is validated, its manifest is compared against the
+manifest saved for the previous version. Files that were added or changed are
+copied into a delta archive. A client holding the previous version rebuilds
+the new one from its old files plus the delta, verifying every file against
+the new manifest, instead of downloading the full archive again.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import hashlib
+import shutil
+import tempfile
+import zipfile
+
+import file_store_service
+
+CHUNK_SIZE = 64 * 1024
+
+
+def get_changed_paths(old_manifest, new_manifest):
+    """Find the files that must be sent to update from one version to another.
+
+    @param old_manifest: The manifest of the version the client has.
+    @type old_manifest: list of dict
+    @param new_manifest: The manifest of the version the client wants.
+    @type new_manifest: list of dict
+    @return: Paths of files in the new version that were added or whose
+        contents changed.
+    @rtype: list of str
+    """
+    old_hashes = dict(
+        (entry['path'], entry['sha256']) for entry in old_manifest
+    )
+    return [
+        entry['path'] for entry in new_manifest
+        if old_hashes.get(entry['path'], None) != entry['sha256']
+    ]
+
+
+def copy_member(source_zip, path, target_zip):
+    """Copy a file between archives without holding it in memory.
+
+    @param source_zip: The archive to copy from.
+    @type source_zip: zipfile.ZipFile
+    @param path: The path of the file within both archives.
+    @type path: str
+    @param target_zip: The archive to copy to.
+    @type target_zip: zipfile.ZipFile
+    """
+    extracted = tempfile.NamedTemporaryFile()
+    try:
+        member = source_zip.open(path)
+        try:
+            shutil.copyfileobj(member, extracted, CHUNK_SIZE)
+        finally:
+            member.close()
+        extracted.flush()
+        target_zip.write(extracted.name, path)
+    finally:
+        extracted.close()
+
+
+def write_delta_archive(archive_file, paths):
+    """Create an archive with a subset of the files in another archive.
+
+    @param archive_file: Seekable file with the full archive contents.
+    @type archive_file: file
+    @param paths: The paths of the files to include.
+    @type paths: list of str
+    @return: Tuple of (temporary file with the delta archive positioned at its
+        start, size in bytes, hex SHA-256 digest of the delta archive).
+    @rtype: tuple
+    """
+    delta_file = tempfile.TemporaryFile()
+    archive_file.seek(0)
+    source_zip = zipfile.ZipFile(archive_file)
+    try:
+        delta_zip = zipfile.ZipFile(delta_file, 'w', zipfile.ZIP_DEFLATED)
+        for path in paths:
+            copy_member(source_zip, path, delta_zip)
+        delta_zip.close()
+    finally:
+        source_zip.close()
+
+    digest = hashlib.sha256()
+    delta_file.seek(0)
+    chunk = delta_file.read(CHUNK_SIZE)
+    while chunk:
+        digest.update(chunk)
+        chunk = delta_file.read(CHUNK_SIZE)
+    size = delta_file.tell()
+
+    delta_file.seek(0)
+    return (delta_file, size, digest.hexdigest())
+
+
+def create_delta(previous, package_name, version, archive_file, manifest):
+    """Create the delta from a package's previous version to a new archive.
+
+    @param previous: Information about the previous version's validated
+        archive including its module.json and manifest.
+    @type previous: dict
+    @param package_name: The name of the package.
+    @type package_name: str
+    @param version: The version of the new archive.
+    @type version: str
+    @param archive_file: Seekable file with the new archive's contents.
+    @type archive_file: file
+    @param manifest: The manifest of the new archive.
+    @type manifest: list of dict
+    @return: None if the previous archive is for the same version or a tuple
+        of (temporary file with the delta archive, information about the delta
+        with from_version, object, size, sha256, and files).
+    @rtype: tuple
+    """
+    from_version = previous['module'].get('version', None)
+    if not from_version or from_version == version:
+        return None
+
+    paths = get_changed_paths(previous['manifest'], manifest)
+    delta_file, size, sha256 = write_delta_archive(archive_file, paths)
+
+    return (delta_file, {
+        'from_version': from_version,
+        'object': file_store_service.get_delta_name(
+            package_name,
+            from_version,
+            version
+        ),
+        'size': size,
+        'sha256': sha256,
+        'files': len(paths)
+    })
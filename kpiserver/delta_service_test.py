@@ -0,0 +1,106 @@
+"""Tests for per-file delta archives between package versions.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import hashlib
+import StringIO
+import unittest
+import zipfile
+
+import delta_service
+
+OLD_MANIFEST = [
+    {'path': 'module.json', 'size': 1, 'sha256': 'a'},
+    {'path': 'main.js', 'size': 1, 'sha256': 'b'},
+    {'path': 'removed.js', 'size': 1, 'sha256': 'c'}
+]
+NEW_MANIFEST = [
+    {'path': 'module.json', 'size': 1, 'sha256': 'd'},
+    {'path': 'main.js', 'size': 1, 'sha256': 'b'},
+    {'path': 'added.js', 'size': 1, 'sha256': 'e'}
+]
+
+
+def create_archive(files):
+    archive = StringIO.StringIO()
+    zip_file = zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED)
+    for name, contents in sorted(files.items()):
+        zip_file.writestr(name, contents)
+    zip_file.close()
+    archive.seek(0)
+    return archive
+
+
+class DeltaServiceTests(unittest.TestCase):
+
+    def test_get_changed_paths(self):
+        self.assertEqual(
+            delta_service.get_changed_paths(OLD_MANIFEST, NEW_MANIFEST),
+            ['module.json', 'added.js']
+        )
+
+    def test_write_delta_archive(self):
+        archive = create_archive({
+            'module.json': '{"version": "1.0.1"}',
+            'main.js': 'unchanged',
+            'added.js': 'added'
+        })
+
+        delta_file, size, sha256 = delta_service.write_delta_archive(
+            archive,
+            ['module.json', 'added.js']
+        )
+        contents = delta_file.read()
+        delta_file.close()
+
+        self.assertEqual(size, len(contents))
+        self.assertEqual(sha256, hashlib.sha256(contents).hexdigest())
+        delta_zip = zipfile.ZipFile(StringIO.StringIO(contents))
+        self.assertEqual(
+            sorted(delta_zip.namelist()),
+            ['added.js', 'module.json']
+        )
+        self.assertEqual(delta_zip.read('added.js'), 'added')
+
+    def test_create_delta(self):
+        archive = create_archive({
+            'module.json': '{"version": "1.0.1"}',
+            'main.js': 'unchanged',
+            'added.js': 'added'
+        })
+        previous = {'module': {'version': '1.0.0'}, 'manifest': OLD_MANIFEST}
+
+        delta_file, delta_info = delta_service.create_delta(
+            previous,
+            'simple_ain',
+            '1.0.1',
+            archive,
+            NEW_MANIFEST
+        )
+        delta_file.close()
+
+        self.assertEqual(delta_info['from_version'], '1.0.0')
+        self.assertEqual(
+            delta_info['object'],
+            'simple_ain/deltas/1.0.0-1.0.1.zip'
+        )
+        self.assertEqual(delta_info['files'], 2)
+
+    def test_create_delta_same_version(self):
+        previous = {'module': {'version': '1.0.1'}, 'manifest': OLD_MANIFEST}
+        self.assertEqual(
+            delta_service.create_delta(
+                previous,
+                'simple_ain',
+                '1.0.1',
+                None,
+                NEW_MANIFEST
+            ),
+            None
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,6 +17,17 @@ Cheers,
 LabJack
 '''
 
+BULK_PASSWORD_EMAIL_TEMPLATE = '''Hello *|USERNAME|*,
+
+An account for the Kipling Package Index has been created for you. Your
+password is: *|PASSWORD|*.
+
+Cheers,
+LabJack
+'''
+
+MAX_BATCH_SIZE = 100
+
 
 class EmailServiceAdapter:
     """Interface for a service for sending emails to users."""
@@ -40,6 +51,18 @@ class EmailServiceAdapter:
         """
         raise NotImplementedError()
 
+    def queue(self, message):
+        """Queue a message to many recipients to be sent in the background.
+
+        @param message: Information about the message to send like in send
+            plus merge_vars (list of per-recipient substitutions of form
+            [{'rcpt': , 'vars': [{'name': , 'content': }]}]) and
+            preserve_recipients (boolean indicating if every recipient should
+            see the full list of recipients).
+        @type message: dict
+        """
+        raise NotImplementedError()
+
 
 class MandrillServiceAdapter(EmailServiceAdapter):
     """Implementation of the EmailServiceAdapter for Mandrill."""
@@ -55,6 +78,9 @@ class MandrillServiceAdapter(EmailServiceAdapter):
     def send(self, message):
         self.native_client.messages.send(message=message, async=False)
 
+    def queue(self, message):
+        self.native_client.messages.send(message=message, async=True)
+
 
 def get_client(application):
     """Get the email client for the service specified by configuration
@@ -104,3 +130,40 @@ def send_password_email(application, email, username, password=None):
     }
 
     client.send(message)
+
+
+def send_password_emails(application, users):
+    """Send many new users their passwords in batches.
+
+    Each batch is a single request to the mailing service which substitutes
+    each recipient's username and password into their copy of the message.
+
+    @param application: The application that has the configuration values
+        necessary for interacting with the mailing service.
+    @type application: flask.Flask
+    @param users: The email, username, and plaintext password of each user.
+    @type users: list of tuple
+    """
+    client = get_client(application)
+
+    for start in range(0, len(users), MAX_BATCH_SIZE):
+        batch = users[start:start + MAX_BATCH_SIZE]
+        client.queue({
+            'auto_html': True,
+            'from_email': application.config['EMAIL_FROM_ADDRESS'],
+            'from_name': application.config['EMAIL_FROM_NAME'],
+            'subject': 'Your Kipling Package Index Account',
+            'text': BULK_PASSWORD_EMAIL_TEMPLATE,
+            'preserve_recipients': False,
+            'to': [
+                {'email': email, 'name': username, 'type': 'to'}
+                for email, username, password in batch
+            ],
+            'merge_vars': [
+                {'rcpt': email, 'vars': [
+                    {'name': 'USERNAME', 'content': username},
+                    {'name': 'PASSWORD', 'content': password}
+                ]}
+                for email, username, password in batch
+            ]
+        })
@@ -94,6 +94,38 @@ class EmailServiceTests(mox.MoxTestBase):
             TEST_USERNAME
         )
 
+    def test_send_password_emails_batches(self):
+        test_adapter = self.mox.CreateMock(email_service.MandrillServiceAdapter)
+
+        test_application = MockApplication({
+            'MAIL_API_KEY': TEST_API_KEY,
+            'EMAIL_FROM_ADDRESS': EMAIL_FROM_ADDRESS,
+            'EMAIL_FROM_NAME': EMAIL_FROM_NAME
+        })
+        users = [
+            ('%d@example.com' % i, 'user%d' % i, TEST_PASSWORD)
+            for i in range(email_service.MAX_BATCH_SIZE + 1)
+        ]
+
+        self.mox.StubOutWithMock(email_service, 'get_client')
+        email_service.get_client(test_application).AndReturn(test_adapter)
+        test_adapter.queue(mox.Func(
+            lambda message: len(message['to']) == email_service.MAX_BATCH_SIZE
+        ))
+        test_adapter.queue(mox.Func(
+            lambda message: message['merge_vars'] == [{
+                'rcpt': users[-1][0],
+                'vars': [
+                    {'name': 'USERNAME', 'content': users[-1][1]},
+                    {'name': 'PASSWORD', 'content': TEST_PASSWORD}
+                ]
+            }]
+        ))
+
+        self.mox.ReplayAll()
+
+        email_service.send_password_emails(test_application, users)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,62 +1,996 @@
 import base64
+import collections
 import hashlib
 import hmac
+import json
+import os
+import re
+import tempfile
+import threading
 import time
 import urllib
 
 ZIP_MIME_TYPE = 'application/zip'
+PUBLIC_READ_HEADERS = 'x-amz-acl:public-read'
+OBJECT_URL_TEMPLATE = 'https://%s.s3.amazonaws.com/%s'
+PUBLIC_READ_ACL = 'public-read'
+
+SIGV4_ALGORITHM = 'AWS4-HMAC-SHA256'
+SIGV4_TERMINATOR = 'aws4_request'
+SIGV4_DATE_FORMAT = '%Y%m%d'
+SIGV4_TIME_FORMAT = '%Y%m%dT%H%M%SZ'
+POLICY_EXPIRATION_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+S3_SERVICE = 's3'
+DEFAULT_REGION = 'us-east-1'
+GLOBAL_HOST_TEMPLATE = '%s.s3.amazonaws.com'
+REGIONAL_HOST_TEMPLATE = '%s.s3.%s.amazonaws.com'
+MAX_SIGNING_KEYS = 8
+
+DEFAULT_UPLOAD_EXPIRATION = 10
+DEFAULT_DOWNLOAD_EXPIRATION = 60
+DEFAULT_URL_CACHE_SIZE = 1024
+DEFAULT_SIGNATURE_VERSION = 2
+DEFAULT_MAX_UPLOAD_SIZE = 50 * 1024 * 1024
+DEFAULT_ARCHIVE_CACHE_SIZE = 1024 * 1024 * 1024
+
+CONTENT_HASH_PATTERN = re.compile('^[0-9a-f]{64}$')
+MAX_BATCH_SIZE = 500
+CHUNK_SIZE = 64 * 1024
+
+# Cached URLs are handed out again until less than this fraction of their
+# lifetime remains so that clients always get a usable window.
+URL_REFRESH_FRACTION = 0.5
+
+
+class SignedURLCache:
+    """Bounded least recently used cache of signed URLs and their expiry."""
+
+    def __init__(self, max_size):
+        """Create a new empty cache.
+
+        @param max_size: The maximum number of URLs to keep.
+        @type max_size: int
+        """
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, now, min_remaining):
+        """Get a cached URL if it will stay valid long enough.
+
+        @param key: The request the URL was signed for.
+        @type key: tuple
+        @param now: The current time in seconds.
+        @type now: float
+        @param min_remaining: The minimum number of seconds the URL must remain
+            valid for.
+        @type min_remaining: float
+        @return: The cached URL or None if not cached or expiring too soon.
+        @rtype: str
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if not entry or entry[1] - now < min_remaining:
+                return None
+            self.entries[key] = entry
+            return entry[0]
+
+    def put(self, key, url, expires):
+        """Add a signed URL to the cache, evicting the least recently used.
+
+        @param key: The request the URL was signed for.
+        @type key: tuple
+        @param url: The signed URL.
+        @type url: str
+        @param expires: The time in seconds at which the URL expires.
+        @type expires: int
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (url, expires)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+class ArchiveCache:
+    """Size bounded least recently used cache of archives on local disk.
+
+    Entries are keyed by the SHA-256 digest of their contents so a new upload
+    of a package never serves stale bytes; the old entry just ages out. When
+    many requests miss on the same entry at once only one fetches it while
+    the rest wait for that fetch to finish.
+    """
+
+    def __init__(self, directory, max_size):
+        """Create a cache in a directory, indexing any entries already there.
+
+        @param directory: The directory to keep cached archives in.
+        @type directory: str
+        @param max_size: The maximum total size in bytes of cached archives.
+        @type max_size: int
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.total_size = 0
+        self.fills = {}
+        self.hits = 0
+        self.misses = 0
+        self.fill_waits = 0
+        self.evictions = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        existing = []
+        for key in os.listdir(directory):
+            path = os.path.join(directory, key)
+            if CONTENT_HASH_PATTERN.match(key):
+                existing.append((os.path.getatime(path), key))
+        for unused_atime, key in sorted(existing):
+            self.add_entry(key)
+
+    def get_path(self, key):
+        """Get where an entry is kept on disk.
+
+        @param key: The hex SHA-256 digest of the entry's contents.
+        @type key: str
+        @return: The path of the entry.
+        @rtype: str
+        """
+        return os.path.join(self.directory, key)
+
+    def add_entry(self, key):
+        """Index an entry saved to disk and evict others to stay under size.
+
+        Must be called while holding the lock.
+
+        @param key: The hex SHA-256 digest of the entry's contents.
+        @type key: str
+        """
+        size = os.path.getsize(self.get_path(key))
+        self.entries[key] = size
+        self.total_size += size
+        while self.total_size > self.max_size and self.entries:
+            evicted_key, evicted_size = self.entries.popitem(last=False)
+            self.total_size -= evicted_size
+            self.evictions += 1
+            os.remove(self.get_path(evicted_key))
+
+    def open(self, key, fill):
+        """Open a cached archive, fetching it first if not cached.
+
+        @param key: The hex SHA-256 digest of the archive's contents.
+        @type key: str
+        @param fill: Function that writes the archive's contents to the file
+            it is given if the archive is not cached.
+        @type fill: function
+        @return: The cached archive opened for reading. Remains readable even
+            if evicted while open.
+        @rtype: file
+        @raise ValueError: Raised if the key is not a SHA-256 digest or the
+            contents written by fill do not match it.
+        @raise IOError: Raised if fill could not fetch the archive.
+        """
+        if not CONTENT_HASH_PATTERN.match(key):
+            raise ValueError('Cache keys must be hex SHA-256 digests.')
+
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    self.entries[key] = self.entries.pop(key)
+                    self.hits += 1
+                    return open(self.get_path(key), 'rb')
+
+                fill_done = self.fills.get(key, None)
+                if fill_done:
+                    self.fill_waits += 1
+                else:
+                    self.misses += 1
+                    fill_done = threading.Event()
+                    self.fills[key] = fill_done
+                    break
+
+            # Another request is fetching this archive. Check again once it
+            # is done, becoming the filler if that fetch failed.
+            fill_done.wait()
+
+        try:
+            return self.fill_entry(key, fill)
+        finally:
+            with self.lock:
+                del self.fills[key]
+            fill_done.set()
+
+    def fill_entry(self, key, fill):
+        """Fetch an archive into the cache.
+
+        @param key: The hex SHA-256 digest of the archive's contents.
+        @type key: str
+        @param fill: Function that writes the archive's contents to the file
+            it is given.
+        @type fill: function
+        @return: The cached archive opened for reading.
+        @rtype: file
+        """
+        filled = tempfile.NamedTemporaryFile(dir=self.directory, delete=False)
+        saved = False
+        try:
+            try:
+                fill(filled)
+            finally:
+                filled.close()
+
+            if hash_file(filled.name) != key:
+                raise ValueError('Fetched archive does not match %s.' % key)
+            os.rename(filled.name, self.get_path(key))
+            saved = True
+        finally:
+            if not saved:
+                os.remove(filled.name)
+
+        with self.lock:
+            cached = open(self.get_path(key), 'rb')
+            self.add_entry(key)
+        return cached
+
+    def get_stats(self):
+        """Get metrics about how effective the cache has been.
+
+        @return: Dictionary with hits, misses, hit_rate, fill_waits (lookups
+            that waited on another request's fetch before hitting or missing),
+            evictions, entries, and size in bytes.
+        @rtype: dict
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0,
+                'fill_waits': self.fill_waits,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'size': self.total_size
+            }
+
+
+def hash_file(path):
+    """Calculate the SHA-256 digest of a file without loading it into memory.
+
+    @param path: The path of the file to hash.
+    @type path: str
+    @return: The hex SHA-256 digest of the file.
+    @rtype: str
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        chunk = f.read(CHUNK_SIZE)
+        while chunk:
+            digest.update(chunk)
+            chunk = f.read(CHUNK_SIZE)
+    return digest.hexdigest()
+
+
+class URLSigner:
+    """Signs URLs for objects in the uploads bucket.
+
+    The HMAC is keyed with the S3 secret once and copied for each signature
+    and signed URLs are cached until near expiry.
+    """
+
+    def __init__(self, bucket_name, access_key, secret_key, cache_size):
+        """Create a new signer.
+
+        @param bucket_name: The name of the uploads bucket.
+        @type bucket_name: str
+        @param access_key: The key identifying the AWS account.
+        @type access_key: str
+        @param secret_key: The private key to sign with.
+        @type secret_key: str
+        @param cache_size: The maximum number of signed URLs to cache.
+        @type cache_size: int
+        """
+        self.bucket_name = bucket_name
+        self.access_key = access_key
+        self.keyed_hmac = hmac.new(secret_key, digestmod=hashlib.sha1)
+        self.cache = SignedURLCache(cache_size)
+
+    def sign(self, method, object_name, expires_in, mime_type='',
+            amz_headers=None, now=None):
+        """Create or reuse a signed URL for an object.
+
+        @param method: The HTTP method the URL may be used with.
+        @type method: str
+        @param object_name: The name of the object in the uploads bucket.
+        @type object_name: str
+        @param expires_in: The number of seconds a new URL will be valid for.
+        @type expires_in: int
+        @keyword mime_type: The content type the request must use. Defaults to
+            blank.
+        @type mime_type: str
+        @keyword amz_headers: Canonicalized x-amz- headers the request must
+            send or None if no headers are required. Defaults to None.
+        @type amz_headers: str
+        @keyword now: The current time. Defaults to None (time.time()).
+        @type now: float
+        @return: Signed URL valid for at least URL_REFRESH_FRACTION of
+            expires_in seconds.
+        @rtype: str
+        """
+        if now is None:
+            now = time.time()
+
+        key = (method, object_name, mime_type, amz_headers, expires_in)
+        url = self.cache.get(key, now, expires_in * URL_REFRESH_FRACTION)
+        if url:
+            return url
+
+        expires = int(now+expires_in)
+        url = self.create_url(
+            method,
+            object_name,
+            expires_in,
+            mime_type,
+            amz_headers,
+            now
+        )
+        self.cache.put(key, url, expires)
+        return url
+
+    def create_url(self, method, object_name, expires_in, mime_type,
+            amz_headers, now):
+        """Sign a new URL for an object with AWS signature version 2.
+
+        @param method: The HTTP method the URL may be used with.
+        @type method: str
+        @param object_name: The name of the object in the uploads bucket.
+        @type object_name: str
+        @param expires_in: The number of seconds the URL will be valid for.
+        @type expires_in: int
+        @param mime_type: The content type the request must use.
+        @type mime_type: str
+        @param amz_headers: Canonicalized x-amz- headers the request must
+            send or None.
+        @type amz_headers: str
+        @param now: The current time in seconds.
+        @type now: float
+        @return: The signed URL.
+        @rtype: str
+        """
+        expires = int(now+expires_in)
+
+        # We have to construct this by hand as opposed to using somebody like
+        # requestify because we have to hash it and sign it with our Amazon
+        # secret key.
+        signed_parts = [method, '', mime_type, str(expires)]
+        if amz_headers:
+            signed_parts.append(amz_headers)
+        signed_parts.append('/%s/%s' % (self.bucket_name, object_name))
+        request_str = '\n'.join(signed_parts)
+
+        # Signed with secret key without revealing that secret key to the
+        # world.
+        signer = self.keyed_hmac.copy()
+        signer.update(request_str)
+        signature = base64.encodestring(signer.digest())
+        signature = urllib.quote_plus(signature.strip())
+
+        return '%s?AWSAccessKeyId=%s&Expires=%d&Signature=%s' % (
+            OBJECT_URL_TEMPLATE % (self.bucket_name, object_name),
+            self.access_key,
+            expires,
+            signature
+        )
+
+
+def hmac_sha256(key, message):
+    """Calculate the raw HMAC-SHA256 digest of a message.
+
+    @param key: The key to sign with.
+    @type key: str
+    @param message: The message to sign.
+    @type message: str
+    @return: The binary digest.
+    @rtype: str
+    """
+    return hmac.new(key, message, hashlib.sha256).digest()
+
+
+def derive_signing_key(secret_key, date_stamp, region, service):
+    """Derive the AWS signature version 4 key for one day, region, and service.
+
+    @param secret_key: The AWS secret key.
+    @type secret_key: str
+    @param date_stamp: The day the key is for formatted as YYYYMMDD.
+    @type date_stamp: str
+    @param region: The AWS region like us-east-1.
+    @type region: str
+    @param service: The AWS service like s3.
+    @type service: str
+    @return: The binary signing key.
+    @rtype: str
+    """
+    date_key = hmac_sha256('AWS4' + secret_key, date_stamp)
+    region_key = hmac_sha256(date_key, region)
+    service_key = hmac_sha256(region_key, service)
+    return hmac_sha256(service_key, SIGV4_TERMINATOR)
+
+
+def quote_uri_component(value, safe=''):
+    """URI encode a value as required by AWS signature version 4.
+
+    @param value: The value to encode.
+    @type value: str
+    @keyword safe: Additional characters to leave unencoded. Defaults to
+        blank.
+    @type safe: str
+    @return: The encoded value.
+    @rtype: str
+    """
+    return urllib.quote(value, safe='-_.~' + safe)
+
+
+def parse_amz_headers(amz_headers):
+    """Split canonicalized x-amz- headers into header name and value pairs.
+
+    @param amz_headers: Newline separated name:value headers or None.
+    @type amz_headers: str
+    @return: List of (lowercase header name, value) tuples.
+    @rtype: list
+    """
+    if not amz_headers:
+        return []
+    headers = []
+    for line in amz_headers.split('\n'):
+        name, value = line.split(':', 1)
+        headers.append((name.strip().lower(), value.strip()))
+    return headers
+
+
+class SigV4URLSigner(URLSigner):
+    """Signs URLs and POST policies with AWS signature version 4.
+
+    Signing keys are derived once per day, region, and service and reused for
+    every signature made that day.
+    """
+
+    def __init__(self, bucket_name, access_key, secret_key, region,
+            cache_size):
+        """Create a new signer.
+
+        @param bucket_name: The name of the uploads bucket.
+        @type bucket_name: str
+        @param access_key: The key identifying the AWS account.
+        @type access_key: str
+        @param secret_key: The private key to derive signing keys from.
+        @type secret_key: str
+        @param region: The AWS region the bucket is in.
+        @type region: str
+        @param cache_size: The maximum number of signed URLs to cache.
+        @type cache_size: int
+        """
+        self.bucket_name = bucket_name
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.cache = SignedURLCache(cache_size)
+        self.signing_keys = {}
+        self.signing_keys_lock = threading.Lock()
+
+        if region == DEFAULT_REGION:
+            self.host = GLOBAL_HOST_TEMPLATE % bucket_name
+        else:
+            self.host = REGIONAL_HOST_TEMPLATE % (bucket_name, region)
+
+    def get_signing_key(self, date_stamp, service=S3_SERVICE):
+        """Get the signing key for a day, deriving it on first use.
+
+        @param date_stamp: The day the key is for formatted as YYYYMMDD.
+        @type date_stamp: str
+        @keyword service: The AWS service the key is for. Defaults to s3.
+        @type service: str
+        @return: The binary signing key.
+        @rtype: str
+        """
+        key = (date_stamp, self.region, service)
+        with self.signing_keys_lock:
+            signing_key = self.signing_keys.get(key, None)
+            if signing_key:
+                return signing_key
+
+            if len(self.signing_keys) >= MAX_SIGNING_KEYS:
+                self.signing_keys.clear()
+            signing_key = derive_signing_key(
+                self.secret_key,
+                date_stamp,
+                self.region,
+                service
+            )
+            self.signing_keys[key] = signing_key
+            return signing_key
+
+    def get_credential(self, date_stamp):
+        """Get the credential naming the access key and scope of a signature.
+
+        @param date_stamp: The day of the signature formatted as YYYYMMDD.
+        @type date_stamp: str
+        @return: The access key followed by the credential scope.
+        @rtype: str
+        """
+        return '/'.join([
+            self.access_key,
+            date_stamp,
+            self.region,
+            S3_SERVICE,
+            SIGV4_TERMINATOR
+        ])
+
+    def get_bucket_url(self):
+        """Get the URL of the uploads bucket accepting POST uploads.
+
+        @return: The bucket URL.
+        @rtype: str
+        """
+        return 'https://%s/' % self.host
+
+    def create_url(self, method, object_name, expires_in, mime_type,
+            amz_headers, now):
+        """Presign a new URL for an object with AWS signature version 4.
+
+        @param method: The HTTP method the URL may be used with.
+        @type method: str
+        @param object_name: The name of the object in the uploads bucket.
+        @type object_name: str
+        @param expires_in: The number of seconds the URL will be valid for.
+        @type expires_in: int
+        @param mime_type: The content type the request must use or blank.
+        @type mime_type: str
+        @param amz_headers: Canonicalized x-amz- headers the request must
+            send or None.
+        @type amz_headers: str
+        @param now: The current time in seconds.
+        @type now: float
+        @return: The presigned URL.
+        @rtype: str
+        """
+        timestamp = time.gmtime(now)
+        date_stamp = time.strftime(SIGV4_DATE_FORMAT, timestamp)
+        amz_date = time.strftime(SIGV4_TIME_FORMAT, timestamp)
+
+        headers = [('host', self.host)]
+        if mime_type:
+            headers.append(('content-type', mime_type))
+        headers.extend(parse_amz_headers(amz_headers))
+        headers.sort()
+        signed_headers = ';'.join(name for name, value in headers)
+
+        params = sorted([
+            ('X-Amz-Algorithm', SIGV4_ALGORITHM),
+            ('X-Amz-Credential', self.get_credential(date_stamp)),
+            ('X-Amz-Date', amz_date),
+            ('X-Amz-Expires', str(int(expires_in))),
+            ('X-Amz-SignedHeaders', signed_headers)
+        ])
+        query = '&'.join(
+            '%s=%s' % (quote_uri_component(name), quote_uri_component(value))
+            for name, value in params
+        )
+
+        uri = '/' + quote_uri_component(object_name, safe='/')
+        canonical_request = '\n'.join([
+            method,
+            uri,
+            query,
+            ''.join('%s:%s\n' % header for header in headers),
+            signed_headers,
+            UNSIGNED_PAYLOAD
+        ])
+        string_to_sign = '\n'.join([
+            SIGV4_ALGORITHM,
+            amz_date,
+            '/'.join([date_stamp, self.region, S3_SERVICE, SIGV4_TERMINATOR]),
+            hashlib.sha256(canonical_request).hexdigest()
+        ])
+        signature = hmac.new(
+            self.get_signing_key(date_stamp),
+            string_to_sign,
+            hashlib.sha256
+        ).hexdigest()
+
+        return 'https://%s%s?%s&X-Amz-Signature=%s' % (
+            self.host,
+            uri,
+            query,
+            signature
+        )
+
+    def create_post_policy(self, object_name, expires_in, max_size,
+            mime_type=ZIP_MIME_TYPE, acl=PUBLIC_READ_ACL, checksum_sha256=None,
+            now=None):
+        """Create the form fields for a browser-style POST upload of an object.
+
+        @param object_name: The name of the object in the uploads bucket.
+        @type object_name: str
+        @param expires_in: The number of seconds the policy will be valid for.
+        @type expires_in: int
+        @param max_size: The maximum number of bytes that may be uploaded.
+        @type max_size: int
+        @keyword mime_type: The content type the upload must use. Defaults to
+            ZIP_MIME_TYPE.
+        @type mime_type: str
+        @keyword acl: The access control level the upload must request.
+            Defaults to public-read.
+        @type acl: str
+        @keyword checksum_sha256: Hex SHA-256 digest the uploaded contents must
+            match or None if the contents are not known ahead of time. Defaults
+            to None.
+        @type checksum_sha256: str
+        @keyword now: The current time. Defaults to None (time.time()).
+        @type now: float
+        @return: Dictionary of form fields to send before the file.
+        @rtype: dict
+        """
+        if now is None:
+            now = time.time()
+
+        timestamp = time.gmtime(now)
+        date_stamp = time.strftime(SIGV4_DATE_FORMAT, timestamp)
+
+        fields = {
+            'key': object_name,
+            'acl': acl,
+            'Content-Type': mime_type,
+            'x-amz-algorithm': SIGV4_ALGORITHM,
+            'x-amz-credential': self.get_credential(date_stamp),
+            'x-amz-date': time.strftime(SIGV4_TIME_FORMAT, timestamp)
+        }
+        if checksum_sha256:
+            fields['x-amz-checksum-sha256'] = base64.b64encode(
+                checksum_sha256.decode('hex')
+            )
+
+        conditions = [{'bucket': self.bucket_name}]
+        conditions.extend({name: fields[name]} for name in sorted(fields))
+        conditions.append(['content-length-range', 0, max_size])
+        policy = {
+            'expiration': time.strftime(
+                POLICY_EXPIRATION_FORMAT,
+                time.gmtime(now+expires_in)
+            ),
+            'conditions': conditions
+        }
+
+        fields['policy'] = base64.b64encode(json.dumps(policy))
+        fields['x-amz-signature'] = hmac.new(
+            self.get_signing_key(date_stamp),
+            fields['policy'],
+            hashlib.sha256
+        ).hexdigest()
+        return fields
+
+
+def get_signer(application):
+    """Get the URL signer for an application, creating it if needed.
+
+    @param application: The application with the S3 configuration values.
+    @type application: flask.Flask
+    @return: Signer shared across requests.
+    @rtype: URLSigner
+    """
+    signer = application.extensions.get('kpi_url_signer', None)
+    if not signer:
+        config = application.config
+        cache_size = config.get('SIGNED_URL_CACHE_SIZE', DEFAULT_URL_CACHE_SIZE)
+        if use_sigv4(application):
+            signer = SigV4URLSigner(
+                config['UPLOADS_BUCKET_NAME'],
+                config['S3_ACCESS_KEY'],
+                config['S3_SECRET_KEY'],
+                config.get('S3_REGION', DEFAULT_REGION),
+                cache_size
+            )
+        else:
+            signer = URLSigner(
+                config['UPLOADS_BUCKET_NAME'],
+                config['S3_ACCESS_KEY'],
+                config['S3_SECRET_KEY'],
+                cache_size
+            )
+        application.extensions['kpi_url_signer'] = signer
+    return signer
+
+
+def get_archive_cache(application):
+    """Get the local disk cache of archives for an application.
+
+    Uses the ARCHIVE_CACHE_DIR and ARCHIVE_CACHE_MAX_SIZE configuration values.
+
+    @param application: The application with the cache configuration values.
+    @type application: flask.Flask
+    @return: Cache shared across requests or None if ARCHIVE_CACHE_DIR is not
+        configured.
+    @rtype: ArchiveCache
+    """
+    directory = application.config.get('ARCHIVE_CACHE_DIR', None)
+    if not directory:
+        return None
+
+    cache = application.extensions.get('kpi_archive_cache', None)
+    if not cache:
+        cache = ArchiveCache(
+            directory,
+            application.config.get(
+                'ARCHIVE_CACHE_MAX_SIZE',
+                DEFAULT_ARCHIVE_CACHE_SIZE
+            )
+        )
+        application.extensions['kpi_archive_cache'] = cache
+    return cache
+
+
+def use_sigv4(application):
+    """Determine if an application signs requests with AWS signature version 4.
+
+    @param application: The application with the S3 configuration values.
+    @type application: flask.Flask
+    @return: True if the S3_SIGNATURE_VERSION configuration value is 4 and
+        False if it is 2 (the default).
+    @rtype: bool
+    """
+    version = application.config.get(
+        'S3_SIGNATURE_VERSION',
+        DEFAULT_SIGNATURE_VERSION
+    )
+    return int(version) == 4
+
+
+def get_max_upload_size(application):
+    """Get the largest package archive that may be uploaded.
+
+    @param application: The application with the archive configuration values.
+    @type application: flask.Flask
+    @return: The ARCHIVE_MAX_SIZE configuration value in bytes.
+    @rtype: int
+    """
+    return application.config.get('ARCHIVE_MAX_SIZE', DEFAULT_MAX_UPLOAD_SIZE)
+
+
+def get_upload_expiration(application):
+    """Get how long signed upload URLs are valid for.
+
+    @param application: The application with the S3 configuration values.
+    @type application: flask.Flask
+    @return: The UPLOAD_URL_EXPIRATION configuration value in seconds.
+    @rtype: int
+    """
+    return application.config.get(
+        'UPLOAD_URL_EXPIRATION',
+        DEFAULT_UPLOAD_EXPIRATION
+    )
+
+
+def get_download_expiration(application):
+    """Get how long signed download URLs are valid for.
+
+    @param application: The application with the S3 configuration values.
+    @type application: flask.Flask
+    @return: The DOWNLOAD_URL_EXPIRATION configuration value in seconds.
+    @rtype: int
+    """
+    return application.config.get(
+        'DOWNLOAD_URL_EXPIRATION',
+        DEFAULT_DOWNLOAD_EXPIRATION
+    )
+
+
+def get_archive_name(package_name):
+    """Get the name of the object in the uploads bucket for a package archive.
+
+    @param package_name: The name of the package.
+    @type package_name: str
+    @return: The name of the zip archive object.
+    @rtype: str
+    """
+    return package_name + '.zip'
+
+
+def get_delta_name(package_name, from_version, to_version):
+    """Get the name of the object in the uploads bucket for a delta archive.
+
+    @param package_name: The name of the package.
+    @type package_name: str
+    @param from_version: The version the delta updates from.
+    @type from_version: str
+    @param to_version: The version the delta updates to.
+    @type to_version: str
+    @return: The name of the delta archive object.
+    @rtype: str
+    """
+    return '%s/deltas/%s-%s.zip' % (package_name, from_version, to_version)
+
+
+def get_object_url(application, object_name):
+    """Get the public URL of an object in the uploads bucket.
+
+    Uploaded archives are public-read so they may be downloaded (and cached)
+    without a signature.
+
+    @param application: The application with the S3 configuration values.
+    @type application: flask.Flask
+    @param object_name: The name of the object in the uploads bucket.
+    @type object_name: str
+    @return: URL for the object.
+    @rtype: str
+    """
+    return OBJECT_URL_TEMPLATE % (
+        application.config['UPLOADS_BUCKET_NAME'],
+        object_name
+    )
+
+
+def create_signed_url(application, method, object_name, expires_in,
+        mime_type='', amz_headers=None):
+    """Create a URL for an object in the uploads bucket signed for one method.
+
+    @param application: The application with the S3 configuration values.
+    @type application: flask.Flask
+    @param method: The HTTP method the URL may be used with (like PUT or GET).
+    @type method: str
+    @param object_name: The name of the object in the uploads bucket.
+    @type object_name: str
+    @param expires_in: The number of seconds the URL will be valid for.
+    @type expires_in: int
+    @keyword mime_type: The content type the request must use. Defaults to
+        blank.
+    @type mime_type: str
+    @keyword amz_headers: Canonicalized x-amz- headers the request must send
+        (like x-amz-acl:public-read) or None if no headers are required.
+        Defaults to None.
+    @type amz_headers: str
+    @return: Temporary signed URL for the object.
+    @rtype: str
+    """
+    return get_signer(application).sign(
+        method,
+        object_name,
+        expires_in,
+        mime_type=mime_type,
+        amz_headers=amz_headers
+    )
+
+
+def create_signed_urls(application, method, object_names, expires_in,
+        mime_type='', amz_headers=None):
+    """Create signed URLs for many objects in the uploads bucket at once.
+
+    @param application: The application with the S3 configuration values.
+    @type application: flask.Flask
+    @param method: The HTTP method the URLs may be used with.
+    @type method: str
+    @param object_names: The names of the objects in the uploads bucket.
+    @type object_names: iterable over str
+    @param expires_in: The number of seconds the URLs will be valid for.
+    @type expires_in: int
+    @keyword mime_type: The content type the requests must use. Defaults to
+        blank.
+    @type mime_type: str
+    @keyword amz_headers: Canonicalized x-amz- headers the requests must send
+        or None if no headers are required. Defaults to None.
+    @type amz_headers: str
+    @return: Dictionary mapping object name to temporary signed URL.
+    @rtype: dict
+    """
+    signer = get_signer(application)
+    now = time.time()
+    return dict(
+        (object_name, signer.sign(
+            method,
+            object_name,
+            expires_in,
+            mime_type=mime_type,
+            amz_headers=amz_headers,
+            now=now
+        ))
+        for object_name in object_names
+    )
 
 
 def create_file_upload_url(application, package_name):
     """Create a signed URL where the contents of a resource can be uploaded.
 
+    With AWS signature version 4 uploads are instead POSTed to the bucket URL
+    along with the fields from create_file_upload_spec.
+
     @param package_name: The name of the package that a url is being generated
         for.
     @type resource: str
-    @return: Temporary URL that will accept a PUT with resource content.
+    @return: Temporary URL that will accept a PUT with resource content or the
+        bucket URL that will accept a POST with a signed policy.
     @rtype: str
     """
-    object_name = package_name + '.zip'
-    mime_type = ZIP_MIME_TYPE
+    if use_sigv4(application):
+        return get_signer(application).get_bucket_url()
 
     # Creating a signed URL where the user can post their file directly to S3,
     # avoiding costs of transmission and request timeout limits. These signed
     # URLs are strongly encouraged to have an expiration if POST.
-    expires = int(time.time()+10)
-
+    #
     # Amazon requires an access control level for each of its files. These
     # uploads should be read only by the public.
-    amz_headers = "x-amz-acl:public-read"
-
-    # We have to construct this by hand as opposed to using somebody like
-    # requestify because we have to hash it and sign it with our Amazon
-    # secret key.
-    put_request = "PUT\n\n%s\n%d\n%s\n/%s/%s" % (
-        mime_type,
-        expires,
-        amz_headers,
-        application.config['UPLOADS_BUCKET_NAME'],
-        object_name
+    return create_signed_url(
+        application,
+        'PUT',
+        get_archive_name(package_name),
+        get_upload_expiration(application),
+        mime_type=ZIP_MIME_TYPE,
+        amz_headers=PUBLIC_READ_HEADERS
     )
 
-    # Signed with secret key without revealing that secret key to the world.
-    signature = base64.encodestring(hmac.new(
-        application.config['S3_SECRET_KEY'],
-        put_request,
-        hashlib.sha1
-    ).digest())
-    signature = urllib.quote_plus(signature.strip())
 
-    # Build and return final URL
-    url = 'https://%s.s3.amazonaws.com/%s' % (
-        application.config['UPLOADS_BUCKET_NAME'],
-        object_name
+def create_file_upload_spec(application, package_name, checksum_sha256=None):
+    """Create the form fields to send along with an uploaded package archive.
+
+    @param package_name: The name of the package that an upload is being
+        prepared for.
+    @type package_name: str
+    @keyword checksum_sha256: Hex SHA-256 digest the archive must match or None
+        if not known. Defaults to None.
+    @type checksum_sha256: str
+    @return: Signed POST policy fields limiting the upload to the package's
+        archive, ZIP_MIME_TYPE, and the maximum archive size with AWS signature
+        version 4 or an empty dictionary otherwise.
+    @rtype: dict
+    """
+    if not use_sigv4(application):
+        return {}
+
+    return get_signer(application).create_post_policy(
+        get_archive_name(package_name),
+        get_upload_expiration(application),
+        get_max_upload_size(application),
+        checksum_sha256=checksum_sha256
     )
 
-    signed_req_url = '%s?AWSAccessKeyId=%s&Expires=%d&Signature=%s' % (
-        url,
-        application.config['S3_ACCESS_KEY'],
-        expires,
-        signature
+
+def create_file_download_url(application, package_name):
+    """Create a signed URL from which a package's archive can be downloaded.
+
+    @param package_name: The name of the package whose archive should be
+        downloaded.
+    @type package_name: str
+    @return: Temporary URL that will accept a GET for the archive.
+    @rtype: str
+    """
+    return create_signed_url(
+        application,
+        'GET',
+        get_archive_name(package_name),
+        get_download_expiration(application)
+    )
+
+
+def create_file_download_urls(application, package_names):
+    """Create signed URLs from which many packages' archives can be downloaded.
+
+    @param package_names: The names of the packages whose archives should be
+        downloaded.
+    @type package_names: list of str
+    @return: Dictionary mapping package name to temporary URL that will accept
+        a GET for the package's archive.
+    @rtype: dict
+    @raise ValueError: Raised if more than MAX_BATCH_SIZE packages are given.
+    """
+    if len(package_names) > MAX_BATCH_SIZE:
+        raise ValueError('At most %d URLs may be signed at once.' %
+            MAX_BATCH_SIZE)
+
+    urls = create_signed_urls(
+        application,
+        'GET',
+        [get_archive_name(name) for name in package_names],
+        get_download_expiration(application)
     )
-    return signed_req_url
+    return dict((name, urls[get_archive_name(name)]) for name in package_names)
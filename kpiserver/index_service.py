@@ -0,0 +1,326 @@
+"""Compact snapshot of the whole package index for client bootstrap.
+
+New clients need the full catalog. Instead of requesting each package the
+server publishes the catalog as a single versioned, gzip compressed file that
+clients download once and then read in place.
+
+The uncompressed file is little endian binary:
+
+ - A header with the magic bytes, format version, number of packages, number
+   of strings, and the offsets of the string and name tables.
+ - The string table: one offset per string plus a final end offset followed
+   by the UTF-8 string data. Versions, licenses, and author usernames are
+   stored once here and referred to by index.
+ - The name table: the offset of each package's entry, sorted by package
+   name so that clients can binary search it.
+ - The entries: the package name, the string indices of its version and
+   license, its revision, the string indices of its authors, and the
+   remaining public fields as compact JSON.
+
+Usage on the primary (for example from cron):
+```python index_service.py``` publishes a new index to INDEX_DIR.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import StringIO
+import struct
+import sys
+
+import db_service
+
+INDEX_MAGIC = 'KPIX'
+INDEX_FORMAT_VERSION = 1
+HEADER_FORMAT = '<4sHHIIII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+OFFSET_FORMAT = '<%dI'
+NAME_FORMAT = '<H'
+ENTRY_FORMAT = '<IIIH'
+EXTRA_FORMAT = '<I'
+
+EXTRA_FIELDS = ['humanName', 'description', 'homepage', 'repository']
+
+DEFAULT_INDEX_DIR = 'index'
+MANIFEST_NAME = 'index.json'
+INDEX_FILE_TEMPLATE = 'index-%s.kpix.gz'
+INDEX_MIME_TYPE = 'application/gzip'
+VERSION_LENGTH = 16
+
+
+def encode_string(value):
+    """Get the UTF-8 bytes of a string stored in the index.
+
+    @param value: The string to encode.
+    @type value: basestring
+    @return: The encoded string.
+    @rtype: str
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def get_authors(package):
+    """Get the list of authors of a package.
+
+    @param package: The package record.
+    @type package: dict
+    @return: The usernames of the authors.
+    @rtype: list of str
+    """
+    authors = package.get('authors', [])
+    if isinstance(authors, basestring):
+        return [authors]
+    return list(authors)
+
+
+class StringTable:
+    """Table of strings shared by index entries."""
+
+    def __init__(self):
+        """Create a new empty table."""
+        self.ids = {}
+        self.strings = []
+
+    def add(self, value):
+        """Get the index of a string, adding it to the table if needed.
+
+        @param value: The string to look up.
+        @type value: basestring
+        @return: The index of the string in the table.
+        @rtype: int
+        """
+        encoded = encode_string(value)
+        string_id = self.ids.get(encoded, None)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.ids[encoded] = string_id
+            self.strings.append(encoded)
+        return string_id
+
+    def encode(self, offset):
+        """Create the binary table of offsets and string data.
+
+        @param offset: The offset in the file the table will be written at.
+        @type offset: int
+        @return: The encoded table.
+        @rtype: str
+        """
+        data_offset = offset + 4 * (len(self.strings) + 1)
+        offsets = [data_offset]
+        for value in self.strings:
+            offsets.append(offsets[-1] + len(value))
+        return struct.pack(OFFSET_FORMAT % len(offsets), *offsets) + \
+            ''.join(self.strings)
+
+
+def encode_entry(package, strings):
+    """Create the binary index entry for a package.
+
+    @param package: The package record.
+    @type package: dict
+    @param strings: The table to add the package's shared strings to.
+    @type strings: StringTable
+    @return: The encoded entry.
+    @rtype: str
+    """
+    name = encode_string(package['name'])
+    authors = [strings.add(author) for author in get_authors(package)]
+    extra = json.dumps(
+        dict(
+            (field, package[field]) for field in EXTRA_FIELDS
+            if field in package
+        ),
+        separators=(',', ':'),
+        sort_keys=True
+    )
+    return ''.join([
+        struct.pack(NAME_FORMAT, len(name)),
+        name,
+        struct.pack(
+            ENTRY_FORMAT,
+            strings.add(package.get('version', '')),
+            strings.add(package.get('license', '')),
+            package.get(db_service.REVISION_FIELD, 0),
+            len(authors)
+        ),
+        struct.pack(OFFSET_FORMAT % len(authors), *authors),
+        struct.pack(EXTRA_FORMAT, len(extra)),
+        extra
+    ])
+
+
+def build_index(packages):
+    """Create the uncompressed index of a set of packages.
+
+    @param packages: The record of each package to include.
+    @type packages: iterable of dict
+    @return: The index file contents.
+    @rtype: str
+    """
+    packages = sorted(
+        packages,
+        key=lambda package: encode_string(package['name'])
+    )
+    strings = StringTable()
+    entries = [encode_entry(package, strings) for package in packages]
+
+    string_table_offset = HEADER_SIZE
+    string_table = strings.encode(string_table_offset)
+    name_table_offset = string_table_offset + len(string_table)
+    entry_offset = name_table_offset + 4 * len(entries)
+    entry_offsets = []
+    for entry in entries:
+        entry_offsets.append(entry_offset)
+        entry_offset += len(entry)
+
+    header = struct.pack(
+        HEADER_FORMAT,
+        INDEX_MAGIC,
+        INDEX_FORMAT_VERSION,
+        0,
+        len(entries),
+        len(strings.strings),
+        string_table_offset,
+        name_table_offset
+    )
+    name_table = struct.pack(OFFSET_FORMAT % len(entries), *entry_offsets)
+    return header + string_table + name_table + ''.join(entries)
+
+
+def get_index_dir(application):
+    """Get the directory indices are published to.
+
+    @param application: The application whose INDEX_DIR configuration value
+        names the directory.
+    @type application: flask.Flask
+    @return: The absolute path of the directory.
+    @rtype: str
+    """
+    return os.path.abspath(
+        application.config.get('INDEX_DIR', DEFAULT_INDEX_DIR)
+    )
+
+
+def read_manifest(index_dir):
+    """Read the description of the most recently published index.
+
+    @param index_dir: The directory indices are published to.
+    @type index_dir: str
+    @return: The manifest or None if no index has been published.
+    @rtype: dict
+    """
+    try:
+        with open(os.path.join(index_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except IOError:
+        return None
+
+
+def write_atomically(path, contents):
+    """Replace a file so that readers never see a partial write.
+
+    @param path: The path of the file to replace.
+    @type path: str
+    @param contents: The new contents of the file.
+    @type contents: str
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(contents)
+    os.rename(temp_path, path)
+
+
+def compress(contents):
+    """Gzip compress an index the same way every time.
+
+    @param contents: The uncompressed index.
+    @type contents: str
+    @return: The compressed index.
+    @rtype: str
+    """
+    compressed = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as f:
+        f.write(contents)
+    return compressed.getvalue()
+
+
+def publish_index(db_adapter, index_dir):
+    """Write a new index of every package and point the manifest at it.
+
+    The previously published index is kept so that clients that read the old
+    manifest can finish downloading it. Older indices are removed.
+
+    @param db_adapter: The database to read packages from.
+    @type db_adapter: db_service.DBAdapter
+    @param index_dir: The directory to publish to. Created if needed.
+    @type index_dir: str
+    @return: The new manifest.
+    @rtype: dict
+    """
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+
+    packages = list(db_adapter.get_packages())
+    contents = build_index(packages)
+    compressed = compress(contents)
+    version = hashlib.sha256(contents).hexdigest()[:VERSION_LENGTH]
+    manifest = {
+        'format': INDEX_FORMAT_VERSION,
+        'version': version,
+        'file': INDEX_FILE_TEMPLATE % version,
+        'packages': len(packages),
+        'size': len(compressed),
+        'uncompressed_size': len(contents),
+        'sha256': hashlib.sha256(compressed).hexdigest()
+    }
+
+    previous = read_manifest(index_dir)
+    write_atomically(os.path.join(index_dir, manifest['file']), compressed)
+    write_atomically(
+        os.path.join(index_dir, MANIFEST_NAME),
+        json.dumps(manifest, sort_keys=True)
+    )
+
+    keep = set([manifest['file'], MANIFEST_NAME])
+    if previous:
+        keep.add(previous['file'])
+    for file_name in os.listdir(index_dir):
+        if file_name.startswith('index-') and not file_name in keep:
+            os.remove(os.path.join(index_dir, file_name))
+    return manifest
+
+
+def main():
+    """Publish the index from the command line.
+
+    @return: Exit status.
+    @rtype: int
+    """
+    parser = argparse.ArgumentParser(description='Publish the index.')
+    parser.add_argument('--config', default='kpiserver.cfg')
+    args = parser.parse_args()
+
+    import flask
+
+    app = flask.Flask(__name__)
+    app.config.from_pyfile(os.path.abspath(args.config))
+    with app.app_context():
+        db_adapter = db_service.create_command_adapter(app)
+        manifest = publish_index(db_adapter, get_index_dir(app))
+    print 'Published %s with %d packages (%d bytes).' % (
+        manifest['file'],
+        manifest['packages'],
+        manifest['size']
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
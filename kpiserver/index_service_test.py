@@ -0,0 +1,160 @@
+"""Tests for the compact snapshot of the whole package index.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import StringIO
+import struct
+import tempfile
+import unittest
+
+import db_service
+import index_service
+import load_test
+
+TEST_PACKAGES = [
+    {
+        'name': 'zeta',
+        'humanName': 'Zeta',
+        'version': '1.0.0',
+        'license': 'MIT',
+        'authors': ['author'],
+        'description': 'Last package.',
+        'revision': 3,
+        '_id': 'ignored'
+    },
+    {
+        'name': u'alpha',
+        'humanName': u'Alpha \u03b1',
+        'version': '1.0.0',
+        'license': 'MIT',
+        'authors': 'author',
+        'homepage': 'https://example.com'
+    }
+]
+
+
+def read_strings(index):
+    """Decode the string table of an index for checking."""
+    header = struct.unpack_from(index_service.HEADER_FORMAT, index)
+    num_strings = header[4]
+    offsets = struct.unpack_from('<%dI' % (num_strings + 1), index, header[5])
+    return [
+        index[offsets[i]:offsets[i + 1]]
+        for i in range(num_strings)
+    ]
+
+
+def read_entry(index, entry_offset):
+    """Decode an index entry for checking."""
+    strings = read_strings(index)
+    name_length = struct.unpack_from('<H', index, entry_offset)[0]
+    position = entry_offset + 2
+    name = index[position:position + name_length]
+    position += name_length
+    version, license, revision, num_authors = struct.unpack_from(
+        index_service.ENTRY_FORMAT,
+        index,
+        position
+    )
+    position += struct.calcsize(index_service.ENTRY_FORMAT)
+    authors = struct.unpack_from('<%dI' % num_authors, index, position)
+    position += 4 * num_authors
+    extra_length = struct.unpack_from('<I', index, position)[0]
+    position += 4
+    record = json.loads(index[position:position + extra_length])
+    record.update({
+        'name': name,
+        'version': strings[version],
+        'license': strings[license],
+        'revision': revision,
+        'authors': [strings[author] for author in authors]
+    })
+    return record
+
+
+class IndexServiceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_build_index(self):
+        index = index_service.build_index(TEST_PACKAGES)
+        header = struct.unpack_from(index_service.HEADER_FORMAT, index)
+        self.assertEqual(header[:4], ('KPIX', 1, 0, 2))
+
+        self.assertEqual(read_strings(index), ['author', '1.0.0', 'MIT'])
+
+        entry_offsets = struct.unpack_from('<2I', index, header[6])
+        alpha = read_entry(index, entry_offsets[0])
+        self.assertEqual(alpha['name'], 'alpha')
+        self.assertEqual(alpha['humanName'], u'Alpha \u03b1')
+        self.assertEqual(alpha['authors'], ['author'])
+        self.assertEqual(alpha['revision'], 0)
+
+        zeta = read_entry(index, entry_offsets[1])
+        self.assertEqual(zeta['name'], 'zeta')
+        self.assertEqual(zeta['revision'], 3)
+        self.assertEqual(zeta['description'], 'Last package.')
+        self.assertFalse('_id' in zeta)
+
+    def test_build_index_empty(self):
+        index = index_service.build_index([])
+        self.assertEqual(
+            struct.unpack_from(index_service.HEADER_FORMAT, index)[3],
+            0
+        )
+
+    def test_read_manifest_missing(self):
+        self.assertEqual(index_service.read_manifest(self.directory), None)
+
+    def test_publish_index(self):
+        db_adapter = load_test.LoadTestDBAdapter()
+        db_adapter.put_package(dict(
+            TEST_PACKAGES[0],
+            name='first',
+            humanName='First'
+        ))
+        index_dir = os.path.join(self.directory, 'index')
+
+        first = index_service.publish_index(db_adapter, index_dir)
+        self.assertEqual(index_service.read_manifest(index_dir), first)
+        self.assertEqual(first['packages'], 1)
+        with open(os.path.join(index_dir, first['file']), 'rb') as f:
+            compressed = f.read()
+        self.assertEqual(first['size'], len(compressed))
+        self.assertEqual(
+            first['sha256'],
+            hashlib.sha256(compressed).hexdigest()
+        )
+        contents = gzip.GzipFile(fileobj=StringIO.StringIO(compressed)).read()
+        self.assertEqual(first['uncompressed_size'], len(contents))
+
+        self.assertEqual(
+            index_service.publish_index(db_adapter, index_dir),
+            first
+        )
+
+        db_adapter.put_package(dict(TEST_PACKAGES[0], name='second'))
+        second = index_service.publish_index(db_adapter, index_dir)
+        db_adapter.put_package(dict(TEST_PACKAGES[0], name='third'))
+        third = index_service.publish_index(db_adapter, index_dir)
+
+        self.assertNotEqual(second['version'], third['version'])
+        self.assertEqual(
+            sorted(os.listdir(index_dir)),
+            sorted(['index.json', second['file'], third['file']])
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
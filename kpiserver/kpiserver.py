@@ -7,22 +7,64 @@ archive uploads.
 @author: Sam Pottinger (samnsparky)
 @license: GNU GPL v3
 """
-import json
+import functools
 
 import flask
 from flask.ext.pymongo import PyMongo
-from werkzeug.security import generate_password_hash
+from werkzeug.datastructures import ContentRange
 
+import archive_service
+import audit_service
+import cache_service
 import db_service
 import email_service
 import file_store_service
+import index_service
+import password_service
+import rate_limit_service
+import responses
+import stats_service
+import user_import_service
 import util
+import versions
 
 app = flask.Flask(__name__)
 app.config.from_pyfile('kpiserver.cfg', silent=True)
+util.configure_proxies(app)
+
+READ_ONLY_MSG = 'This server is a read only mirror.'
+READ_ONLY_STATUS = 503
+ARCHIVE_PENDING_MSG = 'The archive for version %s has not been validated yet.'
+ARCHIVE_PENDING_STATUS = 409
+
+
+def writes_database(route):
+    """Decorator rejecting requests to a route on read only mirrors.
+
+    Checked before the route does any work like hashing a password.
+
+    @param route: The route function that writes to the database.
+    @type route: function
+    @return: The decorated route.
+    @rtype: function
+    """
+
+    @functools.wraps(route)
+    def decorated_route(*args, **kwargs):
+        if db_service.is_read_only(app):
+            return responses.create_json_response(
+                util.create_error_message(READ_ONLY_MSG),
+                READ_ONLY_STATUS
+            )
+        return route(*args, **kwargs)
+
+    return decorated_route
 
 
 @app.route('/kpi/users.json', methods=['POST'])
+@cache_service.cache_policy('no_store')
+@writes_database
+@rate_limit_service.rate_limited('user_create', False)
 def create_user():
     """Creates a new user in the package index's user access controls system.
 
@@ -47,28 +89,109 @@ def create_user():
     username = flask.request.form['username']
     email = flask.request.form['email']
 
-    if db_adapter.get_user(username):
-        return json.dumps(util.create_error_message(
-            'A user with that username or email address already exists.'
-        ))
-
-    if db_adapter.get_user_by_email(email):
-        return json.dumps(util.create_error_message(
-            'A user with that username or email address already exists.'
-        ))
-
     new_password = util.generate_password()
-    password_hash = generate_password_hash(new_password)
-    db_adapter.put_user({
+    password_hash = password_service.hash_password(app, new_password)
+    inserted = db_adapter.insert_user({
         'username': username,
         'email': email,
         'password_hash': password_hash
     })
+    audit_service.log_event(
+        audit_service.USER_CREATE_EVENT,
+        username=username,
+        success=bool(inserted)
+    )
+    if not inserted:
+        return responses.create_json_response(util.create_error_message(
+            'A user with that username or email address already exists.'
+        ))
+
     email_service.send_password_email(app, email, username, new_password)
-    return json.dumps(util.create_success_message('User account created.'))
+    return responses.create_json_response(
+        util.create_success_message('User account created.')
+    )
+
+
+@app.route('/kpi/users/import.json', methods=['POST'])
+@cache_service.cache_policy('no_store')
+@writes_database
+@rate_limit_service.rate_limited('package_write')
+def import_users():
+    """Create many users at once. Only available to administrators.
+
+    Every user is checked before any are created. Users whose username or
+    email address is already taken are skipped. Each new user is sent an email
+    with a temporary password.
+
+    Form-encoded params:
+
+     - ```username``` The name of the administrator importing users.
+     - ```password``` The password of the administrator importing users.
+     - ```format``` The format of the users document: csv or json.
+     - ```users``` CSV rows of username,email or a JSON list of objects with
+       username and email fields.
+
+    JSON-document returned:
+
+     - ```success``` Boolean value indicating if the batch was valid.
+     - ```message``` Details about the result of the operation. Will be
+       provided in both the success and failure cases.
+     - ```errors``` List of problems found in the batch. Only provided if the
+       batch was invalid.
+     - ```created``` List of usernames created. Only provided on success.
+     - ```skipped``` List of usernames skipped because the username or email
+       was taken. Only provided on success.
+
+    @return: JSON document
+    @rtype: flask.response
+    """
+    form_info = flask.request.form
+    has_permissions = util.check_permissions(
+        db_adapter,
+        form_info['username'],
+        form_info['password']
+    )
+    if not has_permissions or \
+        not user_import_service.is_admin(app, form_info['username']):
+        msg = util.create_error_message('Administrator access required.')
+        return responses.create_json_response(msg, 403)
+
+    try:
+        users = user_import_service.parse_users(
+            form_info.get('users', ''),
+            form_info.get('format', user_import_service.CSV_FORMAT)
+        )
+    except ValueError, e:
+        msg = util.create_error_message('Could not read users: %s' % e)
+        return responses.create_json_response(msg, 400)
+
+    errors = user_import_service.validate_users(users)
+    if errors:
+        msg = util.create_error_message('Invalid users provided.')
+        msg['errors'] = errors
+        return responses.create_json_response(msg, 400)
+
+    created, skipped = user_import_service.import_users(app, db_adapter, users)
+    audit_service.log_event(
+        audit_service.USER_IMPORT_EVENT,
+        username=form_info['username'],
+        created=len(created),
+        skipped=len(skipped),
+        success=True
+    )
+
+    ret_dict = util.create_success_message(
+        '%d users created.' % len(created)
+    )
+    ret_dict['created'] = created
+    ret_dict['skipped'] = skipped
+    return responses.create_json_response(ret_dict)
 
 
 @app.route('/kpi/user/<username>.json', methods=['PUT'])
+@cache_service.cache_policy('no_store')
+@writes_database
+@rate_limit_service.rate_limited('default')
 def update_user(username):
     """Updates the information about a user in the package index.
 
@@ -96,29 +219,36 @@ def update_user(username):
     old_password = flask.request.form['old_password']
     new_password = flask.request.form['new_password']
 
-    if not db_adapter.get_user(username):
-        return json.dumps(util.create_error_message(
+    if not util.check_permissions(db_adapter, username, old_password):
+        return responses.create_json_response(util.create_error_message(
             'Incorrect username or password provided.'
         ))
 
-    if not util.check_permissions(db_adapter, username, old_password):
-        return json.dumps(util.create_error_message(
+    password_hash = password_service.hash_password(app, new_password)
+    user_info = db_adapter.update_user(
+        username,
+        {'password_hash': password_hash}
+    )
+    audit_service.log_event(
+        audit_service.USER_UPDATE_EVENT,
+        username=username,
+        success=bool(user_info)
+    )
+    if not user_info:
+        return responses.create_json_response(util.create_error_message(
             'Incorrect username or password provided.'
         ))
 
-    password_hash = generate_password_hash(new_password)
-    db_adapter.put_user({
-        'username': username,
-        'password_hash': password_hash
-    })
-
-    user_info = db_adapter.get_user(username)
-
     email_service.send_password_email(app, user_info['email'], username)
-    return json.dumps(util.create_success_message('User password updated.'))
+    return responses.create_json_response(
+        util.create_success_message('User password updated.')
+    )
 
 
 @app.route('/kpi/user/<username>/reset.json', methods=['POST'])
+@cache_service.cache_policy('no_store')
+@writes_database
+@rate_limit_service.rate_limited('password_reset', False)
 def reset_user_password(username):
     """Resets a user's password for manipulating the package index.
 
@@ -134,37 +264,43 @@ def reset_user_password(username):
     @return: JSON document
     @rtype: flask.response
     """
-    if not db_adapter.get_user(username):
-        return json.dumps(util.create_error_message(
+    new_password = util.generate_password()
+    password_hash = password_service.hash_password(app, new_password)
+    user_info = db_adapter.update_user(
+        username,
+        {'password_hash': password_hash}
+    )
+    audit_service.log_event(
+        audit_service.PASSWORD_RESET_EVENT,
+        username=username,
+        success=bool(user_info)
+    )
+    if not user_info:
+        return responses.create_json_response(util.create_error_message(
             'Whoops! There was an error on the server.'
         ))
 
-    new_password = util.generate_password()
-    password_hash = generate_password_hash(new_password)
-    db_adapter.put_user({
-        'username': username,
-        'password_hash': password_hash
-    })
-
-    user_info = db_adapter.get_user(username)
-
     email_service.send_password_email(
         app,
         user_info['email'],
         username,
         new_password
     )
-    return json.dumps(util.create_success_message(
+    return responses.create_json_response(util.create_success_message(
         'Password reset. Please check your email inbox.'
     ))
 
 
 @app.route('/kpi/packages.json', methods=['POST'])
+@cache_service.cache_policy('no_store')
+@writes_database
+@rate_limit_service.rate_limited('package_write')
 def create_package():
     """Create a new package in the Kipling package index.
 
     Create a new package in the index. No prior packages may have the same name
-    and the submitting user must be in the authors list.
+    and the submitting user must be in the authors list. Responds with a 409 if
+    a package by the same name exists, including one created concurrently.
 
     Form-encoded params:
 
@@ -202,7 +338,7 @@ def create_package():
         form_info['password']
     )
     if not has_permissions:
-        return json.dumps(
+        return responses.create_json_response(
             util.create_error_message('Username or password incorrect.')
         )
 
@@ -214,25 +350,36 @@ def create_package():
 
     for field in db_service.MINIMUM_REQUIRED_PACKAGE_FIELDS:
         if not field in record:
-            return json.dumps(util.create_error_message(
+            return responses.create_json_response(util.create_error_message(
                 field + ' is required but not provided.'
             ))
 
-    # Check that a package of the same name does not already exist
-    if db_adapter.get_package(record['name']):
-        return json.dumps(util.create_error_message(
-            'A package by that name already exists.'
+    if not versions.is_valid_version(record['version']):
+        return responses.create_json_response(util.create_error_message(
+            'version must be major.minor.patch (ex: 1.2.34).'
         ))
 
     # Check that the user is in the authors list
     util.process_authors(record)
     if not form_info['username'] in record['authors']:
-        return json.dumps(util.create_error_message(
+        return responses.create_json_response(util.create_error_message(
             'Your username must be in the author\'s list.'
         ))
 
-    # Save the package in the data persistance mechanism
-    db_adapter.put_package(record)
+    # Save the package unless a package of the same name already exists
+    if not db_adapter.insert_package(record):
+        return responses.create_json_response(
+            util.create_error_message('A package by that name already exists.'),
+            409
+        )
+    cache_service.purge_package(app, record['name'])
+    audit_service.log_event(
+        audit_service.PACKAGE_CREATE_EVENT,
+        username=form_info['username'],
+        package=record['name'],
+        version=record['version'],
+        success=True
+    )
 
     # Create a soon to be JSON-ified dictionary indicating that the package
     # was successfully added
@@ -244,12 +391,51 @@ def create_package():
         app,
         record['name']
     )
-    ret_dict['upload_spec'] = {}
+    ret_dict['upload_spec'] = file_store_service.create_file_upload_spec(
+        app,
+        record['name']
+    )
+
+    return responses.create_json_response(ret_dict)
 
-    return json.dumps(ret_dict)
+
+@app.route('/kpi/packages/downloads.json', methods=['GET'])
+@cache_service.cache_policy('no_store')
+def read_package_downloads():
+    """Get signed URLs from which many packages' archives can be downloaded.
+
+    Query params:
+
+     - ```names``` CSV list of the names of the packages to download.
+
+    JSON-document returned:
+
+     - ```success``` Boolean indicating if the URLs were created.
+     - ```message``` Information about the error encountered. Only provided on
+       failure.
+     - ```urls``` Dictionary mapping package name to a temporary signed URL for
+       that package's zip archive.
+
+    @return: JSON document
+    @rtype: flask.response
+    """
+    names = flask.request.args.get('names', '')
+    package_names = [name.strip() for name in names.split(',') if name.strip()]
+
+    try:
+        urls = file_store_service.create_file_download_urls(app, package_names)
+    except ValueError, e:
+        msg = util.create_error_message(str(e))
+        return responses.create_json_response(msg, 400)
+
+    return responses.create_json_response({'success': True, 'urls': urls})
 
 
 @app.route('/kpi/package/<package_name>.json', methods=['GET'])
+@cache_service.cache_policy(
+    'package_read',
+    surrogate_keys=cache_service.get_package_surrogate_keys
+)
 def read_package(package_name):
     """Read information about a package already in the index.
 
@@ -285,14 +471,282 @@ def read_package(package_name):
     """
     package = db_adapter.get_package(package_name)
     if package:
-        return json.dumps({'success': True, 'record': package})
+        stats_service.record_event(
+            app,
+            db_adapter,
+            package_name,
+            stats_service.READ_EVENT
+        )
+        response = responses.create_json_response({
+            'success': True,
+            'record': responses.strip_internal_fields(package)
+        })
+        response.set_etag(str(package.get(db_service.REVISION_FIELD, 0)))
+        return response
     else:
-        return json.dumps(
+        return responses.create_json_response(
             util.create_error_message('Package not found in the index.')
         )
 
 
+@app.route('/kpi/package/<package_name>/resolve.json', methods=['GET'])
+@cache_service.cache_policy(
+    'package_read',
+    surrogate_keys=cache_service.get_package_surrogate_keys
+)
+def resolve_package(package_name):
+    """Find the newest release of a package that satisfies a version range.
+
+    Every release is kept so an older release is returned if the current one
+    is outside of the range.
+
+    Query params:
+
+     - ```range``` The version constraint to satisfy like 1.2.3, 1.x, ^1.2,
+       ~1.2.3, or >=1.0.0 <2.0.0. Defaults to * (any version).
+
+    JSON-document returned:
+
+     - ```success``` Boolean indicating if a satisfying release was found.
+     - ```message``` Information about the error encountered. Only provided on
+       failure.
+     - ```record``` Information about the package as returned by
+       read_package.
+
+    @param package_name: The name of the package to resolve.
+    @type package_name: str
+    @return: JSON document
+    @rtype: flask.response
+    """
+    version_range = flask.request.args.get('range', '*')
+    try:
+        lower_key, upper_key = versions.parse_range(version_range)
+    except ValueError:
+        msg = util.create_error_message('Invalid version range.')
+        return responses.create_json_response(msg, 400)
+
+    package = db_adapter.get_latest_package_in_range(
+        package_name,
+        lower_key,
+        upper_key
+    )
+    if package:
+        response = responses.create_json_response({
+            'success': True,
+            'record': responses.strip_internal_fields(package)
+        })
+        response.set_etag(str(package.get(db_service.REVISION_FIELD, 0)))
+        return response
+    else:
+        return responses.create_json_response(util.create_error_message(
+            'No version of the package satisfies the range.'
+        ))
+
+
+@app.route('/kpi/package/<package_name>/deltas.json', methods=['GET'])
+@cache_service.cache_policy(
+    'package_read',
+    surrogate_keys=cache_service.get_package_surrogate_keys
+)
+def read_package_deltas(package_name):
+    """List the downloads available for the current version of a package.
+
+    JSON-document returned:
+
+     - ```success``` Boolean indicating if the package has a validated archive.
+       Answered with a 409 if the current version's archive has not been
+       validated yet.
+     - ```message``` Information about the error encountered. Only provided on
+       failure.
+     - ```version``` The current version of the package.
+     - ```archive``` The full archive with ```url```, ```size```, and
+       ```sha256```.
+     - ```manifest``` The files within the current version each with
+       ```path```, ```size```, and ```sha256```.
+     - ```deltas``` Delta archives with the files changed since a prior
+       version, each with ```from_version```, ```url```, ```size```,
+       ```sha256```, and ```files```.
+
+    @param package_name: The name of the package to list downloads for.
+    @type package_name: str
+    @return: JSON document
+    @rtype: flask.response
+    """
+    package = db_adapter.get_package(package_name)
+    archive = package and package.get(db_service.ARCHIVE_FIELD, None)
+    if not archive or archive['status'] != archive_service.STATUS_VALID:
+        return responses.create_json_response(util.create_error_message(
+            'No validated archive for this package.'
+        ))
+    if not archive_service.is_current_archive(package, archive):
+        return responses.create_json_response(
+            util.create_error_message(ARCHIVE_PENDING_MSG % package['version']),
+            ARCHIVE_PENDING_STATUS
+        )
+
+    stats_service.record_event(
+        app,
+        db_adapter,
+        package_name,
+        stats_service.DOWNLOAD_EVENT
+    )
+
+    archive_name = file_store_service.get_archive_name(package_name)
+    deltas = []
+    for delta in archive.get('deltas', []):
+        deltas.append({
+            'from_version': delta['from_version'],
+            'url': file_store_service.get_object_url(app, delta['object']),
+            'size': delta['size'],
+            'sha256': delta['sha256'],
+            'files': delta['files']
+        })
+
+    response = responses.create_json_response({
+        'success': True,
+        'version': archive['module']['version'],
+        'archive': {
+            'url': file_store_service.get_object_url(app, archive_name),
+            'size': archive['size'],
+            'sha256': archive['sha256']
+        },
+        'manifest': archive['manifest'],
+        'deltas': deltas
+    })
+    response.set_etag(str(package.get(db_service.REVISION_FIELD, 0)))
+    return response
+
+
+@app.route('/kpi/package/<package_name>/archive.zip', methods=['GET'])
+@cache_service.cache_policy(
+    'package_read',
+    surrogate_keys=cache_service.get_package_surrogate_keys
+)
+def read_package_archive(package_name):
+    """Download a package's validated archive through the package index.
+
+    For networks that cannot reach the uploads bucket directly. The archive is
+    streamed from the archive store in fixed size chunks. A single byte range
+    may be requested with a Range header to resume an interrupted download.
+    The ETag is the archive's SHA-256 digest so an If-Range header naming a
+    different archive gets the full new archive instead of a partial one.
+    Answered with a 409 while the current version's archive has not been
+    validated.
+
+    @param package_name: The name of the package to download.
+    @type package_name: str
+    @return: The archive contents or a JSON document describing the error.
+    @rtype: flask.response
+    """
+    package = db_adapter.get_package(package_name)
+    archive = package and package.get(db_service.ARCHIVE_FIELD, None)
+    if not archive or archive['status'] != archive_service.STATUS_VALID:
+        return responses.create_json_response(
+            util.create_error_message('No validated archive for this package.'),
+            404
+        )
+    if not archive_service.is_current_archive(package, archive):
+        return responses.create_json_response(
+            util.create_error_message(ARCHIVE_PENDING_MSG % package['version']),
+            ARCHIVE_PENDING_STATUS
+        )
+
+    size = archive['size']
+    etag = archive['sha256']
+    start, end = util.get_requested_range(flask.request, etag, size)
+    if start is None:
+        response = responses.create_json_response(
+            util.create_error_message('Requested range not satisfiable.'),
+            416
+        )
+        response.headers['Content-Range'] = 'bytes */%d' % size
+        return response
+
+    try:
+        stream = archive_service.open_archive_range(
+            app,
+            package_name,
+            etag,
+            start,
+            end
+        )
+    except IOError:
+        msg = util.create_error_message('Archive unavailable.')
+        return responses.create_json_response(msg, 502)
+
+    if start == 0:
+        stats_service.record_event(
+            app,
+            db_adapter,
+            package_name,
+            stats_service.PROXY_DOWNLOAD_EVENT
+        )
+
+    response = flask.Response(
+        archive_service.stream_archive(stream, end - start),
+        mimetype=file_store_service.ZIP_MIME_TYPE,
+        direct_passthrough=True
+    )
+    response.call_on_close(stream.close)
+    response.content_length = end - start
+    response.headers['Accept-Ranges'] = 'bytes'
+    if end - start != size:
+        response.status_code = 206
+        response.content_range = ContentRange('bytes', start, end, size)
+    response.set_etag(etag)
+    return response
+
+
+@app.route('/kpi/package/<package_name>/stats.json', methods=['GET'])
+@cache_service.cache_policy('stats_read')
+def read_package_stats(package_name):
+    """Get hourly read and download counts for a package.
+
+    Counts are of requests reaching the package index (not those answered by
+    a cache in front of it) and are written in batches so the current hour
+    may lag by up to STATS_FLUSH_INTERVAL seconds.
+
+    Query params:
+
+     - ```hours``` The number of recent hours to report on including the
+       current one. Defaults to 168 (one week).
+
+    JSON-document returned:
+
+     - ```success``` Boolean indicating if the report was created.
+     - ```message``` Information about the error encountered. Only provided on
+       failure.
+     - ```since``` The start of the earliest hour reported on in seconds since
+       epoch.
+     - ```totals``` Dictionary of event name (```reads```, ```downloads```,
+       ```proxy_downloads```) to the total count.
+     - ```hours``` Hourly counts in order. Hours without events are omitted.
+
+    @param package_name: The name of the package to report on.
+    @type package_name: str
+    @return: JSON document
+    @rtype: flask.response
+    """
+    try:
+        hours = int(flask.request.args.get(
+            'hours',
+            stats_service.DEFAULT_REPORT_HOURS
+        ))
+        since_hour = stats_service.get_since_hour(hours)
+    except ValueError, e:
+        msg = util.create_error_message(str(e))
+        return responses.create_json_response(msg, 400)
+
+    rollups = db_adapter.get_package_stats(package_name, since_hour)
+    ret_dict = stats_service.summarize(rollups, since_hour)
+    ret_dict['success'] = True
+    return responses.create_json_response(ret_dict)
+
+
 @app.route('/kpi/package/<package_name>.json', methods=['PUT'])
+@cache_service.cache_policy('no_store')
+@writes_database
+@rate_limit_service.rate_limited('package_write')
 def update_package(package_name):
     """Update information about a package already in the index.
 
@@ -300,6 +754,11 @@ def update_package(package_name):
     name, the submitting user must have permissions to edit that package, and
     the submitting user must be in the authors list.
 
+    An expected revision may be given as the ETag in an If-Match header or as
+    a revision form field. The update is rejected with a 409 if the package's
+    metadata changed since that revision. Saving archive validation results
+    also increments the revision but does not cause a conflict.
+
     Form-encoded params:  
 
      - ```username``` The username of the user who is updating the package.
@@ -309,11 +768,13 @@ def update_package(package_name):
      - ```license``` String description of the license the package is released
        under (like MIT or GNU GPL v3)
      - ```name``` The machine safe name (any valid javascript identifier) of the
-       package. 
+       package. Must match the package being updated.
      - ```humanName``` The name of the package to present to the user (can be
        any valid string).
      - ```version``` The major.minor.incremental (ex: 1.2.34) version number
-       that this package is currently releasing.
+       that this package is currently releasing. Versions in older formats
+       are only accepted for packages whose current version is also in an
+       older format.
      - May also include module.json fields listed in README for kpiclient.
 
     JSON-document returned:
@@ -331,18 +792,24 @@ def update_package(package_name):
     record = {}
     form_info = flask.request.form
 
-    # Check that the user has sufficient permissions to modify the package info.
+    try:
+        expected_revision = util.get_expected_revision(flask.request)
+    except ValueError:
+        msg = util.create_error_message('If-Match must be a package revision.')
+        return responses.create_json_response(msg, 400)
+
+    # Check the user's password. Authorship of the package is checked as part
+    # of the update itself.
     has_permissions = util.check_permissions(
         db_adapter,
         form_info['username'],
-        form_info['password'],
-        package_name
+        form_info['password']
     )
     if not has_permissions:
         msg = util.create_error_message(
             'Username, password, or package name incorrect.'
         )
-        return json.dumps(msg)
+        return responses.create_json_response(msg)
 
     # Check for all required fields for the package metadata document and that
     # no unallowed fields are being inclued
@@ -352,13 +819,61 @@ def update_package(package_name):
 
     for field in db_service.MINIMUM_REQUIRED_PACKAGE_FIELDS:
         if not field in record:
-            return json.dumps(util.create_error_message(
+            return responses.create_json_response(util.create_error_message(
                 field + ' is required but not provided.'
             ))
 
-    # Save to the data persistance service
+    # Packages may not be renamed since the new name could belong to another
+    # package.
+    if record['name'] != package_name:
+        msg = util.create_error_message(
+            'name must match the package being updated.'
+        )
+        return responses.create_json_response(msg, 400)
+
+    # Packages published before versions were validated may keep using older
+    # version formats but others must use major.minor.patch. The update itself
+    # also checks this in case the version changes in the meantime.
+    if not versions.is_valid_version(record['version']):
+        current = db_adapter.get_package(package_name)
+        if current and versions.is_valid_version(current['version']):
+            msg = util.create_error_message(
+                'version must be major.minor.patch (ex: 1.2.34).'
+            )
+            return responses.create_json_response(msg, 400)
+
+    # Save to the data persistance service if the user is an author and, if
+    # the client specified one, the package is still at the expected revision.
+    # Revisions added by archive validation since then do not conflict.
     util.process_authors(record)
-    db_adapter.put_package(record)
+    revision = db_adapter.update_package_as_author(
+        package_name,
+        form_info['username'],
+        record,
+        expected_revision
+    )
+    audit_service.log_event(
+        audit_service.PACKAGE_UPDATE_EVENT,
+        username=form_info['username'],
+        package=package_name,
+        version=record['version'],
+        revision=revision,
+        success=revision != None
+    )
+    if revision == None:
+        is_conflict = expected_revision != None and \
+            db_adapter.is_package_author(package_name, form_info['username'])
+        if is_conflict:
+            msg = util.create_error_message(
+                'Package was modified since the expected revision.'
+            )
+            return responses.create_json_response(msg, 409)
+
+        msg = util.create_error_message(
+            'Username, password, or package name incorrect.'
+        )
+        return responses.create_json_response(msg)
+    cache_service.purge_package(app, package_name)
 
     # Generate soon to be JSON-ified dictionary indicating a successful package
     # update.
@@ -369,12 +884,74 @@ def update_package(package_name):
         app,
         package_name
     )
-    ret_status['upload_spec'] = {}
+    ret_status['upload_spec'] = file_store_service.create_file_upload_spec(
+        app,
+        package_name
+    )
+    ret_status['revision'] = revision
+
+    response = responses.create_json_response(ret_status)
+    response.set_etag(str(revision))
+    return response
 
-    return json.dumps(ret_status)
+
+@app.route('/kpi/package/<package_name>/uploaded.json', methods=['POST'])
+@cache_service.cache_policy('no_store')
+@writes_database
+@rate_limit_service.rate_limited('package_write')
+def complete_package_upload(package_name):
+    """Report that a package's zip archive finished uploading.
+
+    Queues the archive for validation and extraction of its module.json and
+    file manifest. The results are saved on the package record in the
+    ```archive``` field once processing finishes.
+
+    Form-encoded params:
+
+     - ```username``` The username of the user who uploaded the archive.
+     - ```password``` The password of the user who uploaded the archive.
+
+    JSON-document returned:
+
+     - ```success``` Boolean value indicating if the archive was queued for
+       processing.
+     - ```message``` Details about the result of the operation. Will be provided
+       in both the success and failure cases.
+
+    @param package_name: The name of the package whose archive was uploaded.
+    @type package_name: str
+    @return: JSON document
+    @rtype: flask.response
+    """
+    form_info = flask.request.form
+    uac_error = util.create_error_message(
+        'Username, password, or package name incorrect.'
+    )
+
+    has_permissions = util.check_permissions(
+        db_adapter,
+        form_info['username'],
+        form_info['password']
+    )
+    if not has_permissions:
+        return responses.create_json_response(uac_error)
+
+    package = db_adapter.get_package(package_name)
+    if not package or not form_info['username'] in package['authors']:
+        return responses.create_json_response(uac_error)
+
+    archive_service.enqueue_archive(app, db_adapter, package)
+
+    return responses.create_json_response(
+        util.create_success_message('Archive queued for validation.'),
+        202
+    )
 
 
 @app.route('/kpi/package/<package_name>.json/delete', methods=['POST'])
+@cache_service.cache_policy('no_store')
+@writes_database
+@rate_limit_service.rate_limited('package_write')
 def delete_package(package_name):
     """Remove a package from the index.
 
@@ -396,34 +973,114 @@ def delete_package(package_name):
     @return: JSON document
     @rtype: flask.response
     """
+    username = flask.request.form['username']
     has_permissions = util.check_permissions(
         db_adapter,
-        flask.request.form['username'],
-        flask.request.form['password'],
-        package_name
+        username,
+        flask.request.form['password']
     )
-    if not has_permissions:
+    if has_permissions:
+        deleted = db_adapter.delete_package_as_author(package_name, username)
+    else:
+        deleted = False
+
+    audit_service.log_event(
+        audit_service.PACKAGE_DELETE_EVENT,
+        username=username,
+        package=package_name,
+        success=deleted
+    )
+    if not deleted:
         msg = util.create_error_message(
             'Username, password, or package name incorrect.'
         )
-        return json.dumps(msg)
+        return responses.create_json_response(msg)
+
+    cache_service.purge_package(app, package_name)
+    return responses.create_json_response(
+        util.create_success_message('Package deleted.')
+    )
 
-    db_adapter.delete_package(package_name)
-    return json.dumps(util.create_success_message('Package deleted.'))
+
+@app.route('/kpi/index.json', methods=['GET'])
+@cache_service.cache_policy('index_manifest')
+def read_index_manifest():
+    """Describe the most recently published snapshot of the whole index.
+
+    JSON-document returned:
+
+     - ```success``` Boolean indicating if an index has been published.
+     - ```message``` Information about the error encountered. Blank if no error.
+     - ```version``` Identifier of the index contents.
+     - ```file``` Name of the index to download from
+       ```/kpi/index/[file]```. The file is gzip compressed and never changes
+       so it may be cached indefinitely.
+     - ```format``` Version of the binary format of the index.
+     - ```packages``` The number of packages in the index.
+     - ```size``` The size of the compressed file in bytes.
+     - ```uncompressed_size``` The size of the index in bytes.
+     - ```sha256``` The SHA-256 digest of the compressed file.
+
+    @return: JSON document
+    @rtype: flask.response
+    """
+    manifest = index_service.read_manifest(index_service.get_index_dir(app))
+    if not manifest:
+        return responses.create_json_response(
+            util.create_error_message('No index has been published.'),
+            404
+        )
+
+    ret_dict = util.create_success_message('')
+    ret_dict.update(manifest)
+    return responses.create_json_response(ret_dict)
+
+
+@app.route('/kpi/index/<file_name>', methods=['GET'])
+@cache_service.cache_policy('index_file')
+def read_index_file(file_name):
+    """Download a published snapshot of the whole index.
+
+    @param file_name: The name of the file as given in /kpi/index.json.
+    @type file_name: str
+    @return: The gzip compressed index.
+    @rtype: flask.response
+    """
+    return flask.send_from_directory(
+        index_service.get_index_dir(app),
+        file_name,
+        mimetype=index_service.INDEX_MIME_TYPE
+    )
 
 
 @app.route('/kpi/status.json', methods=['GET'])
+@cache_service.cache_policy('no_store')
 def status():
     """Check the status of the application.
 
-    @return: JSON document with success and message fields.
+    @return: JSON document with success and message fields plus archive_cache
+        metrics if the local archive cache is enabled.
     @rtype: flask.response
     """
-    db_adapter.initialize_indicies()
-    return json.dumps(util.create_success_message("No errors detected."))
+    ret_dict = util.create_success_message("No errors detected.")
+
+    archive_cache = file_store_service.get_archive_cache(app)
+    if archive_cache:
+        ret_dict['archive_cache'] = archive_cache.get_stats()
+
+    return responses.create_json_response(ret_dict)
 
 
 if __name__ == '__main__':
-    mongo = PyMongo(app)
-    db_adapter = db_service.DBAdapter(mongo)
+    # Fork the hashing processes before the audit log or database client start
+    # any threads.
+    password_service.configure(app)
+    audit_service.configure(app)
+    if app.config.get('DB_BACKEND', db_service.DEFAULT_BACKEND) == 'mongo':
+        mongo = PyMongo(app)
+    else:
+        mongo = None
+    db_adapter = db_service.create_adapter(app, mongo)
+    with app.app_context():
+        db_adapter.initialize_indicies()
     app.run()
@@ -6,15 +6,30 @@
 """
 import copy
 import json
+import os
+import shutil
+import StringIO
+import tempfile
+import time
 import unittest
 
 import mox
+from bson.objectid import ObjectId
 
+import archive_service
+import audit_service
+import cache_service
 import db_service
 import email_service
 import file_store_service
+import index_service
 import kpiserver
+import password_service
+import rate_limit_service
+import stats_service
+import user_import_service
 import util
+import versions
 
 TEST_PASSWORD = 'crackme'
 TEST_OTHER_USERNAME = 'otheruser'
@@ -46,6 +61,14 @@ TEST_PACKAGE = {
     'authors': TEST_AUTHORS_INCLUSIVE
 }
 
+TEST_ARCHIVE_CONTENTS = '0123456789'
+TEST_ARCHIVE_PACKAGE = dict(TEST_PACKAGE, archive={
+    'status': 'valid',
+    'size': len(TEST_ARCHIVE_CONTENTS),
+    'sha256': 'abc',
+    'module': {'name': TEST_NAME, 'version': TEST_VERSION}
+})
+
 
 class KPIServerTests(mox.MoxTestBase):
 
@@ -53,28 +76,40 @@ class KPIServerTests(mox.MoxTestBase):
         mox.MoxTestBase.setUp(self)
         self.app = kpiserver.app.test_client()
         kpiserver.app.config['DEBUG'] = True
+        kpiserver.app.config['RATE_LIMIT_ENABLED'] = False
+        kpiserver.app.config['STATS_ENABLED'] = False
+        kpiserver.app.config['PASSWORD_HASH_PROCESSES'] = 0
 
-    def test_create_user_prior_username(self):
+    def test_write_read_only(self):
+        self.mox.StubOutWithMock(password_service, 'hash_password')
         test_adapter = self.mox.CreateMock(db_service.DBAdapter)
-        test_adapter.get_user(TEST_USERNAME).AndReturn(TEST_USER)
         self.mox.ReplayAll()
 
         kpiserver.db_adapter = test_adapter
+        kpiserver.app.config['DB_BACKEND'] = 'memory'
+        try:
+            response = self.app.post('/kpi/users.json', data=dict(
+                username=TEST_USERNAME,
+                email=TEST_EMAIL
+            ))
+            self.assertEqual(response.status_code, 503)
+            self.assertFalse(json.loads(response.data)['success'])
+
+            response = self.app.put(
+                '/kpi/package/%s.json' % TEST_NAME,
+                data=dict(username=TEST_USERNAME, password=TEST_PASSWORD)
+            )
+            self.assertEqual(response.status_code, 503)
+        finally:
+            del kpiserver.app.config['DB_BACKEND']
 
-        response = self.app.post('/kpi/users.json', data=dict(
-            username=TEST_USERNAME,
-            email=TEST_EMAIL,
-            password=TEST_PASSWORD
-        ))
-
-        self.assertEqual(response.status_code, 200)
-        json_result = json.loads(response.data)
-        self.assertFalse(json_result['success'])
-
-    def test_create_user_prior_email(self):
+    def test_create_user_prior_user(self):
         test_adapter = self.mox.CreateMock(db_service.DBAdapter)
-        test_adapter.get_user(TEST_USERNAME).AndReturn(None)
-        test_adapter.get_user_by_email(TEST_EMAIL).AndReturn(TEST_USER)
+        test_adapter.insert_user({
+            'username': TEST_USERNAME,
+            'email': TEST_EMAIL,
+            'password_hash': mox.IsA(basestring)
+        }).AndReturn(False)
         self.mox.ReplayAll()
 
         kpiserver.db_adapter = test_adapter
@@ -91,14 +126,12 @@ class KPIServerTests(mox.MoxTestBase):
 
     def test_create_user_success(self):
         test_adapter = self.mox.CreateMock(db_service.DBAdapter)
-        test_adapter.get_user(TEST_USERNAME).AndReturn(None)
-        test_adapter.get_user_by_email(TEST_EMAIL).AndReturn(None)
 
-        test_adapter.put_user({
+        test_adapter.insert_user({
             'username': TEST_USERNAME,
             'email': TEST_EMAIL,
             'password_hash': mox.IsA(basestring)
-        })
+        }).AndReturn(True)
 
         self.mox.StubOutWithMock(email_service, 'send_password_email')
         email_service.send_password_email(
@@ -122,25 +155,8 @@ class KPIServerTests(mox.MoxTestBase):
         json_result = json.loads(response.data)
         self.assertTrue(json_result['success'])
 
-    def test_update_user_no_user(self):
-        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
-        test_adapter.get_user(TEST_USERNAME).AndReturn(None)
-        self.mox.ReplayAll()
-
-        kpiserver.db_adapter = test_adapter
-
-        response = self.app.put('/kpi/user/%s.json' % TEST_USERNAME, data=dict(
-            old_password='oldpass',
-            new_password='newpass'
-        ))
-
-        self.assertEqual(response.status_code, 200)
-        json_result = json.loads(response.data)
-        self.assertFalse(json_result['success'])
-
     def test_update_user_invalid_password(self):
         test_adapter = self.mox.CreateMock(db_service.DBAdapter)
-        test_adapter.get_user(TEST_USERNAME).AndReturn(TEST_USER)
 
         self.mox.StubOutWithMock(util, 'check_permissions')
         util.check_permissions(
@@ -167,21 +183,17 @@ class KPIServerTests(mox.MoxTestBase):
         test_adapter = self.mox.CreateMock(db_service.DBAdapter)
 
         # Get through UAC
-        test_adapter.get_user(TEST_USERNAME).AndReturn(TEST_USER)
         util.check_permissions(
             test_adapter,
             TEST_USERNAME,
             'oldpass'
         ).AndReturn(True)
 
-        # Update the user
-        test_adapter.put_user({
-            'username': TEST_USERNAME,
-            'password_hash': mox.IsA(basestring)
-        })
-
-        # Get email address for user and send password update
-        test_adapter.get_user(TEST_USERNAME).AndReturn(TEST_USER)
+        # Update the user and get email address for password update
+        test_adapter.update_user(
+            TEST_USERNAME,
+            {'password_hash': mox.IsA(basestring)}
+        ).AndReturn(TEST_USER)
         email_service.send_password_email(
             kpiserver.app,
             TEST_EMAIL,
@@ -201,23 +213,34 @@ class KPIServerTests(mox.MoxTestBase):
         json_result = json.loads(response.data)
         self.assertTrue(json_result['success'])
 
+    def test_reset_user_no_user(self):
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_adapter.update_user(
+            TEST_USERNAME,
+            {'password_hash': mox.IsA(basestring)}
+        ).AndReturn(None)
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+
+        response = self.app.post('/kpi/user/%s/reset.json' % TEST_USERNAME)
+
+        self.assertEqual(response.status_code, 200)
+        json_result = json.loads(response.data)
+        self.assertFalse(json_result['success'])
+
     def test_reset_user_success(self):
         self.mox.StubOutWithMock(util, 'generate_password')
         self.mox.StubOutWithMock(email_service, 'send_password_email')
         test_adapter = self.mox.CreateMock(db_service.DBAdapter)
 
-        # Get through UAC
-        test_adapter.get_user(TEST_USERNAME).AndReturn(TEST_USER)
         util.generate_password().AndReturn(TEST_PASSWORD)
 
-        # Update the user
-        test_adapter.put_user({
-            'username': TEST_USERNAME,
-            'password_hash': mox.IsA(basestring)
-        })
-
-        # Get email address for user and send password update
-        test_adapter.get_user(TEST_USERNAME).AndReturn(TEST_USER)
+        # Update the user and get email address for password update
+        test_adapter.update_user(
+            TEST_USERNAME,
+            {'password_hash': mox.IsA(basestring)}
+        ).AndReturn(TEST_USER)
         email_service.send_password_email(
             kpiserver.app,
             TEST_EMAIL,
@@ -275,7 +298,7 @@ class KPIServerTests(mox.MoxTestBase):
             TEST_PASSWORD
         ).AndReturn(True)
 
-        test_adapter.get_package(TEST_NAME).AndReturn(TEST_PACKAGE)
+        test_adapter.insert_package(TEST_PACKAGE).AndReturn(False)
 
         self.mox.ReplayAll()
 
@@ -291,6 +314,34 @@ class KPIServerTests(mox.MoxTestBase):
             version=TEST_VERSION
         ))
 
+        self.assertEqual(response.status_code, 409)
+        json_result = json.loads(response.data)
+        self.assertFalse(json_result['success'])
+
+    def test_create_package_invalid_version(self):
+        self.mox.StubOutWithMock(util, 'check_permissions')
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+
+        util.check_permissions(
+            test_adapter,
+            TEST_USERNAME,
+            TEST_PASSWORD
+        ).AndReturn(True)
+
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+
+        response = self.app.post('/kpi/packages.json', data=dict(
+            username=TEST_USERNAME,
+            password=TEST_PASSWORD,
+            authors=TEST_AUTHORS_INCLUSIVE_STR,
+            license=TEST_LICENSE,
+            name=TEST_NAME,
+            humanName=TEST_HUMAN_NAME,
+            version='1.2'
+        ))
+
         self.assertEqual(response.status_code, 200)
         json_result = json.loads(response.data)
         self.assertFalse(json_result['success'])
@@ -306,8 +357,6 @@ class KPIServerTests(mox.MoxTestBase):
             TEST_PASSWORD
         ).AndReturn(True)
 
-        test_adapter.get_package(TEST_NAME).AndReturn(None)
-
         self.mox.ReplayAll()
 
         kpiserver.db_adapter = test_adapter
@@ -328,6 +377,7 @@ class KPIServerTests(mox.MoxTestBase):
 
     def test_create_package_success(self):
         self.mox.StubOutWithMock(util, 'check_permissions')
+        self.mox.StubOutWithMock(cache_service, 'purge_package')
         self.mox.StubOutWithMock(file_store_service, 'create_file_upload_url')
         test_adapter = self.mox.CreateMock(db_service.DBAdapter)
 
@@ -337,8 +387,8 @@ class KPIServerTests(mox.MoxTestBase):
             TEST_PASSWORD
         ).AndReturn(True)
 
-        test_adapter.get_package(TEST_NAME).AndReturn(None)
-        test_adapter.put_package(TEST_PACKAGE)
+        test_adapter.insert_package(TEST_PACKAGE).AndReturn(True)
+        cache_service.purge_package(kpiserver.app, TEST_NAME)
 
         file_store_service.create_file_upload_url(
             kpiserver.app,
@@ -392,139 +442,914 @@ class KPIServerTests(mox.MoxTestBase):
         json_result = json.loads(response.data)
         self.assertTrue(json_result['success'])
 
-    def test_update_package_fail_uac(self):
-        self.mox.StubOutWithMock(util, 'check_permissions')
-        self.mox.StubOutWithMock(file_store_service, 'create_file_upload_url')
+    def test_read_package_records_stats(self):
+        kpiserver.app.config['STATS_ENABLED'] = True
+        kpiserver.app.config['STATS_FLUSH_INTERVAL'] = 0
+        kpiserver.app.extensions.pop('kpi_stats_buffer', None)
+
         test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_adapter.get_package(TEST_NAME).AndReturn(TEST_PACKAGE)
+        test_adapter.add_package_stats(mox.Func(
+            lambda counts: counts.values() == [{'reads': 1}] and
+                counts.keys()[0][0] == TEST_NAME
+        ))
 
-        util.check_permissions(
-            test_adapter,
-            TEST_USERNAME,
-            TEST_PASSWORD,
-            TEST_NAME
-        ).AndReturn(False)
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+
+        try:
+            response = self.app.get("/kpi/package/%s.json" % TEST_NAME)
+        finally:
+            del kpiserver.app.config['STATS_FLUSH_INTERVAL']
+            kpiserver.app.extensions.pop('kpi_stats_buffer', None)
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_read_package_stats(self):
+        self.mox.StubOutWithMock(stats_service, 'get_since_hour')
+        stats_service.get_since_hour(2).AndReturn(3600)
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_adapter.get_package_stats(TEST_NAME, 3600).AndReturn([
+            {'hour': 3600, 'reads': 2},
+            {'hour': 7200, 'reads': 1, 'downloads': 4}
+        ])
 
         self.mox.ReplayAll()
 
         kpiserver.db_adapter = test_adapter
 
-        response = self.app.put('/kpi/package/%s.json' % TEST_NAME, data=dict(
-            username=TEST_USERNAME,
-            password=TEST_PASSWORD,
-            authors=TEST_AUTHORS_MISSING_STR,
-            license=TEST_LICENSE,
-            humanName=TEST_HUMAN_NAME,
-            name=TEST_NAME,
-            version=TEST_VERSION
-        ))
+        response = self.app.get(
+            '/kpi/package/%s/stats.json?hours=2' % TEST_NAME
+        )
 
         self.assertEqual(response.status_code, 200)
         json_result = json.loads(response.data)
-        self.assertFalse(json_result['success'])
+        self.assertTrue(json_result['success'])
+        self.assertEqual(json_result['since'], 3600)
+        self.assertEqual(
+            json_result['totals'],
+            {'reads': 3, 'downloads': 4, 'proxy_downloads': 0}
+        )
+        self.assertEqual(json_result['hours'][0]['downloads'], 0)
+        self.assertEqual(response.cache_control.max_age, 300)
 
-    def test_update_package_success(self):
-        self.mox.StubOutWithMock(util, 'check_permissions')
-        self.mox.StubOutWithMock(file_store_service, 'create_file_upload_url')
-        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+    def test_read_package_stats_invalid_hours(self):
+        response = self.app.get(
+            '/kpi/package/%s/stats.json?hours=0' % TEST_NAME
+        )
+        self.assertEqual(response.status_code, 400)
 
-        util.check_permissions(
-            test_adapter,
-            TEST_USERNAME,
-            TEST_PASSWORD,
-            TEST_NAME
-        ).AndReturn(True)
+        response = self.app.get(
+            '/kpi/package/%s/stats.json?hours=week' % TEST_NAME
+        )
+        self.assertEqual(response.status_code, 400)
 
-        test_adapter.put_package(TEST_PACKAGE)
+    def test_read_package_strips_internal_fields(self):
+        package = copy.deepcopy(TEST_PACKAGE)
+        package['_id'] = ObjectId()
 
-        file_store_service.create_file_upload_url(
-            kpiserver.app,
-            TEST_NAME
-        ).AndReturn(TEST_UPLOAD_URL)
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_adapter.get_package(TEST_NAME).AndReturn(package)
 
         self.mox.ReplayAll()
 
         kpiserver.db_adapter = test_adapter
 
-        response = self.app.put('/kpi/package/%s.json' % TEST_NAME, data=dict(
-            username=TEST_USERNAME,
-            password=TEST_PASSWORD,
-            authors=TEST_AUTHORS_INCLUSIVE_STR,
-            license=TEST_LICENSE,
-            humanName=TEST_HUMAN_NAME,
-            name=TEST_NAME,
-            version=TEST_VERSION
-        ))
+        response = self.app.get("/kpi/package/%s.json" % TEST_NAME)
 
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/json')
         json_result = json.loads(response.data)
         self.assertTrue(json_result['success'])
-        self.assertEqual(json_result['upload_url'], TEST_UPLOAD_URL)
+        self.assertEqual(json_result['record'], TEST_PACKAGE)
 
-    def test_delete_package_fail_uac(self):
-        self.mox.StubOutWithMock(util, 'check_permissions')
+    def test_read_package_cache_headers(self):
         test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_adapter.get_package(TEST_NAME).AndReturn(TEST_PACKAGE)
 
-        util.check_permissions(
-            test_adapter,
-            TEST_USERNAME,
-            TEST_PASSWORD,
-            TEST_NAME
-        ).AndReturn(False)
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+
+        response = self.app.get("/kpi/package/%s.json" % TEST_NAME)
+
+        self.assertEqual(response.status_code, 200)
+        cache_control = response.cache_control
+        self.assertTrue(cache_control.public)
+        self.assertEqual(cache_control.max_age, 60)
+        self.assertEqual(cache_control['stale-while-revalidate'], '300')
+        self.assertEqual(response.headers['Surrogate-Key'], 'package/name')
+        self.assertEqual(response.headers['ETag'], '"0"')
+
+    def test_resolve_package_success(self):
+        package = copy.deepcopy(TEST_PACKAGE)
+        package.update(versions.get_version_fields(TEST_VERSION))
+
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_adapter.get_latest_package_in_range(
+            TEST_NAME,
+            versions.create_version_key([0, 1, 0]),
+            versions.create_version_key([0, 2, 0])
+        ).AndReturn(package)
 
         self.mox.ReplayAll()
 
         kpiserver.db_adapter = test_adapter
 
-        response = self.app.post(
-            '/kpi/package/%s.json/delete' % TEST_NAME,
-            data=dict(
-                username=TEST_USERNAME,
-                password=TEST_PASSWORD
-            )
+        response = self.app.get(
+            '/kpi/package/%s/resolve.json?range=^0.1' % TEST_NAME
         )
 
         self.assertEqual(response.status_code, 200)
         json_result = json.loads(response.data)
-        self.assertFalse(json_result['success'])
+        self.assertTrue(json_result['success'])
+        self.assertEqual(json_result['record'], TEST_PACKAGE)
 
-    def test_delete_package_success(self):
-        self.mox.StubOutWithMock(util, 'check_permissions')
+    def test_resolve_package_not_satisfied(self):
         test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_adapter.get_latest_package_in_range(
+            TEST_NAME,
+            versions.create_version_key([1, 0, 0]),
+            versions.create_version_key([2, 0, 0])
+        ).AndReturn(None)
 
-        util.check_permissions(
-            test_adapter,
-            TEST_USERNAME,
-            TEST_PASSWORD,
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+
+        response = self.app.get(
+            '/kpi/package/%s/resolve.json?range=%%3E%%3D1.0.0+%%3C2.0.0' %
             TEST_NAME
-        ).AndReturn(True)
+        )
 
-        test_adapter.delete_package(TEST_NAME)
+        self.assertEqual(response.status_code, 200)
+        json_result = json.loads(response.data)
+        self.assertFalse(json_result['success'])
+
+    def test_resolve_package_invalid_range(self):
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
 
         self.mox.ReplayAll()
 
         kpiserver.db_adapter = test_adapter
 
-        response = self.app.post(
-            '/kpi/package/%s.json/delete' % TEST_NAME,
-            data=dict(
-                username=TEST_USERNAME,
-                password=TEST_PASSWORD
-            )
+        response = self.app.get(
+            '/kpi/package/%s/resolve.json?range=latest' % TEST_NAME
         )
 
+        self.assertEqual(response.status_code, 400)
+        json_result = json.loads(response.data)
+        self.assertFalse(json_result['success'])
+
+    def test_read_package_deltas_no_archive(self):
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_adapter.get_package(TEST_NAME).AndReturn(TEST_PACKAGE)
+
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+
+        response = self.app.get('/kpi/package/%s/deltas.json' % TEST_NAME)
+
+        self.assertEqual(response.status_code, 200)
+        json_result = json.loads(response.data)
+        self.assertFalse(json_result['success'])
+
+    def test_read_package_deltas(self):
+        kpiserver.app.config['UPLOADS_BUCKET_NAME'] = 'bucket'
+        manifest = [{'path': 'module.json', 'size': 10, 'sha256': 'abc'}]
+        package = copy.deepcopy(TEST_PACKAGE)
+        package['archive'] = {
+            'status': 'valid',
+            'size': 100,
+            'sha256': 'def',
+            'module': {'name': TEST_NAME, 'version': TEST_VERSION},
+            'manifest': manifest,
+            'deltas': [{
+                'from_version': '0.1.1',
+                'object': 'name/deltas/0.1.1-0.1.2.zip',
+                'size': 20,
+                'sha256': 'ghi',
+                'files': 1
+            }]
+        }
+
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_adapter.get_package(TEST_NAME).AndReturn(package)
+
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+
+        response = self.app.get('/kpi/package/%s/deltas.json' % TEST_NAME)
+
         self.assertEqual(response.status_code, 200)
         json_result = json.loads(response.data)
         self.assertTrue(json_result['success'])
+        self.assertEqual(json_result['version'], TEST_VERSION)
+        self.assertEqual(json_result['manifest'], manifest)
+        self.assertEqual(
+            json_result['archive']['url'],
+            'https://bucket.s3.amazonaws.com/name.zip'
+        )
+        self.assertEqual(
+            json_result['deltas'][0]['url'],
+            'https://bucket.s3.amazonaws.com/name/deltas/0.1.1-0.1.2.zip'
+        )
+
+    def expect_archive_download(self, start, end):
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_adapter.get_package(TEST_NAME).AndReturn(TEST_ARCHIVE_PACKAGE)
+        kpiserver.db_adapter = test_adapter
+
+        if start is None:
+            return
+
+        test_client = self.mox.CreateMock(archive_service.ArchiveStoreAdapter)
+        self.mox.StubOutWithMock(archive_service, 'get_client')
+        archive_service.get_client(kpiserver.app).AndReturn(test_client)
+        test_client.open_archive(
+            'name.zip',
+            start=start,
+            end=end
+        ).AndReturn(StringIO.StringIO(TEST_ARCHIVE_CONTENTS[start:]))
+
+    def test_read_package_archive(self):
+        self.expect_archive_download(0, 10)
+        self.mox.ReplayAll()
+
+        response = self.app.get('/kpi/package/%s/archive.zip' % TEST_NAME)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, TEST_ARCHIVE_CONTENTS)
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(response.headers['ETag'], '"abc"')
+
+    def test_read_package_archive_range(self):
+        self.expect_archive_download(4, 10)
+        self.mox.ReplayAll()
+
+        response = self.app.get(
+            '/kpi/package/%s/archive.zip' % TEST_NAME,
+            headers={'Range': 'bytes=4-', 'If-Range': '"abc"'}
+        )
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, '456789')
+        self.assertEqual(response.headers['Content-Range'], 'bytes 4-9/10')
+        self.assertEqual(response.headers['Content-Length'], '6')
+
+    def test_read_package_archive_if_range_changed(self):
+        self.expect_archive_download(0, 10)
+        self.mox.ReplayAll()
+
+        response = self.app.get(
+            '/kpi/package/%s/archive.zip' % TEST_NAME,
+            headers={'Range': 'bytes=4-', 'If-Range': '"old"'}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, TEST_ARCHIVE_CONTENTS)
+
+    def test_read_package_archive_range_not_satisfiable(self):
+        self.expect_archive_download(None, None)
+        self.mox.ReplayAll()
+
+        response = self.app.get(
+            '/kpi/package/%s/archive.zip' % TEST_NAME,
+            headers={'Range': 'bytes=20-'}
+        )
+
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.headers['Content-Range'], 'bytes */10')
+
+    def test_read_package_archive_not_validated(self):
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_adapter.get_package(TEST_NAME).AndReturn(TEST_PACKAGE)
+        self.mox.ReplayAll()
+        kpiserver.db_adapter = test_adapter
+
+        response = self.app.get('/kpi/package/%s/archive.zip' % TEST_NAME)
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_read_package_archive_previous_version(self):
+        package = dict(TEST_ARCHIVE_PACKAGE, version='0.2.0')
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_adapter.get_package(TEST_NAME).AndReturn(package)
+        test_adapter.get_package(TEST_NAME).AndReturn(package)
+        self.mox.ReplayAll()
+        kpiserver.db_adapter = test_adapter
+
+        response = self.app.get('/kpi/package/%s/archive.zip' % TEST_NAME)
+        self.assertEqual(response.status_code, 409)
+
+        response = self.app.get('/kpi/package/%s/deltas.json' % TEST_NAME)
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(json.loads(response.data)['success'])
+
+    def test_read_package_downloads(self):
+        self.mox.StubOutWithMock(
+            file_store_service,
+            'create_file_download_urls'
+        )
+        file_store_service.create_file_download_urls(
+            kpiserver.app,
+            ['first', 'second']
+        ).AndReturn({'first': 'url1', 'second': 'url2'})
+
+        self.mox.ReplayAll()
+
+        response = self.app.get(
+            '/kpi/packages/downloads.json?names=first,second'
+        )
+
+        self.assertEqual(response.status_code, 200)
+        json_result = json.loads(response.data)
+        self.assertTrue(json_result['success'])
+        self.assertEqual(
+            json_result['urls'],
+            {'first': 'url1', 'second': 'url2'}
+        )
+        self.assertEqual(response.headers['Cache-Control'], 'no-store')
+
+    def test_read_package_downloads_too_many(self):
+        names = ','.join(
+            'p%d' % i for i in range(file_store_service.MAX_BATCH_SIZE + 1)
+        )
+        kpiserver.app.config['UPLOADS_BUCKET_NAME'] = 'bucket'
+
+        response = self.app.get('/kpi/packages/downloads.json?names=' + names)
+
+        self.assertEqual(response.status_code, 400)
+        json_result = json.loads(response.data)
+        self.assertFalse(json_result['success'])
+
+    def test_update_package_fail_uac(self):
+        self.mox.StubOutWithMock(util, 'check_permissions')
+        self.mox.StubOutWithMock(file_store_service, 'create_file_upload_url')
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+
+        util.check_permissions(
+            test_adapter,
+            TEST_USERNAME,
+            TEST_PASSWORD
+        ).AndReturn(False)
+
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+
+        response = self.app.put('/kpi/package/%s.json' % TEST_NAME, data=dict(
+            username=TEST_USERNAME,
+            password=TEST_PASSWORD,
+            authors=TEST_AUTHORS_MISSING_STR,
+            license=TEST_LICENSE,
+            humanName=TEST_HUMAN_NAME,
+            name=TEST_NAME,
+            version=TEST_VERSION
+        ))
+
+        self.assertEqual(response.status_code, 200)
+        json_result = json.loads(response.data)
+        self.assertFalse(json_result['success'])
+
+    def test_update_package_not_author(self):
+        self.mox.StubOutWithMock(util, 'check_permissions')
+        self.mox.StubOutWithMock(cache_service, 'purge_package')
+        self.mox.StubOutWithMock(file_store_service, 'create_file_upload_url')
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+
+        util.check_permissions(
+            test_adapter,
+            TEST_USERNAME,
+            TEST_PASSWORD
+        ).AndReturn(True)
+
+        test_adapter.update_package_as_author(
+            TEST_NAME,
+            TEST_USERNAME,
+            TEST_PACKAGE,
+            None
+        ).AndReturn(None)
+
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+
+        response = self.app.put('/kpi/package/%s.json' % TEST_NAME, data=dict(
+            username=TEST_USERNAME,
+            password=TEST_PASSWORD,
+            authors=TEST_AUTHORS_INCLUSIVE_STR,
+            license=TEST_LICENSE,
+            humanName=TEST_HUMAN_NAME,
+            name=TEST_NAME,
+            version=TEST_VERSION
+        ))
+
+        self.assertEqual(response.status_code, 200)
+        json_result = json.loads(response.data)
+        self.assertFalse(json_result['success'])
+
+    def test_update_package_success(self):
+        self.mox.StubOutWithMock(util, 'check_permissions')
+        self.mox.StubOutWithMock(cache_service, 'purge_package')
+        self.mox.StubOutWithMock(file_store_service, 'create_file_upload_url')
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+
+        util.check_permissions(
+            test_adapter,
+            TEST_USERNAME,
+            TEST_PASSWORD
+        ).AndReturn(True)
+
+        test_adapter.update_package_as_author(
+            TEST_NAME,
+            TEST_USERNAME,
+            TEST_PACKAGE,
+            None
+        ).AndReturn(2)
+        cache_service.purge_package(kpiserver.app, TEST_NAME)
+
+        file_store_service.create_file_upload_url(
+            kpiserver.app,
+            TEST_NAME
+        ).AndReturn(TEST_UPLOAD_URL)
+
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+
+        response = self.app.put('/kpi/package/%s.json' % TEST_NAME, data=dict(
+            username=TEST_USERNAME,
+            password=TEST_PASSWORD,
+            authors=TEST_AUTHORS_INCLUSIVE_STR,
+            license=TEST_LICENSE,
+            humanName=TEST_HUMAN_NAME,
+            name=TEST_NAME,
+            version=TEST_VERSION
+        ))
+
+        self.assertEqual(response.status_code, 200)
+        json_result = json.loads(response.data)
+        self.assertTrue(json_result['success'])
+        self.assertEqual(json_result['upload_url'], TEST_UPLOAD_URL)
+        self.assertEqual(json_result['revision'], 2)
+        self.assertEqual(response.headers['ETag'], '"2"')
+
+    def test_update_package_if_match_success(self):
+        self.mox.StubOutWithMock(util, 'check_permissions')
+        self.mox.StubOutWithMock(cache_service, 'purge_package')
+        self.mox.StubOutWithMock(file_store_service, 'create_file_upload_url')
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+
+        util.check_permissions(
+            test_adapter,
+            TEST_USERNAME,
+            TEST_PASSWORD
+        ).AndReturn(True)
+
+        test_adapter.update_package_as_author(
+            TEST_NAME,
+            TEST_USERNAME,
+            TEST_PACKAGE,
+            3
+        ).AndReturn(4)
+        cache_service.purge_package(kpiserver.app, TEST_NAME)
+
+        file_store_service.create_file_upload_url(
+            kpiserver.app,
+            TEST_NAME
+        ).AndReturn(TEST_UPLOAD_URL)
+
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+
+        response = self.app.put(
+            '/kpi/package/%s.json' % TEST_NAME,
+            headers={'If-Match': '"3"'},
+            data=dict(
+                username=TEST_USERNAME,
+                password=TEST_PASSWORD,
+                authors=TEST_AUTHORS_INCLUSIVE_STR,
+                license=TEST_LICENSE,
+                humanName=TEST_HUMAN_NAME,
+                name=TEST_NAME,
+                version=TEST_VERSION
+            )
+        )
+
+        self.assertEqual(response.status_code, 200)
+        json_result = json.loads(response.data)
+        self.assertTrue(json_result['success'])
+        self.assertEqual(json_result['revision'], 4)
+
+    def test_update_package_revision_conflict(self):
+        self.mox.StubOutWithMock(util, 'check_permissions')
+        self.mox.StubOutWithMock(cache_service, 'purge_package')
+        self.mox.StubOutWithMock(file_store_service, 'create_file_upload_url')
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+
+        util.check_permissions(
+            test_adapter,
+            TEST_USERNAME,
+            TEST_PASSWORD
+        ).AndReturn(True)
+
+        test_adapter.update_package_as_author(
+            TEST_NAME,
+            TEST_USERNAME,
+            TEST_PACKAGE,
+            3
+        ).AndReturn(None)
+        test_adapter.is_package_author(TEST_NAME, TEST_USERNAME).AndReturn(
+            True
+        )
+
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+
+        response = self.app.put('/kpi/package/%s.json' % TEST_NAME, data=dict(
+            username=TEST_USERNAME,
+            password=TEST_PASSWORD,
+            authors=TEST_AUTHORS_INCLUSIVE_STR,
+            license=TEST_LICENSE,
+            humanName=TEST_HUMAN_NAME,
+            name=TEST_NAME,
+            version=TEST_VERSION,
+            revision='3'
+        ))
+
+        self.assertEqual(response.status_code, 409)
+        json_result = json.loads(response.data)
+        self.assertFalse(json_result['success'])
+
+    def test_update_package_invalid_revision(self):
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+
+        response = self.app.put(
+            '/kpi/package/%s.json' % TEST_NAME,
+            headers={'If-Match': '"abc"'},
+            data=dict(
+                username=TEST_USERNAME,
+                password=TEST_PASSWORD,
+                name=TEST_NAME
+            )
+        )
+
+        self.assertEqual(response.status_code, 400)
+        json_result = json.loads(response.data)
+        self.assertFalse(json_result['success'])
+
+    def test_update_package_rename(self):
+        self.mox.StubOutWithMock(util, 'check_permissions')
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+
+        util.check_permissions(
+            test_adapter,
+            TEST_USERNAME,
+            TEST_PASSWORD
+        ).AndReturn(True)
+
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+
+        response = self.app.put('/kpi/package/%s.json' % TEST_NAME, data=dict(
+            username=TEST_USERNAME,
+            password=TEST_PASSWORD,
+            authors=TEST_USERNAME,
+            license=TEST_LICENSE,
+            humanName=TEST_HUMAN_NAME,
+            name='other',
+            version=TEST_VERSION
+        ))
+
+        self.assertEqual(response.status_code, 400)
+        json_result = json.loads(response.data)
+        self.assertFalse(json_result['success'])
+
+    def test_complete_package_upload_not_author(self):
+        self.mox.StubOutWithMock(util, 'check_permissions')
+        self.mox.StubOutWithMock(archive_service, 'enqueue_archive')
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+
+        util.check_permissions(
+            test_adapter,
+            TEST_OTHER_USERNAME,
+            TEST_PASSWORD
+        ).AndReturn(True)
+        package = copy.deepcopy(TEST_PACKAGE)
+        package['authors'] = [TEST_USERNAME]
+        test_adapter.get_package(TEST_NAME).AndReturn(package)
+
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+
+        response = self.app.post(
+            '/kpi/package/%s/uploaded.json' % TEST_NAME,
+            data=dict(username=TEST_OTHER_USERNAME, password=TEST_PASSWORD)
+        )
+
+        self.assertEqual(response.status_code, 200)
+        json_result = json.loads(response.data)
+        self.assertFalse(json_result['success'])
+
+    def test_complete_package_upload_success(self):
+        self.mox.StubOutWithMock(util, 'check_permissions')
+        self.mox.StubOutWithMock(archive_service, 'enqueue_archive')
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+
+        util.check_permissions(
+            test_adapter,
+            TEST_USERNAME,
+            TEST_PASSWORD
+        ).AndReturn(True)
+        test_adapter.get_package(TEST_NAME).AndReturn(TEST_PACKAGE)
+        archive_service.enqueue_archive(
+            kpiserver.app,
+            test_adapter,
+            TEST_PACKAGE
+        )
+
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+
+        response = self.app.post(
+            '/kpi/package/%s/uploaded.json' % TEST_NAME,
+            data=dict(username=TEST_USERNAME, password=TEST_PASSWORD)
+        )
+
+        self.assertEqual(response.status_code, 202)
+        json_result = json.loads(response.data)
+        self.assertTrue(json_result['success'])
+
+    def test_import_users_not_admin(self):
+        self.mox.StubOutWithMock(util, 'check_permissions')
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        util.check_permissions(
+            test_adapter,
+            TEST_USERNAME,
+            TEST_PASSWORD
+        ).AndReturn(True)
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+        kpiserver.app.config['ADMIN_USERNAMES'] = []
+
+        response = self.app.post('/kpi/users/import.json', data=dict(
+            username=TEST_USERNAME,
+            password=TEST_PASSWORD,
+            format='csv',
+            users='user1,user1@example.com'
+        ))
+
+        self.assertEqual(response.status_code, 403)
+
+    def test_import_users_invalid(self):
+        self.mox.StubOutWithMock(util, 'check_permissions')
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        util.check_permissions(
+            test_adapter,
+            TEST_USERNAME,
+            TEST_PASSWORD
+        ).AndReturn(True)
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+        kpiserver.app.config['ADMIN_USERNAMES'] = [TEST_USERNAME]
+
+        response = self.app.post('/kpi/users/import.json', data=dict(
+            username=TEST_USERNAME,
+            password=TEST_PASSWORD,
+            format='csv',
+            users='user1,invalid'
+        ))
+
+        self.assertEqual(response.status_code, 400)
+        json_result = json.loads(response.data)
+        self.assertEqual(len(json_result['errors']), 1)
+
+    def test_import_users(self):
+        self.mox.StubOutWithMock(util, 'check_permissions')
+        self.mox.StubOutWithMock(user_import_service, 'import_users')
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        util.check_permissions(
+            test_adapter,
+            TEST_USERNAME,
+            TEST_PASSWORD
+        ).AndReturn(True)
+        user_import_service.import_users(
+            kpiserver.app,
+            test_adapter,
+            [
+                {'username': 'user1', 'email': 'user1@example.com'},
+                {'username': 'user2', 'email': 'user2@example.com'}
+            ]
+        ).AndReturn((['user1'], ['user2']))
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+        kpiserver.app.config['ADMIN_USERNAMES'] = [TEST_USERNAME]
+
+        response = self.app.post('/kpi/users/import.json', data=dict(
+            username=TEST_USERNAME,
+            password=TEST_PASSWORD,
+            format='json',
+            users=json.dumps([
+                {'username': 'user1', 'email': 'user1@example.com'},
+                {'username': 'user2', 'email': 'user2@example.com'}
+            ])
+        ))
+
+        self.assertEqual(response.status_code, 200)
+        json_result = json.loads(response.data)
+        self.assertTrue(json_result['success'])
+        self.assertEqual(json_result['created'], ['user1'])
+        self.assertEqual(json_result['skipped'], ['user2'])
+
+    def test_delete_package_fail_uac(self):
+        self.mox.StubOutWithMock(util, 'check_permissions')
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+
+        util.check_permissions(
+            test_adapter,
+            TEST_USERNAME,
+            TEST_PASSWORD
+        ).AndReturn(False)
+
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+
+        response = self.app.post(
+            '/kpi/package/%s.json/delete' % TEST_NAME,
+            data=dict(
+                username=TEST_USERNAME,
+                password=TEST_PASSWORD
+            )
+        )
+
+        self.assertEqual(response.status_code, 200)
+        json_result = json.loads(response.data)
+        self.assertFalse(json_result['success'])
+
+    def test_delete_package_not_author(self):
+        self.mox.StubOutWithMock(util, 'check_permissions')
+        self.mox.StubOutWithMock(cache_service, 'purge_package')
+        self.mox.StubOutWithMock(audit_service, 'log_event')
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+
+        util.check_permissions(
+            test_adapter,
+            TEST_USERNAME,
+            TEST_PASSWORD
+        ).AndReturn(True)
+
+        test_adapter.delete_package_as_author(
+            TEST_NAME,
+            TEST_USERNAME
+        ).AndReturn(False)
+
+        audit_service.log_event(
+            audit_service.PACKAGE_DELETE_EVENT,
+            username=TEST_USERNAME,
+            package=TEST_NAME,
+            success=False
+        )
+
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+
+        response = self.app.post(
+            '/kpi/package/%s.json/delete' % TEST_NAME,
+            data=dict(
+                username=TEST_USERNAME,
+                password=TEST_PASSWORD
+            )
+        )
+
+        self.assertEqual(response.status_code, 200)
+        json_result = json.loads(response.data)
+        self.assertFalse(json_result['success'])
+
+    def test_delete_package_success(self):
+        self.mox.StubOutWithMock(util, 'check_permissions')
+        self.mox.StubOutWithMock(cache_service, 'purge_package')
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+
+        util.check_permissions(
+            test_adapter,
+            TEST_USERNAME,
+            TEST_PASSWORD
+        ).AndReturn(True)
+
+        test_adapter.delete_package_as_author(
+            TEST_NAME,
+            TEST_USERNAME
+        ).AndReturn(True)
+        cache_service.purge_package(kpiserver.app, TEST_NAME)
+
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+
+        response = self.app.post(
+            '/kpi/package/%s.json/delete' % TEST_NAME,
+            data=dict(
+                username=TEST_USERNAME,
+                password=TEST_PASSWORD
+            )
+        )
+
+        self.assertEqual(response.status_code, 200)
+        json_result = json.loads(response.data)
+        self.assertTrue(json_result['success'])
+
+    def test_update_package_rate_limited(self):
+        self.mox.StubOutWithMock(util, 'check_permissions')
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        self.mox.ReplayAll()
+
+        kpiserver.db_adapter = test_adapter
+        kpiserver.app.config['RATE_LIMIT_ENABLED'] = True
+        kpiserver.app.config['RATE_LIMITS'] = {
+            'package_write': {'capacity': 1, 'period': 60}
+        }
+        kpiserver.app.extensions.pop('kpi_rate_limit_store', None)
+        rate_limit_service.get_store(kpiserver.app).take(
+            'package_write:ip:127.0.0.1',
+            1,
+            1 / 60.0,
+            time.time()
+        )
+
+        try:
+            response = self.app.put(
+                '/kpi/package/%s.json' % TEST_NAME,
+                data=dict(username=TEST_USERNAME, password=TEST_PASSWORD)
+            )
+        finally:
+            del kpiserver.app.config['RATE_LIMITS']
+            kpiserver.app.extensions.pop('kpi_rate_limit_store', None)
+
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(int(response.headers['Retry-After']) > 0)
+        json_result = json.loads(response.data)
+        self.assertFalse(json_result['success'])
+
+    def test_read_index(self):
+        index_dir = tempfile.mkdtemp()
+        kpiserver.app.config['INDEX_DIR'] = index_dir
+        try:
+            response = self.app.get('/kpi/index.json')
+            self.assertEqual(response.status_code, 404)
+            self.assertFalse(json.loads(response.data)['success'])
+
+            test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+            test_adapter.get_packages().AndReturn([TEST_PACKAGE])
+            self.mox.ReplayAll()
+            manifest = index_service.publish_index(test_adapter, index_dir)
+
+            response = self.app.get('/kpi/index.json')
+            self.assertEqual(response.status_code, 200)
+            json_result = json.loads(response.data)
+            self.assertTrue(json_result['success'])
+            self.assertEqual(json_result['file'], manifest['file'])
+
+            response = self.app.get('/kpi/index/' + manifest['file'])
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'application/gzip')
+            self.assertTrue('max-age=31536000' in
+                response.headers['Cache-Control'])
+            self.assertEqual(len(response.data), manifest['size'])
+            response.close()
+
+            response = self.app.get('/kpi/index/..%2Findex.json')
+            self.assertEqual(response.status_code, 404)
+        finally:
+            del kpiserver.app.config['INDEX_DIR']
+            shutil.rmtree(index_dir)
 
     def test_status(self):
         test_adapter = self.mox.CreateMock(db_service.DBAdapter)
-        test_adapter.initialize_indicies()
         self.mox.ReplayAll()
 
         kpiserver.db_adapter = test_adapter
 
         response = self.app.get('/kpi/status.json')
         self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.cache_control.no_store)
         json_result = json.loads(response.data)
         self.assertTrue(json_result['success'])
 
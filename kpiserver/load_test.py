@@ -0,0 +1,821 @@
+"""Load testing harness for the Kipling Package Index server.
+
+Spins up the server on a local port against an in-memory stand-in for the
+database and a recording stand-in for the email service, seeds it with users
+and packages, and then drives a configurable mix of read / update / create
+requests from concurrent workers. Reports throughput and p50 / p95 / p99
+latency per route and can save or compare against a stored baseline so that
+performance regressions get caught.
+
+Usage: ```python load_test.py [--requests N] [--concurrency N] [--mix ...]```
+Example: ```python load_test.py --mix read=80,update=15,create=5 --compare```
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import argparse
+import copy
+import httplib
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+import urllib
+
+from werkzeug import serving
+from werkzeug.security import generate_password_hash
+
+import db_service
+import email_service
+import kpiserver
+import versions
+
+DEFAULT_NUM_PACKAGES = 200
+DEFAULT_NUM_USERS = 20
+DEFAULT_NUM_REQUESTS = 1000
+DEFAULT_CONCURRENCY = 8
+DEFAULT_MIX = 'read=80,update=15,create=5'
+DEFAULT_TOLERANCE = 0.25
+DEFAULT_DB = 'memory'
+DB_BACKENDS = ['memory', 'sqlite', 'mongo']
+DEFAULT_BASELINE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'load_test_baseline.json'
+)
+
+SEED_PASSWORD = 'loadtest'
+PERCENTILES = [50, 95, 99]
+
+ROUTES = ['read', 'update', 'create']
+ROUTE_DESCRIPTIONS = {
+    'read': 'GET /kpi/package/<name>.json',
+    'update': 'PUT /kpi/package/<name>.json',
+    'create': 'POST /kpi/packages.json'
+}
+
+TEST_CONFIG = {
+    'UPLOADS_BUCKET_NAME': 'loadtest_bucket',
+    'S3_SECRET_KEY': 'loadtest secret',
+    'S3_ACCESS_KEY': 'loadtest_access_key',
+    'EMAIL_FROM_ADDRESS': 'loadtest@example.com',
+    'EMAIL_FROM_NAME': 'KPI Load Test',
+    'RATE_LIMIT_ENABLED': False
+}
+
+
+class LoadTestDBAdapter(db_service.DBAdapter):
+    """In-memory stand-in for the Mongo backed DBAdapter.
+
+    Keeps users, packages, and the releases of each package in dictionaries
+    guarded by a lock so that the harness measures the server itself as
+    opposed to network or disk access to a database.
+    """
+
+    def __init__(self):
+        """Create a new empty in-memory database adapter."""
+        db_service.DBAdapter.__init__(self, None)
+        self.lock = threading.Lock()
+        self.packages = {}
+        self.releases = {}
+        self.users = {}
+        self.stats = {}
+
+    def initialize_indicies(self):
+        pass
+
+    def save_version(self, record):
+        """Keep a copy of a package record as the release of its version.
+
+        Must be called while holding the lock.
+
+        @param record: The package record as written.
+        @type record: dict
+        """
+        releases = self.releases.setdefault(record['name'], {})
+        releases[record['version']] = copy.deepcopy(record)
+
+    def get_package(self, package_name):
+        with self.lock:
+            return copy.deepcopy(self.packages.get(package_name, None))
+
+    def put_package(self, package_info):
+        self.ensure_fields(
+            package_info,
+            db_service.MINIMUM_REQUIRED_PACKAGE_FIELDS
+        )
+        with self.lock:
+            record = self.packages.setdefault(package_info['name'], {})
+            record.update(copy.deepcopy(package_info))
+            record.update(versions.get_version_fields(package_info['version']))
+            record[db_service.ARCHIVE_UPDATES_FIELD] = 0
+            revision = record.get(db_service.REVISION_FIELD, 0) + 1
+            record[db_service.REVISION_FIELD] = revision
+            self.save_version(record)
+
+    def insert_package(self, package_info):
+        self.ensure_fields(
+            package_info,
+            db_service.MINIMUM_REQUIRED_PACKAGE_FIELDS
+        )
+        record = copy.deepcopy(package_info)
+        record.update(versions.get_version_fields(package_info['version']))
+        record[db_service.ARCHIVE_UPDATES_FIELD] = 0
+        record[db_service.REVISION_FIELD] = 1
+        with self.lock:
+            if package_info['name'] in self.packages:
+                return False
+            self.packages[package_info['name']] = record
+            self.save_version(record)
+        return True
+
+    def get_latest_package_in_range(self, package_name, lower_key, upper_key):
+        latest = None
+        with self.lock:
+            for release in self.releases.get(package_name, {}).values():
+                key = release[versions.VERSION_KEY_FIELD]
+                if key == None or key < lower_key:
+                    continue
+                if upper_key != None and key >= upper_key:
+                    continue
+                if not latest or key > latest[versions.VERSION_KEY_FIELD]:
+                    latest = release
+            return copy.deepcopy(latest)
+
+    def is_package_author(self, package_name, username):
+        with self.lock:
+            package = self.packages.get(package_name, None)
+            return package != None and username in package['authors']
+
+    def get_user_as_author(self, username, package_name):
+        with self.lock:
+            user = copy.deepcopy(self.users.get(username, None))
+        return (user, user != None and \
+            self.is_package_author(package_name, username))
+
+    def update_package_as_author(self, package_name, username, package_info,
+            expected_revision=None):
+        self.ensure_fields(
+            package_info,
+            db_service.MINIMUM_REQUIRED_PACKAGE_FIELDS
+        )
+        with self.lock:
+            package = self.packages.get(package_name, None)
+            if not package or not username in package['authors']:
+                return None
+            if not db_service.is_expected_revision(package, expected_revision):
+                return None
+            if not versions.is_valid_version(package_info['version']) and \
+                versions.is_valid_version(package['version']):
+                return None
+            revision = package.get(db_service.REVISION_FIELD, 0)
+            package.update(copy.deepcopy(package_info))
+            package.update(
+                versions.get_version_fields(package_info['version'], False)
+            )
+            package['name'] = package_name
+            package[db_service.ARCHIVE_UPDATES_FIELD] = 0
+            package[db_service.REVISION_FIELD] = revision + 1
+            self.save_version(package)
+            return revision + 1
+
+    def backfill_version_fields(self):
+        return 0
+
+    def backfill_package_versions(self):
+        return 0
+
+    def set_package_archive(self, package_name, version, archive_info):
+        with self.lock:
+            package = self.packages.get(package_name, None)
+            if not package or package['version'] != version:
+                return False
+            package[db_service.ARCHIVE_FIELD] = copy.deepcopy(archive_info)
+            revision = package.get(db_service.REVISION_FIELD, 0) + 1
+            package[db_service.REVISION_FIELD] = revision
+            package[db_service.ARCHIVE_UPDATES_FIELD] = \
+                package.get(db_service.ARCHIVE_UPDATES_FIELD, 0) + 1
+            self.save_version(package)
+            return True
+
+    def delete_package_as_author(self, package_name, username):
+        with self.lock:
+            package = self.packages.get(package_name, None)
+            if not package or not username in package['authors']:
+                return False
+            del self.packages[package_name]
+            self.releases.pop(package_name, None)
+            return True
+
+    def delete_package(self, package_name):
+        with self.lock:
+            self.packages.pop(package_name, None)
+            self.releases.pop(package_name, None)
+
+    def get_packages(self):
+        with self.lock:
+            return copy.deepcopy(self.packages.values())
+
+    def get_user(self, username):
+        with self.lock:
+            return copy.deepcopy(self.users.get(username, None))
+
+    def get_user_by_email(self, email):
+        with self.lock:
+            for user in self.users.values():
+                if user['email'] == email:
+                    return copy.deepcopy(user)
+        return None
+
+    def put_user(self, user_info):
+        with self.lock:
+            record = self.users.setdefault(user_info['username'], {})
+            record.update(copy.deepcopy(user_info))
+
+    def insert_user(self, user_info):
+        self.ensure_fields(user_info, db_service.MINIMUM_REQUIRED_USER_FIELDS)
+        with self.lock:
+            if user_info['username'] in self.users:
+                return False
+            for user in self.users.values():
+                if user['email'] == user_info['email']:
+                    return False
+            self.users[user_info['username']] = copy.deepcopy(user_info)
+        return True
+
+    def find_existing_users(self, usernames, emails):
+        with self.lock:
+            return [
+                {'username': user['username'], 'email': user['email']}
+                for user in self.users.values()
+                if user['username'] in usernames or user['email'] in emails
+            ]
+
+    def insert_users(self, users_info):
+        return [
+            user_info['username']
+            for user_info in users_info
+            if self.insert_user(user_info)
+        ]
+
+    def update_user(self, username, user_info):
+        with self.lock:
+            if not username in self.users:
+                return None
+            self.users[username].update(copy.deepcopy(user_info))
+            return copy.deepcopy(self.users[username])
+
+    def add_package_stats(self, counts):
+        with self.lock:
+            for key, events in counts.items():
+                record = self.stats.setdefault(key, {})
+                for event, count in events.items():
+                    record[event] = record.get(event, 0) + count
+
+    def get_package_stats(self, package_name, since_hour):
+        with self.lock:
+            return [
+                dict(self.stats[key], hour=key[1])
+                for key in sorted(self.stats)
+                if key[0] == package_name and key[1] >= since_hour
+            ]
+
+
+class RecordingEmailServiceAdapter(email_service.EmailServiceAdapter):
+    """Stand-in for the email service that records instead of sending."""
+
+    def __init__(self):
+        """Create a new adapter with no recorded messages."""
+        self.messages = []
+
+    def send(self, message):
+        self.messages.append(message)
+
+
+class QuietRequestHandler(serving.WSGIRequestHandler):
+    """Request handler that does not log each request to stderr."""
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class RouteResults:
+    """Latency measurements and error count for a single route."""
+
+    def __init__(self):
+        """Create a new empty set of results."""
+        self.latencies = []
+        self.errors = 0
+
+
+def parse_mix(mix_str):
+    """Parse a request mix specification.
+
+    @param mix_str: CSV of route=weight pairs like "read=80,update=20".
+    @type mix_str: str
+    @return: Mapping from route name to relative weight.
+    @rtype: dict
+    @raise ValueError: Raised if a route is not recognized or a weight is not
+        a non-negative integer.
+    """
+    mix = {}
+    for entry in mix_str.split(','):
+        route, weight = entry.strip().split('=')
+        if not route in ROUTES:
+            raise ValueError('%s is not a recognized route.' % route)
+        mix[route] = int(weight)
+        if mix[route] < 0:
+            raise ValueError('Weight for %s must not be negative.' % route)
+    return mix
+
+
+def choose_route(mix, rand):
+    """Randomly select a route according to the relative weights of a mix.
+
+    @param mix: Mapping from route name to relative weight.
+    @type mix: dict
+    @param rand: Source of randomness.
+    @type rand: random.Random
+    @return: The name of the selected route.
+    @rtype: str
+    """
+    target = rand.uniform(0, sum(mix.values()))
+    running_total = 0
+    for route in ROUTES:
+        running_total += mix.get(route, 0)
+        if target <= running_total and mix.get(route, 0) > 0:
+            return route
+    return [route for route in ROUTES if mix.get(route, 0) > 0][-1]
+
+
+def percentile(sorted_values, pct):
+    """Find a percentile of a sorted series using the nearest rank method.
+
+    @param sorted_values: The values to find the percentile of in ascending
+        order.
+    @type sorted_values: list of float
+    @param pct: The percentile to find (0 - 100).
+    @type pct: float
+    @return: The value at the given percentile or None if no values.
+    @rtype: float
+    """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(sorted_values)))
+    rank = min(max(rank, 1), len(sorted_values))
+    return sorted_values[rank - 1]
+
+
+def summarize(results, duration):
+    """Summarize raw measurements into throughput and latency percentiles.
+
+    @param results: Mapping from route name to measurements for that route.
+    @type results: dict of RouteResults
+    @param duration: The wall time in seconds the load test took.
+    @type duration: float
+    @return: Mapping from route name to summary with count, errors,
+        throughput (requests / second), and p50_ms, p95_ms, p99_ms.
+    @rtype: dict
+    """
+    summary = {}
+    for route, route_results in results.items():
+        if not route_results.latencies:
+            continue
+        latencies = sorted(route_results.latencies)
+        route_summary = {
+            'count': len(latencies),
+            'errors': route_results.errors,
+            'throughput': len(latencies) / duration
+        }
+        for pct in PERCENTILES:
+            value = percentile(latencies, pct)
+            route_summary['p%d_ms' % pct] = value * 1000
+        summary[route] = route_summary
+    return summary
+
+
+def compare_to_baseline(summary, baseline, tolerance):
+    """Find routes that regressed compared to a prior baseline.
+
+    A route regresses if its p95 latency grew or its throughput shrank by more
+    than the tolerance fraction compared to the baseline.
+
+    @param summary: The summary of the current run as returned by summarize.
+    @type summary: dict
+    @param baseline: The summary of the baseline run.
+    @type baseline: dict
+    @param tolerance: Fraction (like 0.25 for 25%) of allowed slowdown.
+    @type tolerance: float
+    @return: Human readable descriptions of each regression found.
+    @rtype: list of str
+    """
+    regressions = []
+    for route, route_summary in sorted(summary.items()):
+        if not route in baseline:
+            continue
+        route_baseline = baseline[route]
+
+        max_p95 = route_baseline['p95_ms'] * (1 + tolerance)
+        if route_summary['p95_ms'] > max_p95:
+            regressions.append('%s p95 %.2fms exceeds baseline %.2fms' % (
+                route,
+                route_summary['p95_ms'],
+                route_baseline['p95_ms']
+            ))
+
+        min_throughput = route_baseline['throughput'] * (1 - tolerance)
+        if route_summary['throughput'] < min_throughput:
+            regressions.append('%s throughput %.1f/s below baseline %.1f/s' % (
+                route,
+                route_summary['throughput'],
+                route_baseline['throughput']
+            ))
+    return regressions
+
+
+def seed(db_adapter, num_users, num_packages):
+    """Populate a database with users and packages authored by those users.
+
+    @param db_adapter: The database to populate.
+    @type db_adapter: db_service.DBAdapter
+    @param num_users: The number of users to create.
+    @type num_users: int
+    @param num_packages: The number of packages to create.
+    @type num_packages: int
+    @return: List of (package name, author username) tuples created.
+    @rtype: list of tuple
+    """
+    password_hash = generate_password_hash(SEED_PASSWORD)
+    usernames = ['user%d' % i for i in range(num_users)]
+    for username in usernames:
+        db_adapter.put_user({
+            'username': username,
+            'email': username + '@example.com',
+            'password_hash': password_hash
+        })
+
+    packages = []
+    for i in range(num_packages):
+        name = 'package%d' % i
+        author = usernames[i % num_users]
+        db_adapter.put_package(create_package_form(name, author, '1.0.0'))
+        packages.append((name, author))
+    return packages
+
+
+def create_package_form(name, author, version):
+    """Create the fields for a realistic package create / update request.
+
+    @param name: The name of the package.
+    @type name: str
+    @param author: The username of the author of the package.
+    @type author: str
+    @param version: The version of the package being released.
+    @type version: str
+    @return: Package fields.
+    @rtype: dict
+    """
+    return {
+        'name': name,
+        'humanName': name.replace('_', ' ').title(),
+        'version': version,
+        'authors': [author],
+        'license': 'GNU GPL v3',
+        'description': 'Load test package %s. ' % name * 10,
+        'homepage': 'https://example.com/%s' % name,
+        'repository': 'https://example.com/%s.git' % name
+    }
+
+
+class LoadTest:
+    """Driver that runs a request mix against a live server."""
+
+    def __init__(self, host, port, packages, mix, num_requests, concurrency,
+            rand_seed=0):
+        """Create a new load test driver.
+
+        @param host: The host the server is listening on.
+        @type host: str
+        @param port: The port the server is listening on.
+        @type port: int
+        @param packages: List of (package name, author username) that exist.
+        @type packages: list of tuple
+        @param mix: Mapping from route name to relative weight.
+        @type mix: dict
+        @param num_requests: Total number of requests to issue.
+        @type num_requests: int
+        @param concurrency: Number of workers issuing requests in parallel.
+        @type concurrency: int
+        @keyword rand_seed: Seed for request selection so runs are repeatable.
+        @type rand_seed: int
+        """
+        self.host = host
+        self.port = port
+        self.packages = packages
+        self.mix = mix
+        self.num_requests = num_requests
+        self.concurrency = concurrency
+        self.rand_seed = rand_seed
+        self.lock = threading.Lock()
+        self.remaining = num_requests
+        self.created_count = 0
+        self.results = dict((route, RouteResults()) for route in ROUTES)
+
+    def claim_request(self):
+        """Claim the right to issue another request.
+
+        @return: True if a request should be issued and False if all requests
+            have already been claimed.
+        @rtype: bool
+        """
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+    def build_request(self, route, rand):
+        """Build the method, path, and form body for a request to a route.
+
+        @param route: The name of the route to build a request for.
+        @type route: str
+        @param rand: Source of randomness.
+        @type rand: random.Random
+        @return: Tuple of (method, path, form fields or None).
+        @rtype: tuple
+        """
+        name, author = rand.choice(self.packages)
+
+        if route == 'read':
+            return ('GET', '/kpi/package/%s.json' % name, None)
+
+        if route == 'update':
+            version = '1.0.%d' % rand.randint(1, 1000)
+            form = create_package_form(name, author, version)
+            method = 'PUT'
+            path = '/kpi/package/%s.json' % name
+        else:
+            with self.lock:
+                self.created_count += 1
+                created_count = self.created_count
+            name = 'new_package_%d_%d' % (self.rand_seed, created_count)
+            form = create_package_form(name, author, '0.0.1')
+            method = 'POST'
+            path = '/kpi/packages.json'
+
+        form['authors'] = ','.join(form['authors'])
+        form['username'] = author
+        form['password'] = SEED_PASSWORD
+        return (method, path, form)
+
+    def issue_request(self, method, path, form):
+        """Issue a single request against the server.
+
+        @param method: The HTTP method to use.
+        @type method: str
+        @param path: The path to request.
+        @type path: str
+        @param form: Form fields to send or None if no body.
+        @type form: dict
+        @return: True if the server reported success and False otherwise.
+        @rtype: bool
+        """
+        headers = {}
+        body = None
+        if form:
+            body = urllib.urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        connection = httplib.HTTPConnection(self.host, self.port)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            payload = response.read()
+        finally:
+            connection.close()
+
+        if response.status != 200:
+            return False
+        return json.loads(payload)['success']
+
+    def run_worker(self, worker_id):
+        """Issue requests until all requests have been claimed.
+
+        @param worker_id: Unique identifier for this worker.
+        @type worker_id: int
+        """
+        rand = random.Random(self.rand_seed * 1000 + worker_id)
+        while self.claim_request():
+            route = choose_route(self.mix, rand)
+            method, path, form = self.build_request(route, rand)
+
+            start = time.time()
+            try:
+                success = self.issue_request(method, path, form)
+            except (IOError, ValueError, httplib.HTTPException):
+                success = False
+            latency = time.time() - start
+
+            with self.lock:
+                self.results[route].latencies.append(latency)
+                if not success:
+                    self.results[route].errors += 1
+
+    def run(self):
+        """Run the load test to completion.
+
+        @return: The summary of the run as returned by summarize.
+        @rtype: dict
+        """
+        workers = []
+        for worker_id in range(self.concurrency):
+            worker = threading.Thread(target=self.run_worker, args=(worker_id,))
+            worker.daemon = True
+            workers.append(worker)
+
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        duration = time.time() - start
+
+        return summarize(self.results, duration)
+
+
+class MongoClientWrapper:
+    """Stand-in for flask.ext.pymongo.PyMongo around a native client."""
+
+    def __init__(self, uri):
+        import pymongo
+        self.db = pymongo.MongoClient(uri).get_default_database()
+
+
+def create_db_adapter(backend, location=None):
+    """Create the database the server should use during a load test.
+
+    Running the same load test against each backend compares their latency
+    and throughput through the server's routes.
+
+    @param backend: The kind of database to use like memory, sqlite, or mongo.
+    @type backend: str
+    @keyword location: The path of the SQLite database or the URI of the
+        MongoDB database (which will be cleared). Ignored for memory. Defaults
+        to None.
+    @type location: str
+    @return: The new empty database.
+    @rtype: db_service.DBAdapter
+    """
+    if backend == 'sqlite':
+        import sqlite_db_service
+        if os.path.exists(location):
+            os.remove(location)
+        return sqlite_db_service.SQLiteDBAdapter(location)
+    elif backend == 'mongo':
+        db_adapter = db_service.DBAdapter(MongoClientWrapper(location))
+        db_adapter.get_package_collection().drop()
+        db_adapter.get_users_collection().drop()
+        db_adapter.get_stats_collection().drop()
+        db_adapter.initialize_indicies()
+        return db_adapter
+    else:
+        return LoadTestDBAdapter()
+
+
+def install_fakes(db_adapter):
+    """Point the server at in-memory stand-ins for its external services.
+
+    @param db_adapter: The database stand-in the server should use.
+    @type db_adapter: db_service.DBAdapter
+    @return: The email stand-in that will record outgoing emails.
+    @rtype: RecordingEmailServiceAdapter
+    """
+    email_adapter = RecordingEmailServiceAdapter()
+    email_service.get_client = lambda application: email_adapter
+    kpiserver.app.config.update(TEST_CONFIG)
+    kpiserver.db_adapter = db_adapter
+    return email_adapter
+
+
+def start_server(host='127.0.0.1', port=0):
+    """Start the server on a background thread.
+
+    @keyword host: The host to listen on. Defaults to 127.0.0.1.
+    @type host: str
+    @keyword port: The port to listen on. Defaults to 0 (any free port).
+    @type port: int
+    @return: The running server.
+    @rtype: werkzeug.serving.BaseWSGIServer
+    """
+    server = serving.make_server(
+        host,
+        port,
+        kpiserver.app,
+        threaded=True,
+        request_handler=QuietRequestHandler
+    )
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def print_summary(summary):
+    """Print a table describing the results of a load test.
+
+    @param summary: The summary as returned by summarize.
+    @type summary: dict
+    """
+    print '%-30s %7s %7s %10s %9s %9s %9s' % (
+        'route', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'
+    )
+    for route in ROUTES:
+        if not route in summary:
+            continue
+        info = summary[route]
+        print '%-30s %7d %7d %10.1f %9.2f %9.2f %9.2f' % (
+            ROUTE_DESCRIPTIONS[route],
+            info['count'],
+            info['errors'],
+            info['throughput'],
+            info['p50_ms'],
+            info['p95_ms'],
+            info['p99_ms']
+        )
+
+
+def main():
+    """Main driver for running the load test from the command line.
+
+    @return: Exit status (0 if no errors or regressions and 1 otherwise).
+    @rtype: int
+    """
+    parser = argparse.ArgumentParser(description='KPI server load test.')
+    parser.add_argument('--packages', type=int, default=DEFAULT_NUM_PACKAGES)
+    parser.add_argument('--users', type=int, default=DEFAULT_NUM_USERS)
+    parser.add_argument('--requests', type=int, default=DEFAULT_NUM_REQUESTS)
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--db', choices=DB_BACKENDS, default=DEFAULT_DB)
+    parser.add_argument('--db-location', default='load_test.db')
+    args = parser.parse_args()
+
+    db_adapter = create_db_adapter(args.db, args.db_location)
+    packages = seed(db_adapter, args.users, args.packages)
+    install_fakes(db_adapter)
+    server = start_server()
+
+    try:
+        load_test = LoadTest(
+            server.server_address[0],
+            server.server_port,
+            packages,
+            parse_mix(args.mix),
+            args.requests,
+            args.concurrency,
+            args.seed
+        )
+        summary = load_test.run()
+    finally:
+        server.shutdown()
+
+    print_summary(summary)
+    status = 0
+
+    if any(info['errors'] for info in summary.values()):
+        print '[Error] Some requests failed.'
+        status = 1
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(
+                summary,
+                f,
+                indent=4,
+                separators=(',', ': '),
+                sort_keys=True
+            )
+        print 'Baseline saved to %s' % args.baseline
+
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(summary, baseline, args.tolerance)
+        for regression in regressions:
+            print '[Regression] ' + regression
+        if regressions:
+            status = 1
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,194 @@
+"""Tests for the Kipling Package Index server load testing harness.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import random
+import unittest
+
+import mox
+
+import load_test
+import versions
+
+TEST_BASELINE = {
+    'read': {'p95_ms': 10.0, 'throughput': 100.0},
+    'update': {'p95_ms': 20.0, 'throughput': 50.0}
+}
+
+
+class LoadTestTests(mox.MoxTestBase):
+
+    def test_parse_mix(self):
+        mix = load_test.parse_mix('read=80, update=15,create=5')
+        self.assertEqual(mix, {'read': 80, 'update': 15, 'create': 5})
+
+    def test_parse_mix_unknown_route(self):
+        self.assertRaises(ValueError, load_test.parse_mix, 'list=10')
+
+    def test_parse_mix_negative_weight(self):
+        self.assertRaises(ValueError, load_test.parse_mix, 'read=-1')
+
+    def test_choose_route_only_weighted(self):
+        rand = random.Random(0)
+        mix = {'read': 0, 'update': 1}
+        routes = set(load_test.choose_route(mix, rand) for _ in range(100))
+        self.assertEqual(routes, set(['update']))
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(load_test.percentile(values, 50), 50)
+        self.assertEqual(load_test.percentile(values, 95), 95)
+        self.assertEqual(load_test.percentile(values, 99), 99)
+        self.assertEqual(load_test.percentile(values, 100), 100)
+
+    def test_percentile_empty(self):
+        self.assertEqual(load_test.percentile([], 50), None)
+
+    def test_summarize(self):
+        results = {
+            'read': load_test.RouteResults(),
+            'create': load_test.RouteResults()
+        }
+        results['read'].latencies = [0.002, 0.001, 0.003, 0.004]
+        results['read'].errors = 1
+
+        summary = load_test.summarize(results, 2.0)
+
+        self.assertFalse('create' in summary)
+        self.assertEqual(summary['read']['count'], 4)
+        self.assertEqual(summary['read']['errors'], 1)
+        self.assertEqual(summary['read']['throughput'], 2.0)
+        self.assertAlmostEqual(summary['read']['p50_ms'], 2.0)
+        self.assertAlmostEqual(summary['read']['p99_ms'], 4.0)
+
+    def test_compare_to_baseline_within_tolerance(self):
+        summary = {
+            'read': {'p95_ms': 12.0, 'throughput': 80.0},
+            'create': {'p95_ms': 1000.0, 'throughput': 1.0}
+        }
+        regressions = load_test.compare_to_baseline(
+            summary,
+            TEST_BASELINE,
+            0.25
+        )
+        self.assertEqual(regressions, [])
+
+    def test_compare_to_baseline_regressed(self):
+        summary = {
+            'read': {'p95_ms': 13.0, 'throughput': 100.0},
+            'update': {'p95_ms': 20.0, 'throughput': 10.0}
+        }
+        regressions = load_test.compare_to_baseline(
+            summary,
+            TEST_BASELINE,
+            0.25
+        )
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith('read p95'))
+        self.assertTrue(regressions[1].startswith('update throughput'))
+
+    def test_load_test_db_adapter(self):
+        db_adapter = load_test.LoadTestDBAdapter()
+        db_adapter.put_user({
+            'username': 'user',
+            'email': 'user@example.com',
+            'password_hash': 'hash'
+        })
+        db_adapter.put_package(
+            load_test.create_package_form('package', 'user', '1.0.0')
+        )
+        db_adapter.put_package(
+            load_test.create_package_form('package', 'user', '1.0.1')
+        )
+
+        self.assertEqual(db_adapter.get_package('package')['version'], '1.0.1')
+        self.assertEqual(
+            db_adapter.get_user_by_email('user@example.com')['username'],
+            'user'
+        )
+
+        self.assertEqual(
+            db_adapter.get_latest_package_in_range(
+                'package',
+                *versions.parse_range('^1.0')
+            )['version'],
+            '1.0.1'
+        )
+        self.assertEqual(
+            db_adapter.get_latest_package_in_range(
+                'package',
+                *versions.parse_range('>=1.0.2')
+            ),
+            None
+        )
+
+        db_adapter.delete_package('package')
+        self.assertEqual(db_adapter.get_package('package'), None)
+
+    def test_load_test_db_adapter_as_author(self):
+        db_adapter = load_test.LoadTestDBAdapter()
+        db_adapter.put_package(
+            load_test.create_package_form('package', 'user', '1.0.0')
+        )
+        new_info = load_test.create_package_form('package', 'user', '1.0.1')
+
+        self.assertTrue(db_adapter.is_package_author('package', 'user'))
+        self.assertFalse(db_adapter.is_package_author('package', 'other'))
+        self.assertFalse(db_adapter.is_package_author('missing', 'user'))
+        self.assertEqual(
+            db_adapter.get_user_as_author('user', 'package'),
+            (None, False)
+        )
+        db_adapter.put_user({
+            'username': 'user',
+            'email': 'user@example.com',
+            'password_hash': 'hash'
+        })
+        self.assertTrue(db_adapter.get_user_as_author('user', 'package')[1])
+        self.assertFalse(db_adapter.get_user_as_author('user', 'missing')[1])
+
+        self.assertEqual(
+            db_adapter.update_package_as_author('package', 'other', new_info),
+            None
+        )
+        self.assertEqual(
+            db_adapter.update_package_as_author('package', 'user', new_info),
+            2
+        )
+        self.assertEqual(db_adapter.get_package('package')['version'], '1.0.1')
+        self.assertEqual(
+            db_adapter.update_package_as_author(
+                'package',
+                'user',
+                new_info,
+                1
+            ),
+            None
+        )
+
+        self.assertFalse(
+            db_adapter.delete_package_as_author('package', 'other')
+        )
+        self.assertTrue(db_adapter.delete_package_as_author('package', 'user'))
+        self.assertEqual(db_adapter.get_package('package'), None)
+
+    def test_load_test_db_adapter_users(self):
+        db_adapter = load_test.LoadTestDBAdapter()
+        user = {
+            'username': 'user',
+            'email': 'user@example.com',
+            'password_hash': 'hash'
+        }
+        self.assertTrue(db_adapter.insert_user(user))
+        self.assertFalse(db_adapter.insert_user(user))
+
+        updated = db_adapter.update_user('user', {'password_hash': 'new'})
+        self.assertEqual(updated['password_hash'], 'new')
+        self.assertEqual(updated['email'], 'user@example.com')
+        self.assertEqual(db_adapter.update_user('other', {}), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
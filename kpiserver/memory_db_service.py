@@ -0,0 +1,472 @@
+"""In-memory read only implementation of the datastore for index mirrors.
+
+Mirrors only serve package reads so they keep the whole index in memory and
+answer lookups from a dictionary without any network access. The index is
+loaded at startup from a snapshot file exported by the primary and kept
+current by applying a journal of changed packages that the primary appends
+to. Only the current release of each package is kept so version ranges
+resolve against the current release alone.
+
+Snapshots and journals share one line oriented format: a package name, a tab,
+and the package record as JSON. Names containing a tab or newline cannot be
+written. A journal entry with an empty record deletes the package. Snapshots
+start with a header line. The snapshot is memory mapped and only the package
+names are read at startup. Records are decoded the first time they are read.
+
+Usage on the primary:
+
+ - ```python memory_db_service.py snapshot``` exports every package to
+   MEMORY_SNAPSHOT_PATH and clears MEMORY_JOURNAL_PATH.
+ - ```python memory_db_service.py updates``` appends packages changed since
+   the last export to MEMORY_JOURNAL_PATH.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import argparse
+import json
+import mmap
+import os
+import sys
+import threading
+import time
+
+import db_service
+import versions
+
+SNAPSHOT_HEADER = 'KPISNAPSHOT 1\n'
+DEFAULT_SNAPSHOT_PATH = 'kpiserver.snapshot'
+DEFAULT_REFRESH_INTERVAL = 5
+
+COMMANDS = ['snapshot', 'updates']
+
+
+def encode_entry(package_name, record):
+    """Create the snapshot or journal line for a package.
+
+    @param package_name: The name of the package.
+    @type package_name: str
+    @param record: The package record or None if the package was deleted.
+    @type record: dict
+    @return: The line including its trailing newline.
+    @rtype: str
+    @raise ValueError: Raised if the name contains a tab or newline.
+    """
+    if '\t' in package_name or '\n' in package_name:
+        raise ValueError(
+            'Package name %r contains a tab or newline.' % package_name
+        )
+    if record is None:
+        encoded_record = ''
+    else:
+        encoded_record = json.dumps(record, separators=(',', ':'))
+    return '%s\t%s\n' % (package_name, encoded_record)
+
+
+def write_snapshot(path, packages):
+    """Atomically replace a snapshot file with a new export of the index.
+
+    @param path: The path of the snapshot file.
+    @type path: str
+    @param packages: The record of each package in the index.
+    @type packages: iterable of dict
+    @raise ValueError: Raised if a package name cannot be written. The
+        previous snapshot is left in place.
+    """
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(SNAPSHOT_HEADER)
+            for package in packages:
+                f.write(encode_entry(package['name'], package))
+    except:
+        os.remove(temp_path)
+        raise
+    os.rename(temp_path, path)
+
+
+def append_updates(path, updates):
+    """Add changed packages to the end of a journal file.
+
+    @param path: The path of the journal file. Created if it does not exist.
+    @type path: str
+    @param updates: The name of each changed package and its new record or
+        None if it was deleted.
+    @type updates: list of tuple
+    @raise ValueError: Raised if a package name cannot be written. Nothing is
+        appended in that case.
+    """
+    if not updates:
+        return
+    entries = ''.join(
+        encode_entry(package_name, record)
+        for package_name, record in updates
+    )
+    with open(path, 'ab') as f:
+        f.write(entries)
+
+
+def export_snapshot(db_adapter, snapshot_path, journal_path=None):
+    """Export every package to a new snapshot and clear the journal.
+
+    @param db_adapter: The primary's database.
+    @type db_adapter: db_service.DBAdapter
+    @param snapshot_path: The path of the snapshot file to write.
+    @type snapshot_path: str
+    @keyword journal_path: The path of the journal file to clear or None if
+        mirrors do not use a journal. Defaults to None.
+    @type journal_path: str
+    """
+    write_snapshot(snapshot_path, db_adapter.get_packages())
+    if journal_path and os.path.exists(journal_path):
+        os.remove(journal_path)
+
+
+def export_updates(db_adapter, snapshot_path, journal_path):
+    """Append packages changed since the last export to the journal.
+
+    Packages are compared by revision against the snapshot with the journal
+    applied.
+
+    @param db_adapter: The primary's database.
+    @type db_adapter: db_service.DBAdapter
+    @param snapshot_path: The path of the snapshot file the journal follows.
+    @type snapshot_path: str
+    @param journal_path: The path of the journal file to append to.
+    @type journal_path: str
+    @return: The number of packages written to the journal.
+    @rtype: int
+    """
+    exported = MemoryDBAdapter(snapshot_path, journal_path, None)
+    try:
+        remaining = set(exported.get_package_names())
+        updates = []
+        for package in db_adapter.get_packages():
+            package_name = package['name']
+            remaining.discard(package_name)
+            prior = exported.get_package(package_name)
+            revision = package.get(db_service.REVISION_FIELD, 0)
+            if not prior or \
+                prior.get(db_service.REVISION_FIELD, 0) != revision:
+                updates.append((package_name, package))
+        for package_name in sorted(remaining):
+            updates.append((package_name, None))
+    finally:
+        exported.close()
+
+    append_updates(journal_path, updates)
+    return len(updates)
+
+
+class MemoryDBAdapter(db_service.DBAdapter):
+    """Read only implementation of DBAdapter serving packages from memory.
+
+    Users are not available on mirrors and statistics recorded on a mirror
+    are discarded.
+    """
+
+    def __init__(self, snapshot_path, journal_path=None,
+            refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        """Create a new adapter and load the index.
+
+        @param snapshot_path: The path of the snapshot exported by the
+            primary.
+        @type snapshot_path: str
+        @keyword journal_path: The path of the journal of changes made after
+            the snapshot or None if there is no journal. Defaults to None.
+        @type journal_path: str
+        @keyword refresh_interval: The minimum number of seconds between
+            checks for a new snapshot or new journal entries or None to only
+            check when refresh is called. Defaults to DEFAULT_REFRESH_INTERVAL.
+        @type refresh_interval: float
+        """
+        db_service.DBAdapter.__init__(self, None)
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.snapshot_file = None
+        self.snapshot_map = None
+        self.load()
+
+    def load(self):
+        """Replace the index in memory with the snapshot and journal on disk.
+
+        @raise ValueError: Raised if the snapshot file is not a snapshot.
+        """
+        with self.lock:
+            self.close_snapshot()
+            self.snapshot_file = open(self.snapshot_path, 'rb')
+            stat = os.fstat(self.snapshot_file.fileno())
+            self.snapshot_id = (stat.st_ino, stat.st_mtime, stat.st_size)
+            self.snapshot_map = mmap.mmap(
+                self.snapshot_file.fileno(),
+                0,
+                access=mmap.ACCESS_READ
+            )
+            if self.snapshot_map[:len(SNAPSHOT_HEADER)] != SNAPSHOT_HEADER:
+                self.close_snapshot()
+                raise ValueError('%s is not a snapshot.' % self.snapshot_path)
+
+            self.offsets = self.index_snapshot(self.snapshot_map)
+            self.records = {}
+            self.journal_offset = 0
+            self.apply_journal()
+            self.next_refresh = self.get_next_refresh()
+
+    def index_snapshot(self, snapshot_map):
+        """Find where each package's record is in a snapshot.
+
+        @param snapshot_map: The memory mapped snapshot.
+        @type snapshot_map: mmap.mmap
+        @return: Mapping from package name to the start and end offsets of
+            the package's JSON record.
+        @rtype: dict
+        """
+        offsets = {}
+        position = len(SNAPSHOT_HEADER)
+        size = len(snapshot_map)
+        find = snapshot_map.find
+        while position < size:
+            separator = find('\t', position)
+            end = find('\n', separator)
+            if separator == -1 or end == -1:
+                break
+            offsets[snapshot_map[position:separator]] = (separator + 1, end)
+            position = end + 1
+        return offsets
+
+    def apply_journal(self):
+        """Apply journal entries added since the journal was last read.
+
+        Only complete lines are applied so that an entry being appended is
+        picked up by a later refresh.
+        """
+        if not self.journal_path or not os.path.exists(self.journal_path):
+            return
+
+        with open(self.journal_path, 'rb') as f:
+            f.seek(self.journal_offset)
+            data = f.read()
+        complete_size = data.rfind('\n') + 1
+        for line in data[:complete_size].splitlines():
+            package_name, encoded_record = line.split('\t', 1)
+            self.offsets.pop(package_name, None)
+            if encoded_record:
+                self.records[package_name] = json.loads(encoded_record)
+            else:
+                self.records.pop(package_name, None)
+        self.journal_offset += complete_size
+
+    def get_next_refresh(self):
+        """Get when the on disk index should next be checked for changes.
+
+        @return: Seconds since the epoch or None if refreshes are manual.
+        @rtype: float
+        """
+        if self.refresh_interval is None:
+            return None
+        return time.time() + self.refresh_interval
+
+    def refresh(self):
+        """Pick up a new snapshot or new journal entries from the primary."""
+        try:
+            stat = os.stat(self.snapshot_path)
+        except OSError:
+            return
+        snapshot_id = (stat.st_ino, stat.st_mtime, stat.st_size)
+
+        journal_size = 0
+        if self.journal_path and os.path.exists(self.journal_path):
+            journal_size = os.path.getsize(self.journal_path)
+
+        if snapshot_id != self.snapshot_id or \
+            journal_size < self.journal_offset:
+            self.load()
+        elif journal_size > self.journal_offset:
+            with self.lock:
+                self.apply_journal()
+
+    def check_refresh(self):
+        """Refresh if the refresh interval has passed since the last check."""
+        if self.next_refresh is None or time.time() < self.next_refresh:
+            return
+        self.next_refresh = self.get_next_refresh()
+        self.refresh()
+
+    def close_snapshot(self):
+        """Unmap and close the current snapshot if one is open."""
+        if self.snapshot_map:
+            self.snapshot_map.close()
+            self.snapshot_map = None
+        if self.snapshot_file:
+            self.snapshot_file.close()
+            self.snapshot_file = None
+
+    def close(self):
+        """Release the snapshot file. Reads fail afterwards."""
+        with self.lock:
+            self.close_snapshot()
+
+    def get_package_names(self):
+        """Get the name of every package in the index.
+
+        @return: The package names.
+        @rtype: list of str
+        """
+        with self.lock:
+            return self.offsets.keys() + self.records.keys()
+
+    def get_record(self, package_name):
+        """Get the record of a package, decoding it from the snapshot if needed.
+
+        @param package_name: The name of the package to look up.
+        @type package_name: str
+        @return: The shared record or None if the package is not in the index.
+        @rtype: dict
+        """
+        record = self.records.get(package_name, None)
+        if record is not None:
+            return record
+
+        with self.lock:
+            offsets = self.offsets.pop(package_name, None)
+            if not offsets:
+                return self.records.get(package_name, None)
+            start, end = offsets
+            record = json.loads(self.snapshot_map[start:end])
+            self.records[package_name] = record
+            return record
+
+    def initialize_indicies(self):
+        pass
+
+    def get_package(self, package_name):
+        self.check_refresh()
+        record = self.get_record(package_name)
+        return dict(record) if record else None
+
+    def get_packages(self):
+        return [
+            self.get_package(package_name)
+            for package_name in sorted(self.get_package_names())
+        ]
+
+    def get_latest_package_in_range(self, package_name, lower_key, upper_key):
+        package = self.get_package(package_name)
+        if not package:
+            return None
+        key = package.get(versions.VERSION_KEY_FIELD, None)
+        if key == None or key < lower_key:
+            return None
+        if upper_key != None and key >= upper_key:
+            return None
+        return package
+
+    def is_package_author(self, package_name, username):
+        package = self.get_package(package_name)
+        if not package:
+            return False
+        authors = package['authors']
+        if isinstance(authors, basestring):
+            return authors == username
+        return username in authors
+
+    def get_user(self, username):
+        return None
+
+    def get_user_as_author(self, username, package_name):
+        return (None, False)
+
+    def get_user_by_email(self, email):
+        return None
+
+    def find_existing_users(self, usernames, emails):
+        return []
+
+    def add_package_stats(self, counts):
+        pass
+
+    def get_package_stats(self, package_name, since_hour):
+        return []
+
+    def put_package(self, package_info):
+        raise db_service.ReadOnlyError('Mirrors are read only.')
+
+    def insert_package(self, package_info):
+        raise db_service.ReadOnlyError('Mirrors are read only.')
+
+    def update_package_as_author(self, package_name, username, package_info,
+            expected_revision=None):
+        raise db_service.ReadOnlyError('Mirrors are read only.')
+
+    def set_package_archive(self, package_name, version, archive_info):
+        raise db_service.ReadOnlyError('Mirrors are read only.')
+
+    def delete_package_as_author(self, package_name, username):
+        raise db_service.ReadOnlyError('Mirrors are read only.')
+
+    def delete_package(self, package_name):
+        raise db_service.ReadOnlyError('Mirrors are read only.')
+
+    def put_user(self, user_info):
+        raise db_service.ReadOnlyError('Mirrors are read only.')
+
+    def insert_user(self, user_info):
+        raise db_service.ReadOnlyError('Mirrors are read only.')
+
+    def insert_users(self, users_info):
+        raise db_service.ReadOnlyError('Mirrors are read only.')
+
+    def update_user(self, username, user_info):
+        raise db_service.ReadOnlyError('Mirrors are read only.')
+
+    def backfill_version_fields(self):
+        raise db_service.ReadOnlyError('Mirrors are read only.')
+
+    def backfill_package_versions(self):
+        raise db_service.ReadOnlyError('Mirrors are read only.')
+
+
+def main():
+    """Export the primary's index for mirrors from the command line.
+
+    @return: Exit status.
+    @rtype: int
+    """
+    parser = argparse.ArgumentParser(description='Export the index.')
+    parser.add_argument('command', choices=COMMANDS)
+    parser.add_argument('--config', default='kpiserver.cfg')
+    args = parser.parse_args()
+
+    import flask
+
+    app = flask.Flask(__name__)
+    app.config.from_pyfile(os.path.abspath(args.config))
+    snapshot_path = app.config.get(
+        'MEMORY_SNAPSHOT_PATH',
+        DEFAULT_SNAPSHOT_PATH
+    )
+    journal_path = app.config.get('MEMORY_JOURNAL_PATH', None)
+    with app.app_context():
+        db_adapter = db_service.create_command_adapter(app)
+        try:
+            if args.command == 'snapshot' or \
+                not os.path.exists(snapshot_path):
+                export_snapshot(db_adapter, snapshot_path, journal_path)
+                print 'Snapshot written to %s' % snapshot_path
+            elif not journal_path:
+                print 'MEMORY_JOURNAL_PATH is not set.'
+                return 1
+            else:
+                count = export_updates(db_adapter, snapshot_path, journal_path)
+                print '%d updates written to %s' % (count, journal_path)
+        except ValueError, e:
+            print str(e)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
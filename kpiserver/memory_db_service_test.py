@@ -0,0 +1,256 @@
+"""Tests for the in-memory read only implementation of the datastore.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import flask
+
+import db_service
+import db_service_test
+import load_test
+import memory_db_service
+import versions
+
+TEST_PACKAGE_NAME = 'package'
+
+
+def create_test_package(name, version='1.0.0', authors=None):
+    record = dict(
+        db_service_test.TEST_PACKAGE,
+        name=name,
+        version=version,
+        authors=authors or ['author']
+    )
+    record.update(versions.get_version_fields(version))
+    return record
+
+
+class MemoryDBAdapterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.snapshot_path = os.path.join(self.directory, 'index.snapshot')
+        self.journal_path = os.path.join(self.directory, 'index.journal')
+        memory_db_service.write_snapshot(self.snapshot_path, [
+            create_test_package(TEST_PACKAGE_NAME),
+            create_test_package('other', '2.0.0', 'other_author')
+        ])
+        self.adapter = memory_db_service.MemoryDBAdapter(
+            self.snapshot_path,
+            self.journal_path,
+            None
+        )
+
+    def tearDown(self):
+        self.adapter.close()
+        shutil.rmtree(self.directory)
+
+    def test_get_package(self):
+        package = self.adapter.get_package(TEST_PACKAGE_NAME)
+        self.assertEqual(package['version'], '1.0.0')
+        self.assertEqual(self.adapter.get_package('missing'), None)
+
+        package['version'] = 'changed'
+        self.assertEqual(
+            self.adapter.get_package(TEST_PACKAGE_NAME)['version'],
+            '1.0.0'
+        )
+        self.assertEqual(
+            sorted(self.adapter.get_package_names()),
+            ['other', TEST_PACKAGE_NAME]
+        )
+
+    def test_get_latest_package_in_range(self):
+        self.assertEqual(
+            self.adapter.get_latest_package_in_range(
+                'other',
+                *versions.parse_range('^2.0')
+            )['version'],
+            '2.0.0'
+        )
+        self.assertEqual(
+            self.adapter.get_latest_package_in_range(
+                'other',
+                *versions.parse_range('^1.0')
+            ),
+            None
+        )
+
+    def test_get_latest_package_in_range_unkeyed(self):
+        legacy_package = dict(db_service_test.TEST_PACKAGE, version='1.0')
+        memory_db_service.write_snapshot(self.snapshot_path, [legacy_package])
+        adapter = memory_db_service.MemoryDBAdapter(
+            self.snapshot_path,
+            self.journal_path,
+            None
+        )
+
+        try:
+            self.assertEqual(
+                adapter.get_latest_package_in_range(
+                    TEST_PACKAGE_NAME,
+                    *versions.parse_range('^1.0')
+                ),
+                None
+            )
+        finally:
+            adapter.close()
+
+    def test_is_package_author(self):
+        self.assertTrue(self.adapter.is_package_author(
+            TEST_PACKAGE_NAME,
+            'author'
+        ))
+        self.assertTrue(self.adapter.is_package_author(
+            'other',
+            'other_author'
+        ))
+        self.assertFalse(self.adapter.is_package_author('other', 'other'))
+        self.assertFalse(self.adapter.is_package_author('missing', 'author'))
+
+    def test_read_only(self):
+        self.assertRaises(
+            db_service.ReadOnlyError,
+            self.adapter.put_package,
+            create_test_package(TEST_PACKAGE_NAME)
+        )
+        self.assertRaises(
+            db_service.ReadOnlyError,
+            self.adapter.backfill_package_versions
+        )
+        self.assertEqual(self.adapter.get_user('author'), None)
+        self.adapter.add_package_stats({(TEST_PACKAGE_NAME, 0): {'reads': 1}})
+        self.assertEqual(
+            self.adapter.get_package_stats(TEST_PACKAGE_NAME, 0),
+            []
+        )
+
+    def test_unwritable_names(self):
+        for package_name in ['tab\tname', 'new\nline']:
+            self.assertRaises(
+                ValueError,
+                memory_db_service.write_snapshot,
+                self.snapshot_path,
+                [create_test_package(package_name)]
+            )
+            self.assertRaises(
+                ValueError,
+                memory_db_service.append_updates,
+                self.journal_path,
+                [(package_name, None)]
+            )
+        self.assertFalse(os.path.exists(self.snapshot_path + '.tmp'))
+        self.assertFalse(os.path.exists(self.journal_path))
+        self.assertTrue(self.adapter.get_package(TEST_PACKAGE_NAME))
+
+    def test_refresh_journal(self):
+        memory_db_service.append_updates(self.journal_path, [
+            (
+                TEST_PACKAGE_NAME,
+                create_test_package(TEST_PACKAGE_NAME, '1.1.0')
+            ),
+            ('other', None),
+            ('new', create_test_package('new'))
+        ])
+        with open(self.journal_path, 'ab') as f:
+            f.write('partial\t{"name"')
+
+        self.adapter.refresh()
+        self.assertEqual(
+            self.adapter.get_package(TEST_PACKAGE_NAME)['version'],
+            '1.1.0'
+        )
+        self.assertEqual(self.adapter.get_package('other'), None)
+        self.assertEqual(self.adapter.get_package('new')['name'], 'new')
+        self.assertEqual(self.adapter.get_package('partial'), None)
+
+    def test_refresh_snapshot(self):
+        memory_db_service.append_updates(self.journal_path, [('other', None)])
+        self.adapter.refresh()
+
+        os.remove(self.journal_path)
+        memory_db_service.write_snapshot(self.snapshot_path, [
+            create_test_package('replacement')
+        ])
+        os.utime(self.snapshot_path, (0, 0))
+        self.adapter.refresh()
+
+        self.assertEqual(self.adapter.get_package_names(), ['replacement'])
+
+    def test_check_refresh_interval(self):
+        self.adapter.refresh_interval = 60
+        self.adapter.next_refresh = self.adapter.get_next_refresh()
+        memory_db_service.append_updates(self.journal_path, [('other', None)])
+
+        self.assertNotEqual(self.adapter.get_package('other'), None)
+        self.adapter.next_refresh = 0
+        self.assertEqual(self.adapter.get_package('other'), None)
+
+    def test_invalid_snapshot(self):
+        with open(self.snapshot_path, 'wb') as f:
+            f.write('not a snapshot\n')
+        self.assertRaises(
+            ValueError,
+            memory_db_service.MemoryDBAdapter,
+            self.snapshot_path
+        )
+
+    def test_export(self):
+        primary = load_test.LoadTestDBAdapter()
+        primary.put_package(create_test_package(TEST_PACKAGE_NAME))
+        primary.put_package(create_test_package('other'))
+
+        memory_db_service.export_snapshot(
+            primary,
+            self.snapshot_path,
+            self.journal_path
+        )
+        self.assertEqual(
+            memory_db_service.export_updates(
+                primary,
+                self.snapshot_path,
+                self.journal_path
+            ),
+            0
+        )
+
+        primary.put_package(create_test_package(TEST_PACKAGE_NAME, '1.0.1'))
+        primary.delete_package('other')
+        self.assertEqual(
+            memory_db_service.export_updates(
+                primary,
+                self.snapshot_path,
+                self.journal_path
+            ),
+            2
+        )
+
+        self.adapter.refresh()
+        self.assertEqual(
+            self.adapter.get_packages(),
+            primary.get_packages()
+        )
+
+    def test_create_adapter(self):
+        app = flask.Flask(__name__)
+        app.config['DB_BACKEND'] = 'memory'
+        app.config['MEMORY_SNAPSHOT_PATH'] = self.snapshot_path
+        adapter = db_service.create_adapter(app)
+        try:
+            self.assertTrue(isinstance(
+                adapter,
+                memory_db_service.MemoryDBAdapter
+            ))
+            self.assertNotEqual(adapter.get_package(TEST_PACKAGE_NAME), None)
+        finally:
+            adapter.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
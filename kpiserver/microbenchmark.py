@@ -0,0 +1,682 @@
+"""Microbenchmarks for the building blocks of the Kipling Package Index server.
+
+Times individual primitives like password checking, serialization of package
+records, upload URL signing, authors list processing, and index loading and
+lookups across a range of input sizes. Benchmarks in the same group with
+different implementation names can be compared against each other so that
+optimizations can be evaluated objectively before they are adopted.
+
+Usage: ```python microbenchmark.py [--group name] [--compare implementation]```
+Example: ```python microbenchmark.py --group package_json --compare stdlib```
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import argparse
+import atexit
+import json
+import logging
+import logging.handlers
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from werkzeug import security
+
+import audit_service
+import db_service
+import file_store_service
+import memory_db_service
+import responses
+import sqlite_db_service
+import stats_service
+import util
+import versions
+
+DEFAULT_ROUNDS = 5
+DEFAULT_MIN_ROUND_TIME = 0.05
+BASELINE_IMPLEMENTATION = 'current'
+
+TEST_PASSWORD = 'benchmark password'
+
+INDEX_DIRECTORY = tempfile.mkdtemp(prefix='kpi_benchmark_')
+atexit.register(shutil.rmtree, INDEX_DIRECTORY, True)
+
+BENCHMARKS = []
+CLEANUPS = []
+
+
+class Benchmark:
+    """Information about a registered benchmark."""
+
+    def __init__(self, group, implementation, factory, params):
+        """Create a new record of a benchmark.
+
+        @param group: The name of the group of benchmarks measuring the same
+            operation.
+        @type group: str
+        @param implementation: The name of the implementation of the operation
+            being measured.
+        @type implementation: str
+        @param factory: Function that, given a parameter, does any setup and
+            returns a zero argument callable to be timed.
+        @type factory: function
+        @param params: The parameters (like input sizes) to run the benchmark
+            with.
+        @type params: list
+        """
+        self.group = group
+        self.implementation = implementation
+        self.factory = factory
+        self.params = params
+
+
+def benchmark(group, implementation=BASELINE_IMPLEMENTATION, params=None):
+    """Decorator registering a benchmark factory.
+
+    @param group: The name of the group of benchmarks measuring the same
+        operation.
+    @type group: str
+    @keyword implementation: The name of the implementation being measured.
+        Defaults to BASELINE_IMPLEMENTATION.
+    @type implementation: str
+    @keyword params: The parameters to run the benchmark with. Defaults to
+        a single None parameter.
+    @type params: list
+    @return: Decorator that registers and returns the decorated factory.
+    @rtype: function
+    """
+    if params is None:
+        params = [None]
+
+    def decorator(factory):
+        BENCHMARKS.append(Benchmark(group, implementation, factory, params))
+        return factory
+
+    return decorator
+
+
+def add_cleanup(function):
+    """Register a function undoing a benchmark factory's setup.
+
+    For factories that start threads or open files which would otherwise
+    keep running while later benchmarks are timed.
+
+    @param function: Zero argument callable to run once the benchmark ends.
+    @type function: function
+    """
+    CLEANUPS.append(function)
+
+
+def run_cleanups():
+    """Run and forget the functions registered with add_cleanup."""
+    while CLEANUPS:
+        CLEANUPS.pop()()
+
+
+def time_callable(target, rounds=DEFAULT_ROUNDS,
+        min_round_time=DEFAULT_MIN_ROUND_TIME, timer=time.time):
+    """Time a callable, calibrating the number of calls per round.
+
+    @param target: Zero argument callable to time.
+    @type target: function
+    @keyword rounds: The number of timed rounds to run.
+    @type rounds: int
+    @keyword min_round_time: The minimum number of seconds a round should take
+        so that timer resolution does not dominate the measurement.
+    @type min_round_time: float
+    @keyword timer: Function returning the current time in seconds.
+    @type timer: function
+    @return: Dictionary with min, median, mean, and stddev seconds per call as
+        well as the number of calls per round (loops).
+    @rtype: dict
+    """
+    loops = 1
+    while True:
+        start = timer()
+        for _ in xrange(loops):
+            target()
+        elapsed = timer() - start
+        if elapsed >= min_round_time:
+            break
+        loops *= 10
+
+    samples = [elapsed / loops]
+    for _ in xrange(rounds - 1):
+        start = timer()
+        for _ in xrange(loops):
+            target()
+        samples.append((timer() - start) / loops)
+
+    samples.sort()
+    mean = sum(samples) / len(samples)
+    variance = sum((sample - mean) ** 2 for sample in samples) / len(samples)
+    return {
+        'min': samples[0],
+        'median': samples[len(samples) / 2],
+        'mean': mean,
+        'stddev': math.sqrt(variance),
+        'loops': loops
+    }
+
+
+def select_benchmarks(group=None, implementations=None):
+    """Find registered benchmarks matching filters.
+
+    @keyword group: If provided, only benchmarks in this group are returned.
+    @type group: str
+    @keyword implementations: If provided, only benchmarks of these
+        implementations are returned.
+    @type implementations: list of str
+    @return: Matching benchmarks in registration order.
+    @rtype: list of Benchmark
+    """
+    selected = []
+    for candidate in BENCHMARKS:
+        if group and candidate.group != group:
+            continue
+        if implementations and not candidate.implementation in implementations:
+            continue
+        selected.append(candidate)
+    return selected
+
+
+def run_benchmarks(benchmarks, rounds=DEFAULT_ROUNDS,
+        min_round_time=DEFAULT_MIN_ROUND_TIME):
+    """Run a series of benchmarks across all of their parameters.
+
+    @param benchmarks: The benchmarks to run.
+    @type benchmarks: list of Benchmark
+    @keyword rounds: The number of timed rounds for each benchmark.
+    @type rounds: int
+    @keyword min_round_time: The minimum number of seconds per round.
+    @type min_round_time: float
+    @return: List of results, each a dictionary with group, implementation,
+        param, and the timing values from time_callable.
+    @rtype: list of dict
+    """
+    results = []
+    for target in benchmarks:
+        for param in target.params:
+            try:
+                timing = time_callable(
+                    target.factory(param),
+                    rounds=rounds,
+                    min_round_time=min_round_time
+                )
+            finally:
+                run_cleanups()
+            timing['group'] = target.group
+            timing['implementation'] = target.implementation
+            timing['param'] = param
+            results.append(timing)
+    return results
+
+
+def compare_results(results, baseline_implementation):
+    """Calculate the speed of each result relative to a baseline implementation.
+
+    @param results: Results as returned by run_benchmarks.
+    @type results: list of dict
+    @param baseline_implementation: The name of the implementation that other
+        implementations in the same group should be compared against.
+    @type baseline_implementation: str
+    @return: The results with an added relative field holding the ratio of the
+        result's median to the median of the baseline implementation for the
+        same group and param (None if no matching baseline).
+    @rtype: list of dict
+    """
+    baselines = {}
+    for result in results:
+        if result['implementation'] == baseline_implementation:
+            key = (result['group'], repr(result['param']))
+            baselines[key] = result['median']
+
+    for result in results:
+        baseline = baselines.get((result['group'], repr(result['param'])))
+        if baseline:
+            result['relative'] = result['median'] / baseline
+        else:
+            result['relative'] = None
+    return results
+
+
+def print_results(results):
+    """Print a table describing benchmark results.
+
+    @param results: Results as returned by run_benchmarks or compare_results.
+    @type results: list of dict
+    """
+    print '%-24s %-14s %-22s %12s %12s %10s' % (
+        'group', 'implementation', 'param', 'median us', 'stddev us', 'relative'
+    )
+    for result in results:
+        relative = result.get('relative', None)
+        print '%-24s %-14s %-22s %12.2f %12.2f %10s' % (
+            result['group'],
+            result['implementation'],
+            result['param'],
+            result['median'] * 1000000,
+            result['stddev'] * 1000000,
+            '%.2fx' % relative if relative else '-'
+        )
+
+
+class BenchmarkDBAdapter:
+    """Minimal stand-in for the DBAdapter with a single user and package."""
+
+    def __init__(self, user, package):
+        """Create a new stand-in.
+
+        @param user: The user record to return for any username.
+        @type user: dict
+        @param package: The package record to return for any package name.
+        @type package: dict
+        """
+        self.user = user
+        self.package = package
+
+    def get_user(self, username):
+        return self.user
+
+    def get_package(self, package_name):
+        return self.package
+
+    def is_package_author(self, package_name, username):
+        return username in self.package['authors']
+
+    def get_user_as_author(self, username, package_name):
+        return (self.user, username in self.package['authors'])
+
+    def add_package_stats(self, counts):
+        pass
+
+
+def create_package_record(num_authors, description_length):
+    """Create a package record like those returned from the database.
+
+    @param num_authors: The number of authors the package should have.
+    @type num_authors: int
+    @param description_length: The number of characters in the description.
+    @type description_length: int
+    @return: Package record.
+    @rtype: dict
+    """
+    return {
+        'name': 'benchmark_package',
+        'humanName': 'Benchmark Package',
+        'version': '1.2.34',
+        'license': 'GNU GPL v3',
+        'authors': ['author%d' % i for i in range(num_authors)],
+        'description': ('x' * description_length),
+        'homepage': 'https://example.com/benchmark_package',
+        'repository': 'https://example.com/benchmark_package.git'
+    }
+
+
+def create_benchmark_index(num_packages):
+    """Write an index snapshot and SQLite database with the same packages.
+
+    Indices are written once per size and reused by later benchmarks.
+
+    @param num_packages: The number of packages in the index.
+    @type num_packages: int
+    @return: The paths of the snapshot, a JSON document with every record,
+        and the SQLite database.
+    @rtype: tuple of str
+    """
+    prefix = os.path.join(INDEX_DIRECTORY, 'index_%d' % num_packages)
+    paths = (prefix + '.snapshot', prefix + '.json', prefix + '.db')
+    if os.path.exists(paths[0]):
+        return paths
+
+    packages = []
+    for i in range(num_packages):
+        package = create_package_record(3, 200)
+        package['name'] = 'package%d' % i
+        package.update(versions.get_version_fields(package['version']))
+        package[db_service.REVISION_FIELD] = 1
+        packages.append(package)
+
+    memory_db_service.write_snapshot(paths[0], packages)
+    with open(paths[1], 'w') as f:
+        json.dump(dict((package['name'], package) for package in packages), f)
+    sqlite_adapter = sqlite_db_service.SQLiteDBAdapter(paths[2])
+    with sqlite_adapter.transaction() as connection:
+        for package in packages:
+            sqlite_adapter.write_package(connection, package)
+    sqlite_adapter.close()
+    return paths
+
+
+PACKAGE_SIZES = [(1, 100), (10, 1000), (100, 10000), (1000, 100000)]
+AUTHOR_COUNTS = [1, 10, 100, 1000]
+NAME_LENGTHS = [8, 64, 256]
+BATCH_SIZES = [1, 100, 500]
+INDEX_SIZES = [1000, 10000]
+
+
+@benchmark('check_permissions', params=['pbkdf2:sha256:1000', 'pbkdf2:sha256'])
+def bench_check_permissions(method):
+    password_hash = security.generate_password_hash(TEST_PASSWORD, method)
+    db_adapter = BenchmarkDBAdapter(
+        {'username': 'author0', 'password_hash': password_hash},
+        create_package_record(10, 100)
+    )
+    return lambda: util.check_permissions(
+        db_adapter,
+        'author0',
+        TEST_PASSWORD,
+        'benchmark_package'
+    )
+
+
+@benchmark('package_json', params=PACKAGE_SIZES)
+def bench_package_json(size):
+    record = {'success': True, 'record': create_package_record(*size)}
+    return lambda: json.dumps(record)
+
+
+@benchmark('package_json', 'stdlib_compact', params=PACKAGE_SIZES)
+def bench_package_json_compact(size):
+    record = {'success': True, 'record': create_package_record(*size)}
+    return lambda: json.dumps(record, separators=(',', ':'))
+
+
+@benchmark('package_json', 'responses', params=PACKAGE_SIZES)
+def bench_package_json_responses(size):
+    record = {'success': True, 'record': create_package_record(*size)}
+    return lambda: responses.dumps(record)
+
+
+@benchmark('response_compression', 'gzip', params=PACKAGE_SIZES)
+def bench_response_compression_gzip(size):
+    record = {'success': True, 'record': create_package_record(*size)}
+    body = responses.dumps(record)
+    return lambda: responses.compress(body, 'gzip')
+
+
+class BenchmarkApplication:
+    """Stand-in for a flask application providing only configuration."""
+
+    def __init__(self, config):
+        """Create a new stand-in.
+
+        @param config: The configuration values to provide.
+        @type config: dict
+        """
+        self.config = config
+        self.extensions = {}
+
+
+def create_s3_application(config=None):
+    """Create a stand-in application with S3 configuration.
+
+    @keyword config: Additional configuration values. Defaults to None.
+    @type config: dict
+    @return: The stand-in application.
+    @rtype: BenchmarkApplication
+    """
+    application = BenchmarkApplication({
+        'UPLOADS_BUCKET_NAME': 'benchmark_bucket',
+        'S3_SECRET_KEY': 'benchmark secret',
+        'S3_ACCESS_KEY': 'benchmark_access_key'
+    })
+    application.config.update(config or {})
+    return application
+
+
+@benchmark('create_file_upload_url', params=NAME_LENGTHS)
+def bench_create_file_upload_url(name_length):
+    application = create_s3_application()
+    package_name = 'p' * name_length
+    return lambda: file_store_service.create_file_upload_url(
+        application,
+        package_name
+    )
+
+
+@benchmark('create_file_upload_url', 'uncached', params=NAME_LENGTHS)
+def bench_create_file_upload_url_uncached(name_length):
+    application = create_s3_application({'SIGNED_URL_CACHE_SIZE': 0})
+    package_name = 'p' * name_length
+    return lambda: file_store_service.create_file_upload_url(
+        application,
+        package_name
+    )
+
+
+@benchmark('create_file_upload_url', 'sigv4_uncached', params=NAME_LENGTHS)
+def bench_create_file_upload_url_sigv4(name_length):
+    application = create_s3_application({
+        'S3_SIGNATURE_VERSION': 4,
+        'SIGNED_URL_CACHE_SIZE': 0
+    })
+    signer = file_store_service.get_signer(application)
+    object_name = file_store_service.get_archive_name('p' * name_length)
+    return lambda: signer.sign(
+        'PUT',
+        object_name,
+        file_store_service.DEFAULT_UPLOAD_EXPIRATION,
+        mime_type=file_store_service.ZIP_MIME_TYPE,
+        amz_headers=file_store_service.PUBLIC_READ_HEADERS
+    )
+
+
+@benchmark('create_file_upload_url', 'sigv4_post_policy', params=NAME_LENGTHS)
+def bench_create_file_upload_spec_sigv4(name_length):
+    application = create_s3_application({'S3_SIGNATURE_VERSION': 4})
+    package_name = 'p' * name_length
+    return lambda: file_store_service.create_file_upload_spec(
+        application,
+        package_name
+    )
+
+
+@benchmark('sigv4_signing_key')
+def bench_sigv4_signing_key(unused_param):
+    application = create_s3_application({'S3_SIGNATURE_VERSION': 4})
+    signer = file_store_service.get_signer(application)
+    return lambda: signer.get_signing_key('20130524')
+
+
+@benchmark('sigv4_signing_key', 'derived')
+def bench_sigv4_signing_key_derived(unused_param):
+    return lambda: file_store_service.derive_signing_key(
+        'benchmark secret',
+        '20130524',
+        file_store_service.DEFAULT_REGION,
+        file_store_service.S3_SERVICE
+    )
+
+
+@benchmark('sign_download_urls', params=BATCH_SIZES)
+def bench_sign_download_urls(batch_size):
+    application = create_s3_application()
+    names = ['package%d' % i for i in range(batch_size)]
+    return lambda: file_store_service.create_file_download_urls(
+        application,
+        names
+    )
+
+
+@benchmark('sign_download_urls', 'uncached', params=BATCH_SIZES)
+def bench_sign_download_urls_uncached(batch_size):
+    application = create_s3_application({'SIGNED_URL_CACHE_SIZE': 0})
+    names = ['package%d' % i for i in range(batch_size)]
+    return lambda: file_store_service.create_file_download_urls(
+        application,
+        names
+    )
+
+
+@benchmark('record_stats_event')
+def bench_record_stats_event(unused_param):
+    stats_buffer = stats_service.StatsBuffer(
+        BenchmarkApplication({}),
+        BenchmarkDBAdapter(None, None),
+        stats_service.DEFAULT_FLUSH_INTERVAL,
+        sys.maxint
+    )
+    return lambda: stats_buffer.record(
+        'benchmark_package',
+        stats_service.DOWNLOAD_EVENT
+    )
+
+
+@benchmark('record_stats_event', 'unbuffered')
+def bench_record_stats_event_unbuffered(unused_param):
+    stats_buffer = stats_service.StatsBuffer(
+        BenchmarkApplication({}),
+        BenchmarkDBAdapter(None, None),
+        0,
+        sys.maxint
+    )
+    return lambda: stats_buffer.record(
+        'benchmark_package',
+        stats_service.DOWNLOAD_EVENT
+    )
+
+
+def create_audit_logger(handler):
+    """Create a logger outside of the logging hierarchy for benchmarking.
+
+    @param handler: The handler the logger should pass events to.
+    @type handler: logging.Handler
+    @return: Logger recording INFO events to only the given handler.
+    @rtype: logging.Logger
+    """
+    logger = logging.Logger('benchmark_audit', logging.INFO)
+    logger.addHandler(handler)
+    return logger
+
+
+def log_benchmark_event(logger):
+    logger.info(audit_service.create_event(
+        audit_service.PACKAGE_UPDATE_EVENT,
+        {'username': 'benchmark_user', 'package': 'benchmark_package'}
+    ))
+
+
+@benchmark('audit_log_event')
+def bench_audit_log_event(unused_param):
+    audit_log = audit_service.create_audit_log(
+        os.path.join(INDEX_DIRECTORY, 'audit.log'),
+        audit_service.DEFAULT_MAX_BYTES,
+        audit_service.DEFAULT_BACKUP_COUNT,
+        audit_service.DEFAULT_QUEUE_SIZE
+    )
+    audit_log.start()
+    add_cleanup(audit_log.shutdown)
+    logger = create_audit_logger(audit_log.handler)
+    return lambda: log_benchmark_event(logger)
+
+
+@benchmark('audit_log_event', 'synchronous')
+def bench_audit_log_event_synchronous(unused_param):
+    handler = logging.handlers.RotatingFileHandler(
+        os.path.join(INDEX_DIRECTORY, 'audit_synchronous.log'),
+        maxBytes=audit_service.DEFAULT_MAX_BYTES,
+        backupCount=audit_service.DEFAULT_BACKUP_COUNT
+    )
+    handler.setFormatter(audit_service.JSONLinesFormatter())
+    add_cleanup(handler.close)
+    logger = create_audit_logger(handler)
+    return lambda: log_benchmark_event(logger)
+
+
+@benchmark('audit_log_event', 'disabled')
+def bench_audit_log_event_disabled(unused_param):
+    return lambda: audit_service.log_event(
+        audit_service.PACKAGE_UPDATE_EVENT,
+        username='benchmark_user',
+        package='benchmark_package'
+    )
+
+
+@benchmark('process_authors', params=AUTHOR_COUNTS)
+def bench_process_authors(num_authors):
+    authors = ', '.join('author%d' % i for i in range(num_authors))
+    return lambda: util.process_authors({'authors': authors})
+
+
+@benchmark('process_authors', 'already_list', params=AUTHOR_COUNTS)
+def bench_process_authors_list(num_authors):
+    authors = ['author%d' % i for i in range(num_authors)]
+    return lambda: util.process_authors({'authors': authors})
+
+
+def load_memory_index(snapshot_path):
+    memory_db_service.MemoryDBAdapter(snapshot_path, None, None).close()
+
+
+def load_json_index(json_path):
+    with open(json_path) as f:
+        json.load(f)
+
+
+@benchmark('index_startup', params=INDEX_SIZES)
+def bench_index_startup(num_packages):
+    snapshot_path = create_benchmark_index(num_packages)[0]
+    return lambda: load_memory_index(snapshot_path)
+
+
+@benchmark('index_startup', 'json_document', params=INDEX_SIZES)
+def bench_index_startup_json(num_packages):
+    json_path = create_benchmark_index(num_packages)[1]
+    return lambda: load_json_index(json_path)
+
+
+@benchmark('index_get_package', params=INDEX_SIZES)
+def bench_index_get_package(num_packages):
+    snapshot_path = create_benchmark_index(num_packages)[0]
+    db_adapter = memory_db_service.MemoryDBAdapter(snapshot_path)
+    package_name = 'package%d' % (num_packages / 2)
+    return lambda: db_adapter.get_package(package_name)
+
+
+@benchmark('index_get_package', 'sqlite', params=INDEX_SIZES)
+def bench_index_get_package_sqlite(num_packages):
+    db_path = create_benchmark_index(num_packages)[2]
+    db_adapter = sqlite_db_service.SQLiteDBAdapter(db_path)
+    package_name = 'package%d' % (num_packages / 2)
+    return lambda: db_adapter.get_package(package_name)
+
+
+def main():
+    """Main driver for running microbenchmarks from the command line."""
+    parser = argparse.ArgumentParser(description='KPI server microbenchmarks.')
+    parser.add_argument('--group')
+    parser.add_argument('--implementation', action='append')
+    parser.add_argument('--compare', default=BASELINE_IMPLEMENTATION)
+    parser.add_argument('--rounds', type=int, default=DEFAULT_ROUNDS)
+    parser.add_argument(
+        '--min-round-time',
+        type=float,
+        default=DEFAULT_MIN_ROUND_TIME
+    )
+    parser.add_argument('--json', help='Path to save raw results to.')
+    args = parser.parse_args()
+
+    selected = select_benchmarks(args.group, args.implementation)
+    if not selected:
+        print '[Error] No benchmarks matched.'
+        return 1
+
+    results = run_benchmarks(selected, args.rounds, args.min_round_time)
+    results = compare_results(results, args.compare)
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4, separators=(',', ': '))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""Tests for the Kipling Package Index server microbenchmark harness.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import unittest
+
+import mox
+
+import audit_service
+import microbenchmark
+
+# Timings on a shared machine are noisy so the overhead check only fails if
+# every attempt exceeds the bound.
+OVERHEAD_ATTEMPTS = 3
+
+
+class FakeTimer:
+    """Timer that advances by a fixed step every time it is read."""
+
+    def __init__(self, step):
+        self.step = step
+        self.now = 0
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+class MicrobenchmarkTests(mox.MoxTestBase):
+
+    def test_time_callable_calibrates_loops(self):
+        calls = []
+        timer = FakeTimer(0.01)
+        timing = microbenchmark.time_callable(
+            lambda: calls.append(1),
+            rounds=3,
+            min_round_time=0.01,
+            timer=timer
+        )
+        self.assertEqual(timing['loops'], 1)
+        self.assertEqual(len(calls), 3)
+        self.assertAlmostEqual(timing['median'], 0.01)
+        self.assertAlmostEqual(timing['stddev'], 0)
+
+    def test_time_callable_real_timer(self):
+        timing = microbenchmark.time_callable(
+            lambda: None,
+            rounds=2,
+            min_round_time=0.001
+        )
+        self.assertTrue(timing['loops'] > 1)
+        self.assertTrue(timing['min'] <= timing['median'])
+
+    def test_select_benchmarks(self):
+        selected = microbenchmark.select_benchmarks('package_json')
+        self.assertTrue(len(selected) >= 2)
+        for target in selected:
+            self.assertEqual(target.group, 'package_json')
+
+        selected = microbenchmark.select_benchmarks(
+            'package_json',
+            ['stdlib_compact']
+        )
+        self.assertEqual(len(selected), 1)
+
+    def test_compare_results(self):
+        results = [
+            {'group': 'a', 'implementation': 'current', 'param': 1,
+                'median': 2.0},
+            {'group': 'a', 'implementation': 'other', 'param': 1,
+                'median': 1.0},
+            {'group': 'a', 'implementation': 'other', 'param': 2,
+                'median': 1.0}
+        ]
+        compared = microbenchmark.compare_results(results, 'current')
+        self.assertEqual(compared[0]['relative'], 1.0)
+        self.assertEqual(compared[1]['relative'], 0.5)
+        self.assertEqual(compared[2]['relative'], None)
+
+    def test_benchmarks_run(self):
+        for target in microbenchmark.BENCHMARKS:
+            for param in target.params:
+                try:
+                    target.factory(param)()
+                finally:
+                    microbenchmark.run_cleanups()
+
+    def test_run_cleanups(self):
+        calls = []
+        microbenchmark.add_cleanup(lambda: calls.append('first'))
+        microbenchmark.add_cleanup(lambda: calls.append('second'))
+
+        microbenchmark.run_cleanups()
+        microbenchmark.run_cleanups()
+
+        self.assertEqual(calls, ['second', 'first'])
+
+    def measure_audit_log_overhead(self):
+        results = microbenchmark.run_benchmarks(
+            microbenchmark.select_benchmarks('audit_log_event'),
+            rounds=5,
+            min_round_time=0.01
+        )
+        fastest = dict(
+            (result['implementation'], result['min']) for result in results
+        )
+        return fastest[microbenchmark.BASELINE_IMPLEMENTATION] / \
+            fastest['synchronous']
+
+    def test_audit_log_event_overhead(self):
+        for attempt in range(OVERHEAD_ATTEMPTS):
+            ratio = self.measure_audit_log_overhead()
+            if ratio <= audit_service.MAX_EVENT_OVERHEAD_RATIO:
+                return
+        self.fail('Logging an event took %.2fx a synchronous write.' % ratio)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,326 @@
+"""Password hashing for users of the Kipling Package Index.
+
+Password hashes are deliberately slow to compute and hashing on the request
+thread holds the interpreter lock for the whole computation. Hashes are
+instead computed on a shared pool of processes so that hashing spreads across
+cores while request threads only wait on the result. The pool is created by
+configure when the server starts because forking after other threads have
+started can leave locks held in the new processes.
+
+The hash algorithm is configurable. Werkzeug's PBKDF2 hashes are always
+supported. scrypt is supported where hashlib provides it and argon2 where the
+argon2-cffi module is installed. Hashes made with a different algorithm than
+the one configured are replaced with a new hash the next time the user's
+password is checked.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import binascii
+import hashlib
+import hmac
+import multiprocessing
+import threading
+
+from werkzeug import security
+
+PBKDF2_ALGORITHM = 'pbkdf2:sha256'
+SCRYPT_ALGORITHM = 'scrypt'
+ARGON2_ALGORITHM = 'argon2'
+DEFAULT_ALGORITHM = PBKDF2_ALGORITHM
+
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SCRYPT_KEY_LENGTH = 64
+SALT_LENGTH = 16
+
+ARGON2_PREFIX = '$argon2'
+
+executor_lock = threading.Lock()
+
+
+def is_available(algorithm):
+    """Determine if an algorithm can be used in this environment.
+
+    @param algorithm: The name of the algorithm like SCRYPT_ALGORITHM.
+    @type algorithm: str
+    @return: True if passwords can be hashed with the algorithm.
+    @rtype: bool
+    """
+    if algorithm == SCRYPT_ALGORITHM:
+        return hasattr(hashlib, 'scrypt')
+    elif algorithm == ARGON2_ALGORITHM:
+        try:
+            import argon2
+        except ImportError:
+            return False
+        return True
+    else:
+        return algorithm.startswith('pbkdf2:')
+
+
+def get_algorithm(application):
+    """Get the algorithm new password hashes should use.
+
+    @param application: The application whose PASSWORD_HASH_ALGORITHM
+        configuration value names the algorithm or None for the default.
+    @type application: flask.Flask
+    @return: The name of the algorithm.
+    @rtype: str
+    @raise ValueError: Raised if the configured algorithm is not available.
+    """
+    if not application:
+        return DEFAULT_ALGORITHM
+
+    algorithm = application.config.get(
+        'PASSWORD_HASH_ALGORITHM',
+        DEFAULT_ALGORITHM
+    )
+    if not is_available(algorithm):
+        raise ValueError('%s hashing is not available.' % algorithm)
+    return algorithm
+
+
+def generate_password_hash(password, algorithm=DEFAULT_ALGORITHM):
+    """Hash a password.
+
+    @param password: The plaintext password to hash.
+    @type password: str
+    @keyword algorithm: The name of the algorithm to use. Defaults to
+        DEFAULT_ALGORITHM.
+    @type algorithm: str
+    @return: The hash including the algorithm and its parameters.
+    @rtype: str
+    """
+    if algorithm == SCRYPT_ALGORITHM:
+        salt = security.gen_salt(SALT_LENGTH)
+        key = hashlib.scrypt(
+            password,
+            salt=salt,
+            n=SCRYPT_N,
+            r=SCRYPT_R,
+            p=SCRYPT_P,
+            dklen=SCRYPT_KEY_LENGTH
+        )
+        method = 'scrypt:%d:%d:%d' % (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+        return '%s$%s$%s' % (method, salt, binascii.hexlify(key))
+    elif algorithm == ARGON2_ALGORITHM:
+        import argon2
+        return argon2.PasswordHasher().hash(password)
+    else:
+        return security.generate_password_hash(password, algorithm)
+
+
+def generate_password_hash_pair(pair):
+    """Hash a password given with its algorithm as a single value for map.
+
+    @param pair: The plaintext password and the name of the algorithm.
+    @type pair: tuple
+    @return: The hash as returned by generate_password_hash.
+    @rtype: str
+    """
+    return generate_password_hash(*pair)
+
+
+def check_password_hash(password_hash, password):
+    """Check a password against a hash made with any supported algorithm.
+
+    @param password_hash: The hash as returned by generate_password_hash.
+    @type password_hash: str
+    @param password: The plaintext password to check.
+    @type password: str
+    @return: True if the password matches and False otherwise.
+    @rtype: bool
+    """
+    if password_hash.startswith(ARGON2_PREFIX):
+        import argon2
+        try:
+            return argon2.PasswordHasher().verify(password_hash, password)
+        except argon2.exceptions.VerificationError:
+            return False
+    elif password_hash.startswith(SCRYPT_ALGORITHM + ':'):
+        if password_hash.count('$') != 2:
+            return False
+        method, salt, expected = password_hash.split('$')
+        n, r, p = [int(value) for value in method.split(':')[1:]]
+        key = hashlib.scrypt(
+            password,
+            salt=salt,
+            n=n,
+            r=r,
+            p=p,
+            dklen=len(expected) / 2
+        )
+        return hmac.compare_digest(binascii.hexlify(key), expected)
+    else:
+        return security.check_password_hash(password_hash, password)
+
+
+def needs_rehash(application, password_hash):
+    """Determine if a hash was made with a different algorithm than configured.
+
+    @param application: The application with the hashing configuration. If
+        None, hashes are never replaced.
+    @type application: flask.Flask
+    @param password_hash: The hash to check.
+    @type password_hash: str
+    @return: True if the password should be hashed again.
+    @rtype: bool
+    """
+    if not application:
+        return False
+
+    algorithm = get_algorithm(application)
+    if algorithm == ARGON2_ALGORITHM:
+        return not password_hash.startswith(ARGON2_PREFIX)
+    method = password_hash.split('$', 1)[0]
+    return method != algorithm and not method.startswith(algorithm + ':')
+
+
+class HashingExecutor:
+    """Pool of processes that compute password hashes."""
+
+    def __init__(self, num_processes):
+        """Create and start a new pool.
+
+        @param num_processes: The number of processes to hash with. If 0,
+            hashes are computed on the calling thread. If None, uses one
+            process per CPU.
+        @type num_processes: int
+        """
+        if num_processes == 0:
+            self.pool = None
+        else:
+            self.pool = multiprocessing.Pool(num_processes)
+
+    def run(self, function, *args):
+        """Call a function in a hashing process and wait for the result.
+
+        @param function: The module level function to call.
+        @type function: function
+        @return: The value returned by the function.
+        """
+        if not self.pool:
+            return function(*args)
+        return self.pool.apply(function, args)
+
+    def map(self, function, values):
+        """Call a function on many values spread across hashing processes.
+
+        @param function: The module level single argument function to call.
+        @type function: function
+        @param values: The values to call the function on.
+        @type values: list
+        @return: The value returned by the function for each value in order.
+        @rtype: list
+        """
+        if not self.pool or len(values) < 2:
+            return map(function, values)
+        return self.pool.map(function, values)
+
+    def shutdown(self):
+        """Stop the hashing processes."""
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+def get_executor(application):
+    """Get the hashing executor for an application, creating it if needed.
+
+    Uses the PASSWORD_HASH_PROCESSES configuration value. Without an
+    application, hashes are computed on the calling thread.
+
+    @param application: The application with the hashing configuration.
+    @type application: flask.Flask
+    @return: The executor shared across requests.
+    @rtype: HashingExecutor
+    """
+    if not application:
+        return HashingExecutor(0)
+
+    executor = application.extensions.get('kpi_hashing_executor', None)
+    if executor:
+        return executor
+
+    with executor_lock:
+        executor = application.extensions.get('kpi_hashing_executor', None)
+        if not executor:
+            executor = HashingExecutor(
+                application.config.get('PASSWORD_HASH_PROCESSES', None)
+            )
+            application.extensions['kpi_hashing_executor'] = executor
+    return executor
+
+
+def configure(application):
+    """Check the hashing configuration and start the hashing processes.
+
+    Call once the configuration is loaded and before starting any other
+    threads so the processes are not forked while another thread holds a
+    lock. Executors are otherwise created on first use.
+
+    @param application: The application with the hashing configuration.
+    @type application: flask.Flask
+    @return: The started executor.
+    @rtype: HashingExecutor
+    @raise ValueError: Raised if the configured algorithm is not available.
+    """
+    get_algorithm(application)
+    return get_executor(application)
+
+
+def hash_password(application, password):
+    """Hash a password with the configured algorithm off the request thread.
+
+    @param application: The application with the hashing configuration.
+    @type application: flask.Flask
+    @param password: The plaintext password to hash.
+    @type password: str
+    @return: The new hash.
+    @rtype: str
+    """
+    return get_executor(application).run(
+        generate_password_hash,
+        password,
+        get_algorithm(application)
+    )
+
+
+def hash_passwords(application, passwords):
+    """Hash many passwords with the configured algorithm across processes.
+
+    @param application: The application with the hashing configuration.
+    @type application: flask.Flask
+    @param passwords: The plaintext passwords to hash.
+    @type passwords: list of str
+    @return: The hash of each password in the same order.
+    @rtype: list of str
+    """
+    algorithm = get_algorithm(application)
+    return get_executor(application).map(
+        generate_password_hash_pair,
+        [(password, algorithm) for password in passwords]
+    )
+
+
+def check_password(application, password_hash, password):
+    """Check a password against a hash off the request thread.
+
+    @param application: The application with the hashing configuration.
+    @type application: flask.Flask
+    @param password_hash: The hash as returned by generate_password_hash.
+    @type password_hash: str
+    @param password: The plaintext password to check.
+    @type password: str
+    @return: True if the password matches and False otherwise.
+    @rtype: bool
+    """
+    return get_executor(application).run(
+        check_password_hash,
+        password_hash,
+        password
+    )
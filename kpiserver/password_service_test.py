@@ -0,0 +1,101 @@
+"""Tests for password hashing.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import unittest
+
+import flask
+
+import password_service
+
+TEST_PASSWORD = 'password'
+LEGACY_HASH = 'sha1$salt$hash'
+
+
+class PasswordServiceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = flask.Flask(__name__)
+        self.app.config['PASSWORD_HASH_PROCESSES'] = 0
+
+    def test_check_password_hash_pbkdf2(self):
+        password_hash = password_service.generate_password_hash(TEST_PASSWORD)
+        self.assertTrue(password_hash.startswith('pbkdf2:sha256:'))
+        self.assertTrue(password_service.check_password_hash(
+            password_hash,
+            TEST_PASSWORD
+        ))
+        self.assertFalse(password_service.check_password_hash(
+            password_hash,
+            'other'
+        ))
+
+    def test_check_password_hash_scrypt(self):
+        if not password_service.is_available('scrypt'):
+            return
+
+        password_hash = password_service.generate_password_hash(
+            TEST_PASSWORD,
+            'scrypt'
+        )
+        self.assertTrue(password_service.check_password_hash(
+            password_hash,
+            TEST_PASSWORD
+        ))
+        self.assertFalse(password_service.check_password_hash(
+            password_hash,
+            'other'
+        ))
+
+    def test_get_algorithm_unavailable(self):
+        self.app.config['PASSWORD_HASH_ALGORITHM'] = 'md5'
+        self.assertRaises(
+            ValueError,
+            password_service.get_algorithm,
+            self.app
+        )
+
+    def test_needs_rehash(self):
+        current_hash = password_service.generate_password_hash(TEST_PASSWORD)
+        self.assertFalse(password_service.needs_rehash(self.app, current_hash))
+        self.assertTrue(password_service.needs_rehash(self.app, LEGACY_HASH))
+        self.assertFalse(password_service.needs_rehash(None, LEGACY_HASH))
+
+        self.app.config['PASSWORD_HASH_ALGORITHM'] = 'pbkdf2:sha512'
+        self.assertTrue(password_service.needs_rehash(self.app, current_hash))
+
+    def test_executor_processes(self):
+        self.app.config['PASSWORD_HASH_PROCESSES'] = 2
+        executor = password_service.get_executor(self.app)
+        self.assertTrue(executor is password_service.get_executor(self.app))
+
+        try:
+            hashes = password_service.hash_passwords(self.app, ['a', 'b'])
+            self.assertTrue(password_service.check_password(
+                self.app,
+                hashes[1],
+                'b'
+            ))
+            password_hash = password_service.hash_password(self.app, 'c')
+            self.assertTrue(password_service.check_password_hash(
+                password_hash,
+                'c'
+            ))
+        finally:
+            executor.shutdown()
+
+    def test_configure(self):
+        executor = password_service.configure(self.app)
+        self.assertTrue(executor is password_service.get_executor(self.app))
+        self.assertEqual(executor.pool, None)
+
+    def test_configure_unavailable_algorithm(self):
+        self.app.config['PASSWORD_HASH_ALGORITHM'] = 'unknown'
+        self.assertRaises(ValueError, password_service.configure, self.app)
+        self.assertFalse('kpi_hashing_executor' in self.app.extensions)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,454 @@
+"""Rate limiting for authenticated routes of the Kipling Package Index.
+
+Token bucket rate limiting keyed by both username and client IP address so that
+a single misbehaving client cannot force expensive password hashing and
+database writes for everyone else. Each route is assigned a named budget and
+requests over the client IP's budget are rejected with a 429 before the route
+does any work. On authenticated routes the user's bucket is only charged once
+the password has been checked so that others cannot use up a user's budget by
+sending requests with their username.
+Bucket state lives in a pluggable store (in-process memory or Redis).
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import collections
+import functools
+import math
+import threading
+import time
+
+import flask
+
+import responses
+import util
+
+TOO_MANY_REQUESTS_STATUS = 429
+TOO_MANY_REQUESTS_MSG = 'Too many requests. Please try again later.'
+
+DEFAULT_RATE_LIMITS = {
+    'default': {'capacity': 60, 'period': 60},
+    'user_create': {'capacity': 5, 'period': 3600},
+    'password_reset': {'capacity': 5, 'period': 3600},
+    'package_write': {'capacity': 30, 'period': 600}
+}
+
+REDIS_KEY_PREFIX = 'kpi:rate:'
+
+MAX_MEMORY_BUCKETS = 100000
+MEMORY_SWEEP_INTERVAL = 60
+
+# Atomically refill and take a token from the bucket stored in the hash at
+# KEYS[1]. ARGV is capacity, refill rate (tokens / second), and current time.
+# Returns {allowed (0 or 1), seconds until a token is available as a string}.
+TOKEN_BUCKET_SCRIPT = '''
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(state[1]) or capacity
+local timestamp = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - timestamp) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'timestamp', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate))
+return {allowed, tostring(wait)}
+'''
+
+
+def take_token(tokens, timestamp, capacity, rate, now):
+    """Refill a token bucket for elapsed time and try to take one token.
+
+    @param tokens: The tokens in the bucket when last updated or None if the
+        bucket is new (full).
+    @type tokens: float
+    @param timestamp: The time the bucket was last updated or None if new.
+    @type timestamp: float
+    @param capacity: The maximum number of tokens the bucket may hold.
+    @type capacity: float
+    @param rate: The number of tokens added to the bucket per second.
+    @type rate: float
+    @param now: The current time in seconds.
+    @type now: float
+    @return: Tuple of (allowed, tokens left, seconds until a token will be
+        available or 0 if allowed).
+    @rtype: tuple
+    """
+    if tokens is None:
+        tokens = capacity
+    if timestamp is None:
+        timestamp = now
+
+    tokens = min(capacity, tokens + max(0, now - timestamp) * rate)
+    if tokens >= 1:
+        return (True, tokens - 1, 0)
+    else:
+        return (False, tokens, (1 - tokens) / rate)
+
+
+class RateLimitStoreAdapter:
+    """Interface for storage of token bucket state."""
+
+    def take(self, key, capacity, rate, now):
+        """Atomically refill and try to take a token from a bucket.
+
+        @param key: Unique identifier for the bucket.
+        @type key: str
+        @param capacity: The maximum number of tokens the bucket may hold.
+        @type capacity: float
+        @param rate: The number of tokens added to the bucket per second.
+        @type rate: float
+        @param now: The current time in seconds.
+        @type now: float
+        @return: Tuple of (allowed, seconds until a token will be available).
+        @rtype: tuple
+        """
+        raise NotImplementedError()
+
+
+class MemoryRateLimitStoreAdapter(RateLimitStoreAdapter):
+    """Implementation of the RateLimitStoreAdapter within this process.
+
+    Buckets are forgotten once they would have refilled since a full bucket is
+    the same as no bucket. Those buckets are swept out periodically and, so
+    that clients sending many distinct usernames cannot grow the store without
+    bound, the least recently used buckets are dropped past max_buckets.
+    """
+
+    def __init__(self, max_buckets=MAX_MEMORY_BUCKETS,
+            sweep_interval=MEMORY_SWEEP_INTERVAL):
+        """Create a new store with no buckets.
+
+        @keyword max_buckets: The maximum number of buckets to keep. Defaults
+            to MAX_MEMORY_BUCKETS.
+        @type max_buckets: int
+        @keyword sweep_interval: The number of seconds between sweeps for
+            refilled buckets. Defaults to MEMORY_SWEEP_INTERVAL.
+        @type sweep_interval: float
+        """
+        self.lock = threading.Lock()
+        self.buckets = collections.OrderedDict()
+        self.max_buckets = max_buckets
+        self.sweep_interval = sweep_interval
+        self.next_sweep = None
+
+    def take(self, key, capacity, rate, now):
+        with self.lock:
+            tokens, timestamp, full_at = self.buckets.pop(
+                key,
+                (None, None, None)
+            )
+            allowed, tokens, wait = take_token(
+                tokens,
+                timestamp,
+                capacity,
+                rate,
+                now
+            )
+            if tokens < capacity:
+                full_at = now + (capacity - tokens) / rate
+                self.buckets[key] = (tokens, now, full_at)
+
+            self.sweep(now)
+            while len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        return (allowed, wait)
+
+    def sweep(self, now):
+        """Forget buckets that have refilled if a sweep is due.
+
+        Must be called with the lock held.
+
+        @param now: The current time in seconds.
+        @type now: float
+        """
+        if self.next_sweep != None and now < self.next_sweep:
+            return
+        self.next_sweep = now + self.sweep_interval
+        refilled = [
+            key for key, (tokens, timestamp, full_at) in self.buckets.items()
+            if full_at <= now
+        ]
+        for key in refilled:
+            del self.buckets[key]
+
+
+class RedisRateLimitStoreAdapter(RateLimitStoreAdapter):
+    """Implementation of the RateLimitStoreAdapter for Redis.
+
+    Shares buckets across server processes and machines. Uses a Lua script so
+    that each refill and take happens atomically within Redis.
+    """
+
+    def __init__(self, native_client):
+        """Create a new adapter around a Redis client.
+
+        @param native_client: The client to adapt.
+        @type native_client: redis.StrictRedis
+        """
+        self.script = native_client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def take(self, key, capacity, rate, now):
+        allowed, wait = self.script(
+            keys=[REDIS_KEY_PREFIX + key],
+            args=[capacity, rate, now]
+        )
+        return (bool(allowed), float(wait))
+
+
+class LocalRedisClient:
+    """In-process stand-in for the parts of a Redis client used for limiting.
+
+    Provides register_script for TOKEN_BUCKET_SCRIPT (running the equivalent
+    Python logic) so that RedisRateLimitStoreAdapter can be exercised without a
+    Redis server.
+    """
+
+    def __init__(self):
+        """Create a new stand-in with no stored hashes."""
+        self.lock = threading.Lock()
+        self.hashes = {}
+
+    def register_script(self, script):
+        """Register a Lua script to run against this client.
+
+        @param script: The Lua source. Only TOKEN_BUCKET_SCRIPT is supported.
+        @type script: str
+        @return: Callable taking keys and args that runs the script.
+        @rtype: function
+        @raise ValueError: Raised if the script is not supported.
+        """
+        if script != TOKEN_BUCKET_SCRIPT:
+            raise ValueError('Only the token bucket script is supported.')
+        return self.run_token_bucket_script
+
+    def run_token_bucket_script(self, keys, args):
+        """Run the equivalent of TOKEN_BUCKET_SCRIPT.
+
+        @param keys: The single key of the hash holding the bucket.
+        @type keys: list of str
+        @param args: Capacity, refill rate, and current time.
+        @type args: list
+        @return: List of allowed (0 or 1) and seconds to wait as a string.
+        @rtype: list
+        """
+        capacity, rate, now = [float(arg) for arg in args]
+        with self.lock:
+            state = self.hashes.get(keys[0], {})
+            allowed, tokens, wait = take_token(
+                state.get('tokens', None),
+                state.get('timestamp', None),
+                capacity,
+                rate,
+                now
+            )
+            self.hashes[keys[0]] = {'tokens': tokens, 'timestamp': now}
+        return [int(allowed), str(wait)]
+
+
+def create_store(application):
+    """Create the bucket store specified by configuration.
+
+    Uses the RATE_LIMIT_BACKEND configuration value which may be 'memory'
+    (default), 'redis' (using RATE_LIMIT_REDIS_URL), or 'local_redis'.
+
+    @param application: The application with the rate limit configuration.
+    @type application: flask.Flask
+    @return: Implementor of RateLimitStoreAdapter
+    @rtype: RateLimitStoreAdapter
+    """
+    backend = application.config.get('RATE_LIMIT_BACKEND', 'memory')
+
+    if backend == 'redis':
+        import redis
+        native_client = redis.StrictRedis.from_url(
+            application.config['RATE_LIMIT_REDIS_URL']
+        )
+        return RedisRateLimitStoreAdapter(native_client)
+    elif backend == 'local_redis':
+        return RedisRateLimitStoreAdapter(LocalRedisClient())
+    else:
+        return MemoryRateLimitStoreAdapter()
+
+
+def get_store(application):
+    """Get the bucket store for an application, creating it if needed.
+
+    @param application: The application with the rate limit configuration.
+    @type application: flask.Flask
+    @return: Implementor of RateLimitStoreAdapter shared across requests.
+    @rtype: RateLimitStoreAdapter
+    """
+    store = application.extensions.get('kpi_rate_limit_store', None)
+    if not store:
+        store = create_store(application)
+        application.extensions['kpi_rate_limit_store'] = store
+    return store
+
+
+def get_budget(application, budget_name):
+    """Get the capacity and refill rate for a named budget.
+
+    Budgets in the RATE_LIMITS configuration value take precedence over those
+    in DEFAULT_RATE_LIMITS.
+
+    @param application: The application with the rate limit configuration.
+    @type application: flask.Flask
+    @param budget_name: The name of the budget.
+    @type budget_name: str
+    @return: Tuple of (capacity, refill rate in tokens per second).
+    @rtype: tuple
+    """
+    configured = application.config.get('RATE_LIMITS', {})
+    budget = configured.get(budget_name, DEFAULT_RATE_LIMITS[budget_name])
+    capacity = float(budget['capacity'])
+    return (capacity, capacity / budget['period'])
+
+
+def get_request_keys(budget_name, username):
+    """Get the keys of the buckets a request should draw from.
+
+    @param budget_name: The name of the budget the route uses.
+    @type budget_name: str
+    @param username: The user making the request or None if not known.
+    @type username: str
+    @return: Bucket keys for the client IP and, if known, the username.
+    @rtype: list of str
+    """
+    keys = ['%s:ip:%s' % (budget_name, flask.request.remote_addr)]
+    if username:
+        keys.append('%s:user:%s' % (budget_name, username))
+    return keys
+
+
+def check_rate_limit(application, budget_name, username, now=None):
+    """Take a token for the current request from each of its buckets.
+
+    @param application: The application with the rate limit configuration.
+    @type application: flask.Flask
+    @param budget_name: The name of the budget the route uses.
+    @type budget_name: str
+    @param username: The user making the request or None if not known.
+    @type username: str
+    @keyword now: The current time. Defaults to None (time.time()).
+    @type now: float
+    @return: None if the request is allowed or the number of seconds the client
+        should wait before retrying if not.
+    @rtype: float
+    """
+    if now is None:
+        now = time.time()
+
+    store = get_store(application)
+    capacity, rate = get_budget(application, budget_name)
+    for key in get_request_keys(budget_name, username):
+        allowed, wait = store.take(key, capacity, rate, now)
+        if not allowed:
+            return wait
+    return None
+
+
+def create_rate_limited_response(wait):
+    """Create the response for a request over budget.
+
+    @param wait: The number of seconds the client should wait before
+        retrying.
+    @type wait: float
+    @return: JSON error response with a Retry-After header.
+    @rtype: flask.Response
+    """
+    response = responses.create_json_response(
+        util.create_error_message(TOO_MANY_REQUESTS_MSG),
+        TOO_MANY_REQUESTS_STATUS
+    )
+    response.headers['Retry-After'] = str(int(math.ceil(wait)))
+    return response
+
+
+def check_user_rate_limit(username, now=None):
+    """Take a token from an authenticated user's bucket for the current route.
+
+    Called once a user's password has been checked. Does nothing outside of a
+    route decorated with rate_limited or if the RATE_LIMIT_ENABLED
+    configuration value is False.
+
+    @param username: The user whose password was checked.
+    @type username: str
+    @keyword now: The current time. Defaults to None (time.time()).
+    @type now: float
+    @raise werkzeug.exceptions.HTTPException: Raised with a 429 response if
+        the user is over budget.
+    """
+    if not flask.has_request_context():
+        return
+    budget_name = getattr(flask.g, 'kpi_rate_limit_budget', None)
+    if not budget_name:
+        return
+
+    application = flask.current_app
+    if not application.config.get('RATE_LIMIT_ENABLED', True):
+        return
+    if now is None:
+        now = time.time()
+
+    capacity, rate = get_budget(application, budget_name)
+    allowed, wait = get_store(application).take(
+        '%s:user:%s' % (budget_name, username),
+        capacity,
+        rate,
+        now
+    )
+    if not allowed:
+        flask.abort(create_rate_limited_response(wait))
+
+
+def rate_limited(budget_name, authenticated=True):
+    """Decorator rejecting requests to a route that exceed a budget.
+
+    Requests draw from the client IP's bucket before the route runs. On
+    authenticated routes the user's bucket is drawn from by
+    check_user_rate_limit once the password is checked. Otherwise the user is
+    read from the username url parameter or form field and their bucket is
+    also drawn from before the route runs. Does nothing if the
+    RATE_LIMIT_ENABLED configuration value is False.
+
+    @param budget_name: The name of the budget the route uses.
+    @type budget_name: str
+    @keyword authenticated: True if the route checks the user's password.
+        Defaults to True.
+    @type authenticated: bool
+    @return: Decorator for a route function.
+    @rtype: function
+    """
+    def decorator(route):
+
+        @functools.wraps(route)
+        def decorated_route(*args, **kwargs):
+            application = flask.current_app
+            if not application.config.get('RATE_LIMIT_ENABLED', True):
+                return route(*args, **kwargs)
+
+            if authenticated:
+                username = None
+                flask.g.kpi_rate_limit_budget = budget_name
+            else:
+                username = kwargs.get('username', None)
+                if not username:
+                    username = flask.request.form.get('username', None)
+
+            wait = check_rate_limit(application, budget_name, username)
+            if wait is None:
+                return route(*args, **kwargs)
+            return create_rate_limited_response(wait)
+
+        return decorated_route
+
+    return decorator
@@ -0,0 +1,223 @@
+"""Tests for rate limiting of authenticated routes.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import json
+import unittest
+
+import flask
+import mox
+from werkzeug import exceptions
+
+import rate_limit_service
+
+
+class RateLimitServiceTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.app = flask.Flask(__name__)
+        self.app.config['RATE_LIMITS'] = {
+            'package_write': {'capacity': 2, 'period': 20}
+        }
+
+    def test_take_token_new_bucket(self):
+        allowed, tokens, wait = rate_limit_service.take_token(
+            None,
+            None,
+            5,
+            1,
+            100
+        )
+        self.assertTrue(allowed)
+        self.assertEqual(tokens, 4)
+        self.assertEqual(wait, 0)
+
+    def test_take_token_empty_bucket(self):
+        allowed, tokens, wait = rate_limit_service.take_token(
+            0,
+            100,
+            5,
+            0.5,
+            101
+        )
+        self.assertFalse(allowed)
+        self.assertEqual(tokens, 0.5)
+        self.assertEqual(wait, 1)
+
+    def test_take_token_refill_capped(self):
+        allowed, tokens, wait = rate_limit_service.take_token(0, 0, 5, 1, 1000)
+        self.assertTrue(allowed)
+        self.assertEqual(tokens, 4)
+
+    def check_store(self, store):
+        self.assertEqual(store.take('key', 2, 0.1, 100), (True, 0))
+        self.assertEqual(store.take('key', 2, 0.1, 100), (True, 0))
+        allowed, wait = store.take('key', 2, 0.1, 100)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(wait, 10)
+        self.assertEqual(store.take('other', 2, 0.1, 100), (True, 0))
+        self.assertEqual(store.take('key', 2, 0.1, 110), (True, 0))
+
+    def test_memory_store(self):
+        self.check_store(rate_limit_service.MemoryRateLimitStoreAdapter())
+
+    def test_memory_store_sweeps_refilled(self):
+        store = rate_limit_service.MemoryRateLimitStoreAdapter(
+            sweep_interval=10
+        )
+        store.take('a', 2, 0.1, 100)
+        store.take('b', 2, 0.1, 105)
+        self.assertEqual(len(store.buckets), 2)
+
+        store.take('c', 2, 0.1, 111)
+        self.assertEqual(store.buckets.keys(), ['b', 'c'])
+
+    def test_memory_store_bounded(self):
+        store = rate_limit_service.MemoryRateLimitStoreAdapter(max_buckets=2)
+        store.take('a', 2, 0.1, 100)
+        store.take('b', 2, 0.1, 100)
+        store.take('a', 2, 0.1, 100)
+        store.take('c', 2, 0.1, 100)
+        self.assertEqual(store.buckets.keys(), ['a', 'c'])
+
+    def test_local_redis_store(self):
+        self.check_store(rate_limit_service.RedisRateLimitStoreAdapter(
+            rate_limit_service.LocalRedisClient()
+        ))
+
+    def test_local_redis_unknown_script(self):
+        client = rate_limit_service.LocalRedisClient()
+        self.assertRaises(ValueError, client.register_script, 'return 1')
+
+    def test_get_store_shared(self):
+        self.app.config['RATE_LIMIT_BACKEND'] = 'local_redis'
+        store = rate_limit_service.get_store(self.app)
+        self.assertTrue(isinstance(
+            store,
+            rate_limit_service.RedisRateLimitStoreAdapter
+        ))
+        self.assertTrue(store is rate_limit_service.get_store(self.app))
+
+    def test_get_budget(self):
+        capacity, rate = rate_limit_service.get_budget(
+            self.app,
+            'package_write'
+        )
+        self.assertEqual(capacity, 2)
+        self.assertEqual(rate, 0.1)
+
+        capacity, rate = rate_limit_service.get_budget(self.app, 'user_create')
+        self.assertEqual(capacity, 5)
+
+    def test_check_rate_limit_by_user(self):
+        with self.app.test_request_context(environ_base={
+                'REMOTE_ADDR': '10.0.0.1'}):
+            for _ in range(2):
+                wait = rate_limit_service.check_rate_limit(
+                    self.app,
+                    'package_write',
+                    'user',
+                    100
+                )
+                self.assertEqual(wait, None)
+
+        with self.app.test_request_context(environ_base={
+                'REMOTE_ADDR': '10.0.0.2'}):
+            wait = rate_limit_service.check_rate_limit(
+                self.app,
+                'package_write',
+                'user',
+                100
+            )
+            self.assertAlmostEqual(wait, 10)
+
+            wait = rate_limit_service.check_rate_limit(
+                self.app,
+                'package_write',
+                'other_user',
+                100
+            )
+            self.assertEqual(wait, None)
+
+    def test_rate_limited_rejects_before_route(self):
+        calls = []
+
+        @rate_limit_service.rate_limited('package_write')
+        def route(username):
+            calls.append(username)
+            return 'ok'
+
+        with self.app.test_request_context():
+            self.assertEqual(route(username='user'), 'ok')
+            self.assertEqual(route(username='user'), 'ok')
+            response = route(username='user')
+
+        self.assertEqual(calls, ['user', 'user'])
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '10')
+        self.assertFalse(json.loads(response.get_data())['success'])
+
+    def test_rate_limited_user_after_authentication(self):
+        @rate_limit_service.rate_limited('package_write')
+        def route(username, password):
+            if password == 'correct':
+                rate_limit_service.check_user_rate_limit(username)
+            return 'ok'
+
+        for address in ['10.0.0.1', '10.0.0.2']:
+            with self.app.test_request_context(environ_base={
+                    'REMOTE_ADDR': address}):
+                self.assertEqual(route(username='user', password='bad'), 'ok')
+
+        for address in ['10.0.0.3', '10.0.0.4']:
+            with self.app.test_request_context(environ_base={
+                    'REMOTE_ADDR': address}):
+                self.assertEqual(
+                    route(username='user', password='correct'),
+                    'ok'
+                )
+
+        with self.app.test_request_context(environ_base={
+                'REMOTE_ADDR': '10.0.0.5'}):
+            try:
+                route(username='user', password='correct')
+                self.fail('Expected the user to be over budget.')
+            except exceptions.HTTPException, e:
+                self.assertEqual(e.response.status_code, 429)
+
+    def test_rate_limited_unauthenticated_by_user(self):
+        @rate_limit_service.rate_limited('package_write', False)
+        def route(username):
+            return 'ok'
+
+        for address in ['10.0.0.1', '10.0.0.2']:
+            with self.app.test_request_context(environ_base={
+                    'REMOTE_ADDR': address}):
+                self.assertEqual(route(username='user'), 'ok')
+
+        with self.app.test_request_context(environ_base={
+                'REMOTE_ADDR': '10.0.0.3'}):
+            self.assertEqual(route(username='user').status_code, 429)
+
+    def test_check_user_rate_limit_outside_route(self):
+        rate_limit_service.check_user_rate_limit('user')
+        with self.app.test_request_context():
+            rate_limit_service.check_user_rate_limit('user')
+
+    def test_rate_limited_disabled(self):
+        self.app.config['RATE_LIMIT_ENABLED'] = False
+
+        @rate_limit_service.rate_limited('package_write')
+        def route():
+            return 'ok'
+
+        with self.app.test_request_context(method='POST'):
+            for _ in range(5):
+                self.assertEqual(route(), 'ok')
+
+
+if __name__ == '__main__':
+    unittest.main()
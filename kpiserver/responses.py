@@ -0,0 +1,204 @@
+"""Serialization and compression of responses from the Kipling Package Index.
+
+Central place where route results become HTTP responses. Uses the fastest
+available JSON encoder (orjson, then ujson, then the standard library), encodes
+database specific values like Mongo ObjectIds, sets the JSON content type, and
+compresses large bodies with brotli or gzip if the client accepts them.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import datetime
+import json
+import zlib
+
+import flask
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from bson.objectid import ObjectId
+except ImportError:
+    ObjectId = None
+
+import db_service
+import versions
+
+JSON_MIME_TYPE = 'application/json'
+INTERNAL_FIELDS = [
+    '_id',
+    db_service.ARCHIVE_UPDATES_FIELD,
+    versions.VERSION_PARTS_FIELD,
+    versions.VERSION_KEY_FIELD
+]
+
+DEFAULT_COMPRESSION_MIN_SIZE = 1024
+GZIP_COMPRESSION_LEVEL = 6
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+BROTLI_QUALITY = 4
+
+
+def encode_special(value):
+    """Encode a value that the JSON encoders do not natively support.
+
+    @param value: The value to encode.
+    @type value: object
+    @return: JSON serializable version of the value.
+    @rtype: str
+    @raise TypeError: Raised if the value is not of a supported type.
+    """
+    if ObjectId and isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def dumps(value):
+    """Serialize a value to a JSON string using the fastest encoder available.
+
+    @param value: The value to serialize.
+    @type value: object
+    @return: JSON encoded value.
+    @rtype: str
+    """
+    if orjson:
+        return orjson.dumps(value, default=encode_special)
+
+    if ujson:
+        try:
+            return ujson.dumps(value)
+        except (TypeError, OverflowError):
+            pass
+
+    return json.dumps(value, default=encode_special, separators=(',', ':'))
+
+
+def strip_internal_fields(record):
+    """Remove database internal fields from a record before returning it.
+
+    @param record: The database record to clean up.
+    @type record: dict
+    @return: Shallow copy of the record without INTERNAL_FIELDS.
+    @rtype: dict
+    """
+    return dict(
+        (key, value) for key, value in record.items()
+        if not key in INTERNAL_FIELDS
+    )
+
+
+def parse_accept_encoding(header_value):
+    """Determine which content encodings a client accepts.
+
+    @param header_value: The value of the Accept-Encoding header.
+    @type header_value: str
+    @return: Lower case names of the encodings with a non-zero quality.
+    @rtype: set of str
+    """
+    accepted = set()
+    if not header_value:
+        return accepted
+
+    for entry in header_value.split(','):
+        parts = entry.strip().split(';')
+        encoding = parts[0].strip().lower()
+        quality = 1.0
+        for param in parts[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0
+        if encoding and quality > 0:
+            accepted.add(encoding)
+    return accepted
+
+
+def choose_encoding(header_value):
+    """Choose the best supported content encoding a client accepts.
+
+    @param header_value: The value of the Accept-Encoding header.
+    @type header_value: str
+    @return: 'br', 'gzip', or None if no compression should be used.
+    @rtype: str
+    """
+    accepted = parse_accept_encoding(header_value)
+    if brotli and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding):
+    """Compress a response body.
+
+    @param body: The uncompressed body.
+    @type body: str
+    @param encoding: The encoding to use as returned by choose_encoding.
+    @type encoding: str
+    @return: The compressed body.
+    @rtype: str
+    """
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+
+    compressor = zlib.compressobj(
+        GZIP_COMPRESSION_LEVEL,
+        zlib.DEFLATED,
+        GZIP_WBITS
+    )
+    return compressor.compress(body) + compressor.flush()
+
+
+def create_json_response(value, status=200):
+    """Create a response for the current request holding a JSON document.
+
+    Bodies of at least RESPONSE_COMPRESSION_MIN_SIZE bytes (a configuration
+    value defaulting to DEFAULT_COMPRESSION_MIN_SIZE) are compressed if the
+    client accepts a supported encoding. Setting that configuration value to
+    None disables compression.
+
+    @param value: The value to serialize into the response body.
+    @type value: object
+    @keyword status: The HTTP status code. Defaults to 200.
+    @type status: int
+    @return: The response to return from a route.
+    @rtype: flask.Response
+    """
+    body = dumps(value)
+    response = flask.Response(body, status=status, mimetype=JSON_MIME_TYPE)
+
+    min_size = flask.current_app.config.get(
+        'RESPONSE_COMPRESSION_MIN_SIZE',
+        DEFAULT_COMPRESSION_MIN_SIZE
+    )
+    if min_size is None:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if len(body) < min_size:
+        return response
+
+    encoding = choose_encoding(flask.request.headers.get('Accept-Encoding'))
+    if encoding:
+        response.set_data(compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+
+    return response
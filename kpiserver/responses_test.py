@@ -0,0 +1,105 @@
+"""Tests for serialization and compression of server responses.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import datetime
+import json
+import unittest
+import zlib
+
+import flask
+import mox
+from bson.objectid import ObjectId
+
+import responses
+
+TEST_OBJECT_ID = '507f1f77bcf86cd799439011'
+TEST_RECORD = {
+    '_id': ObjectId(TEST_OBJECT_ID),
+    'name': 'package',
+    'authors': ['user1', 'user2']
+}
+
+
+class ResponsesTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.app = flask.Flask(__name__)
+        self.app.config['RESPONSE_COMPRESSION_MIN_SIZE'] = 100
+
+    def test_dumps_object_id(self):
+        result = json.loads(responses.dumps(TEST_RECORD))
+        self.assertEqual(result['_id'], TEST_OBJECT_ID)
+        self.assertEqual(result['authors'], ['user1', 'user2'])
+
+    def test_dumps_datetime(self):
+        value = {'updated': datetime.datetime(2014, 1, 2, 3, 4, 5)}
+        result = json.loads(responses.dumps(value))
+        self.assertEqual(result['updated'], '2014-01-02T03:04:05')
+
+    def test_encode_special_unsupported(self):
+        self.assertRaises(TypeError, responses.encode_special, object())
+
+    def test_strip_internal_fields(self):
+        result = responses.strip_internal_fields(TEST_RECORD)
+        self.assertFalse('_id' in result)
+        self.assertEqual(result['name'], 'package')
+        self.assertTrue('_id' in TEST_RECORD)
+
+    def test_parse_accept_encoding(self):
+        accepted = responses.parse_accept_encoding(
+            'gzip;q=1.0, deflate, br;q=0, identity; q=0.5'
+        )
+        self.assertEqual(accepted, set(['gzip', 'deflate', 'identity']))
+
+    def test_choose_encoding(self):
+        self.assertEqual(responses.choose_encoding('deflate, gzip'), 'gzip')
+        self.assertEqual(responses.choose_encoding('*'), 'gzip')
+        self.assertEqual(responses.choose_encoding('gzip;q=0'), None)
+        self.assertEqual(responses.choose_encoding(None), None)
+
+    def test_create_json_response_small(self):
+        with self.app.test_request_context(
+                headers={'Accept-Encoding': 'gzip'}):
+            response = responses.create_json_response({'success': True})
+
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(response.headers.get('Content-Encoding'), None)
+        self.assertEqual(json.loads(response.get_data()), {'success': True})
+
+    def test_create_json_response_compressed(self):
+        value = {'success': True, 'message': 'x' * 1000}
+        with self.app.test_request_context(
+                headers={'Accept-Encoding': 'gzip'}):
+            response = responses.create_json_response(value, 404)
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertTrue('Accept-Encoding' in response.headers['Vary'])
+        body = zlib.decompress(response.get_data(), responses.GZIP_WBITS)
+        self.assertEqual(json.loads(body), value)
+
+    def test_create_json_response_not_accepted(self):
+        value = {'success': True, 'message': 'x' * 1000}
+        with self.app.test_request_context():
+            response = responses.create_json_response(value)
+
+        self.assertEqual(response.headers.get('Content-Encoding'), None)
+        self.assertEqual(json.loads(response.get_data()), value)
+
+    def test_create_json_response_compression_disabled(self):
+        self.app.config['RESPONSE_COMPRESSION_MIN_SIZE'] = None
+        value = {'success': True, 'message': 'x' * 1000}
+        with self.app.test_request_context(
+                headers={'Accept-Encoding': 'gzip'}):
+            response = responses.create_json_response(value)
+
+        self.assertEqual(response.headers.get('Content-Encoding'), None)
+        self.assertEqual(response.headers.get('Vary'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
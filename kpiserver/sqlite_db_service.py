@@ -0,0 +1,602 @@
+"""SQLite backed implementation of the package index's datastore.
+
+Lets small deployments run the index without MongoDB. Package and user
+records are stored as JSON documents alongside the columns they are looked up
+by. Package authors are kept in their own table so that authorship checks use
+an index instead of reading records. The database runs in write-ahead logging
+mode so that reads are not blocked by writes. The schema is created once when
+the adapter is created. Threads borrow connections, each with a cache of
+prepared statements, from a bounded pool.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import contextlib
+import json
+import Queue
+import sqlite3
+import threading
+
+import db_service
+import versions
+
+DEFAULT_DB_PATH = 'kpiserver.db'
+STATEMENT_CACHE_SIZE = 64
+BUSY_TIMEOUT = 10
+DEFAULT_POOL_SIZE = 8
+MAX_QUERY_PARAMS = 499
+UNKEYED_VERSION_KEY = -1
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS packages (
+        name TEXT PRIMARY KEY,
+        version TEXT NOT NULL,
+        version_key INTEGER NOT NULL,
+        revision INTEGER NOT NULL,
+        record TEXT NOT NULL
+    )''',
+    '''CREATE INDEX IF NOT EXISTS packages_version_key
+        ON packages (name, version_key)''',
+    '''CREATE TABLE IF NOT EXISTS package_versions (
+        name TEXT NOT NULL,
+        version TEXT NOT NULL,
+        version_key INTEGER NOT NULL,
+        record TEXT NOT NULL,
+        PRIMARY KEY (name, version)
+    )''',
+    '''CREATE INDEX IF NOT EXISTS package_versions_key
+        ON package_versions (name, version_key)''',
+    '''CREATE TABLE IF NOT EXISTS package_authors (
+        name TEXT NOT NULL,
+        username TEXT NOT NULL,
+        PRIMARY KEY (name, username)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS users (
+        username TEXT PRIMARY KEY,
+        email TEXT NOT NULL UNIQUE,
+        record TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS package_stats (
+        name TEXT NOT NULL,
+        hour INTEGER NOT NULL,
+        event TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (name, hour, event)
+    )'''
+]
+
+
+def get_authors(package_info):
+    """Get the list of authors of a package.
+
+    @param package_info: The package record.
+    @type package_info: dict
+    @return: The usernames of the authors.
+    @rtype: list of str
+    """
+    authors = package_info['authors']
+    if isinstance(authors, basestring):
+        return [authors]
+    return list(authors)
+
+
+class SQLiteDBAdapter(db_service.DBAdapter):
+    """Implementation of DBAdapter storing records in a SQLite database."""
+
+    def __init__(self, path, pool_size=DEFAULT_POOL_SIZE):
+        """Create a new adapter around a SQLite database file.
+
+        Creates the schema if it does not exist yet.
+
+        @param path: The path to the database file. Created if it does not
+            exist.
+        @type path: str
+        @keyword pool_size: The maximum number of open connections. Threads
+            wait up to BUSY_TIMEOUT seconds for a connection once this many
+            are in use. Defaults to DEFAULT_POOL_SIZE.
+        @type pool_size: int
+        """
+        db_service.DBAdapter.__init__(self, None)
+        self.path = path
+        self.pool_size = pool_size
+        self.idle_connections = Queue.LifoQueue()
+        self.num_connections = 0
+        self.pool_lock = threading.Lock()
+
+        with self.connection() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            for statement in SCHEMA:
+                connection.execute(statement)
+
+    def open_connection(self):
+        """Open a new connection to the database.
+
+        @return: Connection in autocommit mode that may be used from any
+            thread.
+        @rtype: sqlite3.Connection
+        """
+        connection = sqlite3.connect(
+            self.path,
+            timeout=BUSY_TIMEOUT,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def acquire_connection(self):
+        """Take an idle connection from the pool, opening one if there is room.
+
+        @return: Connection for the exclusive use of the caller until it is
+            released.
+        @rtype: sqlite3.Connection
+        @raise sqlite3.OperationalError: Raised if no connection is released
+            within BUSY_TIMEOUT seconds.
+        """
+        try:
+            return self.idle_connections.get_nowait()
+        except Queue.Empty:
+            pass
+
+        with self.pool_lock:
+            has_room = self.num_connections < self.pool_size
+            if has_room:
+                self.num_connections += 1
+
+        if has_room:
+            try:
+                return self.open_connection()
+            except:
+                with self.pool_lock:
+                    self.num_connections -= 1
+                raise
+
+        try:
+            return self.idle_connections.get(timeout=BUSY_TIMEOUT)
+        except Queue.Empty:
+            raise sqlite3.OperationalError('No database connection available.')
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a connection from the pool for the duration of a block.
+
+        @return: Connection in autocommit mode.
+        @rtype: sqlite3.Connection
+        """
+        connection = self.acquire_connection()
+        try:
+            yield connection
+        finally:
+            self.idle_connections.put(connection)
+
+    def close(self):
+        """Close the connections not currently borrowed from the pool."""
+        while True:
+            try:
+                connection = self.idle_connections.get_nowait()
+            except Queue.Empty:
+                return
+            connection.close()
+            with self.pool_lock:
+                self.num_connections -= 1
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run statements in a transaction that holds the write lock.
+
+        Rolls back if an exception is raised and commits otherwise.
+
+        @return: The connection to run statements on.
+        @rtype: sqlite3.Connection
+        """
+        with self.connection() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+    def query_record(self, query, params):
+        """Get the JSON record column from the first row matching a query.
+
+        @param query: The SELECT statement whose first column is a record.
+        @type query: str
+        @param params: The values for the statement's placeholders.
+        @type params: tuple
+        @return: The decoded record or None if no row matched.
+        @rtype: dict
+        """
+        with self.connection() as connection:
+            row = connection.execute(query, params).fetchone()
+        if not row:
+            return None
+        return json.loads(row[0])
+
+    def write_package(self, connection, record):
+        """Save a package record, its authors, and the release of its version.
+
+        @param connection: The connection of the current transaction.
+        @type connection: sqlite3.Connection
+        @param record: The full package record to save.
+        @type record: dict
+        """
+        name = record['name']
+        version_key = record[versions.VERSION_KEY_FIELD]
+        if version_key == None:
+            version_key = UNKEYED_VERSION_KEY
+        connection.execute(
+            'INSERT OR REPLACE INTO packages '
+            '(name, version, version_key, revision, record) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (
+                name,
+                record['version'],
+                version_key,
+                record[db_service.REVISION_FIELD],
+                json.dumps(record)
+            )
+        )
+        self.write_version(connection, record, version_key)
+        connection.execute(
+            'DELETE FROM package_authors WHERE name = ?',
+            (name,)
+        )
+        connection.executemany(
+            'INSERT OR IGNORE INTO package_authors (name, username) '
+            'VALUES (?, ?)',
+            [(name, username) for username in get_authors(record)]
+        )
+
+    def write_version(self, connection, record, version_key):
+        """Save a package record as the release of its version.
+
+        @param connection: The connection of the current transaction.
+        @type connection: sqlite3.Connection
+        @param record: The full package record to save.
+        @type record: dict
+        @param version_key: The version key to index the release by.
+        @type version_key: int
+        """
+        connection.execute(
+            'INSERT OR REPLACE INTO package_versions '
+            '(name, version, version_key, record) VALUES (?, ?, ?, ?)',
+            (record['name'], record['version'], version_key, json.dumps(record))
+        )
+
+    def initialize_indicies(self):
+        # The schema, indicies included, is created with the adapter.
+        pass
+
+    def get_package(self, package_name):
+        return self.query_record(
+            'SELECT record FROM packages WHERE name = ?',
+            (package_name,)
+        )
+
+    def put_package(self, package_info):
+        self.ensure_fields(
+            package_info,
+            db_service.MINIMUM_REQUIRED_PACKAGE_FIELDS
+        )
+        fields = versions.get_version_fields(package_info['version'])
+        with self.transaction() as connection:
+            row = connection.execute(
+                'SELECT record FROM packages WHERE name = ?',
+                (package_info['name'],)
+            ).fetchone()
+            record = json.loads(row[0]) if row else {}
+            record.update(package_info)
+            record.update(fields)
+            record[db_service.ARCHIVE_UPDATES_FIELD] = 0
+            record[db_service.REVISION_FIELD] = \
+                record.get(db_service.REVISION_FIELD, 0) + 1
+            self.write_package(connection, record)
+
+    def insert_package(self, package_info):
+        self.ensure_fields(
+            package_info,
+            db_service.MINIMUM_REQUIRED_PACKAGE_FIELDS
+        )
+        record = dict(package_info)
+        record.update(versions.get_version_fields(package_info['version']))
+        record[db_service.ARCHIVE_UPDATES_FIELD] = 0
+        record[db_service.REVISION_FIELD] = 1
+        with self.transaction() as connection:
+            row = connection.execute(
+                'SELECT 1 FROM packages WHERE name = ?',
+                (package_info['name'],)
+            ).fetchone()
+            if row:
+                return False
+            self.write_package(connection, record)
+        return True
+
+    def get_latest_package_in_range(self, package_name, lower_key, upper_key):
+        if upper_key == None:
+            return self.query_record(
+                'SELECT record FROM package_versions '
+                'WHERE name = ? AND version_key >= ? '
+                'ORDER BY version_key DESC LIMIT 1',
+                (package_name, lower_key)
+            )
+        return self.query_record(
+            'SELECT record FROM package_versions '
+            'WHERE name = ? AND version_key >= ? AND version_key < ? '
+            'ORDER BY version_key DESC LIMIT 1',
+            (package_name, lower_key, upper_key)
+        )
+
+    def is_package_author(self, package_name, username):
+        with self.connection() as connection:
+            row = connection.execute(
+                'SELECT 1 FROM package_authors WHERE name = ? AND username = ?',
+                (package_name, username)
+            ).fetchone()
+        return row != None
+
+    def get_user_as_author(self, username, package_name):
+        with self.connection() as connection:
+            row = connection.execute(
+                'SELECT record, EXISTS (SELECT 1 FROM package_authors '
+                'WHERE name = ? AND package_authors.username = users.username) '
+                'FROM users WHERE username = ?',
+                (package_name, username)
+            ).fetchone()
+        if not row:
+            return (None, False)
+        return (json.loads(row[0]), row[1] == 1)
+
+    def update_package_as_author(self, package_name, username, package_info,
+            expected_revision=None):
+        self.ensure_fields(
+            package_info,
+            db_service.MINIMUM_REQUIRED_PACKAGE_FIELDS
+        )
+        fields = versions.get_version_fields(package_info['version'], False)
+        with self.transaction() as connection:
+            row = connection.execute(
+                'SELECT packages.record, packages.revision FROM packages '
+                'JOIN package_authors ON packages.name = package_authors.name '
+                'WHERE packages.name = ? AND package_authors.username = ?',
+                (package_name, username)
+            ).fetchone()
+            if not row:
+                return None
+            record = json.loads(row[0])
+            if not db_service.is_expected_revision(record, expected_revision):
+                return None
+            if not versions.is_valid_version(package_info['version']) and \
+                versions.is_valid_version(record['version']):
+                return None
+
+            record.update(package_info)
+            record.update(fields)
+            record['name'] = package_name
+            record[db_service.ARCHIVE_UPDATES_FIELD] = 0
+            record[db_service.REVISION_FIELD] = row[1] + 1
+            self.write_package(connection, record)
+            return record[db_service.REVISION_FIELD]
+
+    def backfill_version_fields(self):
+        return 0
+
+    def backfill_package_versions(self):
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                'INSERT OR IGNORE INTO package_versions '
+                '(name, version, version_key, record) '
+                'SELECT name, version, version_key, record FROM packages'
+            )
+            return cursor.rowcount
+
+    def set_package_archive(self, package_name, version, archive_info):
+        with self.transaction() as connection:
+            row = connection.execute(
+                'SELECT record FROM packages WHERE name = ? AND version = ?',
+                (package_name, version)
+            ).fetchone()
+            if not row:
+                return False
+
+            record = json.loads(row[0])
+            record[db_service.ARCHIVE_FIELD] = archive_info
+            record[db_service.REVISION_FIELD] += 1
+            record[db_service.ARCHIVE_UPDATES_FIELD] = \
+                record.get(db_service.ARCHIVE_UPDATES_FIELD, 0) + 1
+            connection.execute(
+                'UPDATE packages SET revision = ?, record = ? WHERE name = ?',
+                (
+                    record[db_service.REVISION_FIELD],
+                    json.dumps(record),
+                    package_name
+                )
+            )
+            connection.execute(
+                'UPDATE package_versions SET record = ? '
+                'WHERE name = ? AND version = ?',
+                (json.dumps(record), package_name, version)
+            )
+            return True
+
+    def delete_package_as_author(self, package_name, username):
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                'DELETE FROM packages WHERE name = ? AND EXISTS ('
+                'SELECT 1 FROM package_authors '
+                'WHERE name = ? AND username = ?)',
+                (package_name, package_name, username)
+            )
+            if cursor.rowcount != 1:
+                return False
+            connection.execute(
+                'DELETE FROM package_authors WHERE name = ?',
+                (package_name,)
+            )
+            connection.execute(
+                'DELETE FROM package_versions WHERE name = ?',
+                (package_name,)
+            )
+            return True
+
+    def delete_package(self, package_name):
+        with self.transaction() as connection:
+            connection.execute(
+                'DELETE FROM packages WHERE name = ?',
+                (package_name,)
+            )
+            connection.execute(
+                'DELETE FROM package_authors WHERE name = ?',
+                (package_name,)
+            )
+            connection.execute(
+                'DELETE FROM package_versions WHERE name = ?',
+                (package_name,)
+            )
+
+    def get_packages(self):
+        with self.connection() as connection:
+            rows = connection.execute(
+                'SELECT record FROM packages ORDER BY name'
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get_user(self, username):
+        return self.query_record(
+            'SELECT record FROM users WHERE username = ?',
+            (username,)
+        )
+
+    def get_user_by_email(self, email):
+        return self.query_record(
+            'SELECT record FROM users WHERE email = ?',
+            (email,)
+        )
+
+    def put_user(self, user_info):
+        self.ensure_fields(user_info, db_service.MINIMUM_REQUIRED_USER_FIELDS)
+        with self.transaction() as connection:
+            row = connection.execute(
+                'SELECT record FROM users WHERE username = ?',
+                (user_info['username'],)
+            ).fetchone()
+            record = json.loads(row[0]) if row else {}
+            record.update(user_info)
+            connection.execute(
+                'INSERT OR REPLACE INTO users (username, email, record) '
+                'VALUES (?, ?, ?)',
+                (record['username'], record['email'], json.dumps(record))
+            )
+
+    def insert_user(self, user_info):
+        self.ensure_fields(user_info, db_service.MINIMUM_REQUIRED_USER_FIELDS)
+        try:
+            with self.connection() as connection:
+                connection.execute(
+                    'INSERT INTO users (username, email, record) '
+                    'VALUES (?, ?, ?)',
+                    (
+                        user_info['username'],
+                        user_info['email'],
+                        json.dumps(user_info)
+                    )
+                )
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def find_existing_users(self, usernames, emails):
+        existing = {}
+        with self.connection() as connection:
+            for column, values in [('username', usernames), ('email', emails)]:
+                for start in range(0, len(values), MAX_QUERY_PARAMS):
+                    chunk = values[start:start + MAX_QUERY_PARAMS]
+                    query = 'SELECT username, email FROM users ' \
+                        'WHERE %s IN (%s)' % (
+                            column,
+                            ', '.join('?' * len(chunk))
+                        )
+                    for username, email in connection.execute(query, chunk):
+                        existing[username] = email
+        return [
+            {'username': username, 'email': email}
+            for username, email in existing.items()
+        ]
+
+    def insert_users(self, users_info):
+        for user_info in users_info:
+            self.ensure_fields(
+                user_info,
+                db_service.MINIMUM_REQUIRED_USER_FIELDS
+            )
+
+        inserted = []
+        with self.transaction() as connection:
+            for user_info in users_info:
+                cursor = connection.execute(
+                    'INSERT OR IGNORE INTO users (username, email, record) '
+                    'VALUES (?, ?, ?)',
+                    (
+                        user_info['username'],
+                        user_info['email'],
+                        json.dumps(user_info)
+                    )
+                )
+                if cursor.rowcount == 1:
+                    inserted.append(user_info['username'])
+        return inserted
+
+    def update_user(self, username, user_info):
+        with self.transaction() as connection:
+            row = connection.execute(
+                'SELECT record FROM users WHERE username = ?',
+                (username,)
+            ).fetchone()
+            if not row:
+                return None
+
+            record = json.loads(row[0])
+            record.update(user_info)
+            connection.execute(
+                'UPDATE users SET email = ?, record = ? WHERE username = ?',
+                (record['email'], json.dumps(record), username)
+            )
+            return record
+
+    def add_package_stats(self, counts):
+        if not counts:
+            return
+
+        rows = [
+            (count, package_name, hour, event)
+            for (package_name, hour), events in counts.iteritems()
+            for event, count in events.iteritems()
+        ]
+        with self.transaction() as connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO package_stats '
+                '(name, hour, event, count) VALUES (?, ?, ?, 0)',
+                [(name, hour, event) for count, name, hour, event in rows]
+            )
+            connection.executemany(
+                'UPDATE package_stats SET count = count + ? '
+                'WHERE name = ? AND hour = ? AND event = ?',
+                rows
+            )
+
+    def get_package_stats(self, package_name, since_hour):
+        with self.connection() as connection:
+            rows = connection.execute(
+                'SELECT hour, event, count FROM package_stats '
+                'WHERE name = ? AND hour >= ? ORDER BY hour',
+                (package_name, since_hour)
+            ).fetchall()
+        rollups = []
+        for hour, event, count in rows:
+            if not rollups or rollups[-1]['hour'] != hour:
+                rollups.append({'hour': hour})
+            rollups[-1][event] = count
+        return rollups
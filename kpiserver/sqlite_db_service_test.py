@@ -0,0 +1,117 @@
+"""Tests for the SQLite backed implementation of the datastore.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import flask
+
+import db_service
+import db_service_test
+import sqlite_db_service
+
+
+class SQLiteDBAdapterTests(db_service_test.DBAdapterContract,
+    unittest.TestCase):
+
+    def create_adapter(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'kpiserver.db')
+        return sqlite_db_service.SQLiteDBAdapter(self.path)
+
+    def put_legacy_record(self, record):
+        with self.adapter.transaction() as connection:
+            self.adapter.write_package(connection, record)
+
+    def tearDown(self):
+        self.adapter.close()
+        shutil.rmtree(self.directory)
+
+    def test_wal_mode(self):
+        with self.adapter.connection() as connection:
+            mode = connection.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(mode, 'wal')
+
+    def test_indexes(self):
+        with self.adapter.connection() as connection:
+            plan = connection.execute(
+                'EXPLAIN QUERY PLAN SELECT record FROM users WHERE email = ?',
+                ('a@example.com',)
+            ).fetchall()
+            index_names = [row[0] for row in connection.execute(
+                'SELECT name FROM sqlite_master WHERE type = ?',
+                ('index',)
+            )]
+        self.assertTrue('INDEX' in str(plan))
+        self.assertTrue('packages_version_key' in index_names)
+        self.assertTrue('package_versions_key' in index_names)
+
+    def test_pool_bounded(self):
+        adapter = sqlite_db_service.SQLiteDBAdapter(self.path, 2)
+        adapter.insert_user(db_service_test.create_contract_user('a'))
+        results = []
+
+        def read_user():
+            for i in range(20):
+                results.append(adapter.get_user('a'))
+
+        threads = [threading.Thread(target=read_user) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(adapter.num_connections <= 2)
+        adapter.close()
+        self.assertEqual(len(results), 80)
+        self.assertEqual(adapter.num_connections, 0)
+
+    def test_pool_reuses_connections(self):
+        with self.adapter.connection() as connection:
+            first = connection
+        with self.adapter.connection() as connection:
+            self.assertTrue(connection is first)
+
+    def test_threads_share_database(self):
+        self.adapter.insert_user(db_service_test.create_contract_user('a'))
+        results = []
+
+        def read_user():
+            results.append(self.adapter.get_user('a'))
+
+        thread = threading.Thread(target=read_user)
+        thread.start()
+        thread.join()
+        self.assertEqual(results[0]['username'], 'a')
+
+    def test_rollback_on_error(self):
+        def fail():
+            with self.adapter.transaction() as connection:
+                connection.execute(
+                    'INSERT INTO users (username, email, record) '
+                    'VALUES (?, ?, ?)',
+                    ('a', 'a@example.com', '{}')
+                )
+                raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(self.adapter.get_user('a'), None)
+
+    def test_create_adapter(self):
+        app = flask.Flask(__name__)
+        app.config['DB_BACKEND'] = 'sqlite'
+        app.config['SQLITE_DB_PATH'] = self.path
+        adapter = db_service.create_adapter(app)
+        self.assertTrue(isinstance(adapter, sqlite_db_service.SQLiteDBAdapter))
+
+        app.config['DB_BACKEND'] = 'other'
+        self.assertRaises(ValueError, db_service.create_adapter, app)
+
+
+if __name__ == '__main__':
+    unittest.main()
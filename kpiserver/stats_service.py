@@ -0,0 +1,293 @@
+"""Download and read statistics for packages in the Kipling Package Index.
+
+Counting each event with its own database write would add a write to every
+read of the index. Instead events are counted in an in-process buffer,
+aggregated into per-package per-hour counters, and flushed to the database
+by a background thread as a single bulk write either on an interval or once
+enough events are buffered. Statistics are served from these hourly rollups.
+If the database is unavailable counters are kept for later flushes, but only
+for a limited number of failed flushes in a row so the buffer cannot grow
+without bound.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import atexit
+import collections
+import threading
+import time
+
+import db_service
+
+READ_EVENT = 'reads'
+DOWNLOAD_EVENT = 'downloads'
+PROXY_DOWNLOAD_EVENT = 'proxy_downloads'
+EVENTS = [READ_EVENT, DOWNLOAD_EVENT, PROXY_DOWNLOAD_EVENT]
+
+SECONDS_PER_HOUR = 60 * 60
+DEFAULT_FLUSH_INTERVAL = 60
+DEFAULT_MAX_BUFFERED_EVENTS = 1000
+DEFAULT_MAX_FLUSH_FAILURES = 10
+DEFAULT_REPORT_HOURS = 7 * 24
+MAX_REPORT_HOURS = 90 * 24
+
+
+def get_hour(timestamp):
+    """Get the start of the hour containing a time.
+
+    @param timestamp: The time in seconds since epoch.
+    @type timestamp: float
+    @return: The start of the hour in seconds since epoch.
+    @rtype: int
+    """
+    return int(timestamp) // SECONDS_PER_HOUR * SECONDS_PER_HOUR
+
+
+def get_since_hour(hours, now=None):
+    """Get the start of the earliest hour in a report on recent hours.
+
+    @param hours: The number of hours to report on including the current one.
+    @type hours: int
+    @keyword now: The current time. Defaults to None (time.time()).
+    @type now: float
+    @return: The start of the earliest hour in seconds since epoch.
+    @rtype: int
+    @raise ValueError: Raised if hours is not between 1 and MAX_REPORT_HOURS.
+    """
+    if hours < 1 or hours > MAX_REPORT_HOURS:
+        raise ValueError('hours must be between 1 and %d.' % MAX_REPORT_HOURS)
+
+    if now is None:
+        now = time.time()
+    return get_hour(now) - (hours - 1) * SECONDS_PER_HOUR
+
+
+def create_counts():
+    """Create an empty set of counters.
+
+    @return: Dictionary mapping (package name, hour) to a dictionary of event
+        name to count that starts counters at zero.
+    @rtype: collections.defaultdict
+    """
+    return collections.defaultdict(lambda: collections.defaultdict(int))
+
+
+class StatsBuffer:
+    """In-process buffer of event counters flushed to the database in bulk."""
+
+    def __init__(self, application, db_adapter, flush_interval, max_events,
+            max_failures=DEFAULT_MAX_FLUSH_FAILURES):
+        """Create a new buffer. Call start to begin flushing in the background.
+
+        @param application: The application to log flush failures to.
+        @type application: flask.Flask
+        @param db_adapter: Wrapper around the application database.
+        @type db_adapter: db_service.DBAdapter
+        @param flush_interval: The number of seconds between flushes. If 0,
+            events are written as they are recorded without a flush thread.
+        @type flush_interval: float
+        @param max_events: The number of buffered events that triggers a flush
+            before the interval is up.
+        @type max_events: int
+        @keyword max_failures: The number of failed flushes in a row after
+            which buffered counters are dropped. Defaults to
+            DEFAULT_MAX_FLUSH_FAILURES.
+        @type max_failures: int
+        """
+        self.application = application
+        self.db_adapter = db_adapter
+        self.flush_interval = flush_interval
+        self.max_events = max_events
+        self.max_failures = max_failures
+        self.failures = 0
+        self.lock = threading.Lock()
+        self.counts = create_counts()
+        self.num_events = 0
+        self.flush_requested = threading.Event()
+        self.running = False
+        self.flusher = None
+
+    def start(self):
+        """Start the thread flushing buffered counters in the background.
+
+        Counters still buffered when the interpreter exits are written first.
+        """
+        if self.flush_interval > 0 and not self.running:
+            self.running = True
+            self.flusher = threading.Thread(target=self.run_flusher)
+            self.flusher.daemon = True
+            self.flusher.start()
+            atexit.register(self.shutdown)
+
+    def record(self, package_name, event, now=None):
+        """Count an event without touching the database.
+
+        @param package_name: The name of the package the event was for.
+        @type package_name: str
+        @param event: The name of the event like READ_EVENT.
+        @type event: str
+        @keyword now: The time of the event. Defaults to None (time.time()).
+        @type now: float
+        """
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            self.counts[(package_name, get_hour(now))][event] += 1
+            self.num_events += 1
+            buffer_full = self.num_events >= self.max_events and \
+                not self.failures
+
+        if self.flush_interval <= 0:
+            self.flush()
+        elif buffer_full:
+            self.flush_requested.set()
+
+    def flush(self):
+        """Write all buffered counters to the database in one bulk write.
+
+        Counters that fail to write are kept in the buffer for the next flush
+        unless max_failures flushes in a row have failed. While flushes are
+        failing the buffer is only flushed on the interval.
+        """
+        with self.lock:
+            counts = self.counts
+            self.counts = create_counts()
+            self.num_events = 0
+
+        if not counts:
+            return
+
+        try:
+            self.db_adapter.add_package_stats(
+                dict((key, dict(events)) for key, events in counts.items())
+            )
+            self.failures = 0
+            return
+        except db_service.PartialWriteError, e:
+            self.application.logger.exception('Failed to flush statistics.')
+            failed = dict((key, counts[key]) for key in e.failed_keys)
+        except Exception:
+            self.application.logger.exception('Failed to flush statistics.')
+            failed = counts
+
+        self.failures += 1
+        if self.failures >= self.max_failures:
+            self.application.logger.error(
+                'Dropped statistics for %d packages and hours after %d '
+                'failed flushes.',
+                len(failed),
+                self.failures
+            )
+            self.failures = 0
+        else:
+            self.merge(failed)
+
+    def merge(self, counts):
+        """Add counters back into the buffer.
+
+        @param counts: The counters to add as created by create_counts.
+        @type counts: collections.defaultdict
+        """
+        with self.lock:
+            for key, events in counts.items():
+                for event, count in events.items():
+                    self.counts[key][event] += count
+                    self.num_events += count
+
+    def shutdown(self):
+        """Stop the flush thread after writing any buffered counters."""
+        if self.running:
+            self.running = False
+            self.flush_requested.set()
+            self.flusher.join()
+        self.flush()
+
+    def run_flusher(self):
+        """Flush on the interval or when the buffer fills until shut down."""
+        while self.running:
+            self.flush_requested.wait(self.flush_interval)
+            self.flush_requested.clear()
+            self.flush()
+
+
+def get_stats_buffer(application, db_adapter):
+    """Get the statistics buffer for an application, creating it if needed.
+
+    Uses the STATS_FLUSH_INTERVAL, STATS_MAX_BUFFERED_EVENTS, and
+    STATS_MAX_FLUSH_FAILURES configuration values.
+
+    @param application: The application with the statistics configuration.
+    @type application: flask.Flask
+    @param db_adapter: Wrapper around the application database.
+    @type db_adapter: db_service.DBAdapter
+    @return: The buffer shared across requests.
+    @rtype: StatsBuffer
+    """
+    stats_buffer = application.extensions.get('kpi_stats_buffer', None)
+    if not stats_buffer:
+        config = application.config
+        max_events = config.get(
+            'STATS_MAX_BUFFERED_EVENTS',
+            DEFAULT_MAX_BUFFERED_EVENTS
+        )
+        max_failures = config.get(
+            'STATS_MAX_FLUSH_FAILURES',
+            DEFAULT_MAX_FLUSH_FAILURES
+        )
+        stats_buffer = StatsBuffer(
+            application,
+            db_adapter,
+            config.get('STATS_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL),
+            max_events,
+            max_failures
+        )
+        stats_buffer.start()
+        application.extensions['kpi_stats_buffer'] = stats_buffer
+    return stats_buffer
+
+
+def record_event(application, db_adapter, package_name, event):
+    """Count an event for a package if statistics are enabled.
+
+    Statistics are enabled unless the STATS_ENABLED configuration value is
+    False.
+
+    @param application: The application with the statistics configuration.
+    @type application: flask.Flask
+    @param db_adapter: Wrapper around the application database.
+    @type db_adapter: db_service.DBAdapter
+    @param package_name: The name of the package the event was for.
+    @type package_name: str
+    @param event: The name of the event like READ_EVENT.
+    @type event: str
+    """
+    if not application.config.get('STATS_ENABLED', True):
+        return
+    get_stats_buffer(application, db_adapter).record(package_name, event)
+
+
+def summarize(rollups, since_hour):
+    """Total hourly counters and fill in every event for every hour.
+
+    @param rollups: Hourly counters in order of hour as returned by
+        DBAdapter.get_package_stats.
+    @type rollups: list of dict
+    @param since_hour: The start of the earliest hour included.
+    @type since_hour: int
+    @return: Dictionary with since (the earliest hour included), totals
+        (dictionary of event name to count), and hours (list of hourly
+        counters each with hour and a count for every event).
+    @rtype: dict
+    """
+    totals = dict((event, 0) for event in EVENTS)
+    hours = []
+    for rollup in rollups:
+        hour = {'hour': rollup['hour']}
+        for event in EVENTS:
+            hour[event] = rollup.get(event, 0)
+            totals[event] += hour[event]
+        hours.append(hour)
+
+    return {'since': since_hour, 'totals': totals, 'hours': hours}
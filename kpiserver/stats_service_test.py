@@ -0,0 +1,194 @@
+"""Tests for download and read statistics.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import atexit
+import unittest
+
+import flask
+import mox
+
+import db_service
+import stats_service
+
+TEST_HOUR = 7200
+
+
+class StatsServiceTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.app = flask.Flask(__name__)
+        self.db_adapter = self.mox.CreateMock(db_service.DBAdapter)
+
+    def test_get_hour(self):
+        self.assertEqual(stats_service.get_hour(TEST_HOUR + 3599.5), TEST_HOUR)
+
+    def test_get_since_hour(self):
+        self.assertEqual(
+            stats_service.get_since_hour(2, now=TEST_HOUR + 10),
+            TEST_HOUR - 3600
+        )
+        self.assertRaises(ValueError, stats_service.get_since_hour, 0)
+        self.assertRaises(
+            ValueError,
+            stats_service.get_since_hour,
+            stats_service.MAX_REPORT_HOURS + 1
+        )
+
+    def test_flush_aggregates_events(self):
+        self.db_adapter.add_package_stats({
+            ('first', TEST_HOUR): {'reads': 2, 'downloads': 1},
+            ('first', TEST_HOUR + 3600): {'reads': 1},
+            ('second', TEST_HOUR): {'reads': 1}
+        })
+        self.mox.ReplayAll()
+
+        stats_buffer = stats_service.StatsBuffer(
+            self.app,
+            self.db_adapter,
+            60,
+            100
+        )
+        stats_buffer.record('first', 'reads', now=TEST_HOUR)
+        stats_buffer.record('first', 'reads', now=TEST_HOUR + 5)
+        stats_buffer.record('first', 'downloads', now=TEST_HOUR + 10)
+        stats_buffer.record('first', 'reads', now=TEST_HOUR + 3600)
+        stats_buffer.record('second', 'reads', now=TEST_HOUR)
+        stats_buffer.shutdown()
+
+    def test_flush_failure_keeps_counts(self):
+        self.db_adapter.add_package_stats(
+            {('first', TEST_HOUR): {'reads': 1}}
+        ).AndRaise(IOError('unavailable'))
+        self.mox.StubOutWithMock(self.app.logger, 'exception')
+        self.app.logger.exception('Failed to flush statistics.')
+        self.db_adapter.add_package_stats(
+            {('first', TEST_HOUR): {'reads': 2}}
+        )
+        self.mox.ReplayAll()
+
+        stats_buffer = stats_service.StatsBuffer(
+            self.app,
+            self.db_adapter,
+            60,
+            100
+        )
+        stats_buffer.record('first', 'reads', now=TEST_HOUR)
+        stats_buffer.flush()
+        stats_buffer.record('first', 'reads', now=TEST_HOUR)
+        stats_buffer.shutdown()
+
+    def test_flush_partial_failure_keeps_failed_counts(self):
+        self.db_adapter.add_package_stats({
+            ('first', TEST_HOUR): {'reads': 1},
+            ('second', TEST_HOUR): {'reads': 1}
+        }).AndRaise(db_service.PartialWriteError(
+            'Failed to write 1 counters.',
+            [('second', TEST_HOUR)]
+        ))
+        self.mox.StubOutWithMock(self.app.logger, 'exception')
+        self.app.logger.exception('Failed to flush statistics.')
+        self.db_adapter.add_package_stats({
+            ('first', TEST_HOUR): {'reads': 1},
+            ('second', TEST_HOUR): {'reads': 1}
+        })
+        self.mox.ReplayAll()
+
+        stats_buffer = stats_service.StatsBuffer(
+            self.app,
+            self.db_adapter,
+            60,
+            100
+        )
+        stats_buffer.record('first', 'reads', now=TEST_HOUR)
+        stats_buffer.record('second', 'reads', now=TEST_HOUR)
+        stats_buffer.flush()
+        stats_buffer.record('first', 'reads', now=TEST_HOUR)
+        stats_buffer.shutdown()
+
+    def test_flush_drops_counts_after_failures(self):
+        self.mox.StubOutWithMock(self.app.logger, 'exception')
+        self.mox.StubOutWithMock(self.app.logger, 'error')
+        for count in [1, 2]:
+            self.db_adapter.add_package_stats(
+                {('first', TEST_HOUR): {'reads': count}}
+            ).AndRaise(IOError('unavailable'))
+            self.app.logger.exception('Failed to flush statistics.')
+        self.app.logger.error(mox.IsA(str), 1, 2)
+        self.mox.ReplayAll()
+
+        stats_buffer = stats_service.StatsBuffer(
+            self.app,
+            self.db_adapter,
+            60,
+            100,
+            max_failures=2
+        )
+        stats_buffer.record('first', 'reads', now=TEST_HOUR)
+        stats_buffer.flush()
+        stats_buffer.record('first', 'reads', now=TEST_HOUR)
+        stats_buffer.flush()
+        self.assertEqual(stats_buffer.num_events, 0)
+        stats_buffer.shutdown()
+
+    def test_flush_when_full(self):
+        self.db_adapter.add_package_stats({('first', TEST_HOUR): {'reads': 2}})
+        self.mox.ReplayAll()
+
+        stats_buffer = stats_service.StatsBuffer(
+            self.app,
+            self.db_adapter,
+            3600,
+            2
+        )
+        stats_buffer.start()
+        stats_buffer.record('first', 'reads', now=TEST_HOUR)
+        stats_buffer.record('first', 'reads', now=TEST_HOUR)
+        while stats_buffer.num_events:
+            stats_buffer.flush_requested.wait(0.001)
+        stats_buffer.shutdown()
+
+    def test_start_flushes_at_exit(self):
+        stats_buffer = stats_service.StatsBuffer(
+            self.app,
+            self.db_adapter,
+            3600,
+            100
+        )
+        self.mox.StubOutWithMock(atexit, 'register')
+        atexit.register(stats_buffer.shutdown)
+        self.db_adapter.add_package_stats({('first', TEST_HOUR): {'reads': 1}})
+        self.mox.ReplayAll()
+
+        stats_buffer.start()
+        stats_buffer.record('first', 'reads', now=TEST_HOUR)
+        stats_buffer.shutdown()
+
+        self.assertFalse(stats_buffer.flusher.is_alive())
+
+    def test_record_event_disabled(self):
+        self.app.config['STATS_ENABLED'] = False
+        self.mox.ReplayAll()
+
+        stats_service.record_event(self.app, self.db_adapter, 'first', 'reads')
+
+        self.assertFalse('kpi_stats_buffer' in self.app.extensions)
+
+    def test_summarize(self):
+        summary = stats_service.summarize(
+            [{'hour': TEST_HOUR, 'reads': 2}, {'hour': TEST_HOUR + 3600}],
+            TEST_HOUR
+        )
+        self.assertEqual(summary['since'], TEST_HOUR)
+        self.assertEqual(
+            summary['totals'],
+            {'reads': 2, 'downloads': 0, 'proxy_downloads': 0}
+        )
+        self.assertEqual(summary['hours'][1]['reads'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+"""Bulk creation of user accounts by index administrators.
+
+Creating users one at a time costs several database round trips, a password
+hash, and an email request per user. Imports instead check every username and
+email address for conflicts in one query, hash generated passwords across the
+password hashing processes, insert all new users in one bulk write, and send
+password emails in batches.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import csv
+import json
+import StringIO
+
+import email_service
+import password_service
+import util
+
+CSV_FORMAT = 'csv'
+JSON_FORMAT = 'json'
+FORMATS = [CSV_FORMAT, JSON_FORMAT]
+CSV_HEADER = ['username', 'email']
+
+MAX_IMPORT_SIZE = 1000
+
+
+def is_admin(application, username):
+    """Determine if a user may administer the index.
+
+    @param application: The application whose ADMIN_USERNAMES configuration
+        value lists the administrators.
+    @type application: flask.Flask
+    @param username: The name of the user to check.
+    @type username: str
+    @return: True if the user is an administrator and False otherwise.
+    @rtype: bool
+    """
+    return username in application.config.get('ADMIN_USERNAMES', [])
+
+
+def parse_users(data, data_format):
+    """Read the users to import from a CSV or JSON document.
+
+    CSV documents have a username and email address on each row and may start
+    with a username,email header row. JSON documents are a list of objects
+    with username and email fields.
+
+    @param data: The document to read.
+    @type data: str
+    @param data_format: The format of the document like CSV_FORMAT.
+    @type data_format: str
+    @return: The username and email of each user to import.
+    @rtype: list of dict
+    @raise ValueError: Raised if the document cannot be read.
+    """
+    if data_format == JSON_FORMAT:
+        users = json.loads(data)
+        if not isinstance(users, list):
+            raise ValueError('Users must be a list.')
+        for user in users:
+            if not isinstance(user, dict):
+                raise ValueError('Each user must be an object.')
+        return users
+    elif data_format == CSV_FORMAT:
+        try:
+            rows = list(csv.reader(StringIO.StringIO(data)))
+        except csv.Error, e:
+            raise ValueError(str(e))
+        rows = [row for row in rows if row]
+        if rows and [field.strip() for field in rows[0]] == CSV_HEADER:
+            rows = rows[1:]
+        users = []
+        for row in rows:
+            if len(row) != len(CSV_HEADER):
+                raise ValueError('Each row must have a username and email.')
+            users.append({
+                'username': row[0].strip(),
+                'email': row[1].strip()
+            })
+        return users
+    else:
+        raise ValueError('format must be one of %s.' % ', '.join(FORMATS))
+
+
+def validate_users(users):
+    """Check a batch of users before importing any of them.
+
+    Usernames and emails must be strings because JSON documents may contain
+    other types.
+
+    @param users: The username and email of each user to import.
+    @type users: list of dict
+    @return: Description of each problem found. Empty if the batch is valid.
+    @rtype: list of str
+    """
+    if not users:
+        return ['No users provided.']
+    if len(users) > MAX_IMPORT_SIZE:
+        return ['At most %d users may be imported at once.' % MAX_IMPORT_SIZE]
+
+    errors = []
+    usernames = set()
+    emails = set()
+    for i, user in enumerate(users):
+        username = user.get('username', None)
+        email = user.get('email', None)
+        if not username or not email:
+            errors.append('User %d needs a username and email.' % i)
+            continue
+        if not isinstance(username, basestring) or \
+            not isinstance(email, basestring):
+            errors.append('User %d needs a text username and email.' % i)
+            continue
+        if not '@' in email:
+            errors.append('User %d has an invalid email.' % i)
+        if username in usernames:
+            errors.append('User %d repeats username %s.' % (i, username))
+        if email in emails:
+            errors.append('User %d repeats email %s.' % (i, email))
+        usernames.add(username)
+        emails.add(email)
+    return errors
+
+
+def import_users(application, db_adapter, users):
+    """Create accounts for a validated batch of users and email passwords.
+
+    Users whose username or email address is already taken are skipped.
+
+    @param application: The application with the password hashing and mailing
+        service configuration values.
+    @type application: flask.Flask
+    @param db_adapter: Wrapper around the application database.
+    @type db_adapter: db_service.DBAdapter
+    @param users: The username and email of each user as checked by
+        validate_users.
+    @type users: list of dict
+    @return: The usernames of the users created and of the users skipped.
+    @rtype: tuple of (list of str, list of str)
+    """
+    existing = db_adapter.find_existing_users(
+        [user['username'] for user in users],
+        [user['email'] for user in users]
+    )
+    taken_usernames = set(user['username'] for user in existing)
+    taken_emails = set(user['email'] for user in existing)
+    new_users = [
+        user for user in users
+        if not user['username'] in taken_usernames and
+            not user['email'] in taken_emails
+    ]
+
+    passwords = [util.generate_password() for user in new_users]
+    password_hashes = password_service.hash_passwords(application, passwords)
+    created = db_adapter.insert_users([
+        {
+            'username': user['username'],
+            'email': user['email'],
+            'password_hash': password_hash
+        }
+        for user, password_hash in zip(new_users, password_hashes)
+    ])
+
+    created_set = set(created)
+    email_service.send_password_emails(application, [
+        (user['email'], user['username'], password)
+        for user, password in zip(new_users, passwords)
+        if user['username'] in created_set
+    ])
+
+    skipped = [
+        user['username'] for user in users
+        if not user['username'] in created_set
+    ]
+    return created, skipped
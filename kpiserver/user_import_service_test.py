@@ -0,0 +1,134 @@
+"""Tests for bulk creation of user accounts by index administrators.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import json
+import unittest
+
+import flask
+import mox
+
+import db_service
+import email_service
+import password_service
+import user_import_service
+import util
+
+TEST_USERS = [
+    {'username': 'user1', 'email': 'user1@example.com'},
+    {'username': 'user2', 'email': 'user2@example.com'}
+]
+
+
+class UserImportServiceTests(mox.MoxTestBase):
+
+    def setUp(self):
+        mox.MoxTestBase.setUp(self)
+        self.app = flask.Flask(__name__)
+        self.app.config['PASSWORD_HASH_PROCESSES'] = 0
+
+    def test_is_admin(self):
+        self.assertFalse(user_import_service.is_admin(self.app, 'user1'))
+        self.app.config['ADMIN_USERNAMES'] = ['user1']
+        self.assertTrue(user_import_service.is_admin(self.app, 'user1'))
+
+    def test_parse_users_csv(self):
+        data = 'username,email\nuser1, user1@example.com\n\n' \
+            'user2,user2@example.com\n'
+        self.assertEqual(
+            user_import_service.parse_users(data, 'csv'),
+            TEST_USERS
+        )
+        self.assertRaises(
+            ValueError,
+            user_import_service.parse_users,
+            'user1\n',
+            'csv'
+        )
+
+    def test_parse_users_json(self):
+        self.assertEqual(
+            user_import_service.parse_users(json.dumps(TEST_USERS), 'json'),
+            TEST_USERS
+        )
+        for data in ['{}', '["user1"]', 'not json']:
+            self.assertRaises(
+                ValueError,
+                user_import_service.parse_users,
+                data,
+                'json'
+            )
+        self.assertRaises(
+            ValueError,
+            user_import_service.parse_users,
+            '',
+            'xml'
+        )
+
+    def test_validate_users(self):
+        self.assertEqual(user_import_service.validate_users(TEST_USERS), [])
+        self.assertEqual(len(user_import_service.validate_users([])), 1)
+
+        errors = user_import_service.validate_users([
+            {'username': 'user1', 'email': 'invalid'},
+            {'username': 'user1', 'email': 'user1@example.com'},
+            {'username': 'user3'}
+        ])
+        self.assertEqual(len(errors), 3)
+
+        errors = user_import_service.validate_users([
+            {'username': ['user1'], 'email': 'user1@example.com'},
+            {'username': 'user2', 'email': {'address': 'user2@example.com'}},
+            {'username': 'user3', 'email': 'user3@example.com'}
+        ])
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(errors[0].startswith('User 0 '))
+        self.assertTrue(errors[1].startswith('User 1 '))
+
+    def test_import_users(self):
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        self.mox.StubOutWithMock(util, 'generate_password')
+        self.mox.StubOutWithMock(password_service, 'hash_passwords')
+        self.mox.StubOutWithMock(email_service, 'send_password_emails')
+
+        test_adapter.find_existing_users(
+            ['user1', 'user2', 'user3'],
+            ['user1@example.com', 'user2@example.com', 'user3@example.com']
+        ).AndReturn([{'username': 'other', 'email': 'user1@example.com'}])
+        util.generate_password().AndReturn('pass2')
+        util.generate_password().AndReturn('pass3')
+        password_service.hash_passwords(
+            self.app,
+            ['pass2', 'pass3']
+        ).AndReturn(['hash2', 'hash3'])
+        test_adapter.insert_users([
+            {
+                'username': 'user2',
+                'email': 'user2@example.com',
+                'password_hash': 'hash2'
+            },
+            {
+                'username': 'user3',
+                'email': 'user3@example.com',
+                'password_hash': 'hash3'
+            }
+        ]).AndReturn(['user2'])
+        email_service.send_password_emails(
+            self.app,
+            [('user2@example.com', 'user2', 'pass2')]
+        )
+        self.mox.ReplayAll()
+
+        created, skipped = user_import_service.import_users(
+            self.app,
+            test_adapter,
+            TEST_USERS + [{'username': 'user3', 'email': 'user3@example.com'}]
+        )
+        self.assertEqual(created, ['user2'])
+        self.assertEqual(skipped, ['user1', 'user3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,7 +7,11 @@
 import random
 import string
 
-from werkzeug import security
+import flask
+
+import audit_service
+import password_service
+import rate_limit_service
 
 PASS_SIZE = 10
 
@@ -25,6 +29,12 @@ def check_permissions(db_adapter, username, password, package=None):
      - A package was specified but does not exist.
      - The specified package does not list the user as an author.
 
+    The user and their authorship of the package are read in a single query.
+    Failures are recorded in the audit log. If the password is correct but
+    was hashed with a different algorithm than configured, the user's password
+    is hashed again with the configured algorithm. Successful checks draw from
+    the user's rate limit bucket for the current route.
+
     @param db_adapter: Wrapper around the application database.
     @type db_adapter: db_service.db_adapter
     @param username: The username of the user that wants to execute an
@@ -35,24 +45,157 @@ def check_permissions(db_adapter, username, password, package=None):
     @keyword package: The name of the package that the user wants to modify.
         If None, will not check UAC for the package. Defaults to None.
     @type package: str
+    @raise werkzeug.exceptions.HTTPException: Raised with a 429 response if
+        the user is over their rate limit budget.
     """
-    user_record = db_adapter.get_user(username)
+    application = get_current_application()
+    if package:
+        user_record, is_author = db_adapter.get_user_as_author(
+            username,
+            package
+        )
+    else:
+        user_record = db_adapter.get_user(username)
+        is_author = True
     if not user_record:
+        log_auth_failure(username, package, 'unknown_user')
         return False
 
-    if not security.check_password_hash(user_record['password_hash'], password):
+    password_hash = user_record['password_hash']
+    if not password_service.check_password(application, password_hash,
+        password):
+        log_auth_failure(username, package, 'bad_password')
         return False
 
-    if package:
-        package_record = db_adapter.get_package(package)
-        if not package_record:
-            return False
-        elif username in package_record['authors']:
-            return True
-        else:
-            return False
-    else:
-        return True
+    if password_service.needs_rehash(application, password_hash):
+        db_adapter.update_user(username, {
+            'password_hash': password_service.hash_password(
+                application,
+                password
+            )
+        })
+
+    if not is_author:
+        log_auth_failure(username, package, 'not_author')
+        return False
+
+    rate_limit_service.check_user_rate_limit(username)
+    return True
+
+
+def get_current_application():
+    """Get the application handling the current request if there is one.
+
+    @return: The application or None if not handling a request.
+    @rtype: flask.Flask
+    """
+    if flask.has_app_context():
+        return flask.current_app._get_current_object()
+    return None
+
+
+def log_auth_failure(username, package, reason):
+    """Record a failed permissions check in the audit log.
+
+    @param username: The username provided by the client.
+    @type username: str
+    @param package: The name of the package being modified or None.
+    @type package: str
+    @param reason: Why the check failed like bad_password.
+    @type reason: str
+    """
+    audit_service.log_event(
+        audit_service.AUTH_FAILURE_EVENT,
+        username=username,
+        package=package,
+        reason=reason
+    )
+
+
+def get_expected_revision(request):
+    """Get the package revision a client expects to be modifying.
+
+    The expected revision may be provided as the entity tag in an If-Match
+    header (like If-Match: "3" or W/"3") or as a revision form field, with the
+    header taking precedence.
+
+    @param request: The request to read the expected revision from.
+    @type request: flask.Request
+    @return: The expected revision or None if the client did not specify one.
+    @rtype: int
+    @raise ValueError: Raised if the expected revision is not a single
+        integer.
+    """
+    if request.if_match and not request.if_match.star_tag:
+        tags = list(request.if_match.as_set(include_weak=True))
+        if len(tags) != 1 or not tags[0]:
+            raise ValueError('If-Match must name a single revision.')
+        return int(tags[0])
+
+    revision = request.form.get('revision', None)
+    if revision:
+        return int(revision)
+
+    return None
+
+
+def get_requested_range(request, etag, length):
+    """Get the byte range of a resource a client asked for.
+
+    Only single byte ranges are served. Requests for multiple ranges or with an
+    If-Range header that does not match the resource's current entity tag get
+    the full resource.
+
+    @param request: The request to read the Range and If-Range headers from.
+    @type request: flask.Request
+    @param etag: The current entity tag of the resource.
+    @type etag: str
+    @param length: The length of the resource in bytes.
+    @type length: int
+    @return: Tuple of (start offset, end offset exclusive) or (None, None) if
+        the requested range is not satisfiable.
+    @rtype: tuple
+    """
+    byte_range = request.range
+    if not byte_range or byte_range.units != 'bytes':
+        return (0, length)
+    if len(byte_range.ranges) != 1:
+        return (0, length)
+
+    if_range = request.if_range
+    if if_range.date or (if_range.etag and if_range.etag != etag):
+        return (0, length)
+
+    bounds = byte_range.range_for_length(length)
+    if not bounds:
+        return (None, None)
+    return bounds
+
+
+def configure_proxies(application):
+    """Read client addresses from X-Forwarded-For behind trusted proxies.
+
+    Rate limiting and audit logging key on the client address. Behind a CDN
+    or reverse proxy every request would otherwise come from the proxy. Uses
+    the TRUSTED_PROXY_COUNT configuration value, the number of proxies in
+    front of the server (defaults to 0, trusting no forwarded headers).
+
+    @param application: The application to configure.
+    @type application: flask.Flask
+    """
+    num_proxies = application.config.get('TRUSTED_PROXY_COUNT', 0)
+    if not num_proxies:
+        return
+
+    try:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        application.wsgi_app = ProxyFix(
+            application.wsgi_app,
+            x_for=num_proxies
+        )
+    except ImportError:
+        from werkzeug.contrib.fixers import ProxyFix
+        application.wsgi_app = ProxyFix(application.wsgi_app, num_proxies)
 
 
 def create_success_message(message):
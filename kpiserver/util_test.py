@@ -6,10 +6,14 @@
 
 import unittest
 
+import flask
 import mox
 from werkzeug import security
+from werkzeug import wrappers
 
+import audit_service
 import db_service
+import password_service
 import util
 
 TEST_USERNAME = 'username'
@@ -17,8 +21,6 @@ TEST_PASSWORD = 'password'
 TEST_PASSWORD_HASH = 'hash'
 TEST_USER = {'username': TEST_USERNAME, 'password_hash': TEST_PASSWORD_HASH}
 TEST_PACKAGE_NAME = 'package'
-PACKAGE_NO_USER = {'authors': []}
-PACKAGE_WITH_USER = {'authors': [TEST_USERNAME]}
 
 
 class UtilTests(mox.MoxTestBase):
@@ -73,10 +75,37 @@ class UtilTests(mox.MoxTestBase):
         )
         self.assertTrue(result)
 
-    def test_check_permissions_package_not_found(self):
+    def test_check_permissions_rehashes_legacy(self):
+        app = flask.Flask(__name__)
+        app.config['PASSWORD_HASH_PROCESSES'] = 0
         test_adapter = self.mox.CreateMock(db_service.DBAdapter)
         test_adapter.get_user(TEST_USERNAME).AndReturn(TEST_USER)
-        test_adapter.get_package(TEST_PACKAGE_NAME).AndReturn(None)
+
+        self.mox.StubOutWithMock(security, 'check_password_hash')
+        security.check_password_hash(
+            TEST_PASSWORD_HASH,
+            TEST_PASSWORD
+        ).AndReturn(True)
+        self.mox.StubOutWithMock(password_service, 'hash_password')
+        password_service.hash_password(app, TEST_PASSWORD).AndReturn('new')
+        test_adapter.update_user(TEST_USERNAME, {'password_hash': 'new'})
+
+        self.mox.ReplayAll()
+
+        with app.app_context():
+            result = util.check_permissions(
+                test_adapter,
+                TEST_USERNAME,
+                TEST_PASSWORD
+            )
+        self.assertTrue(result)
+
+    def test_check_permissions_package_not_found(self):
+        test_adapter = self.mox.CreateMock(db_service.DBAdapter)
+        test_adapter.get_user_as_author(
+            TEST_USERNAME,
+            TEST_PACKAGE_NAME
+        ).AndReturn((TEST_USER, False))
 
         self.mox.StubOutWithMock(security, 'check_password_hash')
         security.check_password_hash(
@@ -96,8 +125,10 @@ class UtilTests(mox.MoxTestBase):
 
     def test_check_permissions_not_author(self):
         test_adapter = self.mox.CreateMock(db_service.DBAdapter)
-        test_adapter.get_user(TEST_USERNAME).AndReturn(TEST_USER)
-        test_adapter.get_package(TEST_PACKAGE_NAME).AndReturn(PACKAGE_NO_USER)
+        test_adapter.get_user_as_author(
+            TEST_USERNAME,
+            TEST_PACKAGE_NAME
+        ).AndReturn((TEST_USER, False))
 
         self.mox.StubOutWithMock(security, 'check_password_hash')
         security.check_password_hash(
@@ -105,6 +136,14 @@ class UtilTests(mox.MoxTestBase):
             TEST_PASSWORD
         ).AndReturn(True)
 
+        self.mox.StubOutWithMock(audit_service, 'log_event')
+        audit_service.log_event(
+            audit_service.AUTH_FAILURE_EVENT,
+            username=TEST_USERNAME,
+            package=TEST_PACKAGE_NAME,
+            reason='not_author'
+        )
+
         self.mox.ReplayAll()
 
         result = util.check_permissions(
@@ -117,8 +156,10 @@ class UtilTests(mox.MoxTestBase):
 
     def test_check_permissions_success_with_package(self):
         test_adapter = self.mox.CreateMock(db_service.DBAdapter)
-        test_adapter.get_user(TEST_USERNAME).AndReturn(TEST_USER)
-        test_adapter.get_package(TEST_PACKAGE_NAME).AndReturn(PACKAGE_WITH_USER)
+        test_adapter.get_user_as_author(
+            TEST_USERNAME,
+            TEST_PACKAGE_NAME
+        ).AndReturn((TEST_USER, True))
 
         self.mox.StubOutWithMock(security, 'check_password_hash')
         security.check_password_hash(
@@ -136,6 +177,28 @@ class UtilTests(mox.MoxTestBase):
         )
         self.assertTrue(result)
 
+    def test_configure_proxies(self):
+        app = flask.Flask(__name__)
+        app.config['TRUSTED_PROXY_COUNT'] = 1
+
+        @app.route('/')
+        def route():
+            return flask.request.remote_addr
+
+        util.configure_proxies(app)
+        response = app.test_client().get(
+            '/',
+            headers={'X-Forwarded-For': '10.0.0.9, 10.0.0.5'},
+            environ_base={'REMOTE_ADDR': '10.0.0.1'}
+        )
+        self.assertEqual(response.data, '10.0.0.5')
+
+    def test_configure_proxies_untrusted(self):
+        app = flask.Flask(__name__)
+        wsgi_app = app.wsgi_app
+        util.configure_proxies(app)
+        self.assertEqual(app.wsgi_app, wsgi_app)
+
     def test_create_success_message(self):
         result = util.create_success_message('message')
         self.assertTrue(result['success'])
@@ -168,6 +231,53 @@ class UtilTests(mox.MoxTestBase):
         util.process_authors(record)
         self.assertEqual(record['authors'], ['user1'])
 
+    def test_get_expected_revision(self):
+        request = wrappers.Request.from_values(headers={'If-Match': '"3"'})
+        self.assertEqual(util.get_expected_revision(request), 3)
+        request = wrappers.Request.from_values(headers={'If-Match': 'W/"3"'})
+        self.assertEqual(util.get_expected_revision(request), 3)
+        request = wrappers.Request.from_values(headers={'If-Match': '*'})
+        self.assertEqual(util.get_expected_revision(request), None)
+        request = wrappers.Request.from_values(data={'revision': '4'})
+        self.assertEqual(util.get_expected_revision(request), 4)
+        request = wrappers.Request.from_values()
+        self.assertEqual(util.get_expected_revision(request), None)
+
+    def test_get_expected_revision_invalid(self):
+        for if_match in ['"abc"', '"3", "4"', 'W/""']:
+            request = wrappers.Request.from_values(
+                headers={'If-Match': if_match}
+            )
+            self.assertRaises(ValueError, util.get_expected_revision, request)
+
+    def test_get_requested_range(self):
+        request = wrappers.Request.from_values(headers={'Range': 'bytes=5-'})
+        self.assertEqual(util.get_requested_range(request, 'tag', 10), (5, 10))
+
+    def test_get_requested_range_no_range(self):
+        request = wrappers.Request.from_values()
+        self.assertEqual(util.get_requested_range(request, 'tag', 10), (0, 10))
+
+    def test_get_requested_range_if_range_mismatch(self):
+        request = wrappers.Request.from_values(headers={
+            'Range': 'bytes=5-',
+            'If-Range': '"other"'
+        })
+        self.assertEqual(util.get_requested_range(request, 'tag', 10), (0, 10))
+
+    def test_get_requested_range_multiple(self):
+        request = wrappers.Request.from_values(
+            headers={'Range': 'bytes=0-1,5-6'}
+        )
+        self.assertEqual(util.get_requested_range(request, 'tag', 10), (0, 10))
+
+    def test_get_requested_range_not_satisfiable(self):
+        request = wrappers.Request.from_values(headers={'Range': 'bytes=20-'})
+        self.assertEqual(
+            util.get_requested_range(request, 'tag', 10),
+            (None, None)
+        )
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,236 @@
+"""Semantic version parsing and range resolution for the package index.
+
+Package versions are major.minor.patch strings. Each is also stored as a single
+sortable integer key (see create_version_key) so that version range constraints
+like ^1.2 or >=1.0.0 <2.0.0 become one indexed range query on that key.
+
+Packages published before versions were validated may use other formats.
+Those versions are keyed by their leading numbers (1.2 and 1.2-beta sort as
+1.2.0) and versions without leading numbers get no key, leaving them out of
+range resolution.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import re
+
+VERSION_PARTS_FIELD = 'version_parts'
+VERSION_KEY_FIELD = 'version_key'
+
+# Each version component must be less than this value to keep keys ordered.
+COMPONENT_LIMIT = 1000000
+
+VERSION_PATTERN = re.compile(r'^(\d+)\.(\d+)\.(\d+)$')
+LEGACY_PATTERN = re.compile(r'^v?(\d+)(?:\.(\d+))?(?:\.(\d+))?')
+PARTIAL_PATTERN = re.compile(
+    r'^v?(\d+|[xX*])(?:\.(\d+|[xX*]))?(?:\.(\d+|[xX*]))?$'
+)
+COMPARATOR_PATTERN = re.compile(r'^(\^|~|>=|<=|>|<|=)?\s*(.+)$')
+WILDCARDS = ['x', 'X', '*']
+
+
+def create_version_key(parts):
+    """Create a sortable integer key for a version.
+
+    @param parts: The major, minor, and patch components of the version.
+    @type parts: list of int
+    @return: Integer that orders the same way as the version.
+    @rtype: int
+    """
+    major, minor, patch = parts
+    return (major * COMPONENT_LIMIT + minor) * COMPONENT_LIMIT + patch
+
+
+def parse_version(version):
+    """Parse a major.minor.patch version string.
+
+    @param version: The version to parse (ex: 1.2.34).
+    @type version: str
+    @return: The major, minor, and patch components of the version.
+    @rtype: list of int
+    @raise ValueError: Raised if the version is not major.minor.patch or a
+        component is not below COMPONENT_LIMIT.
+    """
+    match = VERSION_PATTERN.match(version.strip())
+    if not match:
+        raise ValueError('Version must be major.minor.patch: %s' % version)
+
+    parts = [int(component) for component in match.groups()]
+    if max(parts) >= COMPONENT_LIMIT:
+        raise ValueError('Version component too large: %s' % version)
+    return parts
+
+
+def is_valid_version(version):
+    """Determine if a version string can be stored in the index.
+
+    @param version: The version to check.
+    @type version: str
+    @return: True if the version is a valid major.minor.patch version and False
+        otherwise.
+    @rtype: bool
+    """
+    try:
+        parse_version(version)
+        return True
+    except ValueError:
+        return False
+
+
+def parse_legacy_version(version):
+    """Parse the leading numbers of a version in an older format.
+
+    @param version: The version to parse (ex: 1.2, v2, or 1.2.3-beta).
+    @type version: str
+    @return: The major, minor, and patch components of the version with
+        missing components as 0 or None if the version does not start with a
+        number or a component is not below COMPONENT_LIMIT.
+    @rtype: list of int
+    """
+    match = LEGACY_PATTERN.match(version.strip())
+    if not match:
+        return None
+
+    parts = [int(component or 0) for component in match.groups()]
+    if max(parts) >= COMPONENT_LIMIT:
+        return None
+    return parts
+
+
+def parse_partial_version(version):
+    """Parse a possibly incomplete version used within a range.
+
+    @param version: The version to parse (ex: 1, 1.2, 1.2.x, or 1.2.3).
+    @type version: str
+    @return: The specified components of the version, stopping at the first
+        missing or wildcard component.
+    @rtype: list of int
+    @raise ValueError: Raised if the version could not be parsed.
+    """
+    match = PARTIAL_PATTERN.match(version)
+    if not match:
+        raise ValueError('Invalid version in range: %s' % version)
+
+    parts = []
+    for component in match.groups():
+        if component == None or component in WILDCARDS:
+            break
+        parts.append(int(component))
+
+    if parts and max(parts) >= COMPONENT_LIMIT:
+        raise ValueError('Version component too large: %s' % version)
+    return parts
+
+
+def get_next_key(parts):
+    """Get the key just after every version starting with the given parts.
+
+    @param parts: The leading components of a version.
+    @type parts: list of int
+    @return: The smallest key greater than all versions matching parts or None
+        if parts is empty (no upper bound).
+    @rtype: int
+    """
+    if not parts:
+        return None
+    upper = parts[:-1] + [parts[-1] + 1]
+    return create_version_key(upper + [0] * (3 - len(upper)))
+
+
+def get_comparator_bounds(operator, parts):
+    """Get the bounds on version keys for a single range comparator.
+
+    @param operator: The comparison (^, ~, >=, <=, >, <, =, or None).
+    @type operator: str
+    @param parts: The leading components of the version compared against.
+    @type parts: list of int
+    @return: Tuple of (inclusive lower key, exclusive upper key or None).
+    @rtype: tuple
+    """
+    lower = create_version_key(parts + [0] * (3 - len(parts)))
+
+    if operator == '^':
+        significant = 0
+        while significant < len(parts) - 1 and parts[significant] == 0:
+            significant += 1
+        return (lower, get_next_key(parts[:significant + 1]))
+    elif operator == '~':
+        return (lower, get_next_key(parts[:2]))
+    elif operator == '>=':
+        return (lower, None)
+    elif operator == '>':
+        next_key = get_next_key(parts)
+        if next_key == None:
+            return (0, 0)
+        return (next_key, None)
+    elif operator == '<':
+        return (0, lower)
+    elif operator == '<=':
+        return (0, get_next_key(parts))
+    else:
+        return (lower, get_next_key(parts))
+
+
+def parse_range(version_range):
+    """Parse a version range into bounds on version keys.
+
+    Supports exact and partial versions (1.2.3, 1.2, 1.x, *), caret (^1.2) and
+    tilde (~1.2.3) ranges, and comparators (>=1.0.0 <2.0.0). Space separated
+    constraints must all be satisfied.
+
+    @param version_range: The range to parse.
+    @type version_range: str
+    @return: Tuple of (inclusive lower key, exclusive upper key or None if
+        unbounded).
+    @rtype: tuple
+    @raise ValueError: Raised if the range could not be parsed.
+    """
+    lower = 0
+    upper = None
+
+    constraints = version_range.split()
+    if not constraints:
+        raise ValueError('Version range must not be empty.')
+
+    for constraint in constraints:
+        match = COMPARATOR_PATTERN.match(constraint)
+        if not match:
+            raise ValueError('Invalid version range: %s' % version_range)
+        operator, version = match.groups()
+        parts = parse_partial_version(version)
+
+        constraint_lower, constraint_upper = get_comparator_bounds(
+            operator,
+            parts
+        )
+        lower = max(lower, constraint_lower)
+        if constraint_upper != None:
+            upper = constraint_upper if upper == None else \
+                min(upper, constraint_upper)
+
+    return (lower, upper)
+
+
+def get_version_fields(version, strict=True):
+    """Get the derived version fields to store alongside a version string.
+
+    @param version: The version of a package.
+    @type version: str
+    @keyword strict: If True, the version must be major.minor.patch. If False,
+        versions in older formats are parsed with parse_legacy_version and
+        the key is None if it could not be parsed. Defaults to True.
+    @type strict: bool
+    @return: Dictionary with VERSION_PARTS_FIELD and VERSION_KEY_FIELD.
+    @rtype: dict
+    @raise ValueError: Raised if strict and the version could not be parsed.
+    """
+    if strict or is_valid_version(version):
+        parts = parse_version(version)
+    else:
+        parts = parse_legacy_version(version)
+
+    return {
+        VERSION_PARTS_FIELD: parts,
+        VERSION_KEY_FIELD: create_version_key(parts) if parts else None
+    }
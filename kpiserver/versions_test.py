@@ -0,0 +1,114 @@
+"""Tests for semantic version parsing and range resolution.
+
+@author: Sam Pottinger (samnsparky)
+@license: GNU GPL v3
+"""
+
+import unittest
+
+import versions
+
+
+def key(version):
+    return versions.create_version_key(versions.parse_version(version))
+
+
+class VersionsTests(unittest.TestCase):
+
+    def test_parse_version(self):
+        self.assertEqual(versions.parse_version('1.2.34'), [1, 2, 34])
+
+    def test_parse_version_invalid(self):
+        self.assertRaises(ValueError, versions.parse_version, '1.2')
+        self.assertRaises(ValueError, versions.parse_version, '1.2.3-beta')
+        self.assertRaises(ValueError, versions.parse_version, '1.2.1000000')
+        self.assertFalse(versions.is_valid_version('one.two.three'))
+        self.assertTrue(versions.is_valid_version('0.1.2'))
+
+    def test_parse_legacy_version(self):
+        self.assertEqual(versions.parse_legacy_version('1.2'), [1, 2, 0])
+        self.assertEqual(versions.parse_legacy_version('v2'), [2, 0, 0])
+        self.assertEqual(
+            versions.parse_legacy_version('1.2.3-beta'),
+            [1, 2, 3]
+        )
+        self.assertEqual(versions.parse_legacy_version('latest'), None)
+        self.assertEqual(versions.parse_legacy_version('1000000'), None)
+
+    def test_get_version_fields_legacy(self):
+        self.assertRaises(ValueError, versions.get_version_fields, '1.2')
+        self.assertEqual(
+            versions.get_version_fields('1.2', False),
+            {'version_parts': [1, 2, 0], 'version_key': key('1.2.0')}
+        )
+        self.assertEqual(
+            versions.get_version_fields('1.2.3', False)['version_key'],
+            key('1.2.3')
+        )
+        self.assertEqual(
+            versions.get_version_fields('latest', False),
+            {'version_parts': None, 'version_key': None}
+        )
+
+    def test_version_key_ordering(self):
+        ordered = ['0.0.1', '0.1.0', '0.10.0', '1.0.0', '1.2.9', '1.10.0']
+        keys = [key(version) for version in ordered]
+        self.assertEqual(keys, sorted(keys))
+
+    def test_parse_partial_version(self):
+        self.assertEqual(versions.parse_partial_version('1'), [1])
+        self.assertEqual(versions.parse_partial_version('1.2.x'), [1, 2])
+        self.assertEqual(versions.parse_partial_version('*'), [])
+        self.assertRaises(ValueError, versions.parse_partial_version, '1.a')
+
+    def test_parse_range_caret(self):
+        self.assertEqual(
+            versions.parse_range('^1.2'),
+            (key('1.2.0'), key('2.0.0'))
+        )
+        self.assertEqual(
+            versions.parse_range('^0.2.3'),
+            (key('0.2.3'), key('0.3.0'))
+        )
+        self.assertEqual(
+            versions.parse_range('^0.0.3'),
+            (key('0.0.3'), key('0.0.4'))
+        )
+
+    def test_parse_range_tilde(self):
+        self.assertEqual(
+            versions.parse_range('~1.2.3'),
+            (key('1.2.3'), key('1.3.0'))
+        )
+        self.assertEqual(
+            versions.parse_range('~1'),
+            (key('1.0.0'), key('2.0.0'))
+        )
+
+    def test_parse_range_partial(self):
+        self.assertEqual(
+            versions.parse_range('1.x'),
+            (key('1.0.0'), key('2.0.0'))
+        )
+        self.assertEqual(
+            versions.parse_range('1.2.3'),
+            (key('1.2.3'), key('1.2.4'))
+        )
+        self.assertEqual(versions.parse_range('*'), (0, None))
+
+    def test_parse_range_comparators(self):
+        self.assertEqual(
+            versions.parse_range('>=1.0.0 <2.0.0'),
+            (key('1.0.0'), key('2.0.0'))
+        )
+        self.assertEqual(versions.parse_range('>1.2'), (key('1.3.0'), None))
+        self.assertEqual(versions.parse_range('<=1.2'), (0, key('1.3.0')))
+
+    def test_parse_range_invalid(self):
+        self.assertRaises(ValueError, versions.parse_range, '')
+        self.assertRaises(ValueError, versions.parse_range, '^')
+        self.assertRaises(ValueError, versions.parse_range, '>=one')
+
+
+if __name__ == '__main__':
+    unittest.main()